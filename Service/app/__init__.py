@@ -55,6 +55,7 @@ def create_app(config_filename="config.py"):
     # ept objects
     from .models.aci.ept.ept_endpoint import eptEndpoint
     from .models.aci.ept.ept_epg import eptEpg
+    from .models.aci.ept.ept_epm_digest import eptEpmDigest
     from .models.aci.ept.ept_history import eptHistory
     from .models.aci.ept.ept_move import eptMove
     from .models.aci.ept.ept_node import eptNode
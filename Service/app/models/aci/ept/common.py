@@ -3,12 +3,18 @@ common ept functions
 """
 from ... utils import get_app_config
 from . ept_msg import MSG_TYPE
+from . ept_msg import WORK_TYPE
 from . ept_msg import eptMsg
 
+import array
+import bisect
+import heapq
 import logging
 import hashlib
 import os
 import re
+import socket
+import struct
 import threading
 import time
 import traceback
@@ -30,12 +36,23 @@ MINIMUM_SUPPORTED_VERSION           = "2.2.1n"
 HELLO_INTERVAL                      = 5.0
 HELLO_TIMEOUT                       = 60.0
 WATCH_INTERVAL                      = 1.0
+WATCH_BATCH_SIZE                    = 500
+CLEAR_BATCH_SIZE                    = 16
+CLEAR_MAX_PI_CACHE_SIZE             = 4096
+CLEAR_SESSION_IDLE_TIMEOUT          = 300.0
+CLEAR_PI_CACHE_TTL                  = 300.0
 NOTIFY_INTERVAL                     = 1.0
 NOTIFY_QUEUE_MAX_SIZE               = 4096
+NOTIFY_OVERFLOW_MAX_SIZE            = 4096
+NOTIFY_EMAIL_MAX_BULK               = 10
+NOTIFY_SMTP_IDLE_TIMEOUT            = 60.0
 CACHE_STATS_INTERVAL                = 300.0
+CACHE_BUDGET_INTERVAL               = 60.0
+SHARED_CACHE_MAX_INVALID            = 1024
 SEQUENCE_TIMEOUT                    = 100.0
 MANAGER_CTRL_CHANNEL                = "mctrl"
 MANAGER_CTRL_RESPONSE_CHANNEL       = "r_mctrl"
+MANAGER_DISPATCH_CHANNEL            = "mdisp"
 MANAGER_WORK_QUEUE                  = "mq"
 SUBSCRIBER_CTRL_CHANNEL             = "sctrl"
 WATCHER_BROADCAST_CHANNEL           = "bcx"
@@ -43,10 +60,33 @@ WORKER_BROADCAST_CHANNEL            = "bcw"
 WORKER_CTRL_CHANNEL                 = "wctrl"
 WORKER_UPDATE_INTERVAL              = 15.0
 RAPID_CALCULATE_INTERVAL            = 15.0
+RAPID_FLUSH_INTERVAL                = 5.0
 MAX_SEND_MSG_LENGTH                 = 10240
 BG_EVENT_HANDLER_INTERVAL           = 0.01
+BUILD_PROGRESS_INTERVAL             = 15.0
+WRITE_BUFFER_MAX_OPS                = 1024
+WRITE_BUFFER_MAX_DELAY              = 0.1
+WRITE_BUFFER_MAX_RETRIES            = 3
+WRITE_BUFFER_INTERVAL               = 0.05
 HASH_SHIFT                          = 128
 HASH_PRIME                          = 1000003
+HASH_RING_REPLICAS                  = 128
+HASH_RING_MASK                      = 0xffffffffffffffff
+HASH_RING_MULTIPLIER                = 0x9e3779b97f4a7c15
+
+# roles that support live rebalance when a worker joins or leaves. Other roles (watcher) hold state
+# in memory that cannot be migrated and a change in workers for that role triggers a fabric restart.
+LIVE_REBALANCE_ROLES                = ["worker"]
+# work types sent directly to a specific worker that are never migrated on rebalance
+REBALANCE_SKIP_WORK_TYPES           = [WORK_TYPE.FABRIC_EPM_EOF]
+# max time manager waits for workers to pause and for dispatchers/subscribers to hold sends during
+# rebalance, and max time a paused worker (or held sender) waits for the manager to resume it
+REBALANCE_ACK_TIMEOUT               = 10.0
+REBALANCE_PAUSE_TIMEOUT             = 60.0
+# interval before an aborted rebalance (missing pause or hold ack) is retried
+REBALANCE_RETRY_INTERVAL            = 5.0
+# blpop timeout (in seconds) for worker queues so worker can pause for rebalance while idle
+WORKER_QUEUE_POLL_TIMEOUT           = 1
 
 # when API requests msg queue length, manager can read the full data off each queue and accurate
 # msgs within bulk messages for accurate count. There is a performance hit to this so the
@@ -319,11 +359,7 @@ def push_event(collection, key, event, rotate=None, increment=True):
         the 'count' attribute of the object.
         return bool success
     """
-    update = {"$push": {"events": {"$each": [event], "$position": 0 } } } 
-    if rotate is not None:
-        update["$push"]["events"]["$slice"] = rotate
-    if increment:
-        update["$inc"] = {"count": 1}
+    update = get_push_event_update(event, rotate=rotate, increment=increment)
     # logger.debug("push event key: %s, event:%s", key, event)
     r = collection.update_one(key, update, upsert=True)
     # to support disabling write concern, we can only check for a successfull push if ack is enabled
@@ -338,6 +374,15 @@ def push_event(collection, key, event, rotate=None, increment=True):
                 return False
     return True
 
+def get_push_event_update(event, rotate=None, increment=True):
+    """ return update document to push an event into the events list of an object """
+    update = {"$push": {"events": {"$each": [event], "$position": 0 } } } 
+    if rotate is not None:
+        update["$push"]["events"]["$slice"] = rotate
+    if increment:
+        update["$inc"] = {"count": 1}
+    return update
+
 def get_addr_type(addr, addr_type):
     # receive an addr and addr_type (mac or ip) and return a type of mac, ipv4, or ipv6
     if addr_type == "ip":
@@ -401,6 +446,146 @@ def parse_tz(tz):
         logger.warn("failed to parse timezone: %s", tz)
         return tz
 
+def get_cache_generation_key(fabric, classname):
+    """ return redis key for flush generation of a cached collection for fabric """
+    return "cgen`%s`%s" % (fabric, classname)
+
+def get_cache_invalid_key(fabric, classname):
+    """ return redis key for set of names invalidated within current flush generation """
+    return "cinv`%s`%s" % (fabric, classname)
+
+def update_cache_generation(redis, fabric, classname, name=None):
+    """ update shared cache state for a collection before a FLUSH_CACHE broadcast. A full flush
+        (name of None) starts a new flush generation so the shared segment is rebuilt. A named flush
+        only adds the name to the invalidated names of the current generation which each worker
+        checks before the shared segment. If more than SHARED_CACHE_MAX_INVALID names are
+        invalidated then a new generation is started instead.
+    """
+    inv_key = get_cache_invalid_key(fabric, classname)
+    if name is not None and len(name) > 0:
+        pl = redis.pipeline()
+        pl.sadd(inv_key, name)
+        pl.scard(inv_key)
+        if pl.execute()[1] <= SHARED_CACHE_MAX_INVALID:
+            return
+    pl = redis.pipeline()
+    pl.incr(get_cache_generation_key(fabric, classname))
+    pl.delete(inv_key)
+    pl.execute()
+
+def get_dispatcher_count():
+    """ return number of manager dispatcher processes. If 0 then manager dispatches all work """
+    return int(get_app_config().get("MANAGER_DISPATCHER_COUNT", 0))
+
+def get_dispatch_queue_name(index):
+    """ return work queue name for dispatcher index """
+    return "%s_%s" % (MANAGER_WORK_QUEUE, index)
+
+def get_queue_seq_key(queue):
+    """ return redis key holding the last seq allocated on a worker queue """
+    return "seq`%s" % queue
+
+def get_dispatch_queue(fabric):
+    """ return queue for work that needs to be dispatched to a worker for provided fabric. When 
+        dispatchers are enabled then work is partitioned by fabric across the dispatcher queues 
+        which maintains ordering for all work within a fabric.
+    """
+    count = get_dispatcher_count()
+    if count <= 0:
+        return MANAGER_WORK_QUEUE
+    return get_dispatch_queue_name(int(hashlib.md5("%s" % fabric).hexdigest(), base=16) % count)
+
+class HashRing(object):
+    """ consistent hash ring over a list of members. Each member is added to the ring at 
+        HASH_RING_REPLICAS points based on its id so adding or removing a member only moves the
+        keys owned by that member. Provide key function to get unique id string for each member.
+    """
+    def __init__(self, members, key=None):
+        self.members = members
+        entries = []
+        for m in members:
+            mid = key(m) if key is not None else m
+            for i in xrange(0, HASH_RING_REPLICAS):
+                entries.append((int(hashlib.md5("%s-%s" % (mid, i)).hexdigest()[0:16], 16), m))
+        entries.sort(key=lambda e: e[0])
+        self.points = [e[0] for e in entries]
+        self.owners = [e[1] for e in entries]
+
+    def __repr__(self):
+        return "ring members:%s, points:%s" % (len(self.members), len(self.points))
+
+    def get(self, _hash):
+        """ return member owning provided hash (from get_msg_hash) or None if ring is empty """
+        if len(self.points) == 0:
+            return None
+        # fold large hash into 64-bits and then mix so sequential addresses are evenly distributed
+        h = 0
+        _hash = abs(_hash)
+        while _hash > 0:
+            h^= _hash & HASH_RING_MASK
+            _hash>>= 64
+        h = (h * HASH_RING_MULTIPLIER) & HASH_RING_MASK
+        i = bisect.bisect(self.points, h)
+        if i >= len(self.points):
+            i = 0
+        return self.owners[i]
+
+class EndpointPresence(object):
+    """ compact set of (node, vnid, addr) used to track endpoints returned on an epm class query.
+        Each endpoint is stored as a 64-bit key (md5 prefix) within a sorted array instead of a 
+        nested dict which requires a small fraction of the memory on large fabrics. Keys are 
+        collected in fixed size runs that are sorted as they fill and merged on first lookup so 
+        peak memory stays bounded during the build.
+        Note, a 64-bit key has a negligible but non-zero false positive rate on membership test.
+    """
+    RUN_SIZE = 1048576
+
+    def __init__(self):
+        self.runs = []
+        self.current = []
+        self.keys = array.array("L")
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        # key is tuple (node, vnid, addr)
+        return self.contains(*key)
+
+    @staticmethod
+    def get_key(node, vnid, addr):
+        """ return 64-bit integer key for endpoint """
+        return struct.unpack("<Q", hashlib.md5("%s|%s|%s" % (node, vnid, addr)).digest()[0:8])[0]
+
+    def add(self, node, vnid, addr):
+        """ add endpoint to presence set """
+        self.current.append(EndpointPresence.get_key(node, vnid, addr))
+        self.count+= 1
+        if len(self.current) >= self.RUN_SIZE:
+            self.current.sort()
+            self.runs.append(array.array("L", self.current))
+            self.current = []
+
+    def freeze(self):
+        """ merge all pending runs into sorted key array """
+        if len(self.current) > 0:
+            self.current.sort()
+            self.runs.append(array.array("L", self.current))
+            self.current = []
+        if len(self.runs) > 0:
+            self.runs.append(self.keys)
+            self.keys = array.array("L", heapq.merge(*self.runs))
+            self.runs = []
+
+    def contains(self, node, vnid, addr):
+        """ return True if endpoint is within presence set """
+        if len(self.current) > 0 or len(self.runs) > 0:
+            self.freeze()
+        key = EndpointPresence.get_key(node, vnid, addr)
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
 def get_msg_hash(msg):
     """ receive eptMsg object with addr, vnid, and type attributes and return calculated hash """
     # multiple types of work objects supported by each has an addr field. It may have a vnid
@@ -594,6 +779,22 @@ def get_ipv6_prefix(ipv6):
     mask = (~(pow(2,128-mask)-1)) & 0xffffffffffffffffffffffffffffffff
     return (addr&mask, mask)
 
+def get_ip_int(ip):
+    """ receives ipv4 or ipv6 address string without mask and returns tuple (addr, is_ipv6) where
+        addr is a 32-bit or 128-bit int.  returns (None, None) on error
+    """
+    is_ipv6 = ":" in ip
+    try:
+        if is_ipv6:
+            (upper, lower) = struct.unpack("!QQ", socket.inet_pton(socket.AF_INET6, ip))
+            return ((upper << 64) | lower, True)
+        return (struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip))[0], False)
+    except (socket.error, ValueError, TypeError) as e:
+        # fallback to regex parser (i.e., address with mask or platform without inet_pton)
+        (addr, mask) = get_ip_prefix(ip)
+        if addr is None:
+            return (None, None)
+        return (addr, is_ipv6)
 
 def get_random_sequence():
     # using os.urandom return a pseudo random sequeunce number
@@ -1,16 +1,24 @@
 
 from ... utils import get_db
+from ... utils import get_redis
+from . common import get_ip_int
 from . common import get_ip_prefix
 from . ept_endpoint import eptEndpoint
 from . ept_epg import eptEpg
 from . ept_node import eptNode
 from . ept_pc import eptPc
+from . ept_shared_cache import eptSharedCache
 from . ept_tunnel import eptTunnel
 from . ept_subnet import eptSubnet
 from . ept_vnid import eptVnid
 from . ept_vpc import eptVpc
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import array
 import logging
+import time
 import traceback
 
 # module level logging
@@ -35,21 +43,66 @@ class eptCache(object):
 
             get_subnets         return [eptSubnet] for provided bd
 
-            get_rapid_endpoint  return rapidEndpointCachedObject from cache or new object
+            get_subnet_prefixes return subnetPrefixCachedObject with precompiled subnets for bd
+
+            get_rapid_endpoint  return rapidEndpointCachedObject from rapid table or new object
+
+            flush_rapid         write rapid counters updated since last flush to eptEndpoint
+
+            get_endpoint_state  return endpointStateCachedObject from cache or new object
 
             ip_is_offsubnet     return bool if ip is outside of subnets for bd corresponding to 
                                 vrf, pctag
 
             offsubnet check:
-            vnid,pctag-> eptEpg.bd_vnid -> list(eptSubnets)
-                                                  |
-                                                  + ip ------> offsubnetCachedObject
+            vnid,pctag-> eptEpg.bd_vnid -> list(eptSubnets) -> subnetPrefixCachedObject
+                                                                    |
+                                                                    + ip ------> bool
+
+        if shared_cache_dir is provided, then misses for the node, tunnel, vpc, pc, vnid, epg, and
+        subnet caches are served from an eptSharedCache segment shared by all workers on the host
+        instead of a db lookup
+
+        warm_up can be used to bulk load the same caches for the fabric, growing each cache from the
+        number of objects in the corresponding collection
+
+        apply_memory_budget resizes all caches to fit within a memory budget. Caches under pressure
+        (full with misses since last call) receive the remaining budget in proportion to the time
+        spent on their misses
     """
     MAX_CACHE_SIZE = 512
-    MAX_OFFSUBNET_CACHE_SIZE = 1024
-    MAX_ENDPOINT_CACHE_SIZE = 1024
+    MAX_RAPID_TABLE_SIZE = 262144
+    MAX_ENDPOINT_STATE_CACHE_SIZE = 4096
+    # on warm up, caches grow to the number of keys in the collection plus headroom up to max size
+    WARM_CACHE_HEADROOM = 1.25
+    WARM_CACHE_MAX_SIZE = 262144
+    # caches resized by memory budget with the minimum size and estimated bytes per entry
+    BUDGET_CACHES = [
+        ("node_cache", MAX_CACHE_SIZE, 2048),
+        ("tunnel_cache", MAX_CACHE_SIZE, 1024),
+        ("vpc_cache", MAX_CACHE_SIZE, 1024),
+        ("pc_cache", MAX_CACHE_SIZE, 1024),
+        ("vnid_cache", MAX_CACHE_SIZE, 1024),
+        ("epg_cache", MAX_CACHE_SIZE, 2048),
+        ("subnet_cache", MAX_CACHE_SIZE, 4096),
+        ("prefix_cache", MAX_CACHE_SIZE, 1024),
+        ("endpoint_cache", MAX_ENDPOINT_STATE_CACHE_SIZE, 8192),
+    ]
+    # assumed cost in seconds of a miss for caches where miss time is not measured
+    BUDGET_DEFAULT_MISS_COST = 0.001
     KEY_DELIM = "`"             # majority of keys are integers, this should be sufficient delimiter
-    def __init__(self, fabric):
+    # collections that support shared cache and warm up along with the corresponding cache and the
+    # keys used for cache lookup
+    COLLECTION_CACHES = [
+        ("node_cache", eptNode, ["node"]),
+        ("tunnel_cache", eptTunnel, ["node", "intf"]),
+        ("vpc_cache", eptVpc, ["node", "intf"]),
+        ("pc_cache", eptPc, ["node", "intf"]),
+        ("vnid_cache", eptVnid, ["vnid"]),
+        ("epg_cache", eptEpg, ["vrf", "pctag"]),
+        ("subnet_cache", eptSubnet, ["bd"]),
+    ]
+    def __init__(self, fabric, shared_cache_dir=None):
         self.fabric = fabric
         self.flush_requests = 0
         self.key_delim = eptCache.KEY_DELIM
@@ -60,15 +113,31 @@ class eptCache(object):
         self.vnid_cache = hitCache(eptCache.MAX_CACHE_SIZE)         # eptVnid(vnid) = eptVnid
         self.epg_cache = hitCache(eptCache.MAX_CACHE_SIZE)          # eptEpg(vrf,pctag) = eptEpg
         self.subnet_cache = hitCache(eptCache.MAX_CACHE_SIZE)       # eptSubnet(bd) = list(eptSubnet)
-        # (vrf,pctag,ip) = eptOffSubnet
-        self.offsubnet_cache = hitCache(eptCache.MAX_OFFSUBNET_CACHE_SIZE) 
-        # (vnid,addr) = rapidEndpointCachedObject
-        self.rapid_cache = hitCache(eptCache.MAX_ENDPOINT_CACHE_SIZE, callback=self.evict_rapid) 
+        # eptSubnet(bd) = subnetPrefixCachedObject
+        self.prefix_cache = hitCache(eptCache.MAX_CACHE_SIZE)
+        # (vnid,addr) = rapid counters returned as rapidEndpointCachedObject
+        self.rapid_table = rapidCounterTable(fabric, eptCache.MAX_RAPID_TABLE_SIZE, 
+                                                callback=self.evict_rapid)
+        # (vnid,addr) = endpointStateCachedObject
+        self.endpoint_cache = hitCache(eptCache.MAX_ENDPOINT_STATE_CACHE_SIZE)
+        # optional eptWriteBuffer used when saving rapid counters
+        self.write_buffer = None
+        # miss_count and miss_time of each cache at last apply_memory_budget
+        self.budget_stats = {}
+        # optional eptSharedCache per collection indexed by classname
+        self.shared_cache = {}
+        if shared_cache_dir is not None:
+            redis_db = get_redis()
+            for (cache_name, eptObject, keys) in eptCache.COLLECTION_CACHES:
+                self.shared_cache[eptObject._classname] = eptSharedCache(shared_cache_dir, fabric,
+                                                            eptObject, keys, redis_db=redis_db)
 
     def handle_flush(self, collection_name, name=None):
         """ flush one or more entries in collection name """
         logger.debug("flush request for %s: %s", collection_name, name)
         self.flush_requests+= 1
+        if collection_name in self.shared_cache:
+            self.shared_cache[collection_name].reload_generation(name=name)
         if collection_name == eptNode._classname:
             self.node_cache.flush()     # always full cache flush for node
         elif collection_name == eptTunnel._classname:
@@ -84,15 +153,9 @@ class eptCache(object):
             if name is not None: self.vnid_cache.remove(name, name=True)
             else: self.vnid_cache.flush()
         elif collection_name == eptEpg._classname:
-            # need to remove one or all entries in offsubnet cache based on matching epg.bd
-            if name is not None: 
-                epg = self.epg_cache.search(name, name=True)
-                if not isinstance(epg, hitCacheNotFound) and epg is not None:
-                    self.offsubnet_flush(epg.bd)
-                self.epg_cache.remove(name, name=True)
-            else: 
-                self.epg_cache.flush()
-                self.offsubnet_cache.flush()
+            # subnet prefixes are indexed by bd so they are not affected by an epg change
+            if name is not None: self.epg_cache.remove(name, name=True)
+            else: self.epg_cache.flush()
         elif collection_name == eptSubnet._classname:
             # eptSubnet maps to subnet_cache which is the only current cache that maps to a list. If
             # one entry is flushed, we don't know if that was an add or create so we need to
@@ -100,8 +163,8 @@ class eptCache(object):
             # we need to know the bd for the corresponding subnet. If not found in cache and not
             # found in eptSubnet table, then we need to flush the entire cache. Else, we can flush
             # just the subnets corresponding to the affected bd.
-            # the offsubnet cache also needs to be updated, however it already supports a flush on
-            # a per bd basis so we will be flushing just that bd or the full cache.
+            # the prefix cache is also indexed by bd so we will be flushing just that bd or the full
+            # cache.
             flush_bd = None
             if name is not None:
                 subnets = self.subnet_cache.search(name, name=True)
@@ -119,19 +182,108 @@ class eptCache(object):
                     if len(obj)>0:
                         flush_bd = obj[0].bd
                         logger.debug("deriving bd 0x%x from db subnet %s", flush_bd, obj[0].name)
-            # flush subnet_cache and offsubnet_cache for specific bd or all bds
+            # flush subnet_cache and prefix_cache for specific bd or all bds
             if flush_bd is not None:
-                logger.debug("flushing subnet_cache and offsubnet_cache for bd 0x%x", flush_bd)
+                logger.debug("flushing subnet_cache and prefix_cache for bd 0x%x", flush_bd)
                 keystr = self.get_key_str(bd=flush_bd)
                 self.subnet_cache.remove(keystr)
-                self.offsubnet_flush(flush_bd)
+                self.prefix_cache.remove(keystr)
             else:
-                logger.debug("flushing full subnet_cache and offsubnet_cache")
+                logger.debug("flushing full subnet_cache and prefix_cache")
                 self.subnet_cache.flush()
-                self.offsubnet_cache.flush()
+                self.prefix_cache.flush()
         else:
             logger.debug("flush for unsupported collection name: %s", collection_name)
 
+    def warm_up(self):
+        """ bulk load node, tunnel, vpc, pc, vnid, epg, and subnet caches with a single db query per
+            collection. Each cache is grown to fit all keys within the collection for this fabric
+            so initial lookups from all workers do not miss at the same time. Lookups for keys not
+            present in the db are still added to the cache on first miss.
+            return total number of keys loaded
+        """
+        ts = time.time()
+        total = 0
+        for (cache_name, eptObject, keys) in eptCache.COLLECTION_CACHES:
+            cache = getattr(self, cache_name)
+            objects = {}
+            for obj in eptObject.find(fabric=self.fabric):
+                keystr = self.get_key_str(**dict((k, getattr(obj, k)) for k in keys))
+                if keystr not in objects:
+                    objects[keystr] = []
+                objects[keystr].append(obj)
+            self.grow_cache(cache, len(objects))
+            if cache is self.subnet_cache:
+                # prefix cache is built from subnet cache and has the same keys
+                self.grow_cache(self.prefix_cache, len(objects))
+                count = cache.preload(objects.iteritems())
+            else:
+                count = cache.preload((k, objects[k][0]) for k in objects)
+            logger.debug("warm up %s loaded %s of %s keys (max size %s)", cache_name, count, 
+                        len(objects), cache.max_size)
+            total+= count
+        logger.debug("cache warm up for fabric %s loaded %s keys in %0.3f sec", self.fabric, total,
+                        time.time() - ts)
+        return total
+
+    def grow_cache(self, cache, count):
+        """ increase cache max size to fit count keys plus headroom. Cache size is never reduced """
+        size = min(eptCache.WARM_CACHE_MAX_SIZE, int(count * eptCache.WARM_CACHE_HEADROOM))
+        if size > cache.max_size:
+            cache.max_size = size
+
+    def apply_memory_budget(self, budget):
+        """ resize each cache so total estimated memory of all caches fits within budget bytes.
+            Each cache is guaranteed its minimum size. Caches that are not full or did not miss
+            since the last call keep their current working set plus headroom. The remaining budget
+            is split across caches under pressure by miss time which accounts for both hit rate
+            and the cost of each miss (db lookup). A reduced max size is applied on the next push
+            to the cache.
+            return estimated bytes used by all caches
+        """
+        caches = []
+        reserved = 0
+        for (cache_name, min_size, entry_bytes) in eptCache.BUDGET_CACHES:
+            cache = getattr(self, cache_name)
+            (last_miss_count, last_miss_time) = self.budget_stats.get(cache_name, (0, 0.0))
+            misses = max(0, cache.miss_count - last_miss_count)
+            miss_time = max(0.0, cache.miss_time - last_miss_time)
+            self.budget_stats[cache_name] = (cache.miss_count, cache.miss_time)
+            if miss_time <= 0:
+                miss_time = misses * eptCache.BUDGET_DEFAULT_MISS_COST
+            size = cache.get_size()
+            pressure = size >= cache.max_size and misses > 0
+            if pressure:
+                reserve = min_size
+            elif size >= cache.max_size:
+                reserve = max(min_size, size)
+            else:
+                reserve = max(min_size, int(size * eptCache.WARM_CACHE_HEADROOM))
+            reserved+= reserve * entry_bytes
+            caches.append([cache, min_size, entry_bytes, reserve, pressure, miss_time])
+        if reserved > budget:
+            # working sets exceed budget, scale down all caches toward their minimum size
+            ratio = float(budget) / reserved
+            for c in caches:
+                c[3] = max(c[1], int(c[3] * ratio))
+            remaining = 0
+        else:
+            remaining = budget - reserved
+        total_miss_time = sum([c[5] for c in caches if c[4]])
+        for (cache, min_size, entry_bytes, reserve, pressure, miss_time) in caches:
+            size = reserve
+            if pressure and total_miss_time > 0:
+                size+= int(remaining * (miss_time / total_miss_time) / entry_bytes)
+            cache.max_size = size
+        return self.get_memory_usage()
+
+    def get_memory_usage(self):
+        """ return estimated bytes used by all caches """
+        usage = 0
+        for (cache_name, min_size, entry_bytes) in eptCache.BUDGET_CACHES:
+            usage+= getattr(self, cache_name).get_size() * entry_bytes
+        return usage
+
     def get_key_str(self, **keys):
         """ return std key string for consistency between any method calculating cache key string"""
         return self.key_delim.join(["%s" % keys[k] for k in sorted(keys)])
@@ -162,7 +314,13 @@ class eptCache(object):
         if not db_lookup: 
             # if entry not in cache and db_lookup disabled, then return None 
             return None
-        obj = eptObject.find(projection=projection, fabric=self.fabric, **keys)
+        obj = None
+        ts = time.time()
+        if projection is None and eptObject._classname in self.shared_cache:
+            obj = self.shared_cache[eptObject._classname].find(keystr)
+        if obj is None:
+            obj = eptObject.find(projection=projection, fabric=self.fabric, **keys)
+        cache.miss_time+= time.time() - ts
         if len(obj) == 0:
             logger.debug("(cache) not found in db: %s %s", eptObject._classname, keys)
             # add None to cache for keys to prevent db lookup on next check
@@ -226,23 +384,50 @@ class eptCache(object):
         return ret.name
 
     def get_rapid_endpoint(self, vnid, addr, addr_type):
-        """ return rapidEndpointCachedObject from cache or new object """
-        ret = self.generic_cache_lookup(self.rapid_cache, rapidEndpointCachedObject, db_lookup=False,
-                                        vnid=vnid, addr=addr)
+        """ return rapidEndpointCachedObject from rapid table, adding new entry if not present """
+        keystr = self.get_key_str(vnid=vnid, addr=addr)
+        return self.rapid_table.get(keystr, vnid, addr, addr_type, write_buffer=self.write_buffer)
+
+    def flush_rapid(self):
+        """ write rapid counters updated since last flush to eptEndpoint """
+        self.rapid_table.flush(write_buffer=self.write_buffer)
+
+    def evict_rapid(self, cached_rapid):
+        """ triggered when rapid counters are removed from the rapid table after they have been
+            written to eptEndpoint
+        """
+        # rapid counters are also part of the endpoint state, keep it in sync with the db
+        keystr = self.get_key_str(vnid=cached_rapid.vnid, addr=cached_rapid.addr)
+        state = self.endpoint_cache.peek(keystr)
+        if state is not None and state.endpoint is not None:
+            state.endpoint["is_rapid"] = cached_rapid.is_rapid
+            state.endpoint["rapid_lts"] = cached_rapid.rapid_lts
+            state.endpoint["rapid_count"] = cached_rapid.rapid_count
+            state.endpoint["rapid_lcount"] = cached_rapid.rapid_lcount
+            state.endpoint["rapid_icount"] = cached_rapid.rapid_icount
+
+    def get_endpoint_state(self, vnid, addr):
+        """ return endpointStateCachedObject from cache or new object. A new object has not yet
+            been loaded from the db which the caller can check via history/endpoint_loaded attributes
+        """
+        ret = self.generic_cache_lookup(self.endpoint_cache, endpointStateCachedObject, 
+                                        db_lookup=False, vnid=vnid, addr=addr)
         if ret is None:
-            # create a new rapidEndpointCachedObject and add to cache
-            ret = rapidEndpointCachedObject(self.fabric, vnid, addr, addr_type)
-            # add result to cache for next lookup
+            ret = endpointStateCachedObject(vnid, addr)
             keystr = self.get_key_str(vnid=vnid, addr=addr)
-            self.rapid_cache.push(keystr, ret)
+            self.endpoint_cache.push(keystr, ret)
         return ret
 
-    def evict_rapid(self, cached_rapid):
-        """ triggered when rapidEndpointCachedObject is evicted from cache
-            here we need to save result to eptEndpoint as this and recalculations are the only 
-            time when rapid counters are saved to db
-        """
-        cached_rapid.save()
+    def release_endpoint_state(self):
+        """ save rapid counters to db and flush all cached endpoint state """
+        self.flush_rapid()
+        self.rapid_table.clear()
+        self.endpoint_cache.flush()
+
+    def remove_endpoint_state(self, vnid, addr):
+        """ remove endpoint state from cache, next lookup will reload state from db """
+        keystr = self.get_key_str(vnid=vnid, addr=addr)
+        self.endpoint_cache.remove(keystr, preserve_none=True)
 
     def get_subnets(self, bd):
         """ return list of subnet objects for provided bd.  Return an empty list of subnets not
@@ -252,59 +437,38 @@ class eptCache(object):
         if subnets is None: return []
         return subnets
 
+    def get_subnet_prefixes(self, bd):
+        """ return subnetPrefixCachedObject with precompiled subnets for provided bd """
+        keystr = self.get_key_str(bd=bd)
+        ret = self.prefix_cache.search(keystr)
+        if isinstance(ret, hitCacheNotFound):
+            ret = subnetPrefixCachedObject(bd, self.get_subnets(bd))
+            self.prefix_cache.push(keystr, ret)
+        return ret
+
     def ip_is_offsubnet(self, vrf, pctag, ip):
         """ return bool if ip is offsubnet
             if unable to determine bd then cannot execute offsubnet check and return False.  If 
             unable to parse ip address then also an error and assume not offsubnet
         """
-        ret = self.generic_cache_lookup(self.offsubnet_cache,offsubnetCachedObject, db_lookup=False,
-                vrf=vrf, pctag=pctag, ip=ip)
-        if ret is not None:
-            return ret.offsubnet
-
         # get bd for corresponding epg (vrf, pctag)
         epg = self.get_epg_name(vrf, pctag, return_object=True)
         if epg is None:
             logger.warn("failed to perform subnet check for %s, epg not found(%s, %s)",ip,vrf,pctag)
             return False
-        # try to parse ip string address
-        (addr, mask) = get_ip_prefix(ip)
-        if addr is None or mask is None:
+        (addr, is_ipv6) = get_ip_int(ip)
+        if addr is None:
             logger.warn("failed to parse ip address: %s", ip)
             return False
-        else:
-            # get list of subnets and check each for a match against the addr (assume offsubnet 
-            # until matched against one of the bd subnets)
-            offsubnet = True
-            subnets = self.get_subnets(epg.bd)
-            for s in subnets:
-                (saddr, smask) = get_ip_prefix(s.ip)
-                if saddr is None or smask is None:
-                    logger.warn("failed to parse ip address for subnet(%s): %s", s.name, s.ip)
-                    continue
-                if addr & smask == saddr:
-                    logger.debug("addr %s matched subnet: %s", ip, s.name)
-                    offsubnet = False
-                    break
-            if offsubnet:
-                logger.debug("addr %s not matched against any of the %s subnets in bd %s", ip, 
-                    len(subnets), epg.bd)
-
-        # add result to cache for next lookup
-        keystr = self.get_key_str(vrf=vrf, pctag=pctag, ip=ip)
-        self.offsubnet_cache.push(keystr, offsubnetCachedObject(epg.bd, offsubnet))
-        return offsubnet
-
-    def offsubnet_flush(self, bd):
-        """ offsubnet_cache contains offsubnetCachedObjects with key of vrf,pctag,ip. Flush occurs
-            based on bd so need to walk through all nodes in list and remove nodes with provided bd.
-        """
-        remove_nodes = []
-        for n in self.offsubnet_cache.get_node_list():
-            if n.val is not None and hasattr(n.val, "bd") and n.val.bd == bd:
-                remove_nodes.append(n)
-        for n in remove_nodes:
-            self.offsubnet_cache._remove_node(n)
+        # check addr against precompiled bd subnets (assume offsubnet until matched)
+        prefixes = self.get_subnet_prefixes(epg.bd)
+        name = prefixes.match(addr, is_ipv6)
+        if name is not None:
+            logger.debug("addr %s matched subnet: %s", ip, name)
+            return False
+        logger.debug("addr %s not matched against any of the %s subnets in bd %s", ip, 
+            prefixes.count, epg.bd)
+        return True
 
     def log_stats(self):
         """ log statistics for each cache """
@@ -314,30 +478,30 @@ class eptCache(object):
             "vpc_cache", 
             "epg_cache", 
             "subnet_cache", 
-            "offsubnet_cache",
-            "rapid_cache",
+            "prefix_cache",
+            "rapid_table",
+            "endpoint_cache",
         ]
         logger.debug("cache stats for fabric %s, flush_request: 0x%08x", self.fabric, 
                 self.flush_requests)
         for cache_name in caches:
             c = getattr(self, cache_name)
-            logger.debug("[hit: 0x%08x, miss: 0x%08x, evict: 0x%08x, flush: 0x%08x] %s", 
-                c.hit_count, c.miss_count, c.evict_count, c.flush_count, cache_name)
+            logger.debug("[hit: 0x%08x, miss: 0x%08x, evict: 0x%08x, flush: 0x%08x, size: %s/%s] %s",
+                c.hit_count, c.miss_count, c.evict_count, c.flush_count, c.get_size(), c.max_size,
+                cache_name)
+        for classname in sorted(self.shared_cache):
+            logger.debug("shared cache %s", self.shared_cache[classname])
 
 class rapidEndpointCachedObject(object):
-    """ rapid statistics for eptEndpoint """
+    """ rapid statistics for eptEndpoint. This is a view of a single entry within rapidCounterTable
+        and is only valid until the next call to rapidCounterTable get/remove/clear. Setting any
+        counter marks the entry dirty so it is written on the next table flush.
+    """
+    __slots__ = ("table", "slot")
     _classname = "rapid_endpoint_cache"
-    def __init__(self, fabric, vnid, addr, addr_type):
-        self.fabric = fabric
-        self.addr = addr
-        self.vnid = vnid
-        self.type = addr_type
-        self.is_rapid = False
-        self.is_rapid_ts = 0.0
-        self.rapid_lts = 0.0
-        self.rapid_count = 0
-        self.rapid_lcount = 0
-        self.rapid_icount = 0
+    def __init__(self, table, slot):
+        self.table = table
+        self.slot = slot
 
     def __repr__(self):
         return "is_rapid:%r, ts:%.3f, lts:%.3f [c:0x%08x, l:0x%08x, i:0x%08x]" % (
@@ -345,41 +509,300 @@ class rapidEndpointCachedObject(object):
             self.rapid_count, self.rapid_lcount, self.rapid_icount
         )
 
+    @property
+    def fabric(self):
+        return self.table.fabric
+
+    @property
+    def vnid(self):
+        return self.table.vnid[self.slot]
+
+    @property
+    def addr(self):
+        return self.table.addr[self.slot]
+
+    def _get_type(self):
+        return self.table.type[self.slot]
+    def _set_type(self, val):
+        self.table.type[self.slot] = val
+    type = property(_get_type, _set_type)
+
+    def _get_is_rapid(self):
+        return self.table.is_rapid[self.slot] == 1
+    def _set_is_rapid(self, val):
+        self.table.is_rapid[self.slot] = 1 if val else 0
+        self.table.dirty.add(self.slot)
+    is_rapid = property(_get_is_rapid, _set_is_rapid)
+
+    def _get_is_rapid_ts(self):
+        return self.table.is_rapid_ts[self.slot]
+    def _set_is_rapid_ts(self, val):
+        self.table.is_rapid_ts[self.slot] = val
+        self.table.dirty.add(self.slot)
+    is_rapid_ts = property(_get_is_rapid_ts, _set_is_rapid_ts)
+
+    def _get_rapid_lts(self):
+        return self.table.rapid_lts[self.slot]
+    def _set_rapid_lts(self, val):
+        self.table.rapid_lts[self.slot] = val
+        self.table.dirty.add(self.slot)
+    rapid_lts = property(_get_rapid_lts, _set_rapid_lts)
+
+    def _get_rapid_count(self):
+        return self.table.rapid_count[self.slot]
+    def _set_rapid_count(self, val):
+        self.table.rapid_count[self.slot] = val
+        self.table.dirty.add(self.slot)
+    rapid_count = property(_get_rapid_count, _set_rapid_count)
+
+    def _get_rapid_lcount(self):
+        return self.table.rapid_lcount[self.slot]
+    def _set_rapid_lcount(self, val):
+        self.table.rapid_lcount[self.slot] = val
+        self.table.dirty.add(self.slot)
+    rapid_lcount = property(_get_rapid_lcount, _set_rapid_lcount)
+
+    def _get_rapid_icount(self):
+        return self.table.rapid_icount[self.slot]
+    def _set_rapid_icount(self, val):
+        self.table.rapid_icount[self.slot] = val
+        self.table.dirty.add(self.slot)
+    rapid_icount = property(_get_rapid_icount, _set_rapid_icount)
+
     def save(self):
-        """ save rapid counters to eptEndpoint entry, this is update for subset of attributes """
-        get_db()[eptEndpoint._classname].update_one({
-            "fabric": self.fabric,
-            "addr": self.addr,
-            "vnid": self.vnid
-        }, {"$set":{
-            "is_rapid": self.is_rapid,
-            "is_rapid_ts": self.is_rapid_ts,
-            "rapid_lts": self.rapid_lts,
-            "rapid_count": self.rapid_count,
-            "rapid_lcount": self.rapid_lcount,
-            "rapid_icount": self.rapid_icount,
-        }})
-
-class offsubnetCachedObject(object):
-    """ cache objects support a key and val where val can contain an optionally name used mainly for
-        remove(flush) operations.  We want to cache the result of offsubnet check using 
-        key=vrf,pctag,ip and result=bool as well as supporting a flush for any change to eptEpg or
-        eptSubnet that has bd corresponding to epg belonging to vrf,pctag. To do this, we create 
-        an offsubnetCachedObject that has two attributes:
-            bd = bd vnid corresponding to eptEpg/eptSubnet that created the entry
-            offsubnet = boolean (true if offsubnet else false)
+        """ mark rapid counters as dirty, counters are written to eptEndpoint on next table flush.
+            This is only required if the entry must be written without any counter update
+        """
+        self.table.dirty.add(self.slot)
+
+class rapidCounterTable(object):
+    """ compact table of rapid counters for all endpoints tracked by the worker. Counters are stored
+        in parallel arrays indexed by slot with a single dict from key string to slot. Updated
+        entries are marked dirty and written to eptEndpoint in bulk on flush instead of on each 
+        rapid calculation or eviction.
+
+        When the table reaches max_size, dirty entries are flushed and the entries with the oldest
+        rapid_lts that are not currently rapid are removed. Provide a callback function that
+        receives rapidEndpointCachedObject of each removed entry.
+
+        hit/miss/evict/flush counters and get_size are compatible with hitCache statistics
     """
-    _classname = "offsubnet_cache"
-    def __init__(self, bd, offsubnet):
+    def __init__(self, fabric, max_size, callback=None):
+        self.fabric = fabric
+        self.max_size = max_size
+        self.evict_callback = callback
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evict_count = 0
+        self.flush_count = 0
+        self.write_count = 0
+        self.init_table()
+
+    def init_table(self):
+        # allocate empty table
+        self.index = {}                 # key string to slot
+        self.dirty = set()              # slots updated since last flush
+        self.free = []                  # slots available for reuse
+        self.compact_size = self.max_size
+        self.vnid = array.array("l")
+        self.addr = []
+        self.type = []
+        self.is_rapid = array.array("b")
+        self.is_rapid_ts = array.array("d")
+        self.rapid_lts = array.array("d")
+        self.rapid_count = array.array("l")
+        self.rapid_lcount = array.array("l")
+        self.rapid_icount = array.array("l")
+
+    def __repr__(self):
+        return "len:%s, dirty:%s, free:%s, writes:%s" % (len(self.index), len(self.dirty),
+                                                            len(self.free), self.write_count)
+
+    def get_size(self):
+        """ get number of entries currently in table """
+        return len(self.index)
+
+    def get(self, keystr, vnid, addr, addr_type, write_buffer=None):
+        """ return rapidEndpointCachedObject for keystr, adding a new entry with zero counters if
+            not present. write_buffer is used to flush dirty entries if the table is full.
+        """
+        slot = self.index.get(keystr, None)
+        if slot is not None:
+            self.hit_count+= 1
+            return rapidEndpointCachedObject(self, slot)
+        self.miss_count+= 1
+        if len(self.index) >= self.compact_size:
+            self.compact(write_buffer=write_buffer)
+        if len(self.free) > 0:
+            slot = self.free.pop()
+            self.vnid[slot] = vnid
+            self.addr[slot] = addr
+            self.type[slot] = addr_type
+            self.is_rapid[slot] = 0
+            self.is_rapid_ts[slot] = 0.0
+            self.rapid_lts[slot] = 0.0
+            self.rapid_count[slot] = 0
+            self.rapid_lcount[slot] = 0
+            self.rapid_icount[slot] = 0
+        else:
+            slot = len(self.addr)
+            self.vnid.append(vnid)
+            self.addr.append(addr)
+            self.type.append(addr_type)
+            self.is_rapid.append(0)
+            self.is_rapid_ts.append(0.0)
+            self.rapid_lts.append(0.0)
+            self.rapid_count.append(0)
+            self.rapid_lcount.append(0)
+            self.rapid_icount.append(0)
+        self.index[keystr] = slot
+        return rapidEndpointCachedObject(self, slot)
+
+    def remove(self, keystr):
+        """ remove entry without writing counters to the db """
+        slot = self.index.pop(keystr, None)
+        if slot is not None:
+            self.dirty.discard(slot)
+            self.addr[slot] = None
+            self.type[slot] = None
+            self.free.append(slot)
+            self.evict_count+= 1
+
+    def clear(self):
+        """ remove all entries without writing counters to the db """
+        self.init_table()
+        self.flush_count+= 1
+
+    def flush(self, write_buffer=None):
+        """ write counters for all dirty entries to eptEndpoint. If write_buffer is provided then the
+            updates are buffered, else a single unordered bulk write is executed.
+            return number of entries written
+        """
+        if len(self.dirty) == 0:
+            return 0
+        dirty = self.dirty
+        self.dirty = set()
+        ops = []
+        for slot in dirty:
+            flt = {
+                "fabric": self.fabric,
+                "addr": self.addr[slot],
+                "vnid": self.vnid[slot],
+            }
+            update = {"$set":{
+                "is_rapid": self.is_rapid[slot] == 1,
+                "is_rapid_ts": self.is_rapid_ts[slot],
+                "rapid_lts": self.rapid_lts[slot],
+                "rapid_count": self.rapid_count[slot],
+                "rapid_lcount": self.rapid_lcount[slot],
+                "rapid_icount": self.rapid_icount[slot],
+            }}
+            if write_buffer is not None:
+                write_buffer.update_one(eptEndpoint._classname, (flt["vnid"], flt["addr"]), flt, 
+                                        update)
+            else:
+                ops.append(UpdateOne(flt, update))
+        self.write_count+= len(dirty)
+        if len(ops) > 0:
+            try:
+                get_db()[eptEndpoint._classname].bulk_write(ops, ordered=False)
+            except BulkWriteError as be:
+                logger.warn("%s bulkwrite error: %s", eptEndpoint._classname, be.details)
+        return len(dirty)
+
+    def compact(self, write_buffer=None):
+        """ flush dirty entries and then remove entries with the oldest rapid_lts that are not
+            currently rapid until the table is at 3/4 of max_size
+        """
+        self.flush(write_buffer=write_buffer)
+        count = max(0, len(self.index) - (self.max_size * 3) / 4)
+        candidates = [(self.rapid_lts[slot], keystr) for (keystr, slot) in self.index.iteritems()
+                        if self.is_rapid[slot] == 0]
+        candidates.sort()
+        for (lts, keystr) in candidates[0:count]:
+            if self.evict_callback is not None:
+                try:
+                    self.evict_callback(rapidEndpointCachedObject(self, self.index[keystr]))
+                except Exception as e:
+                    logger.debug("Traceback:\n%s", traceback.format_exc())
+                    logger.warn("failed to execute rapid table evict callback: %s", e)
+            self.remove(keystr)
+        # rapid entries are never removed so allow table to grow before next compaction
+        self.compact_size = max(self.max_size, len(self.index) + self.max_size / 4)
+        if len(self.index) >= self.max_size:
+            logger.warn("rapid table exceeds max size with %s rapid endpoints", len(self.index))
+
+class endpointStateCachedObject(object):
+    """ write-through endpoint state for eptWorker. Each endpoint (vnid,addr) is hashed to a single
+        worker so the worker owning the endpoint is the only writer for eptHistory and eptEndpoint
+        objects (with exception of is_stale/is_offsubnet flags set by watcher). This allows the
+        worker to keep the last state in memory instead of reading from db on each event:
+            history     dict indexed by node-id with list containing most recent eptHistoryEvent
+                        (with embedded watch_* attributes). None if not yet loaded from db
+            endpoint    eptEndpoint projection dict with last two local events and rapid counters.
+                        None if eptEndpoint does not exist
+    """
+    _classname = "endpoint_state_cache"
+    def __init__(self, vnid, addr):
+        self.vnid = vnid
+        self.addr = addr
+        self.history = None
+        self.endpoint = None
+        self.endpoint_loaded = False
+
+    def __repr__(self):
+        return "history:%s, endpoint:%s" % (
+            len(self.history) if self.history is not None else None,
+            self.endpoint_loaded,
+        )
+
+class subnetPrefixCachedObject(object):
+    """ subnets for a bd precompiled into integer prefixes. For each address family, the subnets are
+        grouped by mask into a dict of network address to subnet name. A lookup is a single masked
+        dict check for each distinct mask within the bd (typically only a few) with no string
+        parsing of the subnets.
+            bd      bd vnid of the subnets
+            count   number of valid subnets
+            ipv4    list of tuples (mask, dict(network, name)) for ipv4 subnets
+            ipv6    list of tuples (mask, dict(network, name)) for ipv6 subnets
+    """
+    _classname = "subnet_prefix_cache"
+    def __init__(self, bd, subnets):
         self.bd = bd
-        self.offsubnet = offsubnet
+        self.count = 0
+        ipv4 = {}
+        ipv6 = {}
+        for s in subnets:
+            (saddr, smask) = get_ip_prefix(s.ip)
+            if saddr is None or smask is None:
+                logger.warn("failed to parse ip address for subnet(%s): %s", s.name, s.ip)
+                continue
+            family = ipv6 if ":" in s.ip else ipv4
+            if smask not in family:
+                family[smask] = {}
+            family[smask][saddr] = s.name
+            self.count+= 1
+        # check longest masks first so the most specific subnet is reported on match
+        self.ipv4 = sorted(ipv4.items(), reverse=True)
+        self.ipv6 = sorted(ipv6.items(), reverse=True)
+
+    def match(self, addr, is_ipv6=False):
+        """ return name of subnet containing addr or None if not within any subnet """
+        for (mask, networks) in (self.ipv6 if is_ipv6 else self.ipv4):
+            name = networks.get(addr & mask, None)
+            if name is not None:
+                return name
+        return None
 
 class hitCacheNotFound(object):
     """ when searching for an object within hitCache and the corresponding name or key is not found,
         and instance of hitCacheNotFound object is returned.  This is to distinguish between None
         (which is a valid result), and object missing within cache
     """
-    pass
+    __slots__ = ()
+
+# single not found instance returned on every miss to avoid an allocation per miss
+HIT_CACHE_NOT_FOUND = hitCacheNotFound()
 
 class hitCache(object):
     """ hit linked list
@@ -391,7 +814,8 @@ class hitCache(object):
         then the node at the end of the list will be dropped.  
         
         Note, maintaining hash based key with linked list structure is much faster than previous
-        O(n) lookup required to remove key from list.
+        O(n) lookup required to remove key from list. All operations are O(1), a hit only relinks
+        the node to the head of the list and does not rebuild the name/none indexes.
 
         provide a callback function that receives val of evicted object to get perform additional
         logic on cache eviction (i.e., cache write back logic). callback must accept single argument
@@ -406,6 +830,7 @@ class hitCache(object):
         self.none_hash = {}     # objects with no name set (cached 'not found' objects)
         self.hit_count = 0
         self.miss_count = 0
+        self.miss_time = 0.0    # total time spent by caller resolving misses
         self.evict_count = 0
         self.flush_count = 0
         if callback is not None and callable(callback):
@@ -445,60 +870,83 @@ class hitCache(object):
         """ get number of nodes currently in cached linked list """
         return len(self.key_hash)
 
+    def peek(self, key):
+        """ return value for key without triggering a hit or updating counters. Return None if key
+            is not found within the cache
+        """
+        node = self.key_hash.get(key, None)
+        if node is not None:
+            return node.val
+        return None
+
     def search(self, key, name=False):
-        """ search for key within cache.  If found then trigger a push(hit) for that key and return
+        """ search for key within cache.  If found then trigger a hit for that key and return
             corresponding value. Set name to true to perform lookup against name_hash instead of 
             key_hash.  Note, a match in name_hash does NOT trigger push/hit against object
 
             return hitCacheNotFound object if not found
         """
         if name:
-            if key in self.name_hash:
+            node = self.name_hash.get(key, None)
+            if node is not None:
                 self.hit_count+= 1
-                return self.name_hash[key].val
-        elif key in self.key_hash:
-            self.hit_count+= 1
-            node = self.key_hash[key]
-            self.push(node.key, node.val) 
-            return node.val
+                return node.val
+        else:
+            node = self.key_hash.get(key, None)
+            if node is not None:
+                self.hit_count+= 1
+                if node is not self.head:
+                    self._unlink(node)
+                    self._link_head(node)
+                return node.val
         self.miss_count+= 1
-        return hitCacheNotFound()
+        return HIT_CACHE_NOT_FOUND
 
     def push(self, key, val):
-        """ push a new or existing node to the top of the list. If the node already exists, then it
-            is simply moved to the top of the list.
+        """ push a new or existing node to the top of the list. If the node already exists, then its
+            value is updated and it is moved to the top of the list.
             if val contains 'name' attribute, then a parallel entry is added to the name_hash as 
             well as the key_hash dicts
         """
-        node = None
-        if key not in self.key_hash:
-            node = hitCacheNode(key, val)
-        else:
-            node = self.key_hash[key]
-            self._remove_node(node)
-        # unconditionally add back to key_hash and name hash
+        node = self.key_hash.get(key, None)
+        if node is not None:
+            if node.val is not val:
+                self._unindex(node)
+                node.set_val(val)
+                self._index(node)
+            if node is not self.head:
+                self._unlink(node)
+                self._link_head(node)
+            return
+        node = hitCacheNode(key, val)
         self.key_hash[key] = node
-        for name in node.name:
-            self.name_hash[name] = node
-        if node.val is None:
-            self.none_hash[key] = node
+        self._index(node)
+        self._link_head(node)
+        # max size may have been reduced so evict until the cache fits
+        while len(self.key_hash) > self.max_size:
+            self.evict_count+=1
+            tail = self.tail
+            if self.evict_callback is not None:
+                try:
+                    self.evict_callback(tail.val)
+                except Exception as e:
+                    logger.debug("Traceback:\n%s", traceback.format_exc())
+                    logger.warn("failed to execute cache evict callback: %s", e)
+            self._remove_node(tail)
 
-        # update head/tail pointers
-        if self.head is None:
-            self.head = node
-            self.tail = node
-        else:
-            self._set_node_child(node, self.head)
-            self.head = node
-            if len(self.key_hash) > self.max_size:
-                self.evict_count+=1
-                if self.evict_callback is not None and self.tail is not None:
-                    try:
-                        self.evict_callback(self.tail.val)
-                    except Exception as e:
-                        logger.debug("Traceback:\n%s", traceback.format_exc())
-                        logger.warn("failed to execute cache evict callback: %s", e)
-                self._remove_node(self.tail)
+    def preload(self, iterable):
+        """ bulk add (key, val) tuples to the cache without affecting hit/miss counters. Items are
+            added in order so the last item in the iterable is at the head of the list. Once the
+            cache is full, remaining items are ignored instead of evicting items just loaded.
+            return number of items added
+        """
+        count = 0
+        for (key, val) in iterable:
+            if key not in self.key_hash and len(self.key_hash) >= self.max_size:
+                break
+            self.push(key, val)
+            count+= 1
+        return count
 
     def remove(self, key, name=False, preserve_none=False):
         """ remove a key from linked list if found.  If name is set to True, then use name_hash as
@@ -507,62 +955,84 @@ class hitCache(object):
         """
         if name:
             node = self.name_hash.get(key, None)
-            #logger.debug("remove name %s [%s]", key, node)
         else:
             node = self.key_hash.get(key, None)
         if node is not None:
             self._remove_node(node)
             self.evict_count+=1
-        if not preserve_none:
-            none_keys = self.none_hash.keys()
-            for k in none_keys:
-                node = self.none_hash.get(k, None)
-                if node is not None:
-                    self._remove_node(node)
-                    self.evict_count+=1
-
-    def _set_node_child(self, node, child):
-        # add a child to a specific node, updatoing tail pointer if needed
-        node.child = child
-        if child is not None:
-            child.parent = node
-            if self.tail == node:
-                self.tail = child
+        if not preserve_none and len(self.none_hash) > 0:
+            # each None entry is removed exactly once so this is amortized O(1) per push
+            none_hash = self.none_hash
+            self.none_hash = {}
+            for node in none_hash.itervalues():
+                self._remove_node(node)
+                self.evict_count+=1
 
-    def _remove_node(self, node):
-        # remove a node from linked list while maintaining head/tail pointers
-        self.key_hash.pop(node.key, None)
+    def _index(self, node):
+        # add node to name and none indexes
+        for name in node.name:
+            self.name_hash[name] = node
+        if node.val is None:
+            self.none_hash[node.key] = node
+
+    def _unindex(self, node):
+        # remove node from name and none indexes
         self.none_hash.pop(node.key, None)
         for name in node.name:
-            self.name_hash.pop(name, None)
-        if self.head == node:
-            self.head = node.child
-        if self.tail == node:
-            self.tail = node.parent
+            if self.name_hash.get(name, None) is node:
+                self.name_hash.pop(name, None)
 
+    def _link_head(self, node):
+        # link an unlinked node at the head of the list
+        node.parent = None
+        node.child = self.head
+        if self.head is not None:
+            self.head.parent = node
+        else:
+            self.tail = node
+        self.head = node
+
+    def _unlink(self, node):
+        # unlink a node from the list while maintaining head/tail pointers
         if node.parent is not None:
             node.parent.child = node.child
+        else:
+            self.head = node.child
         if node.child is not None:
             node.child.parent = node.parent
+        else:
+            self.tail = node.parent
         node.parent = None
         node.child = None
 
+    def _remove_node(self, node):
+        # remove a node from linked list and all indexes
+        self.key_hash.pop(node.key, None)
+        self._unindex(node)
+        self._unlink(node)
+
 class hitCacheNode(object):
     """ individual hit node within hit node linked list """
+    __slots__ = ("key", "val", "parent", "child", "name")
+
     def __init__(self, key, val):
         self.key = key
-        self.val = val
         self.parent = None
         self.child = None
-        self.name = []      # one or more names representing this node (many-to-one relation)
-        # val is a single object or list of objects. Each object may have a name attribute which 
-        # needs to be added to name list
+        self.set_val(val)
+
+    def set_val(self, val):
+        """ set node value and the one or more names representing this node (many-to-one relation).
+            val is a single object or list of objects. Each object may have a name attribute which 
+            needs to be added to name list
+        """
+        self.val = val
         if type(val) is list:
-            for v in val:
-                if hasattr(v, "name"):
-                    self.name.append(v.name)
-        elif hasattr(val,"name"):
+            self.name = [v.name for v in val if hasattr(v, "name")]
+        elif hasattr(val, "name"):
             self.name = [val.name]
+        else:
+            self.name = ()
 
     def __repr__(self):
         return " %s<-(%s.%s %s)->%s " % (
@@ -570,4 +1040,3 @@ class hitCacheNode(object):
             self.key, self.val, self.name,
             self.child.key if self.child is not None else None
         )
-
@@ -0,0 +1,430 @@
+
+from .. utils import get_apic_session
+from .. utils import get_ssh_connection
+from . common import CLEAR_BATCH_SIZE
+from . common import CLEAR_MAX_PI_CACHE_SIZE
+from . common import CLEAR_SESSION_IDLE_TIMEOUT
+from . common import get_mac_string
+from . common import get_mac_value
+from . common import parse_vrf_name
+from . ept_vnid import eptVnid
+from six.moves.queue import Empty
+from six.moves.queue import Queue
+
+import logging
+import re
+import threading
+import time
+import traceback
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+def parse_moquery_objects(output):
+    """ parse moquery output into list of dicts of attribute name to value, one dict per object.
+        Each object starts with a '# class' header line.  Attribute lines before the first header
+        are treated as a single object.
+    """
+    ret = []
+    attr = None
+    for line in output.split("\n"):
+        line = line.strip()
+        if line.startswith("#"):
+            attr = {}
+            ret.append(attr)
+            continue
+        r1 = re.search("^(?P<key>[a-zA-Z0-9_]+)[ ]*:[ ]*(?P<value>\S.*)?$", line)
+        if r1 is None:
+            continue
+        if attr is None:
+            attr = {}
+            ret.append(attr)
+        key = r1.group("key")
+        if key in attr:
+            # repeated attribute without a header starts a new object
+            attr = {}
+            ret.append(attr)
+        attr[key] = (r1.group("value") or "").strip()
+    return ret
+
+class eptClearEndpoint(object):
+    """ single endpoint clear request on a node. The success flag is set after the request is
+        executed by eptClearService.clear
+    """
+    def __init__(self, pod, node, vnid, addr, addr_type="ip", vrf_name=""):
+        self.pod = int(pod)
+        self.node = int(node)
+        self.vnid = int(vnid)
+        self.addr = addr
+        self.addr_type = addr_type
+        self.vrf_name = vrf_name if vrf_name is not None else ""
+        self.success = False
+
+    def __repr__(self):
+        return "node:%s, vnid:%s, addr:%s, success:%r" % (self.node, self.vnid, self.addr,
+                self.success)
+
+class eptClearService(object):
+    """ in-process endpoint clear for a single fabric. Ssh connections to each node are opened
+        through the apic and kept in a pool so subsequent clears on the same node reuse the
+        connection instead of performing a new apic login and ssh handshake. Up to max_sessions
+        connections are opened per node and connections idle for more than idle_timeout seconds
+        are closed by close_idle. A clear that fails on a reused connection is retried once on a
+        new connection.
+
+        Clear requests are grouped per node and up to concurrency nodes are cleared in parallel.
+        The clear commands for a node are chained and executed in rounds of up to batch_size
+        commands per round.  For mac endpoints, the PI vlan of the mac FD is resolved on the node
+        with moquery commands chained in rounds of the same size and cached per (node, FD dn). If
+        pi_cache_ttl is set, the cache is reset once it is older than pi_cache_ttl seconds.
+
+        If an apic session is provided it is used for all ssh connections, else a session is
+        created on demand for each call to clear and closed when the call completes.
+    """
+    def __init__(self, fabric, session=None, concurrency=1, max_sessions=1,
+                    batch_size=CLEAR_BATCH_SIZE, idle_timeout=CLEAR_SESSION_IDLE_TIMEOUT,
+                    pi_cache_ttl=None):
+        self.fabric = fabric
+        self.session = session
+        self.concurrency = max(1, concurrency)
+        self.max_sessions = max(1, max_sessions)
+        self.batch_size = max(1, batch_size)
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Condition()
+        self.pool = {}              # node to list of idle tuple (connection, last used ts)
+        self.active = {}            # node to number of connections currently in use
+        self.pi_cache = {}          # (node, fd dn) to pi vlan
+        self.pi_cache_ttl = pi_cache_ttl
+        self.pi_cache_ts = time.time()
+        # stats
+        self.clear_count = 0
+        self.fail_count = 0
+        self.connect_count = 0
+        self.reuse_count = 0
+        self.retry_count = 0
+
+    def __repr__(self):
+        return "clear:%s, fail:%s, connect:%s, reuse:%s, retry:%s, idle:%s" % (self.clear_count,
+            self.fail_count, self.connect_count, self.reuse_count, self.retry_count,
+            sum([len(self.pool[n]) for n in self.pool]))
+
+    def clear(self, endpoints):
+        """ clear list of eptClearEndpoint objects. The success flag is set on each endpoint.
+            return dict indexed by node id with per-node result:
+                {"total": int, "success": int, "time": float seconds}
+        """
+        results = {}
+        nodes = {}
+        for ep in endpoints:
+            ep.success = False
+            if ep.node not in nodes:
+                nodes[ep.node] = []
+            nodes[ep.node].append(ep)
+        if len(nodes) == 0:
+            return results
+        state = {
+            "lock": threading.Lock(),
+            "session": self.session,
+            "vrf_names": {},
+        }
+        node_queue = Queue()
+        for node in sorted(nodes):
+            node_queue.put(node)
+        concurrency = min(self.concurrency, len(nodes))
+        logger.debug("clear %s endpoints on %s nodes (concurrency %s)", len(endpoints), len(nodes),
+                concurrency)
+        try:
+            if concurrency == 1:
+                self.clear_node_thread(node_queue, nodes, state, results)
+            else:
+                threads = []
+                for i in xrange(0, concurrency):
+                    t = threading.Thread(target=self.clear_node_thread,
+                            args=(node_queue, nodes, state, results))
+                    t.name = "clear-%s" % i
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                for t in threads:
+                    t.join()
+        finally:
+            if self.session is None and state["session"] is not None:
+                state["session"].close()
+        with self.lock:
+            for ep in endpoints:
+                if ep.success:
+                    self.clear_count+= 1
+                else:
+                    self.fail_count+= 1
+        return results
+
+    def clear_node_thread(self, node_queue, nodes, state, results):
+        """ thread for clear that clears each node until node_queue is empty """
+        while True:
+            try:
+                node = node_queue.get_nowait()
+            except Empty:
+                return
+            ts = time.time()
+            try:
+                self.clear_node(node, nodes[node], state)
+            except Exception as e:
+                logger.error("Traceback:\n%s", traceback.format_exc())
+            results[node] = {
+                "total": len(nodes[node]),
+                "success": len([ep for ep in nodes[node] if ep.success]),
+                "time": time.time() - ts,
+            }
+
+    def clear_node(self, node, endpoints, state):
+        """ execute clear for list of eptClearEndpoint objects on a single node. A connection
+            reused from the pool may have been closed by the node while idle, so if the clear fails
+            on a reused connection then the connection is released as unhealthy and the clear of
+            the remaining endpoints is retried once on a new connection
+        """
+        reuse = True
+        while True:
+            (c, reused) = self.acquire(node, endpoints[0].pod, state, reuse=reuse)
+            if c is None:
+                logger.warn("failed to ssh to pod:%s node:%s", endpoints[0].pod, node)
+                return
+            healthy = False
+            try:
+                healthy = self.clear_node_cmds(c, node, endpoints, state)
+            except Exception as e:
+                if not reused:
+                    raise
+                logger.debug("Traceback:\n%s", traceback.format_exc())
+            finally:
+                self.release(node, c, healthy)
+            if healthy or not reused:
+                return
+            logger.debug("clear failed on reused connection to node-%s, retrying on new connection",
+                    node)
+            with self.lock:
+                self.retry_count+= 1
+            reuse = False
+
+    def clear_node_cmds(self, c, node, endpoints, state):
+        """ execute clear commands on connection for each eptClearEndpoint on a single node that is
+            not already cleared. return bool success where False indicates a command failed
+        """
+        cmds = []   # list of tuple (cmd, eptClearEndpoint)
+        macs = []
+        for ep in endpoints:
+            if ep.success:
+                continue
+            if ep.addr_type == "mac":
+                ep.addr = get_mac_string(get_mac_value(ep.addr), fmt="std")
+                macs.append(ep)
+            else:
+                vrf_name = self.get_vrf_name(ep, state)
+                if vrf_name is None:
+                    continue
+                ctype = "ipv6" if ":" in ep.addr else "ip"
+                cmds.append(("vsh -c 'clear system internal epm endpoint key vrf %s %s %s'" % (
+                    vrf_name, ctype, ep.addr), ep))
+        if len(macs) > 0:
+            pi_vlans = self.get_pi_vlans(c, node, macs)
+            if pi_vlans is None:
+                return False
+            for ep in macs:
+                pi = pi_vlans.get(ep, None)
+                if ep not in pi_vlans:
+                    # assume endpoint is no longer present (so cleared!)
+                    logger.debug("mac %s not found on node-%s, assuming cleared", ep.addr, node)
+                    ep.success = True
+                elif pi is not None:
+                    cmd = "vsh -c 'clear system internal epm endpoint key vlan %s mac %s'" % (
+                            pi, ep.addr)
+                    cmds.append((cmd, ep))
+        for i in xrange(0, len(cmds), self.batch_size):
+            batch = cmds[i:i+self.batch_size]
+            cmd = " ; ".join([b[0] for b in batch])
+            if c.cmd(cmd) != "prompt":
+                logger.warn("failed to execute clear cmd on node-%s: %s", node, cmd)
+                return False
+            logger.debug("successfully cleared %s endpoints on node-%s", len(batch), node)
+            for (cmd, ep) in batch:
+                ep.success = True
+        return True
+
+    def get_vrf_name(self, ep, state):
+        """ return vrf name for ip endpoint, determined from eptVnid table if not provided.
+            return None on error
+        """
+        if len(ep.vrf_name) > 0:
+            return ep.vrf_name
+        if ep.vnid in state["vrf_names"]:
+            return state["vrf_names"][ep.vnid]
+        vrf_name = None
+        v = eptVnid.find(fabric=self.get_fabric_name(), vnid=ep.vnid)
+        if len(v) > 0:
+            vrf_name = parse_vrf_name(v[0].name)
+            if vrf_name is None:
+                logger.warn("failed to parse vrf name from ept vnid_name: %s", v[0].name)
+        else:
+            logger.warn("failed to determine vnid_name for fabric:%s,vnid:%s",
+                    self.get_fabric_name(), ep.vnid)
+        state["vrf_names"][ep.vnid] = vrf_name
+        return vrf_name
+
+    def get_pi_vlans(self, c, node, macs):
+        """ return dict of PI vlan indexed by eptClearEndpoint for list of mac endpoints.
+            Endpoints not currently learned on the node are not included in the result and the PI
+            vlan is None for endpoints where the PI vlan could not be determined.
+            return None on error
+        """
+        # to determine mac FD need to first verify mac exists and then use parent dn to query
+        # l2BD, vlanCktEp, vxlanCktEp object (good thing here is that we don't care which object
+        # type, each will have id attribute that is the PI vlan). Since the ssh session is already
+        # up, moquery is executed directly on the node for up to batch_size macs per round
+        fds = {}
+        for i in xrange(0, len(macs), self.batch_size):
+            cmd = " ; ".join(["moquery -c epmMacEp -f 'epm.MacEp.addr==\"%s\"' | egrep '^dn'" % (
+                                ep.addr) for ep in macs[i:i+self.batch_size]])
+            if c.cmd(cmd) != "prompt":
+                logger.warn("failed to execute moquery command to determine mac fd on node-%s",
+                        node)
+                return None
+            for r1 in re.finditer("dn[ ]*:[ ]*(?P<dn>sys/\S+)/db-ep/mac-(?P<mac>[0-9A-Fa-f:]+)",
+                                    c.output):
+                fds.setdefault(r1.group("mac").upper(), []).append(r1.group("dn"))
+        ret = {}
+        lookup = {}
+        with self.lock:
+            if self.pi_cache_ttl is not None and time.time()-self.pi_cache_ts > self.pi_cache_ttl:
+                self.pi_cache = {}
+                self.pi_cache_ts = time.time()
+        for ep in macs:
+            vnid = "vxlan-%s]" % ep.vnid
+            fd = [dn for dn in fds.get(ep.addr.upper(), []) if vnid in dn]
+            if len(fd) == 0:
+                continue
+            with self.lock:
+                pi = self.pi_cache.get((node, fd[0]), None)
+            if pi is not None:
+                ret[ep] = pi
+            else:
+                lookup.setdefault(fd[0], []).append(ep)
+        if len(lookup) == 0:
+            return ret
+        # the class header of each object is kept so dn and id are paired per object regardless
+        # of the order of the attributes within the object
+        dns = sorted(lookup)
+        for i in xrange(0, len(dns), self.batch_size):
+            cmd = " ; ".join(["moquery -d '%s' | egrep '^(#|dn|id) '" % dn
+                                for dn in dns[i:i+self.batch_size]])
+            if c.cmd(cmd) != "prompt":
+                logger.warn("failed to execute moquery command to determine pi vlan on node-%s",
+                        node)
+                return None
+            for attr in parse_moquery_objects(c.output):
+                dn = attr.get("dn", None)
+                pi = attr.get("id", None)
+                if dn not in lookup or pi is None or not pi.isdigit():
+                    continue
+                for ep in lookup[dn]:
+                    ret[ep] = pi
+                with self.lock:
+                    if len(self.pi_cache) >= CLEAR_MAX_PI_CACHE_SIZE:
+                        self.pi_cache = {}
+                    self.pi_cache[(node, dn)] = pi
+        for dn in lookup:
+            if lookup[dn][0] not in ret:
+                logger.warn("failed to extract pi-vlan id from %s: %s", dn, c.output)
+                for ep in lookup[dn]:
+                    ret[ep] = None
+        return ret
+
+    def get_fabric_name(self):
+        """ return fabric name where fabric can be Fabric object or string """
+        return getattr(self.fabric, "fabric", self.fabric)
+
+    def acquire(self, node, pod, state, reuse=True):
+        """ return idle connection for node from the pool or create a new connection if fewer than
+            max_sessions are in use for the node, else block until a connection is released. If
+            reuse is False then idle connections for the node are closed and a new connection is
+            always created.
+            return tuple (connection, bool reused) where connection is None on error
+        """
+        with self.lock:
+            if not reuse:
+                for (c, ts) in self.pool.pop(node, []):
+                    c.close()
+            while True:
+                while reuse and len(self.pool.get(node, [])) > 0:
+                    (c, ts) = self.pool[node].pop()
+                    if c.child is not None and c.child.isalive():
+                        self.active[node] = self.active.get(node, 0) + 1
+                        self.reuse_count+= 1
+                        return (c, True)
+                    c.close()
+                if self.active.get(node, 0) < self.max_sessions:
+                    self.active[node] = self.active.get(node, 0) + 1
+                    break
+                self.lock.wait()
+        c = None
+        try:
+            with state["lock"]:
+                if state["session"] is None:
+                    state["session"] = get_apic_session(self.fabric)
+            if state["session"] is None:
+                logger.warn("failed to get apic session for fabric: %s", self.get_fabric_name())
+            else:
+                c = get_ssh_connection(self.fabric, pod, node, session=state["session"])
+        except Exception as e:
+            logger.error("Traceback:\n%s", traceback.format_exc())
+        if c is None:
+            self.release(node, None, False)
+        else:
+            with self.lock:
+                self.connect_count+= 1
+        return (c, False)
+
+    def release(self, node, c, healthy=True):
+        """ return connection to the pool for node. If the connection is not healthy it is closed
+            so the next acquire creates a new connection
+        """
+        with self.lock:
+            self.active[node] = max(0, self.active.get(node, 0) - 1)
+            if c is not None:
+                if healthy:
+                    self.pool.setdefault(node, []).append((c, time.time()))
+                else:
+                    c.close()
+            self.lock.notify_all()
+
+    def close_idle(self):
+        """ close connections that have been idle for more than idle_timeout seconds.
+            return number of connections closed
+        """
+        count = 0
+        now = time.time()
+        with self.lock:
+            for node in self.pool.keys():
+                idle = []
+                for (c, ts) in self.pool[node]:
+                    if now - ts > self.idle_timeout:
+                        c.close()
+                        count+= 1
+                    else:
+                        idle.append((c, ts))
+                if len(idle) > 0:
+                    self.pool[node] = idle
+                else:
+                    self.pool.pop(node, None)
+        if count > 0:
+            logger.debug("closed %s idle clear connections for %s", count, self.get_fabric_name())
+        return count
+
+    def close(self, clear_cache=True):
+        """ close all idle connections and clear the PI vlan cache unless clear_cache is False """
+        with self.lock:
+            for node in self.pool:
+                for (c, ts) in self.pool[node]:
+                    c.close()
+            self.pool = {}
+            if clear_cache:
+                self.pi_cache = {}
+                self.pi_cache_ts = time.time()
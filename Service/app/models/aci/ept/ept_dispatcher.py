@@ -0,0 +1,492 @@
+from ... utils import get_redis
+from .. utils import register_signal_handlers
+from . common import MANAGER_CTRL_CHANNEL
+from . common import MANAGER_DISPATCH_CHANNEL
+from . common import REBALANCE_ACK_TIMEOUT
+from . common import REBALANCE_PAUSE_TIMEOUT
+from . common import WATCHER_BROADCAST_CHANNEL
+from . common import WORKER_BROADCAST_CHANNEL
+from . common import BackgroundThread
+from . common import HashRing
+from . common import get_dispatch_queue_name
+from . common import get_msg_hash
+from . common import get_queue_seq_key
+from . common import wait_for_redis
+from . ept_msg import MSG_TYPE
+from . ept_msg import WIRE_VERSION_JSON
+from . ept_msg import eptMsg
+from . ept_msg import eptMsgBulk
+from . ept_queue_stats import eptQueueStats
+
+import logging
+import threading
+import time
+import traceback
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+def build_worker_rings(active_workers):
+    """ return dict of HashRing indexed by role for dict of active workers indexed by role """
+    rings = {}
+    for role in active_workers:
+        rings[role] = HashRing(active_workers[role], key=lambda w: w.worker_id)
+    return rings
+
+def send_rebalance_ack(redis, ack_id, version, phase):
+    """ publish REBALANCE_ACK to manager for provided rebalance version and phase """
+    msg = eptMsg(MSG_TYPE.REBALANCE_ACK, data={"id": ack_id, "version": version, "phase": phase})
+    redis.publish(MANAGER_CTRL_CHANNEL, msg.jsonify())
+
+def allocate_seq(redis, worker, qnum, count=1):
+    """ reserve count seq numbers on worker queue qnum and return the last seq reserved. The seq is
+        allocated with a redis incr on the queue so the manager, each dispatcher, and subscribers
+        sending to the same worker queue never reuse or reorder a seq. Caller must hold the queue
+        lock for qnum.
+    """
+    seq = redis.incrby(get_queue_seq_key(worker.queues[qnum]), count)
+    worker.last_seq[qnum] = seq
+    return seq
+
+def merge_worker_table(active_workers, workers):
+    """ return new dict of active workers indexed by role from list of TrackedWorker json (worker
+        table published by manager). Workers already in active_workers keep their current seq and
+        queue locks.
+    """
+    current = {}
+    for role in active_workers:
+        for w in active_workers[role]:
+            current[w.worker_id] = w
+    ret = {}
+    for js in workers:
+        w = current.get(js["worker_id"], None)
+        if w is None or w.start_time != js["start_time"]:
+            w = TrackedWorker.from_json(js)
+        if w.role not in ret:
+            ret[w.role] = []
+        ret[w.role].append(w)
+    return ret
+
+class DispatchFence(object):
+    """ gate sends to worker queues while the manager migrates work between workers. Each send
+        (selecting workers with the current hash rings and enqueuing the msgs) is wrapped with 
+        enter/exit. hold blocks new sends and waits for sends in progress to complete so no work is
+        enqueued until release is called after the new worker table is applied.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.held = False
+        self.inflight = 0
+
+    def enter(self, timeout=REBALANCE_PAUSE_TIMEOUT):
+        """ wait while fence is held (at most timeout seconds) and then start a send """
+        end_ts = time.time() + timeout
+        with self.cond:
+            while self.held:
+                remaining = end_ts - time.time()
+                if remaining <= 0:
+                    logger.warn("timeout waiting for dispatch fence release")
+                    break
+                self.cond.wait(remaining)
+            self.inflight+= 1
+
+    def exit(self):
+        """ send has completed """
+        with self.cond:
+            self.inflight-= 1
+            if self.inflight <= 0:
+                self.cond.notify_all()
+
+    def hold(self, timeout=REBALANCE_ACK_TIMEOUT):
+        """ block new sends and wait for sends in progress to complete, return boolean success """
+        end_ts = time.time() + timeout
+        with self.cond:
+            self.held = True
+            while self.inflight > 0:
+                remaining = end_ts - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def release(self):
+        """ allow sends blocked by hold to continue """
+        with self.cond:
+            self.held = False
+            self.cond.notify_all()
+
+class WorkerDispatch(object):
+    """ dispatch work received on a manager work queue to active workers. This is used by the 
+        WorkerTracker within the manager and by each eptDispatcher process. 
+        stats is a function with args (queue, tx=False, count=1) to update queue stats
+        Workers are selected using a consistent hash ring per role, rebuild_rings must be called
+        whenever active_workers is updated.
+    """
+    def __init__(self, redis, stats):
+        self.redis = redis
+        self.stats = stats
+        self.active_workers = {}    # list of active workers indexed by role
+        self.rings = {}             # HashRing of active workers indexed by role
+        self.fence = DispatchFence()# hold dispatch while manager migrates work
+        self.watcher_broadcast_seq = 0
+        self.worker_broadcast_seq = 0
+
+    def rebuild_rings(self):
+        """ rebuild hash rings from current active workers """
+        self.rings = build_worker_rings(self.active_workers)
+
+    def get_worker(self, role, _hash):
+        """ return TrackedWorker owning provided hash for role or None if no workers available """
+        ring = self.rings.get(role, None)
+        if ring is None:
+            return None
+        return ring.get(_hash)
+
+    def dispatch(self, q, data):
+        """ dispatch a single message received on work queue q """
+        self.fence.enter()
+        try:
+            self._dispatch(q, data)
+        finally:
+            self.fence.exit()
+
+    def _dispatch(self, q, data):
+        # to support msg type BULK, assume an array of messages received
+        msg_list = []
+        try:
+            omsg = eptMsg.parse(data, raw=True) 
+            #logger.debug("msg on q(%s): %s", q, omsg)
+            if omsg.msg_type == MSG_TYPE.BULK and omsg.route is not None:
+                # dispatch serialized msgs using route info computed by sender
+                self.dispatch_routed_bulk(q, omsg)
+                return
+            if omsg.msg_type == MSG_TYPE.BULK:
+                msg_list = omsg.msgs
+            elif omsg.msg_type == MSG_TYPE.WORK:
+                msg_list = [omsg]
+            else:
+                logger.warn("unexpected messaged received on queue %s: %s", q, omsg)
+
+            bulk = []   # list of (hash, msg) to execute against send_bulk
+            for msg in msg_list:
+                # expected only eptWork received on this queue
+                if msg.msg_type == MSG_TYPE.WORK:
+                    self.stats(q, tx=False)
+                    if msg.addr == 0:
+                        # an addr of 0 is a broadcast to all workers of specified role.
+                        # Send broadcast now, not within a batch.
+                        # Note, broadcast may be out of order if received in BULK with ucast msg
+                        self.broadcast(msg) 
+                    else:
+                        # create hash based on address and send to specific worker
+                        bulk.append((get_msg_hash(msg), msg))
+            if len(bulk) > 0:
+                if not self.send_bulk(bulk):
+                    logger.warn("failed to enqueue one or more messages")
+
+        except Exception as e:
+            logger.debug("failed to parse message from q: %s, data: %s", q, data)
+            logger.error("Traceback:\n%s", traceback.format_exc())
+
+    def dispatch_routed_bulk(self, q, omsg):
+        """ dispatch eptMsgBulk with route info without parsing each msg. Only broadcast msgs (hash
+            of None) are parsed so they can be sent on the broadcast channel.
+        """
+        self.stats(q, tx=False, count=len(omsg.raw_msgs))
+        bulk = []   # list of (hash, role, qnum, raw_msg) to execute against send_raw_bulk
+        for i, raw_msg in enumerate(omsg.raw_msgs):
+            (_hash, role, qnum) = omsg.route[i]
+            if _hash is None:
+                # Note, broadcast may be out of order if received in BULK with ucast msg
+                self.broadcast(eptMsg.parse(raw_msg))
+            else:
+                bulk.append((_hash, role, qnum, raw_msg))
+        if len(bulk) > 0:
+            if not self.send_raw_bulk(bulk):
+                logger.warn("failed to enqueue one or more messages")
+
+    def send_bulk(self, msgs):
+        """ receive list of tuples (_hash, msg) and enqueue to an available worker. 
+            Each msg in bulk list must be of type eptMsgWork.  This will create sub bulk messages to
+            reduce the blocking IO for redis calls.
+            return boolean success
+        """
+        all_success = True
+        work = {}   # dict indexed by worker_id and qnum with a tuple (worker, eptMsgBulk)
+        for (_hash, msg) in msgs:
+            worker = self.get_worker(msg.role, _hash)
+            if worker is None:
+                logger.warn("no available workers for role '%s'", msg.role)
+                all_success = False
+            else:
+                if msg.qnum >= len(worker.queues):
+                    logger.warn("unable to enqueue work on worker %s, queue %s does not exist", 
+                        worker.worker_id, msg.qnum)
+                    all_success = False
+                else:
+                    if worker.worker_id not in work:
+                        work[worker.worker_id] = {}
+                    if msg.qnum not in work[worker.worker_id]:
+                        work[worker.worker_id][msg.qnum] = (worker, eptMsgBulk())
+                    work[worker.worker_id][msg.qnum][1].msgs.append(msg)
+                    self.stats(worker.queues[msg.qnum], tx=True)
+
+        # send each message
+        for worker_id in work:
+            for qnum in work[worker_id]:
+                (worker, tx_msg) = work[worker_id][qnum]
+                # encode using highest wire version supported by the worker, single message is sent
+                # without bulk framing when using json
+                with worker.queue_locks[qnum]:
+                    try:
+                        seq = allocate_seq(self.redis, worker, qnum, len(tx_msg.msgs))
+                        for i, msg in enumerate(tx_msg.msgs):
+                            msg.seq = seq - len(tx_msg.msgs) + i + 1
+                        #logger.debug("enqueue %s: %s", worker.queues[qnum], tx_msg)
+                        self.redis.rpush(worker.queues[qnum], tx_msg.pack(worker.wire_version))
+                    except Exception as e:
+                        logger.error("failed to enqueue msg on queue %s: %s", worker.queues[qnum], 
+                                        tx_msg)
+                        all_success = False
+        return all_success
+
+    def send_raw_bulk(self, msgs):
+        """ receive list of tuples (_hash, role, qnum, raw_msg) where raw_msg is an already 
+            serialized eptMsgWork and enqueue to an available worker. The serialized msgs are 
+            forwarded as-is within an eptMsgBulk per worker queue.
+            return boolean success
+        """
+        all_success = True
+        work = {}   # dict indexed by worker_id and qnum with a tuple (worker, list of raw_msg)
+        for (_hash, role, qnum, raw_msg) in msgs:
+            worker = self.get_worker(role, _hash)
+            if worker is None:
+                logger.warn("no available workers for role '%s'", role)
+                all_success = False
+            else:
+                if qnum >= len(worker.queues):
+                    logger.warn("unable to enqueue work on worker %s, queue %s does not exist", 
+                        worker.worker_id, qnum)
+                    all_success = False
+                else:
+                    if worker.worker_id not in work:
+                        work[worker.worker_id] = {}
+                    if qnum not in work[worker.worker_id]:
+                        work[worker.worker_id][qnum] = (worker, [])
+                    work[worker.worker_id][qnum][1].append(raw_msg)
+
+        # send each bulk with seq of last msg
+        for worker_id in work:
+            for qnum in work[worker_id]:
+                (worker, raw_msgs) = work[worker_id][qnum]
+                with worker.queue_locks[qnum]:
+                    self.stats(worker.queues[qnum], tx=True, count=len(raw_msgs))
+                    try:
+                        seq = allocate_seq(self.redis, worker, qnum, len(raw_msgs))
+                        self.redis.rpush(worker.queues[qnum], eptMsgBulk.jsonify_raw(raw_msgs,seq))
+                    except Exception as e:
+                        logger.error("failed to enqueue msg on queue %s: %s", worker.queues[qnum], 
+                                        e)
+                        all_success = False
+        return all_success
+
+    def broadcast(self, msg):
+        """ broadcast single message. Broadcast moved to pub/sub mechanism so simply need
+            to publish the original message onto broadcast channel. msg must be of type eptMsgWork
+            or child with role attribute to determine appropriate channel. If role is None or not
+            present then msg is broadcast to all channels
+            Note, broadcast does not currently use eptMsgBulk (no use case at this time...)
+        """
+        all_channels = [ WORKER_BROADCAST_CHANNEL, WATCHER_BROADCAST_CHANNEL]
+        if not isinstance(msg, list):
+            msg = [msg]
+        for m in msg:
+            role = getattr(m, "role", None)
+            if role == "watcher":
+                channels = [ WATCHER_BROADCAST_CHANNEL ]
+                self.watcher_broadcast_seq+=1
+                seq = [self.watcher_broadcast_seq]
+            elif role == "worker":
+                channels = [ WORKER_BROADCAST_CHANNEL ] 
+                self.worker_broadcast_seq+=1
+                seq = [self.worker_broadcast_seq ]
+            else:
+                channels = all_channels
+                self.watcher_broadcast_seq+=1
+                self.worker_broadcast_seq+=1
+                seq = [self.worker_broadcast_seq, self.watcher_broadcast_seq]
+            for i, channel in enumerate(channels):
+                m.seq = seq[i]
+                logger.debug("broadcast [q:%s] msg: %s", channel, m)
+                self.redis.publish(channel, m.jsonify())
+                self.stats(channel, tx=True)
+
+
+class eptDispatcher(object):
+    """ dispatcher process forked by the manager when MANAGER_DISPATCHER_COUNT is set. Work sent
+        to the manager is partitioned by fabric across dispatcher queues (see get_dispatch_queue) 
+        and each dispatcher consumes a single queue. The manager remains the coordinator for fabric
+        start/stop, worker hello tracking, and the WorkerTracker. It publishes the active worker 
+        table on MANAGER_DISPATCH_CHANNEL which each dispatcher uses to route work.
+    """
+    def __init__(self, manager_id, index, worker_table={}):
+        self.worker_id = "%s-d%s" % (manager_id, index)
+        self.queue = get_dispatch_queue_name(index)
+        self.redis = get_redis()
+        self.subscribe_thread = None
+        self.stats_thread = None
+        self.queue_stats_lock = threading.Lock()
+        self.queue_stats = {}
+        self.dispatch = WorkerDispatch(self.redis, self.increment_stats)
+        # initial worker table copied from manager at start
+        self.update_worker_table(worker_table, ack=False)
+
+    def __repr__(self):
+        return self.worker_id
+
+    def cleanup(self):
+        """ graceful cleanup on exit """
+        if self.stats_thread is not None:
+            self.stats_thread.exit()
+        if self.subscribe_thread is not None:
+            self.subscribe_thread.stop()
+        if self.redis is not None and self.redis.connection_pool is not None:
+            self.redis.connection_pool.disconnect()
+
+    def run(self):
+        """ wrapper around run to handle interrupts/errors """
+        threading.currentThread().name = "disp-main"
+        register_signal_handlers()
+        try:
+            self._run()
+        except (Exception, SystemExit, KeyboardInterrupt) as e:
+            logger.error("Traceback:\n%s", traceback.format_exc())
+        finally:
+            self.cleanup()
+
+    def _run(self):
+        """ listen on dispatch queue and dispatch work to active workers """
+        wait_for_redis(self.redis)
+        self.queue_stats = {
+            self.queue: eptQueueStats.load(proc=self.worker_id, queue=self.queue),
+            "total": eptQueueStats.load(proc=self.worker_id, queue="total"),
+        }
+        for k, q in self.queue_stats.items():
+            q.init_queue()
+        self.stats_thread = BackgroundThread(
+            func=self.update_stats,
+            name="disp-stats",
+            count=0,
+            interval= eptQueueStats.STATS_INTERVAL
+        )
+        self.stats_thread.daemon = True
+        self.stats_thread.start()
+
+        p = self.redis.pubsub(ignore_subscribe_messages=True)
+        p.subscribe(**{MANAGER_DISPATCH_CHANNEL: self.handle_channel_msg})
+        self.subscribe_thread = p.run_in_thread(sleep_time=0.01, daemon=True)
+        self.subscribe_thread.name = "disp-redis"
+
+        logger.debug("[%s] dispatcher ready for work on %s", self, self.queue)
+        while True:
+            (q, data) = self.redis.blpop(self.queue)
+            self.dispatch.dispatch(q, data)
+
+    def handle_channel_msg(self, msg):
+        """ handle worker table updates from the manager """
+        try:
+            if msg["type"] == "message":
+                msg = eptMsg.parse(msg["data"])
+                if msg.msg_type == MSG_TYPE.WORKER_TABLE:
+                    self.update_worker_table(msg.data)
+        except Exception as e:
+            logger.error("[%s] failed to handle msg: %s", self, msg)
+            logger.debug("Traceback:\n%s", traceback.format_exc())
+
+    def update_worker_table(self, table, ack=True):
+        """ rebuild active workers from worker table published by manager. If hold is set then the
+            manager is migrating work between workers. Wait for any dispatch in progress to complete
+            and ack the hold, no further work is dispatched until a table without hold is received.
+        """
+        workers = table.get("workers", [])
+        self.dispatch.active_workers = merge_worker_table(self.dispatch.active_workers, workers)
+        self.dispatch.rebuild_rings()
+        if table.get("hold", False):
+            if not self.dispatch.fence.hold():
+                logger.warn("[%s] timeout waiting for dispatch in progress", self)
+            if ack:
+                send_rebalance_ack(self.redis, self.worker_id, table.get("version", 0), "hold")
+        else:
+            self.dispatch.fence.release()
+
+    def increment_stats(self, queue, tx=False, count=1):
+        # update stats queue
+        with self.queue_stats_lock:
+            if queue in self.queue_stats:
+                if tx:
+                    self.queue_stats[queue].total_tx_msg+= count
+                    self.queue_stats["total"].total_tx_msg+= count
+                else:
+                    self.queue_stats[queue].total_rx_msg+= count
+                    self.queue_stats["total"].total_rx_msg+= count
+
+    def update_stats(self):
+        """ update stats at regular interval """
+        for k, q in self.queue_stats.items():
+            with self.queue_stats_lock:
+                q.collect(qlen = self.redis.llen(k))
+
+class TrackedWorker(object):
+    """ active worker tracker """
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.active = False             # set to true when added to active list
+        self.queues = []                # queue names sorted by priority
+        self.queue_locks = []           # list of thread locks per queue
+        self.role = None
+        self.start_time = 0
+        self.hello_seq = 0
+        self.wire_version = WIRE_VERSION_JSON   # highest wire version supported by worker
+        self.cache_budget = 0           # cache memory budget in bytes reported in worker hello
+        self.cache_usage = 0            # estimated cache memory in bytes reported in worker hello
+        self.last_hello = 0
+        self.last_seq = []              # last seq allocated on worker queue by this process
+        self.last_head = []             # at time of last worker check, seq at head of queue
+        self.last_head_check = 0        # timestamp of last head seq check
+
+    def __repr__(self):
+        return "%s, role:%s, q:%s" % (self.worker_id,self.role,self.queues)
+
+    def to_json(self):
+        return {
+            "worker_id": self.worker_id,
+            "active": self.active,
+            "queues": self.queues,
+            "role": self.role,
+            "start_time": self.start_time,
+            "hello_seq": self.hello_seq,
+            "wire_version": self.wire_version,
+            "cache_budget": self.cache_budget,
+            "cache_usage": self.cache_usage,
+            "last_hello": self.last_hello,
+            "last_seq": self.last_seq
+        }
+
+    @staticmethod
+    def from_json(js):
+        # return TrackedWorker from to_json result
+        w = TrackedWorker(js["worker_id"])
+        w.active = js.get("active", False)
+        w.queues = js.get("queues", [])
+        w.role = js.get("role", None)
+        w.start_time = js.get("start_time", 0)
+        w.hello_seq = js.get("hello_seq", 0)
+        w.wire_version = js.get("wire_version", WIRE_VERSION_JSON)
+        w.cache_budget = js.get("cache_budget", 0)
+        w.cache_usage = js.get("cache_usage", 0)
+        w.last_hello = js.get("last_hello", 0)
+        w.last_seq = list(js.get("last_seq", [0 for q in w.queues]))
+        w.last_head = [0 for q in w.queues]
+        w.queue_locks = [threading.Lock() for q in w.queues]
+        return w
+
@@ -3,12 +3,16 @@ from ... rest import Rest
 from ... rest import api_register
 from ... rest import api_route
 from ... rest import api_callback
-from .. utils import clear_endpoint
+from ... utils import get_app_config
+from . common import CLEAR_PI_CACHE_TTL
 from . common import common_event_attribute
 from . common import get_mac_value
 from . common import get_msg_hash
 from . common import parse_vrf_name
 from . common import subscriber_op
+from . ept_clear import eptClearEndpoint
+from . ept_clear import eptClearService
+from . ept_epm_digest import eptEpmDigest
 from . ept_history import eptHistory
 from . ept_move import eptMove
 from . ept_msg import MSG_TYPE
@@ -30,6 +34,11 @@ import time
 # module level logging
 logger = logging.getLogger(__name__)
 
+# clear service per fabric name shared by clear endpoint api requests so the mac PI vlan cache is
+# kept between requests
+api_clear_services = {}
+api_clear_services_lock = threading.Lock()
+
 # reusable attributes for local event piggy-backing on history meta for consistency
 common_attr = ["ts", "status", "intf_id", "intf_name", "pctag", "encap", "rw_mac", "rw_bd", 
                 "epg_name", "vnid_name"]
@@ -51,6 +60,19 @@ local_event = {
 for a in common_attr:
     local_event[a] = common_event_attribute[a]
 
+def get_api_clear_service(f):
+    """ return eptClearService for Fabric object shared by clear endpoint api requests """
+    concurrency = int(get_app_config().get("API_CLEAR_CONCURRENCY", 1))
+    with api_clear_services_lock:
+        service = api_clear_services.get(f.fabric, None)
+        if service is None:
+            service = eptClearService(f, concurrency=concurrency, pi_cache_ttl=CLEAR_PI_CACHE_TTL)
+            api_clear_services[f.fabric] = service
+        # use latest fabric object and config so updated ssh credentials are used
+        service.fabric = f
+        service.concurrency = max(1, concurrency)
+        return service
+
 @api_register(parent="fabric", path="ept/endpoint")
 class eptEndpoint(Rest):
     """ The calculated result of an endpoint state within the fabric.  This object is created 
@@ -293,10 +315,16 @@ class eptEndpoint(Rest):
         eptHistory.delete(_filters=filters)
         eptRapid.delete(_filters=filters)
         eptRemediate.delete(_filters=filters)
+        # force endpoint to be analyzed on next build when epm_delta_sync is enabled
+        eptEpmDigest.delete(_filters=dict(
+            (k, filters[k]) for k in ["fabric", "vnid", "addr"] if k in filters
+        ))
 
-    @api_route(path="clear", methods=["POST"], swag_ret=["success", "error"])
+    @api_route(path="clear", methods=["POST"], swag_ret=["success", "error", "nodes"])
     def clear_endpoint(self, nodes=[]):
-        """ clear endpoint on one or more nodes """
+        """ clear endpoint on one or more nodes. The result includes the success and time in 
+            seconds to clear the endpoint on each node
+        """
         # on-demand import of eptWorkerFabric only at api call (prevents circular imports)
         from . ept_worker_fabric import eptWorkerFabric
         from .. fabric import Fabric
@@ -345,56 +373,54 @@ class eptEndpoint(Rest):
             error_rows.append("no valid nodes provided")
             abort(400, ". ".join(error_rows))
 
-        # execute clear endpoint in parallel across each node
-        def per_node_clear_endpoint(switch):
-            switch["ret"] = clear_endpoint(self.fabric, switch["pod"], switch["node"], self.vnid, 
-                                self.addr, addr_type, vrf_name)
-            if switch["ret"]:
-                # add event to eptRemediate and send notification
-                switch["worker_fabric"].push_event(eptRemediate._classname, {
-                        "fabric": self.fabric,
-                        "vnid": self.vnid,
-                        "addr": self.addr,
-                        "type": self.type,
-                        "node": switch["node"],
-                    }, {
-                        "ts": time.time(),
-                        "vnid_name": self.first_learn["vnid_name"],
-                        "reason": "api",
-                        "action": "clear"
-                    })
-                # send notification if enabled
-                subject = "api clear endpoint"
-                txt = "api clear endpoint [fabric: %s, %s, addr: %s]" % (
-                    self.fabric,
-                    self.events[0]["vnid_name"] if len(self.events)>0 else "vnid:%d" % self.vnid,
-                    self.addr
-                )
-                switch["worker_fabric"].send_notification("clear", subject, txt)
-            return
+        # execute clear endpoint in parallel across each node with a single apic login
+        endpoints = {}
+        for (pod, node) in valid_nodes:
+            endpoints[node] = eptClearEndpoint(pod, node, self.vnid, self.addr, addr_type=addr_type,
+                                                vrf_name=vrf_name)
+        service = get_api_clear_service(f)
+        try:
+            results = service.clear(endpoints.values())
+        finally:
+            # ssh connections are closed after each request, PI vlan cache is kept for next request
+            service.close(clear_cache=False)
 
         worker_fabric = eptWorkerFabric(self.fabric)
-        threads = []
-        process = {}
-        for (pod, node) in valid_nodes:
-            process[node] = {
-                "pod": pod,
-                "node": node,
-                "worker_fabric": worker_fabric,
-                "ret": None
+        node_results = {}
+        for node in sorted(endpoints):
+            node_results["%s" % node] = {
+                "success": endpoints[node].success,
+                "time": round(results.get(node, {}).get("time", 0), 3),
             }
-            t = threading.Thread(target=per_node_clear_endpoint, args=(process[node],))
-            t.start()
-            threads.append(t)
-        for t in threads: t.join()
-        for node in process:
-            # cleanup worker fabric 
-            process[node]["worker_fabric"].close()
-            if not process[node]["ret"]: 
+            if not endpoints[node].success:
                 error_rows.append("failed to clear endpoint on node %s" % node)
+                continue
+            # add event to eptRemediate and send notification
+            worker_fabric.push_event(eptRemediate._classname, {
+                    "fabric": self.fabric,
+                    "vnid": self.vnid,
+                    "addr": self.addr,
+                    "type": self.type,
+                    "node": node,
+                }, {
+                    "ts": time.time(),
+                    "vnid_name": self.first_learn["vnid_name"],
+                    "reason": "api",
+                    "action": "clear"
+                })
+            # send notification if enabled
+            subject = "api clear endpoint"
+            txt = "api clear endpoint [fabric: %s, %s, addr: %s]" % (
+                self.fabric,
+                self.events[0]["vnid_name"] if len(self.events)>0 else "vnid:%d" % self.vnid,
+                self.addr
+            )
+            worker_fabric.send_notification("clear", subject, txt)
+        worker_fabric.close()
         return jsonify({
             "success": len(error_rows)==0, 
-            "error": ". ".join(error_rows)
+            "error": ". ".join(error_rows),
+            "nodes": node_results,
         })
 
     @api_route(path="hash", methods=["POST"], swag_ret=["hash", "worker_index"])
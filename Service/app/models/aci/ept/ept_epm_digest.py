@@ -0,0 +1,168 @@
+
+from ...rest import Rest
+from ...rest import api_register
+from pymongo import DeleteOne
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import hashlib
+import logging
+import time
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+@api_register(parent="fabric", path="ept/digest")
+class eptEpmDigest(Rest):
+    """ digest of each epm record (epmMacEp, epmIpEp, and epmRsMacEpToIpEpAtt) processed during the
+        initial endpoint db build. On subscriber restart, records with an unchanged digest can be
+        skipped as the workers have already analyzed them. Digests of changed records are staged
+        during the build and only committed after all workers have acked the epm EOF so the table
+        never gets ahead of eptHistory.
+    """
+    logger = logger
+
+    # max number of write operations per bulk_write on stage/commit
+    COMMIT_BATCH_SIZE = 10000
+    # max number of records per digest lookup during the build
+    LOOKUP_BATCH_SIZE = 1000
+
+    META_ACCESS = {
+        "create": False,
+        "read": True,
+        "update": False,
+        "delete": False,
+        "doc_enable": False,
+        "db_index_unique": True,
+        "db_index": ["fabric", "name"],             # fabric+name(dn) is unique
+        "db_index2": ["fabric", "classname"],       # second index for load of each class
+    }
+
+    META = {
+        "name": {
+            "type": str,
+            "key": True,
+            "key_sn": "dn",
+            "description": "name(dn) of the epm record",
+        },
+        "classname": {
+            "type": str,
+            "description": "epm classname for this record",
+            "values": ["epmMacEp", "epmIpEp", "epmRsMacEpToIpEpAtt"],
+        },
+        "node": {
+            "type": int,
+            "description": "node id of the epm record",
+        },
+        "vnid": {
+            "type": int,
+            "description": "vnid of the endpoint (matches eptHistory vnid)",
+        },
+        "addr": {
+            "type": str,
+            "description": "addr of the endpoint (matches eptHistory addr)",
+        },
+        "digest": {
+            "type": str,
+            "description": "digest of modTs and key attributes of the epm record",
+        },
+        "pending": {
+            "type": str,
+            "description": "digest staged during the build, applied to digest on commit",
+        },
+        "ts": {
+            "type": float,
+            "description": "epoch timestamp the digest was committed",
+        },
+    }
+
+    @staticmethod
+    def get_digest(attr):
+        """ return digest string for epm record attributes """
+        return hashlib.md5("%s|%s|%s|%s|%s" % (
+            attr.get("modTs", ""),
+            attr.get("flags", ""),
+            attr.get("ifId", ""),
+            attr.get("pcTag", ""),
+            attr.get("status", ""),
+        )).hexdigest()[0:16]
+
+    @classmethod
+    def get_digests(cls, db, fabric, names):
+        """ return dict of name(dn) to committed digest for provided list of names """
+        digests = {}
+        flt = {"fabric": fabric, "name": {"$in": names}, "digest": {"$exists": True}}
+        for obj in db[cls._classname].find(flt, {"_id": 0, "name": 1, "digest": 1}):
+            digests[obj["name"]] = obj["digest"]
+        return digests
+
+    @classmethod
+    def stage(cls, db, fabric, updates):
+        """ stage digests of changed records during the build. updates is a dict of name(dn) to 
+            tuple (classname, node, vnid, addr, digest). Staged digests are saved as pending and
+            are not returned by get_digests until commit.
+            return bool success
+        """
+        ops = []
+        for name in updates:
+            (classname, node, vnid, addr, digest) = updates[name]
+            ops.append(UpdateOne({"fabric": fabric, "name": name}, {"$set": {
+                "classname": classname,
+                "node": node,
+                "vnid": vnid,
+                "addr": addr,
+                "pending": digest,
+            }}, upsert=True))
+        try:
+            for i in xrange(0, len(ops), cls.COMMIT_BATCH_SIZE):
+                db[cls._classname].bulk_write(ops[i:i+cls.COMMIT_BATCH_SIZE], ordered=False)
+        except BulkWriteError as be:
+            logger.warn("%s bulkwrite error: %s", cls._classname, be.details)
+            return False
+        return True
+
+    @classmethod
+    def clear_pending(cls, db, fabric):
+        """ discard digests staged by a build that was not committed """
+        collection = db[cls._classname]
+        collection.delete_many({"fabric": fabric, "digest": {"$exists": False}})
+        collection.update_many({"fabric": fabric, "pending": {"$exists": True}}, 
+                                {"$unset": {"pending": ""}})
+
+    @classmethod
+    def commit(cls, db, fabric, seen):
+        """ commit digests staged during the build for fabric and delete digests of records no 
+            longer present. seen is an EndpointPresence with (classname, 0, name) of each record
+            returned by the build. Digests are streamed from the db and written in bulks of 
+            COMMIT_BATCH_SIZE so memory is bounded regardless of the number of records.
+            return bool success
+        """
+        ts = time.time()
+        collection = db[cls._classname]
+        ops = []
+        update_count = 0
+        delete_count = 0
+        try:
+            flt = {"fabric": fabric}
+            for obj in collection.find(flt, {"_id": 0, "name": 1, "classname": 1, "pending": 1}):
+                if not seen.contains(obj.get("classname", ""), 0, obj["name"]):
+                    ops.append(DeleteOne({"fabric": fabric, "name": obj["name"]}))
+                    delete_count+= 1
+                elif obj.get("pending", None) is not None:
+                    ops.append(UpdateOne({"fabric": fabric, "name": obj["name"]}, {
+                        "$set": {"digest": obj["pending"], "ts": ts},
+                        "$unset": {"pending": ""},
+                    }))
+                    update_count+= 1
+                if len(ops) >= cls.COMMIT_BATCH_SIZE:
+                    collection.bulk_write(ops, ordered=False)
+                    ops = []
+            if len(ops) > 0:
+                collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as be:
+            logger.warn("%s bulkwrite error: %s", cls._classname, be.details)
+            return False
+        logger.debug("%s committed %s updates and %s deletes for fabric %s in %0.3f",
+            cls._classname, update_count, delete_count, fabric, time.time() - ts)
+        return True
+
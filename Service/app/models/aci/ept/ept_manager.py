@@ -7,6 +7,12 @@ from .. utils import register_signal_handlers
 from .. utils import terminate_process
 from . common import HELLO_INTERVAL
 from . common import HELLO_TIMEOUT
+from . common import LIVE_REBALANCE_ROLES
+from . common import MAX_SEND_MSG_LENGTH
+from . common import REBALANCE_ACK_TIMEOUT
+from . common import REBALANCE_RETRY_INTERVAL
+from . common import REBALANCE_SKIP_WORK_TYPES
+from . common import MANAGER_DISPATCH_CHANNEL
 from . common import WATCHER_BROADCAST_CHANNEL
 from . common import WORKER_BROADCAST_CHANNEL
 from . common import MANAGER_CTRL_CHANNEL
@@ -19,6 +25,9 @@ from . common import WORKER_UPDATE_INTERVAL
 from . common import BackgroundThread
 from . common import db_alive
 from . common import flush_queue
+from . common import get_dispatch_queue
+from . common import get_dispatch_queue_name
+from . common import get_dispatcher_count
 from . common import get_msg_hash
 from . common import get_queue_length
 from . common import log_version
@@ -29,9 +38,15 @@ from . ept_msg import WORK_TYPE
 from . ept_msg import eptMsg
 from . ept_msg import eptMsgBulk
 from . ept_msg import eptMsgHello
+from . ept_msg import eptMsgWork
+from . ept_dispatcher import TrackedWorker
+from . ept_dispatcher import WorkerDispatch
+from . ept_dispatcher import allocate_seq
+from . ept_dispatcher import eptDispatcher
 from . ept_queue_stats import eptQueueStats
 from . ept_subscriber import eptSubscriber
 from multiprocessing import Process
+from redis import WatchError
 
 import logging
 import re
@@ -43,6 +58,81 @@ import traceback
 # module level logging
 logger = logging.getLogger(__name__)
 
+def split_rebalance_frames(frames, worker, retired, get_owner):
+    """ split raw frames read from a worker queue during rebalance into the frames that remain on
+        the queue and the msgs that move to a different worker. get_owner returns the worker that
+        currently owns a work msg. Msgs that are not assigned by hash (non-work msgs and 
+        REBALANCE_SKIP_WORK_TYPES) stay on an active worker queue and are forwarded to all workers
+        of the role when read from a retired worker queue.
+        Return tuple (keep, moved) where keep is list of raw frames and moved is list of tuples
+        (owner, msg) in queue order with owner of None for msgs forwarded to all workers.
+    """
+    keep = []
+    moved = []
+    for data in frames:
+        try:
+            msg = eptMsg.parse(data)
+        except Exception as e:
+            logger.debug("failed to parse message from worker %s, data: %s", worker, data)
+            if not retired:
+                keep.append(data)
+            continue
+        msgs = msg.msgs if msg.msg_type == MSG_TYPE.BULK else [msg]
+        remaining = []
+        for m in msgs:
+            if m.msg_type != MSG_TYPE.WORK or m.wt in REBALANCE_SKIP_WORK_TYPES:
+                if retired:
+                    moved.append((None, m))
+                else:
+                    remaining.append(m)
+                continue
+            owner = get_owner(m)
+            if owner is worker:
+                remaining.append(m)
+            elif owner is None:
+                logger.debug("discarding msg from worker %s, no owner available: %s", worker, m)
+            else:
+                moved.append((owner, m))
+        if len(remaining) == len(msgs):
+            keep.append(data)
+        elif len(remaining) > 0:
+            bulk = eptMsgBulk()
+            bulk.msgs = remaining
+            keep.append(bulk.pack(worker.wire_version))
+    return (keep, moved)
+
+def migrate_queue(redis, worker, qnum, retired, get_owner):
+    """ remove msgs for moved keys from a worker queue (or all msgs from a retired worker queue) 
+        and return list of tuples (owner, msg) as returned by split_rebalance_frames. The queue is
+        read and rewritten in a single transaction watching the queue so any frame popped by the
+        worker (or pushed by a sender) between the read and the write triggers a retry, frames are
+        never lost or repeated.
+    """
+    q = worker.queues[qnum]
+    with worker.queue_locks[qnum]:
+        while True:
+            pl = redis.pipeline()
+            try:
+                pl.watch(q)
+                frames = pl.lrange(q, 0, -1)
+                (keep, moved) = split_rebalance_frames(frames, worker, retired, get_owner)
+                if len(moved) == 0 and not retired:
+                    return moved
+                # replace frames read from the queue with remaining frames
+                pl.multi()
+                if retired:
+                    pl.delete(q)
+                else:
+                    pl.ltrim(q, len(frames), -1)
+                    if len(keep) > 0:
+                        pl.lpush(q, *reversed(keep))
+                pl.execute()
+                return moved
+            except WatchError as e:
+                logger.debug("queue %s modified during migrate, retrying", q)
+            finally:
+                pl.reset()
+
 class eptManager(object):
     
     # list of required roles that need to register before manager is ready to accept work
@@ -58,6 +148,7 @@ class eptManager(object):
         self.db = get_db(uniq=True, overwrite_global=True, write_concern=True)
         self.redis = get_redis()
         self.fabrics = {}               # running fabrics indexed by fabric name
+        self.dispatchers = []           # dispatcher processes when MANAGER_DISPATCHER_COUNT is set
         self.subscribe_thread = None
         self.stats_thread = None
         self.worker_tracker = None
@@ -107,6 +198,9 @@ class eptManager(object):
         for f, fab in self.fabrics.items():
             if fab["process"] is not None:
                 terminate_process(fab["process"])
+        for d in self.dispatchers:
+            if d["process"] is not None:
+                terminate_process(d["process"])
         if self.db is not None:
             self.db.client.close()
         if self.redis is not None and self.redis.connection_pool is not None:
@@ -158,6 +252,11 @@ class eptManager(object):
         while not self.minimum_workers_ready():
             time.sleep(HELLO_INTERVAL)
 
+        # start dispatchers (if enabled) with current worker table
+        for i in xrange(0, get_dispatcher_count()):
+            self.dispatchers.append({"index": i, "process": None})
+        self.check_dispatcher_processes()
+
         # start all fabrics with auto_start enabled
         for f in Fabric.find(auto_start=True):
             self.start_fabric(f.fabric, reason="manager process start", skip_suppress=True)
@@ -166,38 +265,7 @@ class eptManager(object):
         # watch for work that needs to be dispatched to available workers
         while True:
             (q, data) = self.redis.blpop(MANAGER_WORK_QUEUE)
-            # to support msg type BULK, assume an array of messages received
-            msg_list = []
-            try:
-                omsg = eptMsg.parse(data) 
-                #logger.debug("[%s] msg on q(%s): %s", self, q, omsg)
-                if omsg.msg_type == MSG_TYPE.BULK:
-                    msg_list = omsg.msgs
-                elif omsg.msg_type == MSG_TYPE.WORK:
-                    msg_list = [omsg]
-                else:
-                    logger.warn("[%s] unexpected messaged received on queue %s: %s", self, q, msg)
-
-                bulk = []   # list of (hash, msg) to execute against send_bulk
-                for msg in msg_list:
-                    # expected only eptWork received on this queue
-                    if q == MANAGER_WORK_QUEUE and msg.msg_type == MSG_TYPE.WORK:
-                        self.increment_stats(MANAGER_WORK_QUEUE, tx=False)
-                        if msg.addr == 0:
-                            # an addr of 0 is a broadcast to all workers of specified role.
-                            # Send broadcast now, not within a batch.
-                            # Note, broadcast may be out of order if received in BULK with ucast msg
-                            self.worker_tracker.broadcast(msg) 
-                        else:
-                            # create hash based on address and send to specific worker
-                            bulk.append((get_msg_hash(msg), msg))
-                if len(bulk) > 0:
-                    if not self.worker_tracker.send_bulk(bulk):
-                        logger.warn("[%s] failed to enqueue one or more messages", self)
-
-            except Exception as e:
-                logger.debug("failed to parse message from q: %s, data: %s", q, data)
-                logger.error("Traceback:\n%s", traceback.format_exc())
+            self.worker_tracker.dispatch(q, data)
 
     def handle_channel_msg(self, msg):
         """ handle msg received on subscribed channels """
@@ -254,10 +322,12 @@ class eptManager(object):
         elif msg.msg_type == MSG_TYPE.GET_WORKER_HASH:
             # requires addr field only and returns hash, index, and selected worker
             if "addr" in msg.data:
+                worker = None
+                _hash = sum(ord(i) for i in msg.data["addr"])
                 if "worker" in self.worker_tracker.active_workers:
-                    _hash = sum(ord(i) for i in msg.data["addr"])
-                    index = _hash % len(self.worker_tracker.active_workers["worker"])
-                    worker = self.worker_tracker.active_workers["worker"][index]
+                    worker = self.worker_tracker.get_worker("worker", _hash)
+                if worker is not None:
+                    index = self.worker_tracker.active_workers["worker"].index(worker)
                     data = {
                         "addr": msg.data["addr"],
                         "hash": _hash,
@@ -269,6 +339,10 @@ class eptManager(object):
                     self.increment_stats(MANAGER_CTRL_RESPONSE_CHANNEL, tx=True)
             else:
                 logger.warn("worker hash request with no address field")
+
+        elif msg.msg_type == MSG_TYPE.REBALANCE_ACK:
+            self.worker_tracker.handle_rebalance_ack(msg)
+
         else:
             logger.debug("ignoring msg type received on manager ctrl: %s", msg.msg_type)
 
@@ -276,12 +350,14 @@ class eptManager(object):
         # get manager status in background thread and publish result on ctrl response channel
         try:
             start_ts = time.time()
+            queues = [MANAGER_WORK_QUEUE] + [get_dispatch_queue_name(d["index"]) 
+                                                for d in self.dispatchers]
             data = {
                 "manager": {
                     "status": "running" if self.minimum_workers_ready() else "starting",
                     "manager_id": self.worker_id,
-                    "queues": [MANAGER_WORK_QUEUE],
-                    "queue_len":[get_queue_length(self.redis,MANAGER_WORK_QUEUE,accurate=not brief)],
+                    "queues": queues,
+                    "queue_len":[get_queue_length(self.redis, q, accurate=not brief) for q in queues],
                 },
                 "workers": self.worker_tracker.get_worker_status(brief=brief),
                 "fabrics": [{
@@ -327,6 +403,30 @@ class eptManager(object):
             logger.debug("[%s] failed to get manager status", self)
             logger.error("Traceback:\n%s", traceback.format_exc())
 
+    def get_producer_ids(self):
+        """ return list of ids for running subscribers (fabric name) and dispatchers that enqueue
+            work on worker queues
+        """
+        ids = [f for f, fab in self.fabrics.items() 
+                if fab["process"] is not None and fab["process"].is_alive()]
+        ids+= ["%s-d%s" % (self.worker_id, d["index"]) for d in self.dispatchers 
+                if d["process"] is not None and d["process"].is_alive()]
+        return ids
+
+    def check_dispatcher_processes(self):
+        # start any dispatcher process that is not running. Dispatchers have no state other than
+        # the worker table so they can be restarted without impacting the fabric monitors.
+        for d in self.dispatchers:
+            if d["process"] is None or not d["process"].is_alive():
+                if d["process"] is not None:
+                    logger.warn("dispatcher %s no longer alive, restarting", d["index"])
+                disp = eptDispatcher(self.worker_id, d["index"], 
+                                    worker_table=self.worker_tracker.get_worker_table())
+                d["process"] = Process(target=disp.run)
+                d["process"].daemon = True
+                d["process"].start()
+                logger.debug("started dispatcher %s with pid: %s", d["index"], d["process"].pid)
+
     def minimum_workers_ready(self):
         # return true if worker is ready for each required role.
         for role in eptManager.REQUIRED_ROLES:
@@ -369,7 +469,7 @@ class eptManager(object):
                     return False
 
                 f.add_fabric_event("starting", reason)
-                sub = eptSubscriber(f, active_workers=self.worker_tracker.active_workers)
+                sub = eptSubscriber(f, worker_table=self.worker_tracker.get_worker_table())
                 self.fabrics[fabric]["subscriber"] = sub
                 self.fabrics[fabric]["process"] = Process(target=sub.run)
                 self.fabrics[fabric]["process"].daemon = True
@@ -509,16 +609,25 @@ class eptManager(object):
             with self.queue_stats_lock:
                 q.collect(qlen = self.redis.llen(k))
         
-class WorkerTracker(object):
+class WorkerTracker(WorkerDispatch):
     # track list of active workers 
     def __init__(self, manager=None):
+        super(WorkerTracker, self).__init__(manager.redis, manager.increment_stats)
         self.manager = manager
-        self.redis = self.manager.redis
         self.known_subscribers = {} # indexed by fabric-id
         self.known_workers = {}     # indexed by worker_id
-        self.active_workers = {}    # list of active workers indexed by role
-        self.watcher_broadcast_seq = 0
-        self.worker_broadcast_seq = 0
+        self.retired_workers = []   # removed workers with pending work to be migrated
+        self.rebalance_roles = set()# roles pending rebalance
+        self.rebalance_thread = None
+        self.rebalance_lock = threading.Lock()
+        self.rebalance_acks = {}    # set of acked ids indexed by (phase, version)
+        self.rebalance_cond = threading.Condition()
+        # snapshot of worker table (TrackedWorker json) matching current rings. hold is set while
+        # work is being migrated and the version is incremented for each rebalance
+        self.table_lock = threading.RLock()
+        self.table_workers = []
+        self.table_version = 0
+        self.table_hold = False
         self.update_interval = WORKER_UPDATE_INTERVAL # interval to check for new/expired workers
         self.update_thread = BackgroundThread(
             func=self.update_active_workers,
@@ -558,6 +667,7 @@ class WorkerTracker(object):
             self.known_workers[hello.worker_id].queues = hello.queues
             self.known_workers[hello.worker_id].last_hello = time.time()
             self.known_workers[hello.worker_id].hello_seq = hello.seq
+            self.known_workers[hello.worker_id].wire_version = hello.wire_version
             for q in hello.queues:
                 self.known_workers[hello.worker_id].last_seq.append(0)
                 self.known_workers[hello.worker_id].last_head.append(0)
@@ -573,6 +683,8 @@ class WorkerTracker(object):
                     hello.worker_id, self.update_interval)
         else:
             self.known_workers[hello.worker_id].last_hello = time.time()
+        self.known_workers[hello.worker_id].cache_budget = hello.cache_budget
+        self.known_workers[hello.worker_id].cache_usage = hello.cache_usage
 
     def update_active_workers(self):
         # at a regular interval, check for new workers to add to active worker queue along with
@@ -588,15 +700,16 @@ class WorkerTracker(object):
                 logger.warn("worker timeout (last hello: %.3f) %s",ts-w.last_hello, w)
                 remove_workers.append(w)
             elif not w.active:
-                # new worker that needs to be added to active list
-                if w.role not in self.active_workers: 
-                    self.active_workers[w.role] = []
-                self.active_workers[w.role].append(w)
+                # new worker that needs to be added to active list. active_workers is only updated
+                # with rebalance_lock so the rebalance thread has a consistent snapshot
+                with self.rebalance_lock:
+                    if w.role not in self.active_workers: 
+                        self.active_workers[w.role] = []
+                    # sort active workers by worker_id for deterministic ordering
+                    self.active_workers[w.role] = sorted(self.active_workers[w.role] + [w], 
+                                                key=lambda w: int(re.sub("[^0-9]","",w.worker_id)))
                 w.active = True
                 new_workers.append(w)
-                # sort active workers by worker_id for deterministic ordering
-                self.active_workers[w.role] = sorted(self.active_workers[w.role], 
-                                                key=lambda w: int(re.sub("[^0-9]","",w.worker_id)))
                 logger.info("new worker: %s, active_workers: [%s]", w, 
                                     ",".join([sw.worker_id for sw in self.active_workers[w.role]]))
 
@@ -618,18 +731,32 @@ class WorkerTracker(object):
         for w in remove_workers:
             logger.debug("removing worker from known_workers: %s", w)
             self.known_workers.pop(w.worker_id, None)
-            if w.role in self.active_workers and w in self.active_workers[w.role]:
-                logger.debug("removing worker from active_workers[%s]: %s", w.role, w)
-                self.active_workers[w.role].remove(w)
+            with self.rebalance_lock:
+                if w.role in self.active_workers and w in self.active_workers[w.role]:
+                    logger.debug("removing worker from active_workers[%s]: %s", w.role, w)
+                    self.active_workers[w.role] = [aw for aw in self.active_workers[w.role] 
+                                                    if aw is not w]
+                if w.role in LIVE_REBALANCE_ROLES:
+                    # pending work is migrated to new owners during rebalance
+                    self.retired_workers.append(w)
+            if w.role not in LIVE_REBALANCE_ROLES:
+                for i, q in enumerate(w.queues):
+                    logger.debug("deleting work from queue: %s", q)
+                    with w.queue_locks[i]:
+                        self.redis.delete(q)
 
-            # TODO, rebalance work for this worker to a new worker - for now flush and restart
-            for i, q in enumerate(w.queues):
-                logger.debug("deleting work from queue: %s", q)
-                with w.queue_locks[i]:
-                    self.redis.delete(q)
+        # update hash rings and sync worker table to dispatchers and subscribers. Workers with
+        # role in LIVE_REBALANCE_ROLES require pending work for keys that moved to a different 
+        # worker to be migrated which is executed in a background rebalance thread.
+        changed_roles = set([w.role for w in new_workers + remove_workers])
+        if len(changed_roles) > 0:
+            self.start_rebalance(changed_roles)
 
-        # if a worker has died or new worker comes online, then trigger monitor restart
+        # if a worker without live rebalance support has died or new worker comes online, then 
+        # trigger monitor restart
         stop_message = None
+        new_workers = [w for w in new_workers if w.role not in LIVE_REBALANCE_ROLES]
+        remove_workers = [w for w in remove_workers if w.role not in LIVE_REBALANCE_ROLES]
         if len(new_workers)>0: 
             stop_message = "[%s]" % ", ".join([w.worker_id for w in new_workers])
             stop_message = "new worker detected %s" % stop_message
@@ -650,88 +777,213 @@ class WorkerTracker(object):
                 # set to inactive
                 s.active = False
 
+        # publish worker table at each interval so restarted dispatchers/subscribers are synced
+        self.publish_worker_table()
+        if len(self.manager.dispatchers) > 0:
+            self.manager.check_dispatcher_processes()
+
         # trigger manager fabric processes check
         self.manager.check_fabric_processes()
 
-    def send_bulk(self, msgs):
-        """ receive list of tuples (_hash, msg) and enqueue to an available worker. 
-            Each msg in bulk list must be of type eptMsgWork.  This will create sub bulk messages to
-            reduce the blocking IO for redis calls.
-            return boolean success
+    def rebuild_rings(self):
+        """ rebuild hash rings and worker table snapshot from current active workers """
+        with self.table_lock:
+            super(WorkerTracker, self).rebuild_rings()
+            workers = []
+            for role in self.active_workers:
+                workers+= [w.to_json() for w in self.active_workers[role]]
+            self.table_workers = workers
+
+    def get_worker_table(self):
+        """ return worker table published to dispatchers and subscribers """
+        with self.table_lock:
+            return {
+                "workers": self.table_workers,
+                "version": self.table_version,
+                "hold": self.table_hold,
+            }
+
+    def publish_worker_table(self):
+        """ publish active worker table to all dispatchers and subscribers """
+        with self.table_lock:
+            msg = eptMsg(MSG_TYPE.WORKER_TABLE, data=self.get_worker_table())
+            self.redis.publish(MANAGER_DISPATCH_CHANNEL, msg.jsonify())
+
+    def handle_rebalance_ack(self, msg):
+        """ track REBALANCE_ACK from workers, dispatchers, and subscribers """
+        key = (msg.data.get("phase", ""), msg.data.get("version", 0))
+        with self.rebalance_cond:
+            if key not in self.rebalance_acks:
+                self.rebalance_acks[key] = set()
+            self.rebalance_acks[key].add(msg.data.get("id", ""))
+            self.rebalance_cond.notify_all()
+
+    def wait_rebalance_acks(self, phase, version, ids, timeout=REBALANCE_ACK_TIMEOUT):
+        """ wait for REBALANCE_ACK from each id for provided phase and version. Return boolean 
+            success, False if timeout is reached before all acks are received
         """
-        all_success = True
-        work = {}   # dict indexed by worker_id and qnum with a tuple (worker, eptMsgBulk)
-        for (_hash, msg) in msgs:
-            if msg.role not in self.active_workers or len(self.active_workers[msg.role]) == 0:
-                logger.warn("no available workers for role '%s'", msg.role)
-                all_success = False
-            else:
-                index = _hash % len(self.active_workers[msg.role])
-                worker = self.active_workers[msg.role][index]
-                if msg.qnum >= len(worker.queues):
-                    logger.warn("unable to enqueue work on worker %s, queue %s does not exist", 
-                        worker.worker_id, msg.qnum)
-                    all_success = False
-                else:
-                    if worker.worker_id not in work:
-                        work[worker.worker_id] = {}
-                    if msg.qnum not in work[worker.worker_id]:
-                        work[worker.worker_id][msg.qnum] = (worker, eptMsgBulk())
-                    work[worker.worker_id][msg.qnum][1].msgs.append(msg)
-                    with worker.queue_locks[msg.qnum]:
-                        worker.last_seq[msg.qnum]+= 1
-                        msg.seq = worker.last_seq[msg.qnum]
-                        self.manager.increment_stats(worker.queues[msg.qnum], tx=True)
-
-        # send each message
-        for worker_id in work:
-            for qnum in work[worker_id]:
-                (worker, tx_msg) = work[worker_id][qnum]
-                # if there's only one message, then send that single message instead of bulk format
-                if len(tx_msg.msgs) == 1:
-                    tx_msg = tx_msg.msgs[0]
-                else:
-                    tx_msg.seq = tx_msg.msgs[-1].seq
-                with worker.queue_locks[qnum]:
-                    try:
-                        #logger.debug("enqueue %s: %s", worker.queues[qnum], tx_msg)
-                        self.redis.rpush(worker.queues[qnum], tx_msg.jsonify())
-                    except Exception as e:
-                        logger.error("failed to enqueue msg on queue %s: %s", worker.queues[qnum], 
-                                        tx_msg)
-                        all_success = False
-        return all_success
-
-    def broadcast(self, msg):
-        """ broadcast single message. Broadcast moved to pub/sub mechanism so simply need
-            to publish the original message onto broadcast channel. msg must be of type eptMsgWork
-            or child with role attribute to determine appropriate channel. If role is None or not
-            present then msg is broadcast to all channels
-            Note, broadcast does not currently use eptMsgBulk (no use case at this time...)
+        key = (phase, version)
+        end_ts = time.time() + timeout
+        with self.rebalance_cond:
+            try:
+                while True:
+                    pending = set(ids) - self.rebalance_acks.get(key, set())
+                    if len(pending) == 0:
+                        return True
+                    remaining = end_ts - time.time()
+                    if remaining <= 0:
+                        logger.warn("timeout waiting for rebalance %s ack from: [%s]", phase,
+                                    ",".join(sorted(pending)))
+                        return False
+                    self.rebalance_cond.wait(remaining)
+            finally:
+                # acks for this or any previous version are no longer needed
+                for k in self.rebalance_acks.keys():
+                    if k[1] <= version:
+                        self.rebalance_acks.pop(k, None)
+
+    def start_rebalance(self, roles):
+        """ update worker table for roles with a new or removed worker. If any role supports live
+            rebalance or a rebalance is in progress, then the update is queued to the rebalance
+            thread. Else, the hash rings are rebuilt and worker table is published immediately.
         """
-        all_channels = [ WORKER_BROADCAST_CHANNEL, WATCHER_BROADCAST_CHANNEL]
-        if not isinstance(msg, list):
-            msg = [msg]
-        for m in msg:
-            role = getattr(m, "role", None)
-            if role == "watcher":
-                channels = [ WATCHER_BROADCAST_CHANNEL ]
-                self.watcher_broadcast_seq+=1
-                seq = [self.watcher_broadcast_seq]
-            elif role == "worker":
-                channels = [ WORKER_BROADCAST_CHANNEL ] 
-                self.worker_broadcast_seq+=1
-                seq = [self.worker_broadcast_seq ]
-            else:
-                channels = all_channels
-                self.watcher_broadcast_seq+=1
-                self.worker_broadcast_seq+=1
-                seq = [self.worker_broadcast_seq, self.watcher_broadcast_seq]
-            for i, channel in enumerate(channels):
-                m.seq = seq[i]
-                logger.debug("broadcast [q:%s] msg: %s", channel, m)
-                self.redis.publish(channel, m.jsonify())
-                self.manager.increment_stats(channel, tx=True)
+        with self.rebalance_lock:
+            if self.rebalance_thread is None and \
+                len([r for r in roles if r in LIVE_REBALANCE_ROLES]) == 0:
+                self.rebuild_rings()
+                self.publish_worker_table()
+                return
+            self.rebalance_roles.update(roles)
+            if self.rebalance_thread is None:
+                self.rebalance_thread = threading.Thread(target=self.run_rebalance, 
+                                                        name="mgr-rebalance")
+                self.rebalance_thread.daemon = True
+                self.rebalance_thread.start()
+
+    def run_rebalance(self):
+        """ execute rebalance for queued roles until no further roles are pending """
+        while True:
+            with self.rebalance_lock:
+                roles = self.rebalance_roles
+                self.rebalance_roles = set()
+                if len(roles) == 0:
+                    self.rebalance_thread = None
+                    return
+            try:
+                if not self.rebalance(roles):
+                    # retry with any roles queued in the meantime after the retry interval
+                    with self.rebalance_lock:
+                        self.rebalance_roles.update(roles)
+                    time.sleep(REBALANCE_RETRY_INTERVAL)
+            except Exception as e:
+                logger.error("Traceback:\n%s", traceback.format_exc())
+
+    def rebalance(self, roles):
+        """ apply current active workers for provided roles to the worker table and migrate pending
+            work for each key that has moved to a different worker. 
+                1) all workers of the role are paused. Each worker completes work in progress, saves
+                   and releases cached endpoint state, and acks the pause.
+                2) dispatchers and subscribers (and the manager dispatch) are held. Each completes
+                   sends in progress and acks the hold. No work is enqueued while held.
+                3) hash rings are rebuilt and msgs for moved keys are removed from the previous 
+                   owner's queue and appended to the new owner's queue in their original order.
+                   Since all work for the key is still in the previous owner's queue, the migrated
+                   msgs are always ahead of work sent with the new worker table.
+                4) new worker table is published which releases the hold and workers are resumed.
+            If any ack is not received within REBALANCE_ACK_TIMEOUT then the rebalance is aborted 
+            and the workers are resumed with the previous worker table. Return boolean success, 
+            False if the rebalance was aborted and needs to be retried.
+        """
+        live_roles = [r for r in roles if r in LIVE_REBALANCE_ROLES]
+        if len(live_roles) == 0:
+            with self.rebalance_lock:
+                self.rebuild_rings()
+            self.publish_worker_table()
+            return True
+        with self.table_lock:
+            self.table_version+= 1
+            version = self.table_version
+        logger.debug("rebalance version %s for roles: %s", version, live_roles)
+        with self.rebalance_lock:
+            paused = dict([(r, list(self.active_workers.get(r, []))) for r in live_roles])
+        try:
+            ids = []
+            for role in live_roles:
+                ids+= [w.worker_id for w in paused[role]]
+                data = {"phase": "pause", "version": version}
+                self.broadcast(eptMsgWork(0, role, data, WORK_TYPE.WORKER_REBALANCE, fabric=""))
+            if not self.wait_rebalance_acks("pause", version, ids):
+                logger.warn("rebalance version %s aborted, workers not paused", version)
+                return False
+            with self.table_lock:
+                self.table_hold = True
+                self.publish_worker_table()
+            if not self.fence.hold():
+                logger.warn("rebalance version %s aborted, manager dispatch in progress", version)
+                return False
+            if not self.wait_rebalance_acks("hold", version, self.manager.get_producer_ids()):
+                logger.warn("rebalance version %s aborted, senders not held", version)
+                return False
+            # rings and the workers used to migrate each role are built from the same snapshot
+            with self.rebalance_lock:
+                self.rebuild_rings()
+                workers = dict([(r, list(self.active_workers.get(r, []))) for r in live_roles])
+                retired = [w for w in self.retired_workers if w.role in live_roles]
+                self.retired_workers = [w for w in self.retired_workers if w.role not in live_roles]
+            for role in live_roles:
+                self.migrate(role, workers[role], [w for w in retired if w.role == role])
+            return True
+        finally:
+            with self.table_lock:
+                self.table_hold = False
+                self.publish_worker_table()
+            self.fence.release()
+            for role in live_roles:
+                data = {"phase": "resume", "version": version}
+                self.broadcast(eptMsgWork(0, role, data, WORK_TYPE.WORKER_REBALANCE, fabric=""))
+
+    def migrate(self, role, workers, retired):
+        """ move pending msgs for keys owned by a different worker to the new owner. This includes
+            all work on retired worker queues where msgs not assigned by hash (such as epm eof) are
+            forwarded to all active workers of the role. Must only be executed while workers and
+            dispatchers are paused/held, each queue is still rewritten atomically in case a worker
+            resumes on its own after REBALANCE_PAUSE_TIMEOUT.
+        """
+        workers = [w for w in workers if w not in retired]
+        get_owner = lambda m: self.get_worker(role, get_msg_hash(m))
+        moved = {}  # dict indexed by worker_id and qnum with tuple (worker, list of msgs)
+        moved_count = 0
+        for w in workers + retired:
+            is_retired = w in retired
+            for qnum, q in enumerate(w.queues):
+                msgs = migrate_queue(self.redis, w, qnum, is_retired, get_owner)
+                for (owner, m) in msgs:
+                    moved_count+= 1
+                    for o in ([owner] if owner is not None else workers):
+                        oqnum = min(m.qnum, len(o.queues)-1)
+                        if o.worker_id not in moved:
+                            moved[o.worker_id] = {}
+                        if oqnum not in moved[o.worker_id]:
+                            moved[o.worker_id][oqnum] = (o, [])
+                        moved[o.worker_id][oqnum][1].append(m)
+        for worker_id in moved:
+            for qnum in moved[worker_id]:
+                (owner, msgs) = moved[worker_id][qnum]
+                self.push_tail(owner, qnum, msgs)
+        logger.info("rebalance for role %s migrated %s msgs", role, moved_count)
+
+    def push_tail(self, worker, qnum, msgs):
+        """ append list of msgs to tail of worker queue maintaining order of msgs. Each msg is 
+            assigned a new seq on the worker queue
+        """
+        with worker.queue_locks[qnum]:
+            for i in range(0, len(msgs), MAX_SEND_MSG_LENGTH):
+                bulk = eptMsgBulk()
+                bulk.msgs = msgs[i:i+MAX_SEND_MSG_LENGTH]
+                seq = allocate_seq(self.redis, worker, qnum, len(bulk.msgs))
+                for j, m in enumerate(bulk.msgs):
+                    m.seq = seq - len(bulk.msgs) + j + 1
+                self.redis.rpush(worker.queues[qnum], bulk.pack(worker.wire_version))
 
     def flush_queue(self, fabric, q, lock=None):
         """ flush messages for provided fabric and redis queue """
@@ -774,6 +1026,8 @@ class WorkerTracker(object):
         # flush local queues for provided fabric. Note, moved per-worker flush to each worker
         logger.debug("flush fabric '%s'", fabric)
         flush_queue(self.redis, fabric, MANAGER_WORK_QUEUE)
+        if get_dispatcher_count() > 0:
+            flush_queue(self.redis, fabric, get_dispatch_queue(fabric))
 
     def get_worker_status(self, brief=False):
         # return list of dict representation of TrackedWorker objects along with queue_len list 
@@ -785,33 +1039,3 @@ class WorkerTracker(object):
             status.append(js)
         return status
 
-class TrackedWorker(object):
-    """ active worker tracker """
-    def __init__(self, worker_id):
-        self.worker_id = worker_id
-        self.active = False             # set to true when added to active list
-        self.queues = []                # queue names sorted by priority
-        self.queue_locks = []           # list of thread locks per queue
-        self.role = None
-        self.start_time = 0
-        self.hello_seq = 0
-        self.last_hello = 0
-        self.last_seq = []              # last seq enqueued on worker per queue
-        self.last_head = []             # at time of last worker check, seq at head of queue
-        self.last_head_check = 0        # timestamp of last head seq check
-
-    def __repr__(self):
-        return "%s, role:%s, q:%s" % (self.worker_id,self.role,self.queues)
-
-    def to_json(self):
-        return {
-            "worker_id": self.worker_id,
-            "active": self.active,
-            "queues": self.queues,
-            "role": self.role,
-            "start_time": self.start_time,
-            "hello_seq": self.hello_seq,
-            "last_hello": self.last_hello,
-            "last_seq": self.last_seq
-        }
-
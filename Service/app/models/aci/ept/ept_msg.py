@@ -5,6 +5,7 @@ from enum import unique as enum_unique
 import json
 import logging
 import re
+import struct
 import time
 
 # module level logging
@@ -34,6 +35,10 @@ class MSG_TYPE(Enum):
     FABRIC_EPM_EOF_ACK  = "epm_eof_ack"     # sent from worker to subscriber on subscriber channel 
                                             # to indiciate reception/processing of work type
                                             # FABRIC_EPM_EOF.
+    WORKER_TABLE        = "worker_table"    # active worker table published from manager to each
+                                            # dispatcher
+    REBALANCE_ACK       = "rebalance_ack"   # sent from worker, dispatcher, and subscriber to 
+                                            # manager when paused or held for a rebalance
 
 # static work types sent with MSG_TYPE.WORK
 @enum_unique
@@ -57,6 +62,20 @@ class WORK_TYPE(Enum):
                                             # EPM event. In response workers send back 
     FABRIC_WATCH_PAUSE  = "watch_pause"     # sent from subscriber to watcher to pause watch execute
     FABRIC_WATCH_RESUME = "watch_resume"    # sent from subscriber to watcher to resume execute
+    WORKER_REBALANCE    = "worker_rebalance"# broadcast from manager to workers to pause before and
+                                            # resume after work is migrated to a new worker table
+    CACHE_WARMUP        = "cache_warmup"    # broadcast from subscriber to workers after initial
+                                            # build to bulk load fabric caches
+
+# wire format versions advertised by workers within hello. Version 0 is json for all messages. 
+# Version 1 adds a compact binary encoding for eptMsgBulk containing only eptMsgWorkEpmEvent msgs.
+# Binary frames always start with WIRE_MAGIC which is never the first byte of a json message so
+# receivers can auto-detect the encoding of each message.
+WIRE_VERSION_JSON = 0
+WIRE_VERSION_BINARY = 1
+WIRE_VERSION = WIRE_VERSION_BINARY
+WIRE_MAGIC = "\xe5"
+WIRE_NONE = 0xffffffff
 
 class eptMsg(object):
     """ generic ept job for messaging between workers 
@@ -79,16 +98,19 @@ class eptMsg(object):
         return "%s.0x%08x" % (self.msg_type.value, self.seq)
 
     @staticmethod
-    def parse(data, brief=False):
+    def parse(data, brief=False, raw=False):
         # parse data received on message queue and return corresponding eptMsg
         # allow exception to raise on invalid data
+        # raw is only applicable to eptMsgBulk with route info, see eptMsgBulk
+        if isinstance(data, bytes) and data[:1] == WIRE_MAGIC:
+            return wire_unpack_bulk(data, brief=brief)
         js = json.loads(data)
         if js["msg_type"] == MSG_TYPE.WORK.value:
             return eptMsgWork.from_msg_json(js)
         elif js["msg_type"] == MSG_TYPE.HELLO.value:
             return eptMsgHello.from_msg_json(js)
         elif js["msg_type"] == MSG_TYPE.BULK.value:
-            return eptMsgBulk(MSG_TYPE.BULK, js["data"], js["seq"], brief=brief)
+            return eptMsgBulk(MSG_TYPE.BULK, js["data"], js["seq"], brief=brief, raw=raw)
         elif js["msg_type"] == MSG_TYPE.REFRESH_EPT.value:
             return eptMsgSubOp(MSG_TYPE.REFRESH_EPT, js["data"], js["seq"])
         elif js["msg_type"] == MSG_TYPE.DELETE_EPT.value:
@@ -104,16 +126,25 @@ class eptMsg(object):
                 )
 
 class eptMsgBulk(eptMsg):
-    """ list of eptMsg objects that share a common destination and qnum """
-    def __init__(self, msg_type=MSG_TYPE.BULK, data={}, seq=1, brief=False):
+    """ list of eptMsg objects that share a common destination and qnum 
+        A bulk sent to the manager may also include route info which is a list of [hash, role, qnum]
+        for each msg, with hash of None for broadcast msgs. If raw is set and route info is present
+        then msgs are not parsed and the serialized msgs are available in raw_msgs.
+    """
+    def __init__(self, msg_type=MSG_TYPE.BULK, data={}, seq=1, brief=False, raw=False):
         super(eptMsgBulk, self).__init__(msg_type, data, seq)
         self.msg_type = MSG_TYPE.BULK
         self.msgs_count = 0
         self.msgs = []
+        self.raw_msgs = []
+        self.route = None
         # each msg in msgs should be of type eptMsg in jsonify format that needs to be parsed
         if "msgs" in data and len(data["msgs"])>0:
             self.msg_count = len(data["msgs"])
-            if not brief:
+            if raw and "route" in data:
+                self.route = data["route"]
+                self.raw_msgs = data["msgs"]
+            elif not brief:
                 for m in data["msgs"]:
                     self.msgs.append(eptMsg.parse(m))
 
@@ -127,6 +158,45 @@ class eptMsgBulk(eptMsg):
             },
         })
 
+    def jsonify_route(self, route):
+        """ jsonify with route info, a list of [hash, role, qnum] for each msg """
+        return json.dumps({
+            "msg_type": self.msg_type.value,
+            "seq": self.seq,
+            "data": {
+                "msgs": [m.jsonify() for m in self.msgs],
+                "route": route,
+            },
+        })
+
+    @staticmethod
+    def jsonify_raw(raw_msgs, seq):
+        """ jsonify bulk from list of already serialized msgs """
+        return json.dumps({
+            "msg_type": MSG_TYPE.BULK.value,
+            "seq": seq,
+            "data": {
+                "msgs": raw_msgs,
+            },
+        })
+
+    def pack(self, wire_version=WIRE_VERSION_JSON):
+        """ serialize for transport using the highest wire version supported by the receiver. The
+            bulk seq is set to the seq of the last msg. When json is used and there is only a single
+            msg then the msg is sent without the bulk framing.
+        """
+        if len(self.msgs) > 0:
+            self.seq = self.msgs[-1].seq
+        if wire_version >= WIRE_VERSION_BINARY and len(self.msgs) > 0 and \
+            all(isinstance(m, eptMsgWorkEpmEvent) for m in self.msgs):
+            try:
+                return wire_pack_bulk(self.msgs, self.seq)
+            except (ValueError, UnicodeError, struct.error) as e:
+                logger.debug("falling back to json, unable to pack %s: %s", self, e)
+        if len(self.msgs) == 1:
+            return self.msgs[0].jsonify()
+        return self.jsonify()
+
     def __repr__(self):
         return "%s.0x%08x msgs:%s" % (self.msg_type.value, self.seq, len(self.msgs))
 
@@ -169,13 +239,17 @@ class eptMsgSubOp(eptMsg):
 class eptMsgHello(object):
     """ hello message sent from worker to manager """
 
-    def __init__(self, worker_id, role, queues, start_time, seq=1):
+    def __init__(self, worker_id, role, queues, start_time, seq=1, wire_version=WIRE_VERSION_JSON,
+                    cache_budget=0, cache_usage=0):
         self.msg_type = MSG_TYPE.HELLO
         self.worker_id = worker_id
         self.role = role
         self.queues = queues            # list of queue names sorted by priority        
         self.start_time = start_time
         self.seq = seq
+        self.wire_version = wire_version    # highest wire version supported by worker
+        self.cache_budget = cache_budget    # cache memory budget in bytes (0 for fixed cache sizes)
+        self.cache_usage = cache_usage      # estimated bytes used by caches of all fabrics
 
     def __repr__(self):
         return "[%s] %s.0x%08x %s" % (self.worker_id, self.msg_type.value, self.seq, self.role)
@@ -190,12 +264,16 @@ class eptMsgHello(object):
                 "role": self.role,
                 "queues": self.queues, 
                 "start_time": self.start_time,
+                "wire_version": self.wire_version,
+                "cache_budget": self.cache_budget,
+                "cache_usage": self.cache_usage,
             },
         })
 
     @staticmethod
     def from_msg_json(js):
         # return eptMsgHello object from received msg js
+        # older workers do not include wire_version and only support json
         hello_data = js["data"]
         return eptMsgHello(
             hello_data["worker_id"],
@@ -203,6 +281,9 @@ class eptMsgHello(object):
             hello_data["queues"],
             hello_data["start_time"],
             seq = js["seq"],
+            wire_version = hello_data.get("wire_version", WIRE_VERSION_JSON),
+            cache_budget = hello_data.get("cache_budget", 0),
+            cache_usage = hello_data.get("cache_usage", 0),
         )
 
 class eptMsgWork(object):
@@ -507,6 +588,108 @@ epm_rsMacToIp_reg+= "ip-\[(?P<ip>[0-9\.a-fA-F\:]+)\]"
 epm_rsMacToIp_reg = re.compile(epm_rsMacToIp_reg)
 epm_reg = re.compile(epm_reg)
 
+# characters allowed in an epm mac/ip address (same as the addr group in epm_reg)
+epm_addr_chars = "0123456789.abcdefABCDEF:"
+epm_rs_prefix = "/rsmacEpToIpEpAtt-"
+# cache of parsed dn prefix (everything before /db-ep/) to (node, vrf, bd, encap). During build
+# millions of endpoints share a few thousand node/vrf/bd/encap prefixes
+epm_dn_cache = {}
+epm_dn_cache_size = 65536
+
+def parse_epm_dn(dn, rs=False):
+    """ parse epmMacEp/epmIpEp dn (or epmRsMacEpToIpEpAtt dn if rs is True) and return tuple
+        (node, vrf, bd, encap, addr, ip) or None if the dn cannot be parsed. vrf is None for
+        inst-overlay-1 endpoints. The split based parse_epm_dn_fast handles the dn formats
+        published by the leaf and anything else falls back to the epm_reg regex.
+    """
+    ret = parse_epm_dn_fast(dn, rs=rs)
+    if ret is None:
+        ret = parse_epm_dn_regex(dn, rs=rs)
+    return ret
+
+def parse_epm_dn_regex(dn, rs=False):
+    """ parse_epm_dn using epm_reg or epm_rsMacToIp_reg """
+    r1 = epm_rsMacToIp_reg.search(dn) if rs else epm_reg.search(dn)
+    if r1 is None:
+        return None
+    (node, vrf, bd, encap, addr) = r1.group("node", "vrf", "bd", "encap", "addr")
+    return (int(node), int(vrf) if vrf is not None else None, int(bd) if bd is not None else 0,
+            encap if encap is not None else "", addr, r1.group("ip") if rs else "")
+
+def parse_epm_dn_fast(dn, rs=False):
+    """ parse_epm_dn without regex, returns None for any dn that does not exactly match the
+        expected format so the caller can fall back to parse_epm_dn_regex
+    """
+    ip = ""
+    if rs:
+        # rsmacEpToIpEpAtt-[sys/ctx-[vxlan-2916352]/.../db-ep/ip-[10.1.1.101]]
+        i = dn.find(epm_rs_prefix)
+        if i < 0:
+            return None
+        j = dn.find("ip-[", i+len(epm_rs_prefix)+1)
+        k = dn.find("]", j+4)
+        if j < 0 or k < 0:
+            return None
+        ip = dn[j+4:k]
+        if len(ip) == 0 or len(ip.strip(epm_addr_chars)) > 0:
+            return None
+        dn = dn[:i]
+    (prefix, sep, addr) = dn.rpartition("/db-ep/")
+    if len(sep) == 0:
+        return None
+    if addr[0:4] == "mac-":
+        addr = addr[4:]
+    elif addr[0:3] == "ip-":
+        addr = addr[3:]
+    else:
+        return None
+    if addr[0:1] == "[" and addr[-1:] == "]":
+        addr = addr[1:-1]
+    # strip of allowed characters leaves any invalid character (including '/') in place
+    if len(addr) == 0 or len(addr.strip(epm_addr_chars)) > 0:
+        return None
+    ctx = epm_dn_cache.get(prefix, None)
+    if ctx is None:
+        ctx = parse_epm_dn_prefix(prefix)
+        if ctx is None:
+            return None
+        if len(epm_dn_cache) >= epm_dn_cache_size:
+            epm_dn_cache.clear()
+        epm_dn_cache[prefix] = ctx
+    return ctx + (addr, ip)
+
+def parse_epm_dn_prefix(prefix):
+    # return tuple (node, vrf, bd, encap) for dn prefix or None on error. For example:
+    #   topology/pod-1/node-101/sys/ctx-[vxlan-2916352]/bd-[vxlan-15007704]/vlan-[vlan-101]
+    parts = prefix.split("/")
+    if len(parts) < 5 or len(parts) > 7 or parts[3] != "sys":
+        return None
+    (node, vrf, bd, encap) = (parts[2], parts[4], 0, "")
+    if node[0:5] != "node-" or not node[5:].isdigit():
+        return None
+    node = int(node[5:])
+    if vrf == "inst-overlay-1":
+        vrf = None
+    elif vrf[0:11] == "ctx-[vxlan-" and vrf[-1:] == "]" and vrf[11:-1].isdigit():
+        vrf = int(vrf[11:-1])
+    else:
+        return None
+    parts = parts[5:]
+    if len(parts) > 0 and parts[0][0:10] == "bd-[vxlan-":
+        bd = parts.pop(0)
+        if bd[-1:] != "]" or not bd[10:-1].isdigit():
+            return None
+        bd = int(bd[10:-1])
+    if len(parts) > 0:
+        # vlan-[vlan-101] or vxlan-[vxlan-8392001]
+        (encap_type, sep, encap) = parts.pop(0).partition("-[")
+        (encap_id_type, sep, encap_id) = encap[:-1].partition("-")
+        if encap_type not in ("vlan", "vxlan") or encap_id_type not in ("vlan", "vxlan") or \
+            encap[-1:] != "]" or not encap_id.isdigit() or len(parts) > 0:
+            return None
+        encap = encap[:-1]
+    return (node, vrf, bd, encap)
+
 class eptEpmEventParser(object):
     """ shim for creating/parsing epmEvents """
     def __init__(self, fabric, overlay_vnid):
@@ -574,17 +757,16 @@ class eptMsgWorkEpmEvent(eptMsgWork):
             return False
         if self.classname == "epmIpEp":
             self.wt = WORK_TYPE.EPM_IP_EVENT
-            r1 = epm_reg.search(attr["dn"])
+            r1 = parse_epm_dn(attr["dn"])
             self.type = "ip"
         elif self.classname == "epmMacEp":
             self.wt = WORK_TYPE.EPM_MAC_EVENT
-            r1 = epm_reg.search(attr["dn"])
+            r1 = parse_epm_dn(attr["dn"])
             self.type = "mac"
         elif self.classname == "epmRsMacEpToIpEpAtt":
             self.wt = WORK_TYPE.EPM_RS_IP_EVENT
-            r1 = epm_rsMacToIp_reg.search(attr["dn"])
+            r1 = parse_epm_dn(attr["dn"], rs=True)
             self.type = "ip"
-            self.ip = r1.group("ip")
         else:
             logger.warn("insupported epmEvent classname (%s): %s", classname, attr)
             return False
@@ -607,21 +789,12 @@ class eptMsgWorkEpmEvent(eptMsgWork):
             self.pcTag = int(attr.get("pcTag", 0))
         except ValueError as e:
             self.pcTag = 0
-        self.node = int(r1.group("node"))
-        self.addr = r1.group("addr")
 
         # either vrf or ovl will always be set. If ovl then use overlay_vnid for vrf
-        if r1.group("vrf") is not None:
-            self.vrf = int(r1.group("vrf"))
-        elif r1.group("ovl") is not None:
-            self.vrf = overlay_vnid
-        else:
-            logger.warn("parse did not match vrf or ovl %s: %s",attr["dn"],r1.groupdict())
-            return False
-
-        # optional matches that need to be set empty string if not present
-        self.bd = int(r1.group("bd"))   if r1.group("bd") is not None else 0
-        self.encap = r1.group("encap")  if r1.group("encap") is not None else ""
+        (self.node, vrf, self.bd, self.encap, self.addr, ip) = r1
+        self.vrf = vrf if vrf is not None else overlay_vnid
+        if self.classname == "epmRsMacEpToIpEpAtt":
+            self.ip = ip
 
         # set vnid to bd or vrf depending on classname
         self.vnid = self.bd if self.classname == "epmMacEp" else self.vrf
@@ -665,3 +838,108 @@ class eptMsgWorkEpmEvent(eptMsgWork):
             "[force]" if self.force else "",
         )
 
+###############################################################################
+#
+# compact binary wire format (WIRE_VERSION_BINARY) for eptMsgBulk of epm events. During the
+# initial build the subscriber sends bulks of up to MAX_SEND_MSG_LENGTH epm events to each worker
+# and json encoding (with each msg json encoded twice) dominates both the subscriber and worker
+# cpu. All strings within the bulk are interned into a string table and each event is a fixed
+# size struct referencing the string table by index:
+#   header:     magic, version, bulk seq, string count, msg count
+#   strings:    uint16 length + utf-8 bytes per string
+#   msgs:       _wire_epm struct followed by flag_count string indexes
+#
+###############################################################################
+
+_wire_header = struct.Struct(">cBQII")
+_wire_str_len = struct.Struct(">H")
+_wire_index = struct.Struct(">I")
+# wt, force, qnum, ts, seq, pcTag, node, vrf, bd, vnid, fabric, addr, classname, type, status,
+# ifId, encap, ip, flag_count
+_wire_epm = struct.Struct(">BBBdQIIIIIIIIIIIIIB")
+_wire_wt = [WORK_TYPE.EPM_IP_EVENT, WORK_TYPE.EPM_MAC_EVENT, WORK_TYPE.EPM_RS_IP_EVENT]
+_wire_wt_code = dict((wt, i) for i, wt in enumerate(_wire_wt))
+
+def wire_pack_bulk(msgs, seq):
+    """ return binary encoding of list of eptMsgWorkEpmEvent objects. Raise ValueError or
+        struct.error if any msg cannot be represented in binary format
+    """
+    strings = []
+    index = {}
+    def intern(s):
+        if s is None:
+            return WIRE_NONE
+        i = index.get(s, None)
+        if i is None:
+            if not isinstance(s, basestring):
+                raise ValueError("unsupported string value: %s" % s)
+            i = len(strings)
+            index[s] = i
+            strings.append(s.encode("utf-8") if isinstance(s, unicode) else s)
+        return i
+
+    records = []
+    for m in msgs:
+        if m.wt not in _wire_wt_code:
+            raise ValueError("unsupported work type: %s" % m.wt)
+        records.append(_wire_epm.pack(_wire_wt_code[m.wt], int(m.force), m.qnum, m.ts, m.seq,
+            m.pcTag, m.node, m.vrf, m.bd, m.vnid, intern(m.fabric), intern(m.addr),
+            intern(m.classname), intern(m.type), intern(m.status), intern(m.ifId), 
+            intern(m.encap), intern(m.ip), len(m.flags)
+        ))
+        for f in m.flags:
+            records.append(_wire_index.pack(intern(f)))
+
+    ret = [_wire_header.pack(WIRE_MAGIC, WIRE_VERSION_BINARY, seq, len(strings), len(msgs))]
+    for s in strings:
+        ret.append(_wire_str_len.pack(len(s)))
+        ret.append(s)
+    ret.extend(records)
+    return "".join(ret)
+
+def wire_unpack_bulk(data, brief=False):
+    """ return eptMsgBulk from binary encoded data. If brief is set then only the header is parsed
+        and msgs list is not populated
+    """
+    (magic, version, seq, str_count, msg_count) = _wire_header.unpack_from(data, 0)
+    if version != WIRE_VERSION_BINARY:
+        raise ValueError("unsupported wire version: %s" % version)
+    bulk = eptMsgBulk(seq=seq)
+    bulk.msg_count = msg_count
+    if brief:
+        return bulk
+    offset = _wire_header.size
+    strings = []
+    for i in xrange(0, str_count):
+        (length,) = _wire_str_len.unpack_from(data, offset)
+        offset+= _wire_str_len.size
+        strings.append(data[offset:offset+length].decode("utf-8"))
+        offset+= length
+    def lookup(i):
+        return None if i == WIRE_NONE else strings[i]
+
+    for i in xrange(0, msg_count):
+        r = _wire_epm.unpack_from(data, offset)
+        offset+= _wire_epm.size
+        msg = eptMsgWorkEpmEvent(lookup(r[11]), "worker", {}, _wire_wt[r[0]], qnum=r[2], seq=r[4],
+                fabric=lookup(r[10]))
+        msg.force = bool(r[1])
+        msg.ts = r[3]
+        msg.pcTag = r[5]
+        msg.node = r[6]
+        msg.vrf = r[7]
+        msg.bd = r[8]
+        msg.vnid = r[9]
+        msg.classname = lookup(r[12])
+        msg.type = lookup(r[13])
+        msg.status = lookup(r[14])
+        msg.ifId = lookup(r[15])
+        msg.encap = lookup(r[16])
+        msg.ip = lookup(r[17])
+        msg.flags = []
+        for j in xrange(0, r[18]):
+            msg.flags.append(strings[_wire_index.unpack_from(data, offset)[0]])
+            offset+= _wire_index.size
+        bulk.msgs.append(msg)
+    return bulk
+
@@ -226,6 +226,28 @@ class eptSettings(Rest):
             initial epm db build.
             """,
         },
+        "build_node_concurrency": {
+            "type": int,
+            "default": 0,
+            "min": 0,
+            "max": 64,
+            "description": """ by default, the initial endpoint db build performs a single fabric 
+            wide class query for each epm class. Set build_node_concurrency to a non-zero value to 
+            instead query each in-service leaf and spine individually with up to this many node 
+            queries executing in parallel. This can significantly reduce the build time on large
+            fabrics.
+            """,
+        },
+        "epm_delta_sync": {
+            "type": bool,
+            "default": False,
+            "description": """ on restart, only send epm records that have changed since the 
+            previous successful build to the workers for analysis. A digest of each epm record is 
+            persisted after the workers have completed the initial build and records with an 
+            unchanged digest are skipped on the next build. This significantly reduces restart time
+            on large fabrics. Disable to force a full analysis of all epm records on each restart.
+            """,
+        },
         "stale_no_local": {
             "type": bool,
             "default": True,
@@ -0,0 +1,286 @@
+
+from ... utils import get_db
+from . common import get_cache_generation_key
+from . common import get_cache_invalid_key
+
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import traceback
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+class eptSharedCache(object):
+    """ host-local read-only snapshot of a collection for a single fabric that is shared by all
+        worker processes on the host. The snapshot is written once to a segment file within the
+        shared directory and each worker mmaps the file so the data is held once in the page cache
+        instead of once per process.
+
+        Each segment is versioned by the flush generation of the collection which is incremented in
+        redis by the sender of each full FLUSH_CACHE message. When a worker receives a flush, it 
+        reloads the generation and the next lookup maps (or builds) the segment for the new 
+        generation. Only one worker on the host builds a segment, other workers fall back to a db
+        lookup while the segment is being built.
+
+        A flush for a single name does not change the generation. The name is added to a set of 
+        invalidated names in redis for the current generation which each worker loads when the 
+        segment is mapped and updates on each named flush. Lookups for an invalidated name (or 
+        the current key of the named object) fall back to the db until the next generation.
+
+        segment format:
+            header      magic(8), count(uint32)
+            index       count entries of key hash(uint64), offset(uint64), length(uint32) sorted
+                        by key hash
+            data        json encoded [keystr, [obj1, obj2, ...]] for each key
+    """
+    MAGIC = "eptsc001"
+    HEADER = struct.Struct("<8sI")
+    INDEX = struct.Struct("<QQI")
+    KEY_DELIM = "`"
+
+    def __init__(self, directory, fabric, eptObject, keys, redis_db=None):
+        self.directory = directory
+        self.fabric = fabric
+        self.eptObject = eptObject
+        self.keys = sorted(keys)
+        self.redis = redis_db
+        self.generation = None
+        self.segment = None
+        self.count = 0
+        # names(dn) invalidated within the current generation and key strings of those objects
+        self.invalid_names = set()
+        self.invalid_keys = set()
+        # stats
+        self.hit_count = 0
+        self.miss_count = 0
+        self.unavailable_count = 0
+        self.invalid_count = 0
+        self.build_count = 0
+
+    def __repr__(self):
+        return "%s gen:%s, count:%s, hit:%s, miss:%s, unavailable:%s, invalid:%s, build:%s" % (
+            self.eptObject._classname, self.generation, self.count, self.hit_count,
+            self.miss_count, self.unavailable_count, self.invalid_count, self.build_count
+        )
+
+    def get_prefix(self):
+        """ return file path prefix for all segments of this fabric and collection """
+        return os.path.join(self.directory, "%s_%s" % (self.fabric, self.eptObject._classname))
+
+    def get_path(self, generation):
+        """ return segment file path for provided generation """
+        return "%s_%s.seg" % (self.get_prefix(), generation)
+
+    def reload_generation(self, name=None):
+        """ read current flush generation from redis and release the current segment if the
+            generation has changed. If name is provided then the name is invalidated within the
+            current generation.
+        """
+        generation = 0
+        if self.redis is not None:
+            try:
+                generation = int(self.redis.get(get_cache_generation_key(self.fabric,
+                                    self.eptObject._classname)) or 0)
+            except Exception as e:
+                logger.debug("Traceback:\n%s", traceback.format_exc())
+                logger.warn("failed to read cache generation for %s: %s", self, e)
+                generation = None
+        if generation is None or generation != self.generation:
+            self.close()
+            self.invalid_names = set()
+            self.invalid_keys = set()
+        self.generation = generation
+        if name is not None:
+            self.invalidate([name])
+
+    def invalidate(self, names):
+        """ invalidate list of names(dn) within the current generation. The key string of each 
+            named object currently in the db is also invalidated so an object created or moved to
+            a new key after the segment was built is not served from the segment.
+        """
+        names = [n for n in names if n not in self.invalid_names]
+        if len(names) == 0:
+            return
+        self.invalid_names.update(names)
+        flt = {"fabric": self.fabric, "name": {"$in": names}}
+        for doc in get_db()[self.eptObject._classname].find(flt, {"_id": 0}):
+            self.invalid_keys.add(self.get_key_str(doc))
+
+    def close(self):
+        """ release the currently mapped segment """
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = None
+        self.count = 0
+
+    def find(self, keystr):
+        """ return list of eptObject for provided key string. An empty list is returned if no
+            object exists for the key. None is returned if the shared segment is not available and
+            caller should fallback to db lookup.
+        """
+        if self.segment is None and not self.open():
+            self.unavailable_count+= 1
+            return None
+        if keystr in self.invalid_keys:
+            self.invalid_count+= 1
+            return None
+        if not isinstance(keystr, bytes):
+            keystr = keystr.encode("utf-8")
+        khash = self.get_key_hash(keystr)
+        # binary search index for first entry with matching hash and walk forward on collisions
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_index(mid)[0] < khash:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self.count:
+            (ihash, offset, length) = self.get_index(lo)
+            if ihash != khash:
+                break
+            (ikey, docs) = json.loads(self.segment[offset:offset+length])
+            if ikey.encode("utf-8") == keystr:
+                if len([d for d in docs if d.get("name", None) in self.invalid_names]) > 0:
+                    self.invalid_count+= 1
+                    return None
+                self.hit_count+= 1
+                return [self.get_object(d) for d in docs]
+            lo+= 1
+        self.miss_count+= 1
+        return []
+
+    def get_index(self, i):
+        """ return tuple (hash, offset, length) for index entry i """
+        return self.INDEX.unpack_from(self.segment, self.HEADER.size + i*self.INDEX.size)
+
+    def get_object(self, doc):
+        """ return eptObject for db document in the same form as Rest.find """
+        obj = self.eptObject(**doc)
+        obj._exists = True
+        for attr in self.eptObject._attributes:
+            if not self.eptObject._attributes[attr]["key"] and hasattr(obj, attr):
+                obj._original_attributes[attr] = doc.get(attr, getattr(obj, attr))
+        return obj
+
+    @staticmethod
+    def get_key_hash(keystr):
+        """ return 64-bit hash of key string """
+        return struct.unpack("<Q", hashlib.md5(keystr).digest()[0:8])[0]
+
+    def get_key_str(self, doc):
+        """ return key string for db document, this must match eptCache.get_key_str """
+        return self.KEY_DELIM.join(["%s" % doc.get(k, "") for k in self.keys])
+
+    def open(self):
+        """ map segment for current generation, building it if not present on the host.
+            return bool success
+        """
+        if self.generation is None:
+            self.reload_generation()
+            if self.generation is None:
+                return False
+        path = self.get_path(self.generation)
+        if not os.path.exists(path) and not self.build(path):
+            return False
+        try:
+            # names invalidated by any named flush of this generation before the segment is mapped
+            if self.redis is not None:
+                self.invalidate(list(self.redis.smembers(get_cache_invalid_key(self.fabric,
+                                    self.eptObject._classname))))
+            with open(path, "rb") as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, count) = self.HEADER.unpack_from(segment, 0)
+            if magic != self.MAGIC:
+                logger.warn("invalid shared cache segment %s", path)
+                segment.close()
+                return False
+            self.segment = segment
+            self.count = count
+            return True
+        except Exception as e:
+            logger.debug("Traceback:\n%s", traceback.format_exc())
+            logger.warn("failed to map shared cache segment %s: %s", path, e)
+        return False
+
+    def build(self, path):
+        """ build segment for current generation from db. Only one process on the host builds the
+            segment at a time, if the build lock is held by another process then return False
+            immediately. return bool success
+        """
+        lock = None
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            lock = open("%s.lock" % self.get_prefix(), "a")
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    logger.debug("shared cache segment build in progress: %s", path)
+                    return False
+                raise
+            # segment may have been completed by another process while waiting on the lock
+            if os.path.exists(path):
+                return True
+            ts = time.time()
+            objects = {}
+            flt = {"fabric": self.fabric}
+            for doc in get_db()[self.eptObject._classname].find(flt, {"_id": 0}):
+                keystr = self.get_key_str(doc)
+                if keystr not in objects:
+                    objects[keystr] = []
+                objects[keystr].append(doc)
+            index = []
+            data = []
+            offset = self.HEADER.size + self.INDEX.size * len(objects)
+            for keystr in objects:
+                encoded = json.dumps([keystr, objects[keystr]], separators=(",", ":"))
+                bkey = keystr if isinstance(keystr, bytes) else keystr.encode("utf-8")
+                index.append((self.get_key_hash(bkey), offset, len(encoded)))
+                data.append(encoded)
+                offset+= len(encoded)
+            # index is sorted by hash while data remains in original order
+            index.sort(key=lambda i: i[0])
+            tmp_path = "%s.%s.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                f.write(self.HEADER.pack(self.MAGIC, len(index)))
+                for i in index:
+                    f.write(self.INDEX.pack(*i))
+                for d in data:
+                    f.write(d)
+            os.rename(tmp_path, path)
+            self.build_count+= 1
+            # remove segments from previous generations, any process with an older segment mapped
+            # will still have access to it until it is closed
+            for old_path in glob.glob("%s_*.seg" % self.get_prefix()):
+                old_generation = old_path[len(self.get_prefix())+1:-len(".seg")]
+                if old_generation.isdigit() and int(old_generation) < self.generation:
+                    try:
+                        os.remove(old_path)
+                    except OSError as e:
+                        logger.debug("failed to remove old segment %s: %s", old_path, e)
+            logger.debug("built shared cache segment %s with %s keys in %0.3f sec", path,
+                len(index), time.time() - ts)
+            return True
+        except Exception as e:
+            logger.debug("Traceback:\n%s", traceback.format_exc())
+            logger.warn("failed to build shared cache segment %s: %s", path, e)
+        finally:
+            if lock is not None:
+                lock.close()
+        return False
+
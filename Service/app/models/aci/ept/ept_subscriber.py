@@ -12,8 +12,10 @@ from .. utils import validate_session_role
 from .. subscription_ctrl import SubscriptionCtrl
 
 from . common import BG_EVENT_HANDLER_INTERVAL
+from . common import BUILD_PROGRESS_INTERVAL
 from . common import HELLO_INTERVAL
 from . common import MANAGER_CTRL_CHANNEL
+from . common import MANAGER_DISPATCH_CHANNEL
 from . common import MANAGER_WORK_QUEUE
 from . common import MAX_EPM_BUILD_TIME
 from . common import MAX_SEND_MSG_LENGTH
@@ -24,11 +26,15 @@ from . common import WATCHER_BROADCAST_CHANNEL
 from . common import WORKER_BROADCAST_CHANNEL
 from . common import WORKER_CTRL_CHANNEL
 from . common import BackgroundThread
+from . common import EndpointPresence
 from . common import db_alive
+from . common import get_cache_generation_key
+from . common import get_cache_invalid_key
 from . common import get_msg_hash
 from . common import get_vpc_domain_id
 from . common import log_version
 from . common import parse_tz
+from . common import update_cache_generation
 from . ept_msg import MSG_TYPE
 from . ept_msg import WORK_TYPE
 from . ept_msg import eptEpmEventParser
@@ -40,7 +46,14 @@ from . ept_msg import eptMsgWorkDeleteEpt
 from . ept_msg import eptMsgWorkRaw
 from . ept_msg import eptMsgWorkStdMo
 from . ept_msg import eptMsgWorkWatchNode
+from . ept_dispatcher import allocate_seq
+from . ept_dispatcher import build_worker_rings
+from . ept_dispatcher import merge_worker_table
+from . ept_dispatcher import send_rebalance_ack
+from . ept_dispatcher import DispatchFence
+from . ept_cache import eptCache
 from . ept_epg import eptEpg
+from . ept_epm_digest import eptEpmDigest
 from . ept_history import eptHistory
 from . ept_node import eptNode
 from . ept_pc import eptPc
@@ -53,6 +66,7 @@ from . ept_vpc import eptVpc
 from . mo_dependency_map import dependency_map
 
 from importlib import import_module
+from six.moves.queue import Empty
 from six.moves.queue import Queue
 
 import logging
@@ -72,8 +86,8 @@ class eptSubscriber(object):
         epm events are sent to workers to analyze.
         subscriber also listens 
     """
-    def __init__(self, fabric, active_workers={}):
-        # receive instance of Fabric rest object along with dict of active_workers indexed by role
+    def __init__(self, fabric, worker_table={}):
+        # receive instance of Fabric rest object along with worker table published by the manager
         self.fabric = fabric
         self.settings = eptSettings.load(fabric=self.fabric.fabric, settings="default")
         self.initializing = True    # set to queue events until fully initialized
@@ -84,6 +98,7 @@ class eptSubscriber(object):
         self.session = None
         self.bg_thread = None           # background thread used to batch epm/std_mo event messages
         self.stats_thread = None        # update stats at regular interval
+        self.table_thread = None        # pubsub thread receiving worker table updates from manager
         self.epm_event_queue = Queue()
         self.std_mo_event_queue = Queue()
         self.epm_parser = None  # initialized once overlay vnid is known
@@ -92,6 +107,7 @@ class eptSubscriber(object):
         self.manager_ctrl_channel_lock = threading.Lock()
         self.manager_work_queue_lock = threading.Lock()
         self.queue_stats_lock = threading.Lock()
+        self.build_lock = threading.Lock()
 
         # broadcast hello for any managers (registration and keepalives)
         self.hello_thread = None
@@ -99,12 +115,16 @@ class eptSubscriber(object):
         self.hello_msg.seq = 0
 
         # active workers indexed by role. Each role is a list of TrackedWorker objects.
-        # Note, this is initial value of workers when subscriber is started. It may not be accurate 
-        # at a later time and therefore should only be trusted during initial startup. If we want 
-        # to support dynamic worker bringup/teardown in the future, then we will need to implement 
-        # messaging between manager and subscriber with active worker updates to keep them in sync.
-        # for now, if active workers change then subscriber will be restarted by manager process
-        self.active_workers = active_workers
+        # This is the initial value of workers when subscriber is started and is kept in sync via
+        # WORKER_TABLE messages published by the manager on MANAGER_DISPATCH_CHANNEL. Work is
+        # assigned to workers using a consistent hash ring per role so a worker joining/leaving
+        # only moves a small fraction of endpoints. The fence holds all sends while the manager
+        # migrates work for moved endpoints to their new owner.
+        self.fence = DispatchFence()
+        self.active_workers = merge_worker_table({}, worker_table.get("workers", []))
+        self.rings = build_worker_rings(self.active_workers)
+        if worker_table.get("hold", False):
+            self.fence.hold()
 
         # keep a dummy seq for each supported broadcast channel
         self.watcher_broadcast_seq = 0
@@ -138,6 +158,9 @@ class eptSubscriber(object):
         # track when fabric epm EOF was sent 
         self.epm_eof_tracking = None
         self.epm_eof_start = None
+        # presence set of epm records returned by the build with digests staged for commit once
+        # all workers have acked epm EOF (epm_delta_sync)
+        self.epm_digest_seen = None
 
         # classes that have corresponding mo Rest object and handled by handle_std_mo_event
         # the order shouldn't matter during build but just to be safe we'll control the order...
@@ -228,6 +251,11 @@ class eptSubscriber(object):
             # allocate a unique db connection as this is running in a new process
             self.db = get_db(uniq=True, overwrite_global=True, write_concern=True)
             self.redis = get_redis()
+            # listen for worker table updates from manager
+            p = self.redis.pubsub(ignore_subscribe_messages=True)
+            p.subscribe(**{MANAGER_DISPATCH_CHANNEL: self.handle_worker_table_msg})
+            self.table_thread = p.run_in_thread(sleep_time=0.01, daemon=True)
+            self.table_thread.name = "sub-table"
             # start hello thread
             self.hello_thread = BackgroundThread(
                 func=self.send_hello,
@@ -272,6 +300,8 @@ class eptSubscriber(object):
                 self.bg_thread.exit()
             if self.stats_thread is not None:
                 self.stats_thread.exit()
+            if self.table_thread is not None:
+                self.table_thread.stop()
 
     def increment_stats(self, queue, tx=False, count=1):
         """ update queue stats for transmit/receive message """
@@ -346,18 +376,28 @@ class eptSubscriber(object):
             When prepend is set to True, a lpush is executed instead of rpush to force the message
             to the top of the queue.
         """
+        self.fence.enter()
+        try:
+            self._send_msg(msg, prepend=prepend)
+        finally:
+            self.fence.exit()
+
+    def _send_msg(self, msg, prepend=False):
         # dict indexed by worker_id and qnum with a tuple (worker, worker-msgs), where worker-msgs 
         # is a list of eptBulkMsg objects with at most MAX_SEND_MSG_LENGTH per bulk message
         work = {}
         if not isinstance(msg, list):
             msg = [msg]
+        # rings may be replaced at any time by worker table update, use a consistent reference
+        rings = self.rings
         for m in msg:
             m.fabric = self.fabric.fabric
-            if m.role not in self.active_workers or len(self.active_workers[m.role]) == 0:
+            worker = None
+            if m.role in rings:
+                worker = rings[m.role].get(get_msg_hash(m))
+            if worker is None:
                 logger.warn("no available workers for role '%s'", m.role)
             else:
-                _hash = get_msg_hash(m)
-                worker = self.active_workers[m.role][_hash % len(self.active_workers[m.role])]
                 if m.qnum >= len(worker.queues):
                     logger.warn("unable to enqueue work on worker %s, queue %s does not exist", 
                         worker.worker_id, m.qnum)
@@ -376,10 +416,6 @@ class eptSubscriber(object):
                 if len(work[worker.worker_id][m.qnum][1][-1].msgs) >= MAX_SEND_MSG_LENGTH:
                     work[worker.worker_id][m.qnum][1].append(eptMsgBulk())
                 work[worker.worker_id][m.qnum][1][-1].msgs.append(m)
-                # increment seq number for this message and for worker
-                with worker.queue_locks[m.qnum]:
-                    worker.last_seq[m.qnum]+= 1
-                    m.seq = worker.last_seq[m.qnum]
                 self.increment_stats(worker.queues[m.qnum], tx=True)
 
         # at this point work is dict indexed by worker-id and queue. Each queue contains a list of
@@ -388,20 +424,19 @@ class eptSubscriber(object):
             for qnum in work[worker_id]:
                 (worker, bulk_msgs) = work[worker_id][qnum]
                 for bulk in bulk_msgs:
-                    send_count = len(bulk.msgs)
-                    # if there's only one message, then send just that single message
-                    if len(bulk.msgs) == 1:
-                        bulk = bulk.msgs[0]
-                    else:
-                        # update bulk sequence number to last entry sent
-                        bulk.seq = bulk.msgs[-1].seq
+                    # encode using highest wire version supported by the worker, single message is
+                    # sent without bulk framing when using json
                     with worker.queue_locks[qnum]:
                         try:
+                            # reserve seq numbers for each message in bulk
+                            seq = allocate_seq(self.redis, worker, qnum, len(bulk.msgs))
+                            for i, m in enumerate(bulk.msgs):
+                                m.seq = seq - len(bulk.msgs) + i + 1
                             #logger.debug("enqueue %s: %s", worker.queues[qnum], bulk)
                             if prepend:
-                                self.redis.lpush(worker.queues[qnum], bulk.jsonify())
+                                self.redis.lpush(worker.queues[qnum], bulk.pack(worker.wire_version))
                             else:
-                                self.redis.rpush(worker.queues[qnum], bulk.jsonify())
+                                self.redis.rpush(worker.queues[qnum], bulk.pack(worker.wire_version))
                         except Exception as e:
                             logger.debug("Traceback:\n%s", traceback.format_exc())
                             logger.error("failed to enqueue msg on queue (%s) %s: %s", e,
@@ -411,6 +446,13 @@ class eptSubscriber(object):
         """ send one or more msgs directly to a single worker. msg must be of type eptMsgWork or 
             child with addr, qnum, and role set
         """
+        self.fence.enter()
+        try:
+            self._send_msg_direct(worker, msg)
+        finally:
+            self.fence.exit()
+
+    def _send_msg_direct(self, worker, msg):
         if not isinstance(msg, list):
             msg = [msg]
         for m in msg:
@@ -419,14 +461,11 @@ class eptSubscriber(object):
                 logger.warn("unable to enqueue work on worker %s, queue %s does not exist", 
                     worker.worker_id, m.qnum)
             else:
-                # increment seq number for this message and for worker
-                with worker.queue_locks[m.qnum]:
-                    worker.last_seq[m.qnum]+= 1
-                    m.seq = worker.last_seq[m.qnum]
                 self.increment_stats(worker.queues[m.qnum], tx=True)
-                # send mesage
+                # send mesage with seq allocated for the worker queue
                 with worker.queue_locks[m.qnum]:
                     try:
+                        m.seq = allocate_seq(self.redis, worker, m.qnum)
                         self.redis.rpush(worker.queues[m.qnum], m.jsonify())
                     except Exception as e:
                         logger.debug("Traceback:\n%s", traceback.format_exc())
@@ -447,6 +486,48 @@ class eptSubscriber(object):
             logger.debug("[%s] failed to handle msg: %s", self, msg)
             logger.error("Traceback:\n%s", traceback.format_exc())
 
+    def handle_worker_table_msg(self, msg):
+        """ handle worker table published by manager on MANAGER_DISPATCH_CHANNEL """
+        try:
+            if msg["type"] == "message":
+                msg = eptMsg.parse(msg["data"])
+                if msg.msg_type == MSG_TYPE.WORKER_TABLE:
+                    self.update_worker_table(msg.data)
+        except Exception as e:
+            logger.debug("[%s] failed to handle msg: %s", self, msg)
+            logger.error("Traceback:\n%s", traceback.format_exc())
+
+    def update_worker_table(self, table):
+        """ rebuild active workers and hash rings from worker table published by manager. If hold
+            is set then wait for sends in progress to complete and ack the hold to the manager. No
+            further work is sent until a table without hold is received.
+        """
+        active_workers = merge_worker_table(self.active_workers, table.get("workers", []))
+        fab_id = "fab-%s" % self.fabric.fabric
+        worker_ids = {}
+        for role in active_workers:
+            for worker in active_workers[role]:
+                worker_ids[worker.worker_id] = True
+                for q in worker.queues:
+                    with self.queue_stats_lock:
+                        if q not in self.queue_stats:
+                            self.queue_stats[q] = eptQueueStats.load(proc=fab_id, queue=q)
+                            self.queue_stats[q].init_queue()
+        # no longer waiting on epm eof ack from workers that have left
+        if self.epm_eof_tracking is not None:
+            for wid in self.epm_eof_tracking.keys():
+                if wid not in worker_ids:
+                    logger.debug("removing epm eof tracking for inactive worker %s", wid)
+                    self.epm_eof_tracking.pop(wid, None)
+        self.rings = build_worker_rings(active_workers)
+        self.active_workers = active_workers
+        if table.get("hold", False):
+            if not self.fence.hold():
+                logger.warn("timeout waiting for sends in progress")
+            send_rebalance_ack(self.redis, self.fabric.fabric, table.get("version", 0), "hold")
+        else:
+            self.fence.release()
+
     def handle_subscriber_ctrl(self, msg):
         """ handle subscriber control messages """
         # all subscriber ctrl messages must have fabric present
@@ -479,6 +560,7 @@ class eptSubscriber(object):
                 pending = self.get_workers_with_pending_ack()
                 if len(pending) == 0:
                     logger.debug("%s received epm ack from all workers", msg.fabric)
+                    self.commit_epm_digests()
                     # unpause and stop tracking
                     logger.debug("%s broadcasting resume to all watchers", msg.fabric)
                     self.broadcast(eptMsgWork(0,"watcher",{},WORK_TYPE.FABRIC_WATCH_RESUME))
@@ -672,6 +754,12 @@ class eptSubscriber(object):
         # check if subscriptions died during previous step
         self.subscriber_is_alive() 
 
+        # all cached collections have been rebuilt, start a new generation for each so workers
+        # do not reuse a shared cache segment built before this restart
+        self.reset_cache_generations()
+        # caches can now be bulk loaded by workers from the rebuilt collections
+        self.broadcast(eptMsgWork(0, "worker", {}, WORK_TYPE.CACHE_WARMUP))
+
         # slow objects (including std mo objects) initialization completed
         self.initializing = False
         # safe to call resume even if never paused
@@ -734,6 +822,8 @@ class eptSubscriber(object):
                             )
                     logger.warn(err)
                     self.fabric.add_fabric_event("warning", err)
+                    # workers may not have processed all records, discard pending digests
+                    self.discard_epm_digests()
                     # unpause and stop tracking
                     logger.debug("broadcasting resume to all watchers")
                     self.broadcast(eptMsgWork(0,"watcher",{},WORK_TYPE.FABRIC_WATCH_RESUME))
@@ -842,9 +932,28 @@ class eptSubscriber(object):
         self.initializing = False
         self.subscriber.resume(self.subscription_classes + self.ordered_mo_classes)
 
+    def reset_cache_generations(self):
+        """ start a new flush generation for each cached collection and flush workers. The new
+            generation is at least the current time in msec so it is newer than any segment left
+            on the host from a previous run even if the generation in redis was lost
+        """
+        seed = int(time.time()*1000)
+        for (cache_name, eptObject, keys) in eptCache.COLLECTION_CACHES:
+            key = get_cache_generation_key(self.fabric.fabric, eptObject._classname)
+            generation = self.redis.incr(key)
+            if generation < seed:
+                # concurrent flushes only increment the key so the result is still >= seed
+                self.redis.incrby(key, seed - generation)
+            self.redis.delete(get_cache_invalid_key(self.fabric.fabric, eptObject._classname))
+            data = {"cache": eptObject._classname, "name": None}
+            self.broadcast(eptMsgWork(0, "worker", data, WORK_TYPE.FLUSH_CACHE))
+
     def send_flush(self, collection, name=None):
         """ send flush message to workers for provided collection """
         logger.debug("flush %s (name:%s)", collection._classname, name)
+        # update shared cache generation before the broadcast so workers sharing a host cache 
+        # reload it (or invalidate the name) when the flush is received
+        update_cache_generation(self.redis, self.fabric.fabric, collection._classname, name)
         # node addr of 0 is broadcast to all nodes of provided role
         data = {"cache": collection._classname, "name": name}
         self.broadcast(eptMsgWork(0, "worker", data, WORK_TYPE.FLUSH_CACHE))
@@ -1536,59 +1645,57 @@ class eptSubscriber(object):
             endpoints previously within the database but not returned on query, all other objects 
             will result in a create job.
 
+            When epm_delta_sync is enabled, records with a digest matching the digest committed 
+            on the previous build are not sent to the workers. The endpoint is still tracked in the
+            endpoints presence set so no delete job is created for it. Committed digests are looked
+            up per page of records so the digest table is never loaded into memory.
+
+            When build_node_concurrency is enabled, the epm classes are queried per node with up to
+            build_node_concurrency nodes queried in parallel.
+
             Return boolean success
         """
         logger.debug("initialize endpoint db")
         start_time = time.time()
+        delta_sync = self.settings.epm_delta_sync
+        self.epm_digest_seen = None
+        if delta_sync:
+            # digests staged by a previous build that was never committed are discarded
+            eptEpmDigest.clear_pending(self.db, self.fabric.fabric)
+            self.epm_digest_seen = EndpointPresence()
+        else:
+            # digests from a previous build are stale once records are processed without tracking
+            eptEpmDigest.delete(_filters={"fabric": self.fabric.fabric})
 
-        # 3-level dict to track endpoints returned from class query endpoints[node][vnid][addr] = 1
-        endpoints = {}
+        # track endpoints returned from class query using compact presence set
+        endpoints = EndpointPresence()
+        # total create and skipped (unchanged) records
+        counts = {"create": 0, "skip": 0}
         # we will start epm subscription AFTER get_class (which can take a long time) but before 
         # processing endpoints.  This minimizes amount of time we lose data without having to buffer
         # all events that are recieved during get requests.
         paused = self.settings.queue_init_epm_events
-        total_create = 0
-        for c in self.epm_subscription_classes:
-            if c == "epmRsMacEpToIpEpAtt":
-                gen = get_class(self.session, c, stream=True, orderBy="%s.dn" % c)
-            else:
-                gen = get_class(self.session, c, stream=True, orderBy="%s.addr" % c)
-            ts = time.time()
-            create_count = 0
-            create_msgs = []
-            if not self.subscriber.add_interest(c, self.handle_epm_event, paused=paused):
-                logger.warn("failed to add interest %s to subscriber", c)
-                return False
-            for obj in gen:
-                if obj is None:
-                    logger.error("failed to get epm data for class %s", c)
+        if self.settings.build_node_concurrency > 0:
+            for c in self.epm_subscription_classes:
+                if not self.subscriber.add_interest(c, self.handle_epm_event, paused=paused):
+                    logger.warn("failed to add interest %s to subscriber", c)
                     return False
-                if c in obj and "attributes" in obj[c]:
-                    msg = self.epm_parser.parse(c, obj[c]["attributes"], ts)
-                    if msg is not None:
-                        create_count+=1
-                        create_msgs.append(msg)
-                        if msg.node not in endpoints: endpoints[msg.node] = {}
-                        if msg.vnid not in endpoints[msg.node]: endpoints[msg.node][msg.vnid] = {}
-                        endpoints[msg.node][msg.vnid][msg.addr] = 1
-                        # process the data now as we can't afford buffer all msgs in memory on 
-                        # scale setups.
-                        if len(create_msgs) >= MAX_SEND_MSG_LENGTH:
-                            logger.debug("build_endpoint_db sending %s create for %s", 
-                                    len(create_msgs), c)
-                            self.send_msg(create_msgs)
-                            create_msgs = []
+            if not self.build_endpoint_db_per_node(endpoints, counts, 
+                    self.settings.build_node_concurrency):
+                return False
+        else:
+            for c in self.epm_subscription_classes:
+                if c == "epmRsMacEpToIpEpAtt":
+                    gen = get_class(self.session, c, stream=True, orderBy="%s.dn" % c)
                 else:
-                    logger.warn("invalid %s object: %s", c, obj)
-
-            # send remaining create messages
-            if len(create_msgs) > 0:
-                logger.debug("build_endpoint_db sending %s create for %s", len(create_msgs),c)
-                self.send_msg(create_msgs)
-                create_msgs = []
-            # print total for reference
-            logger.debug("build_endpoint_db total %s create for %s", create_count, c)
-            total_create+= create_count
+                    gen = get_class(self.session, c, stream=True, orderBy="%s.addr" % c)
+                if not self.subscriber.add_interest(c, self.handle_epm_event, paused=paused):
+                    logger.warn("failed to add interest %s to subscriber", c)
+                    return False
+                if not self.build_epm_class(c, gen, endpoints, counts):
+                    return False
+        total_create = counts["create"]
+        total_skip = counts["skip"]
 
         # stream delete jobs
         delete_count = 0
@@ -1610,9 +1717,180 @@ class eptSubscriber(object):
         logger.debug("build_endpoint_db total time: %.3f", time.time()-start_time)
         # add fabric event so user is aware of number of create/delete events that will be processed
         overview = "analyzing %s endpoint records" % (total_create + delete_count)
+        if delta_sync:
+            overview+= " (%s unchanged)" % total_skip
         self.fabric.add_fabric_event("initializing", overview)
         return True
 
+    def build_epm_class(self, c, gen, endpoints, counts, node_dn=None):
+        """ send create msgs to workers for each epm object of class c received from generator gen.
+            Each endpoint is added to the endpoints presence set and counts dict is updated with 
+            number of created and skipped (unchanged digest) records. This may be executed from 
+            multiple threads when building per node.
+            Return boolean success
+        """
+        ts = time.time()
+        create_count = 0
+        create_msgs = []
+        skip_count = 0
+        delta_sync = self.settings.epm_delta_sync
+        page = []   # list of (attr, msg) pending digest lookup when delta_sync is enabled
+        for obj in gen:
+            if obj is None:
+                logger.error("failed to get epm data for class %s %s", c, node_dn or "")
+                return False
+            if c in obj and "attributes" in obj[c]:
+                attr = obj[c]["attributes"]
+                msg = self.epm_parser.parse(c, attr, ts)
+                if msg is not None:
+                    with self.build_lock:
+                        endpoints.add(msg.node, msg.vnid, msg.addr)
+                    if delta_sync:
+                        page.append((attr, msg))
+                        if len(page) < eptEpmDigest.LOOKUP_BATCH_SIZE:
+                            continue
+                        msgs = self.filter_epm_digests(c, page)
+                        skip_count+= len(page) - len(msgs)
+                        page = []
+                    else:
+                        msgs = [msg]
+                    create_count+= len(msgs)
+                    create_msgs.extend(msgs)
+                    # process the data now as we can't afford buffer all msgs in memory on 
+                    # scale setups.
+                    if len(create_msgs) >= MAX_SEND_MSG_LENGTH:
+                        logger.debug("build_endpoint_db sending %s create for %s", 
+                                len(create_msgs), c)
+                        self.send_msg(create_msgs)
+                        create_msgs = []
+            else:
+                logger.warn("invalid %s object: %s", c, obj)
+
+        # check digests for last page of records
+        if len(page) > 0:
+            msgs = self.filter_epm_digests(c, page)
+            skip_count+= len(page) - len(msgs)
+            create_count+= len(msgs)
+            create_msgs.extend(msgs)
+        # send remaining create messages
+        if len(create_msgs) > 0:
+            logger.debug("build_endpoint_db sending %s create for %s", len(create_msgs),c)
+            self.send_msg(create_msgs)
+            create_msgs = []
+        # print total for reference
+        logger.debug("build_endpoint_db total %s create (%s unchanged) for %s %s", create_count, 
+                skip_count, c, node_dn or "")
+        with self.build_lock:
+            counts["create"]+= create_count
+            counts["skip"]+= skip_count
+        return True
+
+    def filter_epm_digests(self, c, page):
+        """ receive list of (attr, msg) for epm class c and return list of msgs for records with a
+            digest that does not match the digest committed on the previous build. Each record is
+            added to the epm_digest_seen presence set and digests of changed records are staged
+            for commit once all workers have acked epm EOF.
+        """
+        digests = eptEpmDigest.get_digests(self.db, self.fabric.fabric, 
+                                            [attr["dn"] for (attr, msg) in page])
+        updates = {}
+        msgs = []
+        with self.build_lock:
+            for (attr, msg) in page:
+                self.epm_digest_seen.add(c, 0, attr["dn"])
+        for (attr, msg) in page:
+            digest = eptEpmDigest.get_digest(attr)
+            if digests.get(attr["dn"], None) == digest:
+                continue
+            # eptHistory addr for epmRsMacEpToIpEpAtt is the ip
+            addr = msg.ip if c == "epmRsMacEpToIpEpAtt" else msg.addr
+            updates[attr["dn"]] = (c, msg.node, msg.vnid, addr, digest)
+            msgs.append(msg)
+        if len(updates) > 0:
+            eptEpmDigest.stage(self.db, self.fabric.fabric, updates)
+        return msgs
+
+    def build_endpoint_db_per_node(self, endpoints, counts, concurrency):
+        """ query each epm class per in-service leaf/spine using up to concurrency threads. 
+            Progress is reported in fabric events as nodes complete.
+            Return boolean success
+        """
+        node_queue = Queue()
+        for n in sorted(eptNode.find(fabric=self.fabric.fabric), key=lambda n: n.node):
+            if n.role in ["leaf", "spine"] and n.state == "in-service":
+                node_queue.put("topology/pod-%s/node-%s" % (n.pod_id, n.node))
+        state = {
+            "total": node_queue.qsize(),
+            "complete": 0,
+            "failed": None,
+            "last_event": time.time(),
+        }
+        logger.debug("build_endpoint_db per node for %s nodes (concurrency %s)", state["total"],
+                concurrency)
+        threads = []
+        for i in xrange(0, min(concurrency, state["total"])):
+            t = threading.Thread(target=self.build_endpoint_db_node_thread, 
+                    args=(node_queue, endpoints, counts, state))
+            t.name = "sub-build-%s" % i
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if state["failed"] is not None:
+            logger.warn("build_endpoint_db failed to get epm data from %s", state["failed"])
+            return False
+        return True
+
+    def build_endpoint_db_node_thread(self, node_queue, endpoints, counts, state):
+        """ thread for build_endpoint_db_per_node that builds nodes until node_queue is empty """
+        while state["failed"] is None:
+            try:
+                node_dn = node_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                for c in self.epm_subscription_classes:
+                    if c == "epmRsMacEpToIpEpAtt":
+                        order_by = "%s.dn" % c
+                    else:
+                        order_by = "%s.addr" % c
+                    gen = get_class(self.session, c, stream=True, node_dn=node_dn, 
+                            orderBy=order_by)
+                    if not self.build_epm_class(c, gen, endpoints, counts, node_dn):
+                        state["failed"] = node_dn
+                        return
+            except Exception as e:
+                logger.error("Traceback:\n%s", traceback.format_exc())
+                state["failed"] = node_dn
+                return
+            # report progress at most every BUILD_PROGRESS_INTERVAL and on last node
+            with self.build_lock:
+                state["complete"]+= 1
+                ts = time.time()
+                if state["complete"] >= state["total"] or \
+                    ts - state["last_event"] >= BUILD_PROGRESS_INTERVAL:
+                    state["last_event"] = ts
+                    self.fabric.add_fabric_event("initializing", 
+                            "building endpoint db, %s complete (%s/%s nodes)" % (node_dn,
+                            state["complete"], state["total"]))
+
+    def commit_epm_digests(self):
+        """ commit staged epm digests after all workers have completed the initial build """
+        if self.epm_digest_seen is None:
+            return
+        logger.debug("%s committing epm digests for %s records", self.fabric.fabric,
+                len(self.epm_digest_seen))
+        eptEpmDigest.commit(self.db, self.fabric.fabric, self.epm_digest_seen)
+        self.epm_digest_seen = None
+
+    def discard_epm_digests(self):
+        """ discard staged epm digests when workers have not completed the initial build """
+        if self.epm_digest_seen is None:
+            return
+        eptEpmDigest.clear_pending(self.db, self.fabric.fabric)
+        self.epm_digest_seen = None
+
     def refresh_endpoint(self, vnid, addr, addr_type):
         """ perform endpoint refresh. This triggers an API query for epmDb filtering on provided
             addr and vnid. The results are fed through handle_epm_event which is enqueued onto 
@@ -1636,8 +1914,8 @@ class eptSubscriber(object):
             }
         objects = get_class(self.session, classname, **kwargs)
         ts = time.time()
-        # 3-level dict to track endpoints returned from class query endpoints[node][vnid][addr] = 1
-        endpoints = {}
+        # track endpoints returned from class query
+        endpoints = EndpointPresence()
         # queue all the events to send at one time...
         create_msgs = []
         # queue all the events to send at one time...
@@ -1650,11 +1928,7 @@ class eptSubscriber(object):
                     msg = self.epm_parser.parse(classname, attr, attr["_ts"])
                     if msg is not None:
                         create_msgs.append(msg)
-                        if msg.node not in endpoints:
-                            endpoints[msg.node] = {}
-                        if msg.vnid not in endpoints[msg.node]:
-                            endpoints[msg.node][msg.vnid] = {}
-                        endpoints[msg.node][msg.vnid][msg.addr] = 1
+                        endpoints.add(msg.node, msg.vnid, msg.addr)
                 else:
                     logger.debug("ignoring invalid epm object %s", obj)
             # get delete jobs
@@ -1670,8 +1944,8 @@ class eptSubscriber(object):
             logger.debug("failed to get epm objects")
 
     def get_epm_delete_msgs(self, endpoints, addr=None, vnid=None):
-        """ from provided create endpoint dict and flt, stream iterators for epm delete msgs
-            endpoints must be 3-level dict in the form endpoints[node][vnid][addr]
+        """ from provided create endpoint presence set and flt, stream iterators for epm delete 
+            msgs. endpoints must be an EndpointPresence object
         """
         logger.debug("get epm delete messages (flt addr:%s, vnid:%s)", addr, vnid)
 
@@ -1694,9 +1968,8 @@ class eptSubscriber(object):
 
         ts = time.time()
         for obj in self.db[eptHistory._classname].find(flt, projection):
-            # if in endpoints dict, then stil exists in the fabric so do not create a delete event
-            if obj["node"] in endpoints and obj["vnid"] in endpoints[obj["node"]] and \
-                obj["addr"] in endpoints[obj["node"]][obj["vnid"]]:
+            # if in endpoints set, then stil exists in the fabric so do not create a delete event
+            if endpoints.contains(obj["node"], obj["vnid"], obj["addr"]):
                 continue
             if obj["type"] == "mac":
                 msg = self.epm_parser.get_delete_event("epmMacEp", obj["node"], 
@@ -0,0 +1,103 @@
+
+import heapq
+import itertools
+import logging
+import threading
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+class eptWatchQueue(object):
+    """ pending watch events for the watcher indexed by unique key. Each fabric has a heap ordered
+        by execute timestamp (xts) so ready events are popped in O(log n) instead of scanning every
+        pending event.
+
+        When a key is re-armed, the new msg replaces the old msg in the key index and the old heap
+        entry is left in place. Heap entries whose msg no longer matches the key index are discarded
+        when popped (lazy deletion). The heaps are rebuilt if the number of stale entries grows
+        larger than the number of pending events.
+
+        Each msg must have fabric, xts, and wf attributes. If the fabric of the next ready msg is
+        paused (msg.wf.watcher_paused) then all events for the fabric are skipped.
+    """
+    # min number of heap entries before stale entries are compacted
+    COMPACT_MIN_SIZE = 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.msgs = {}          # key to pending msg
+        self.heaps = {}         # fabric to heap of (xts, seq, key, msg)
+        self.entries = 0        # total heap entries including stale entries
+        self.seq = itertools.count()
+
+    def __len__(self):
+        return len(self.msgs)
+
+    def __contains__(self, key):
+        return key in self.msgs
+
+    def __repr__(self):
+        return "pending:%s, entries:%s, fabrics:%s" % (len(self.msgs), self.entries,
+                                                        len(self.heaps))
+
+    def push(self, key, msg):
+        """ add or re-arm watch event for key """
+        with self.lock:
+            self.msgs[key] = msg
+            if msg.fabric not in self.heaps:
+                self.heaps[msg.fabric] = []
+            heapq.heappush(self.heaps[msg.fabric], (msg.xts, next(self.seq), key, msg))
+            self.entries+= 1
+            if self.entries > 2*len(self.msgs) + eptWatchQueue.COMPACT_MIN_SIZE:
+                self._compact()
+
+    def pop_ready(self, ts):
+        """ remove and return list of (key, msg) with xts <= ts for fabrics that are not paused """
+        work = []
+        paused = {}             # count of pending entries per paused fabric for accounting only
+        with self.lock:
+            for fabric in self.heaps.keys():
+                heap = self.heaps[fabric]
+                while len(heap) > 0 and heap[0][0] <= ts:
+                    (xts, seq, key, msg) = heap[0]
+                    if self.msgs.get(key, None) is not msg:
+                        heapq.heappop(heap)
+                        self.entries-= 1
+                    elif msg.wf.watcher_paused:
+                        paused[fabric] = len(heap)
+                        break
+                    else:
+                        heapq.heappop(heap)
+                        self.entries-= 1
+                        self.msgs.pop(key, None)
+                        work.append((key, msg))
+                if len(heap) == 0:
+                    self.heaps.pop(fabric, None)
+        for fabric in paused:
+            logger.debug("paused %s watch events for fabric %s", paused[fabric], fabric)
+        return work
+
+    def remove_fabric(self, fabric):
+        """ remove all pending events for fabric, return number of events removed """
+        count = 0
+        with self.lock:
+            heap = self.heaps.pop(fabric, [])
+            self.entries-= len(heap)
+            for (xts, seq, key, msg) in heap:
+                if self.msgs.get(key, None) is msg:
+                    self.msgs.pop(key, None)
+                    count+= 1
+        return count
+
+    def _compact(self):
+        # rebuild heaps from pending msgs to drop stale entries, must be called with lock held
+        heaps = {}
+        for key, msg in self.msgs.iteritems():
+            if msg.fabric not in heaps:
+                heaps[msg.fabric] = []
+            heaps[msg.fabric].append((msg.xts, next(self.seq), key, msg))
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        self.heaps = heaps
+        self.entries = len(self.msgs)
+
@@ -1,13 +1,16 @@
 
+from ... utils import get_app_config
 from ... utils import get_redis
 from ... utils import get_db
-from .. utils import execute_worker
 from .. utils import raise_interrupt
 from .. utils import register_signal_handlers
+from . common import CACHE_BUDGET_INTERVAL
 from . common import CACHE_STATS_INTERVAL
 from . common import HELLO_INTERVAL
 from . common import MANAGER_WORK_QUEUE
 from . common import RAPID_CALCULATE_INTERVAL
+from . common import RAPID_FLUSH_INTERVAL
+from . common import REBALANCE_PAUSE_TIMEOUT
 from . common import TRANSITORY_DELETE
 from . common import TRANSITORY_OFFSUBNET
 from . common import TRANSITORY_RAPID
@@ -16,21 +19,30 @@ from . common import TRANSITORY_STALE_NO_LOCAL
 from . common import SUPPRESS_WATCH_OFFSUBNET
 from . common import SUPPRESS_WATCH_STALE
 from . common import SUBSCRIBER_CTRL_CHANNEL
+from . common import WATCH_BATCH_SIZE
 from . common import WATCH_INTERVAL
 from . common import WATCHER_BROADCAST_CHANNEL
 from . common import WORKER_BROADCAST_CHANNEL
 from . common import WORKER_CTRL_CHANNEL
+from . common import WORKER_QUEUE_POLL_TIMEOUT
+from . common import WRITE_BUFFER_INTERVAL
 from . common import MAX_SEND_MSG_LENGTH
 from . common import BackgroundThread
 from . common import db_alive
 from . common import flush_queue
 from . common import get_addr_type
+from . common import get_push_event_update
+from . common import get_dispatch_queue
+from . common import get_msg_hash
 from . common import get_vpc_domain_id
 from . common import log_version
 from . common import parse_vrf_name
 from . common import split_vpc_domain_id
+from . common import update_cache_generation
 from . common import wait_for_db
 from . common import wait_for_redis
+from . ept_clear import eptClearEndpoint
+from . ept_dispatcher import send_rebalance_ack
 from . ept_endpoint import eptEndpoint
 from . ept_endpoint import eptEndpointEvent
 from . ept_history import eptHistory
@@ -38,6 +50,7 @@ from . ept_history import eptHistoryEvent
 from . ept_move import eptMove
 from . ept_move import eptMoveEvent
 from . ept_msg import MSG_TYPE
+from . ept_msg import WIRE_VERSION
 from . ept_msg import WORK_TYPE
 from . ept_msg import eptMsg
 from . ept_msg import eptMsgBulk
@@ -56,9 +69,14 @@ from . ept_remediate import eptRemediate
 from . ept_queue_stats import eptQueueStats
 from . ept_stale import eptStale
 from . ept_stale import eptStaleEvent
+from . ept_watch_queue import eptWatchQueue
 from . ept_worker_fabric import eptWorkerFabric
 from . mo_dependency_map import dependency_map
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from six.moves.queue import Queue
+
 import copy
 import json
 import logging
@@ -95,27 +113,55 @@ class eptWorker(object):
         self.channel_thread = None
         # check execute_ts for watch events at regular interval
         self.watch_thread = None
+        # flush buffered db writes at regular interval
+        self.write_thread = None
+        # flush rapid counters at regular interval
+        self.rapid_thread = None
+        # worker buffers hot path db writes and flushes them in bulk
+        self.write_buffer = False
+        if self.role == "worker":
+            self.write_buffer = bool(get_app_config().get("WORKER_WRITE_BUFFER", True))
+        # worker bulk loads fabric caches when subscriber completes initial build
+        self.cache_warmup = False
+        if self.role == "worker":
+            self.cache_warmup = bool(get_app_config().get("WORKER_CACHE_WARMUP", True))
+        # memory budget in bytes shared by caches of all fabrics, 0 for fixed cache sizes
+        self.cache_budget = 0
+        if self.role == "worker":
+            self.cache_budget = int(get_app_config().get("WORKER_CACHE_MEMORY_MB", 0)) * 1024 * 1024
+        # max number of nodes across all fabrics the watcher clears endpoints on in parallel
+        self.watch_clear_concurrency = int(get_app_config().get("WATCHER_CLEAR_CONCURRENCY", 1))
+        # watcher clears endpoints in background threads so ssh delays do not block watch events.
+        # clear_pending holds (fabric, node, vnid, addr) of each endpoint queued or being cleared
+        self.clear_queue = Queue()
+        self.clear_threads = []
+        self.clear_pending = set()
+        self.clear_lock = threading.Lock()
 
         # keep a dummy seq for each supported broadcast channel
         self.watcher_broadcast_seq = 0
         self.worker_broadcast_seq = 0
 
         # watcher active keys where key is unique fabric+addr+vnid+node (rapid excludes node)
-        self.watch_stale = {}
-        self.watch_offsubnet = {}
-        self.watch_rapid = {}
+        self.watch_stale = eptWatchQueue()
+        self.watch_offsubnet = eptWatchQueue()
+        self.watch_rapid = eptWatchQueue()
 
         # multithreading locks
         self.queue_stats_lock = threading.Lock()
-        self.watch_stale_lock = threading.Lock()
-        self.watch_offsubnet_lock = threading.Lock()
-        self.watch_rapid_lock = threading.Lock()
         self.manager_work_queue_lock = threading.Lock()
         self.priority_lock = threading.Lock()
         self.non_priority_lock = threading.Lock()
 
-        # queues that this worker will listen on 
+        # rebalance version of pending pause request from manager and event set on resume
+        self.rebalance_pause = None
+        self.rebalance_resume = threading.Event()
+        self.rebalance_resume.set()
+
+        # queues that this worker will listen on in priority order
         self.queues = [ "q0_%s" % self.worker_id ]
+        # max number of queued messages handled per redis round trip
+        self.queue_batch_size = max(1, int(get_app_config().get("WORKER_QUEUE_BATCH_SIZE", 64)))
         self.queue_stats = {
             "q0_%s" % self.worker_id: eptQueueStats.load(
                 proc=self.worker_id,
@@ -149,7 +195,9 @@ class eptWorker(object):
 
         start_ts = time.time()
         self.cache_stats_time = start_ts
-        self.hello_msg = eptMsgHello(self.worker_id, self.role, self.queues, start_ts)
+        self.cache_budget_time = start_ts
+        self.hello_msg = eptMsgHello(self.worker_id, self.role, self.queues, start_ts,
+                                        wire_version=WIRE_VERSION, cache_budget=self.cache_budget)
         self.hello_msg.seq = 0
 
         # handlers registered based on configured role
@@ -182,7 +230,17 @@ class eptWorker(object):
                 WORK_TYPE.DELETE_EPT: self.handle_endpoint_delete,
                 WORK_TYPE.SETTINGS_RELOAD: self.handle_settings_reload,
                 WORK_TYPE.FABRIC_EPM_EOF:  self.handle_epm_eof,
+                WORK_TYPE.WORKER_REBALANCE: self.handle_worker_rebalance,
+                WORK_TYPE.CACHE_WARMUP: self.handle_cache_warmup,
             }
+            # endpoint events are the only work that can run against buffered writes, all other
+            # work types flush the write buffer for the fabric first so they see the db state
+            self.buffered_work_types = [
+                WORK_TYPE.RAW,
+                WORK_TYPE.EPM_IP_EVENT,
+                WORK_TYPE.EPM_MAC_EVENT,
+                WORK_TYPE.EPM_RS_IP_EVENT,
+            ]
         else:
             raise Exception("unknown role '%s'" % self.role)
 
@@ -228,6 +286,26 @@ class eptWorker(object):
                 )
                 self.watch_thread.daemon = True
                 self.watch_thread.start()
+            # buffered writes need to be flushed within max delay even if no new work is received
+            if self.write_buffer:
+                self.write_thread = BackgroundThread(
+                    func=self.flush_expired_writes,
+                    name="wrk-write",
+                    count=0,
+                    interval=WRITE_BUFFER_INTERVAL
+                )
+                self.write_thread.daemon = True
+                self.write_thread.start()
+            # rapid counters are held in memory by worker and written to the db in bulk
+            if self.role == "worker":
+                self.rapid_thread = BackgroundThread(
+                    func=self.flush_rapid,
+                    name="wrk-rapid",
+                    count=0,
+                    interval=RAPID_FLUSH_INTERVAL
+                )
+                self.rapid_thread.daemon = True
+                self.rapid_thread.start()
 
             # start listening to redis channels/queues
             self._run()
@@ -238,6 +316,13 @@ class eptWorker(object):
                 self.hello_thread.exit()
             if self.watch_thread is not None:
                 self.watch_thread.exit()
+            self.stop_clear_threads()
+            if self.write_thread is not None:
+                self.write_thread.exit()
+            if self.rapid_thread is not None:
+                self.rapid_thread.exit()
+            self.flush_rapid()
+            self.flush_writes()
             if self.stats_thread is not None:
                 self.stats_thread.exit()
             if self.channel_thread is not None:
@@ -250,15 +335,46 @@ class eptWorker(object):
     def _run(self):
         """ listen for work on redis queues """
         # first check/wait on redis and mongo connection, then start hello thread
-        logger.debug("[%s] listening for jobs on queues: %s", self, self.queues)
+        logger.debug("[%s] listening for jobs on queues: %s (batch size %s)", self, self.queues,
+                        self.queue_batch_size)
         while True: 
-            (q, data) = self.redis.blpop(self.queues)
+            self.check_rebalance()
+            # block for first message and then drain any other pending messages up to batch size.
+            # blpop uses a timeout so an idle worker can still pause for rebalance
+            ret = self.redis.blpop(self.queues, timeout=WORKER_QUEUE_POLL_TIMEOUT)
+            if ret is None:
+                continue
+            (q, data) = ret
+            batch = [(q, data)]
+            if self.queue_batch_size > 1:
+                batch+= self.get_queue_batch(self.queue_batch_size - 1)
+                # keep queue priority within the batch, order within each queue is preserved
+                if len(self.queues) > 1:
+                    batch.sort(key=lambda b: self.queues.index(b[0]))
             # need to grab both priority and non-priority locks but immediately release priority
-            # which will allow channel message to hold it and block non_priority
+            # which will allow channel message to hold it and block non_priority. The full batch
+            # is handled under the non_priority lock so channel messages preempt between batches
             self.priority_lock.acquire()
             with self.non_priority_lock:
                 self.priority_lock.release()
-                self.handle_redis_msgs(q, data)
+                for (q, data) in batch:
+                    self.handle_redis_msgs(q, data)
+
+    def get_queue_batch(self, count):
+        """ pop up to count messages from worker queues in priority order without blocking. Each
+            queue is read with a single lrange/ltrim transaction. Return list of (queue, data)
+        """
+        ret = []
+        for q in self.queues:
+            if count <= 0:
+                break
+            pl = self.redis.pipeline()
+            pl.lrange(q, 0, count-1)
+            pl.ltrim(q, count, -1)
+            data = pl.execute()[0]
+            count-= len(data)
+            ret.extend([(q, d) for d in data])
+        return ret
 
     def handle_channel_msg(self, msg):
         """ handle msg received on subscribed channels """
@@ -299,9 +415,14 @@ class eptWorker(object):
                 try:
                     logger.debug("[%s] msg on q(%s): %s", self, q, msg)
                     if msg.msg_type == MSG_TYPE.WORK:
-                        if msg.wt in self.work_type_handlers:
+                        if msg.wt == WORK_TYPE.WORKER_REBALANCE:
+                            # rebalance applies to all fabrics
+                            self.handle_worker_rebalance(msg)
+                        elif msg.wt in self.work_type_handlers:
                             # set msg.wf to current fabric eptWorkerFabric object
                             self.set_msg_worker_fabric(msg)
+                            if self.write_buffer and msg.wt not in self.buffered_work_types:
+                                msg.wf.flush_writes()
                             self.work_type_handlers[msg.wt](msg)
                         else:
                             logger.warn("unsupported work type[%s] for role[%s]",msg.wt,self.role)
@@ -375,24 +496,44 @@ class eptWorker(object):
     def send_msg(self, msg):
         """ send one or more eptMsgWork objects to worker via manager work queue 
             limit the number of messages sent at a time to MAX_SEND_MSG_LENGTH
+            messages are always sent as eptMsgBulk with route info (worker hash, role, and qnum)
+            so the manager can dispatch to workers without parsing each message
+            if manager dispatchers are enabled then messages are sent to the dispatch queue for the
+            corresponding fabric
         """
-        if isinstance(msg, list):
+        if not isinstance(msg, list):
+            msg = [msg]
+        # receiver may read objects updated by this worker so any buffered writes must be flushed
+        if self.write_buffer:
+            for fabric in set([m.fabric for m in msg]):
+                if fabric in self.fabrics:
+                    self.fabrics[fabric].flush_writes()
+        # group messages per dispatch queue maintaining order within each queue
+        queues = {}
+        for m in msg:
+            q = get_dispatch_queue(m.fabric)
+            if q not in queues:
+                queues[q] = []
+            queues[q].append(m)
+        for q, qmsgs in queues.items():
             # break up msg into multiple blocks and send as single eptMsgBulk
-            for i in range(0, len(msg), MAX_SEND_MSG_LENGTH):
+            for i in range(0, len(qmsgs), MAX_SEND_MSG_LENGTH):
                 bulk = eptMsgBulk()
-                bulk.msgs = [m for m in msg[i:i+MAX_SEND_MSG_LENGTH]]
+                bulk.msgs = [m for m in qmsgs[i:i+MAX_SEND_MSG_LENGTH]]
                 if len(bulk.msgs)>0:
+                    # addr of 0 is a broadcast to all workers of role and does not require hash
+                    route = [[get_msg_hash(m) if m.addr != 0 else None, m.role, m.qnum] 
+                                for m in bulk.msgs]
                     with self.manager_work_queue_lock:
-                        self.redis.rpush(MANAGER_WORK_QUEUE, bulk.jsonify())
+                        self.redis.rpush(q, bulk.jsonify_route(route))
                     self.increment_stats(MANAGER_WORK_QUEUE, tx=True, count=len(bulk.msgs))
-        else:
-            with self.manager_work_queue_lock:
-                self.redis.rpush(MANAGER_WORK_QUEUE, msg.jsonify())
-            self.increment_stats(MANAGER_WORK_QUEUE, tx=True)
 
     def send_flush(self, fabric, collection, name=None):
         """ send flush message to workers for provided collection """
         logger.debug("flush %s (name:%s)", collection._classname, name)
+        # update shared cache generation before the broadcast so workers sharing a host cache 
+        # reload it (or invalidate the name) when the flush is received
+        update_cache_generation(self.redis, fabric, collection._classname, name)
         data = {"cache": collection._classname, "name": name}
         self.broadcast(eptMsgWork(0, "worker", data, WORK_TYPE.FLUSH_CACHE, fabric=fabric))
 
@@ -414,6 +555,25 @@ class eptWorker(object):
                 if f in fabrics: 
                     self.fabrics[f].cache.log_stats()
 
+        # resize caches to fit memory budget, usage is reported in the next hello
+        if self.cache_budget > 0 and ts - self.cache_budget_time > CACHE_BUDGET_INTERVAL:
+            self.cache_budget_time = ts
+            self.hello_msg.cache_usage = self.apply_cache_budget()
+
+    def apply_cache_budget(self):
+        """ split cache memory budget evenly across fabrics and resize caches of each fabric.
+            return estimated bytes used by all caches
+        """
+        usage = 0
+        fabrics = self.fabrics.keys()
+        if len(fabrics) > 0:
+            budget = self.cache_budget / len(fabrics)
+            for f in fabrics:
+                wf = self.fabrics.get(f, None)
+                if wf is not None:
+                    usage+= wf.cache.apply_memory_budget(budget)
+        return usage
+
     def fabric_start(self, fabric):
         """ start fabric to init cache and for watcher process, to set a start timestamp for the 
             fabric for extending transitory timers
@@ -421,7 +581,8 @@ class eptWorker(object):
         # need to trigger a graceful stop for worker process if already cached
         self.fabric_stop(fabric)
         logger.debug("[%s] start fabric: %s", self, fabric)
-        self.fabrics[fabric] = eptWorkerFabric(fabric)
+        self.fabrics[fabric] = eptWorkerFabric(fabric, write_buffer=self.write_buffer,
+                                                shared_cache=self.role == "worker")
         if self.role == "watcher":
             self.fabrics[fabric].watcher_init()
 
@@ -438,19 +599,13 @@ class eptWorker(object):
             flush_queue(self.redis, fabric, q)
         if self.role == "watcher":
             watches = [
-                ("offsubnet", self.watch_offsubnet_lock, self.watch_offsubnet),
-                ("stale", self.watch_stale_lock, self.watch_stale),
-                ("rapid", self.watch_rapid_lock, self.watch_rapid),
+                ("offsubnet", self.watch_offsubnet),
+                ("stale", self.watch_stale),
+                ("rapid", self.watch_rapid),
             ]
-            for (name, lock, d) in watches:
-                pop = []
-                with lock:
-                    for (key, msg) in d.items():
-                        if msg.fabric == fabric: 
-                            pop.append(key)
-                    for k in pop: 
-                        d.pop(k, None)
-                logger.debug("[%s] %s events removed from watch_%s", self, len(pop), name)
+            for (name, watch_queue) in watches:
+                count = watch_queue.remove_fabric(fabric)
+                logger.debug("[%s] %s events removed from watch_%s", self, count, name)
 
     def flush_cache(self, msg):
         """ receive flush cache work containing cache and optional object name """
@@ -466,10 +621,75 @@ class eptWorker(object):
         else:
             logger.warn("invalid flush cache message")
 
+    def handle_worker_rebalance(self, msg):
+        """ manager is migrating work for endpoints that have moved to a different worker. On pause,
+            the worker stops reading from its queues (see check_rebalance) until resume is received
+        """
+        phase = msg.data.get("phase", "")
+        logger.debug("worker rebalance %s (version %s)", phase, msg.data.get("version", 0))
+        if phase == "pause":
+            self.rebalance_resume.clear()
+            self.rebalance_pause = msg.data.get("version", 0)
+        elif phase == "resume":
+            self.rebalance_resume.set()
+        else:
+            logger.warn("unsupported worker rebalance phase: %s", phase)
+
+    def check_rebalance(self):
+        """ if a rebalance pause is pending then save and release all cached endpoint state so the
+            next event for an endpoint is loaded from the db including any updates from the previous
+            owner, ack the pause to the manager, and block until the manager resumes the worker.
+            This is executed by the main worker thread between batches so no work is in progress.
+        """
+        if self.rebalance_pause is None:
+            return
+        with self.priority_lock:
+            with self.non_priority_lock:
+                version = self.rebalance_pause
+                self.rebalance_pause = None
+                for fabric in self.fabrics.keys():
+                    wf = self.fabrics.get(fabric, None)
+                    if wf is not None:
+                        wf.cache.release_endpoint_state()
+                        wf.flush_writes()
+                send_rebalance_ack(self.redis, self.worker_id, version, "pause")
+        if not self.rebalance_resume.wait(REBALANCE_PAUSE_TIMEOUT):
+            logger.warn("timeout waiting for rebalance resume (version %s)", version)
+
+    def flush_rapid(self):
+        """ write rapid counters updated since last flush for all fabrics. This is executed in a
+            background thread so it must hold both priority and non_priority locks to prevent
+            concurrent access to the rapid table with the worker thread
+        """
+        with self.priority_lock:
+            with self.non_priority_lock:
+                for fabric in self.fabrics.keys():
+                    wf = self.fabrics.get(fabric, None)
+                    if wf is not None:
+                        try:
+                            wf.cache.flush_rapid()
+                        except Exception as e:
+                            logger.error("Traceback:\n%s", traceback.format_exc())
+
+    def flush_writes(self):
+        """ flush buffered db writes for all fabrics """
+        for fabric in self.fabrics.keys():
+            wf = self.fabrics.get(fabric, None)
+            if wf is not None:
+                wf.flush_writes()
+
+    def flush_expired_writes(self):
+        """ flush buffered db writes for each fabric where the oldest write exceeds max delay """
+        for fabric in self.fabrics.keys():
+            wf = self.fabrics.get(fabric, None)
+            if wf is not None:
+                wf.flush_expired_writes()
+
     def set_msg_worker_fabric(self, msg):
         """ create eptWorkerFabric object for this fabric if not already known """
         if msg.fabric not in self.fabrics:
-            self.fabrics[msg.fabric] = eptWorkerFabric(msg.fabric)
+            self.fabrics[msg.fabric] = eptWorkerFabric(msg.fabric, write_buffer=self.write_buffer,
+                                                        shared_cache=self.role == "worker")
         setattr(msg, "wf", self.fabrics[msg.fabric])
         setattr(msg, "now", time.time())
 
@@ -509,9 +729,59 @@ class eptWorker(object):
                 logger.debug("ignoring event, endpoint is_rapid")
                 return
 
+        # the endpoint is owned by this worker (msg hash) so the last per-node history events and 
+        # local events can be kept in the endpoint state cache. On miss, fall back to the db.
+        state = msg.wf.cache.get_endpoint_state(msg.vnid, addr)
+        if state.history is not None:
+            per_node_history_events = state.history
+        else:
+            msg.wf.flush_writes()
+            per_node_history_events = self.get_per_node_history_events(msg.fabric, msg.vnid, addr)
+            state.history = per_node_history_events
+
+        try:
+            # update endpoint history table and determine based on event if analysis is required
+            # if this is a new event, the event is inserted into per_node_history_events 
+            analysis_required = self.update_endpoint_history(msg, per_node_history_events)
+
+            # we no longer care what the original msg event type. However, we need to maintain the 
+            # correct key (fabric, vnid, addr, node) and to ensure that addr is pointing to correct
+            # value for EPM_RS_IP_EVENTs. Also, we need to update type to 'ip'.
+            if is_rs_ip_event:
+                msg.addr = msg.ip
+                msg.type = "ip"
+
+            # update ept_endpoint with local event. Return last locals events for move analyze
+            # note the result may be None if endpoint is_rapid
+            update_local_result = self.update_local(msg, per_node_history_events, cached_rapid, 
+                                        state=state)
+
+            # perform move/offsubnet/stale analysis
+            if (analysis_required or msg.force) and update_local_result is not None:
+                if msg.wf.settings.analyze_move:
+                    if update_local_result.analyze_move:
+                        self.analyze_move(msg, update_local_result.local_events)
+                    else:
+                        logger.debug("skipping analyze move since update_local produced no update")
+                if msg.wf.settings.analyze_offsubnet:
+                    self.analyze_offsubnet(msg, per_node_history_events, update_local_result)
+                if msg.wf.settings.analyze_stale:
+                    self.analyze_stale(msg, per_node_history_events, update_local_result)
+        except Exception as e:
+            # state may be partially updated, force reload from db on next event for endpoint
+            msg.wf.cache.remove_endpoint_state(msg.vnid, addr)
+            raise
+        # only the most recent event per node is required for next analysis
+        for node in per_node_history_events:
+            del per_node_history_events[node][1:]
+
+    def get_per_node_history_events(self, fabric, vnid, addr):
+        """ get last eptHistory event for endpoint across all nodes from db. Return dict indexed by
+            node-id containing list with events.0 (with watch info embedded)
+        """
         flt = {
-            "fabric": msg.fabric,
-            "vnid": msg.vnid,
+            "fabric": fabric,
+            "vnid": vnid,
             "addr": addr,
         }
         projection = {
@@ -532,33 +802,7 @@ class eptWorker(object):
                 events[0].watch_stale_event = eptStaleEvent.from_dict(h["watch_stale_event"])
                 events[0].watch_offsubnet_ts = h["watch_offsubnet_ts"]
                 per_node_history_events[h["node"]] = events
-
-        # update endpoint history table and determine based on event if analysis is required
-        # if this is a new event, the event is inserted into per_node_history_events 
-        analysis_required = self.update_endpoint_history(msg, per_node_history_events)
-
-        # we no longer care what the original msg event type. However, we need to maintain the 
-        # correct key (fabric, vnid, addr, node) and to ensure that addr is pointing to correct
-        # value for EPM_RS_IP_EVENTs. Also, we need to update type to 'ip'.
-        if is_rs_ip_event:
-            msg.addr = msg.ip
-            msg.type = "ip"
-
-        # update ept_endpoint with local event. Return last locals events for move analyze
-        # note the result may be None if endpoint is_rapid
-        update_local_result = self.update_local(msg, per_node_history_events, cached_rapid) 
-
-        # perform move/offsubnet/stale analysis
-        if (analysis_required or msg.force) and update_local_result is not None:
-            if msg.wf.settings.analyze_move:
-                if update_local_result.analyze_move:
-                    self.analyze_move(msg, update_local_result.local_events)
-                else:
-                    logger.debug("skipping analyze move since update_local produced no update")
-            if msg.wf.settings.analyze_offsubnet:
-                self.analyze_offsubnet(msg, per_node_history_events, update_local_result)
-            if msg.wf.settings.analyze_stale:
-                self.analyze_stale(msg, per_node_history_events, update_local_result)
+        return per_node_history_events
 
     def update_endpoint_history(self, msg, per_node_history_events):
         """ push event into eptHistory table and determine if analysis is required """
@@ -657,11 +901,11 @@ class eptWorker(object):
                 # if this is new endpoint from rs_ip_event, ensure address is ip and rw info set
                 event.rw_mac = msg.addr
                 event.rw_bd = msg.bd
-                eptHistory(fabric=msg.fabric, node=msg.node, vnid=msg.vnid, addr=msg.ip, 
-                        type=msg.type, count=1, events=[event.to_dict()]).save(refresh=False)
+                msg.wf.save(eptHistory(fabric=msg.fabric, node=msg.node, vnid=msg.vnid, 
+                        addr=msg.ip, type=msg.type, count=1, events=[event.to_dict()]))
             else:
-                eptHistory(fabric=msg.fabric, node=msg.node, vnid=msg.vnid, addr=msg.addr, 
-                        type=msg.type, count=1, events=[event.to_dict()]).save(refresh=False)
+                msg.wf.save(eptHistory(fabric=msg.fabric, node=msg.node, vnid=msg.vnid, 
+                        addr=msg.addr, type=msg.type, count=1, events=[event.to_dict()]))
             per_node_history_events[msg.node] = [event]
 
             # no analysis required for new event if:
@@ -794,7 +1038,7 @@ class eptWorker(object):
             logger.debug("no update detected for eptHistory")
             return False
 
-    def update_local(self, msg, per_node_history_event, cached_rapid):
+    def update_local(self, msg, per_node_history_event, cached_rapid, state=None):
         """ update/add local entries to ept_endpoint table and return list of most recent
             fabric-wide complete local events (where complete requires rewrite info for ip endpoints)
             -   calculates where endpoint is local relevant to all nodes in the fabric. Note, the
@@ -806,6 +1050,9 @@ class eptWorker(object):
             -   if previous event was a delete and current event is create with timestamp less than 
                 transitory time, then overwrite the delete with the create
 
+            if state (endpointStateCachedObject) is provided, then the eptEndpoint projection is 
+            read from and written through to the state instead of reading from the db
+
             return eptWorkerUpdateLocalResult object
         """
         ret = eptWorkerUpdateLocalResult()
@@ -830,7 +1077,15 @@ class eptWorker(object):
             "vnid": msg.vnid,
             "addr": msg.addr,
         }
-        endpoint = self.db[eptEndpoint._classname].find_one(flt, projection)
+        if state is not None and state.endpoint_loaded:
+            endpoint = state.endpoint
+        else:
+            msg.wf.flush_writes()
+            endpoint = self.db[eptEndpoint._classname].find_one(flt, projection)
+            if state is not None:
+                state.endpoint = endpoint
+                state.endpoint_loaded = True
+        ret.endpoint = endpoint
         # if analyze_rapid is enabled and cached_rapid.rapid_count is 0, then no rapid calculation
         # has been performed yet and we need to update all values and trigger analysis. Else,
         # just update rapid_count. note cached_rapid is None if analyze_rapid is disabled
@@ -876,8 +1131,21 @@ class eptWorker(object):
             endpoint_type = get_addr_type(msg.addr, msg.type)
             dummy_event = eptEndpointEvent.from_dict({"vnid_name":msg.vnid_name}).to_dict()
             logger.debug("learn type set to %s", learn_type)
-            eptEndpoint(fabric=msg.fabric, vnid=msg.vnid, addr=msg.addr,type=endpoint_type,
-                    first_learn=dummy_event, learn_type=learn_type).save(refresh=False)
+            msg.wf.save(eptEndpoint(fabric=msg.fabric, vnid=msg.vnid, addr=msg.addr,
+                    type=endpoint_type, first_learn=dummy_event, learn_type=learn_type))
+            ret.endpoint = {
+                "learn_type": learn_type,
+                "is_stale": False,
+                "is_offsubnet": False,
+                "events": [],
+                "is_rapid": False,
+                "rapid_lts": 0.0,
+                "rapid_count": 0,
+                "rapid_lcount": 0,
+                "rapid_icount": 0,
+            }
+            if state is not None:
+                state.endpoint = ret.endpoint
 
         # determine current complete local event
         local_event = None
@@ -901,9 +1169,10 @@ class eptWorker(object):
             # that allows update of learn_type when local_event does not exists.
             if last_learn_type is not None and last_learn_type=="epg" and learn_type!="epg":
                 logger.debug("updating learn_type from %s to %s", last_learn_type, learn_type)
-                self.db[eptEndpoint._classname].update(flt, 
+                msg.wf.update_one(eptEndpoint._classname, flt, 
                     {"$set":{"learn_type": learn_type}}
                 )
+                ret.endpoint["learn_type"] = learn_type
             if last_event is not None and last_event.node > 0:
                 local_event = eptEndpointEvent.from_dict({
                     "ts":msg.ts, 
@@ -943,7 +1212,7 @@ class eptWorker(object):
             # if this is the first event, then set first_learn, count, and events in single update
             if last_event is None:
                 logger.debug("creating new entry in endpoint table: %s", local_event)
-                self.db[eptEndpoint._classname].update_one(flt, {"$set":{
+                msg.wf.update_one(eptEndpoint._classname, flt, {"$set":{
                     "first_learn": db_event,
                     "events": [db_event],
                     "count": 1,
@@ -984,16 +1253,17 @@ class eptWorker(object):
                     # check if learn_type has changed for this complete event
                     if last_learn_type is not None and last_learn_type!=learn_type:
                         logger.debug("learn type updated from %s to %s",last_learn_type,learn_type)
-                        self.db[eptEndpoint._classname].update(flt, 
+                        msg.wf.update_one(eptEndpoint._classname, flt, 
                             {"$set":{"learn_type": learn_type}}
                         )
+                        ret.endpoint["learn_type"] = learn_type
                     if updated:
                         # if the previous entry was a delete and the current entry is not a delete, 
                         # then check for possible merge.
                         if last_event.node==0 and local_event.node>0 and ts_delta<=TRANSITORY_DELETE:
                             logger.debug("overwritting eptEndpoint [ts delta(%.3f) < %.3f] with: %s",
                                 ts_delta, TRANSITORY_DELETE, local_event)
-                            self.db[eptEndpoint._classname].update(flt, 
+                            msg.wf.update_one(eptEndpoint._classname, flt, 
                                     {"$set":{"events.0": db_event}}
                                 )
                             ret.local_events[0] = local_event
@@ -1011,6 +1281,8 @@ class eptWorker(object):
             logger.debug("final local result: %s", ret.local_events[0])
         else:
             logger.debug("final local result: empty")
+        # local_events always reflect the db events list, keep the last two within endpoint state
+        ret.endpoint["events"] = [e.to_dict() for e in ret.local_events[0:2]]
         # return last local endpoint events
         return ret
 
@@ -1082,7 +1354,7 @@ class eptWorker(object):
                 self.send_msg(mmsg)
 
             logger.debug("rapid rate:%.3f, ts:%.3f, rapid:%r",rate,ts_delta,cached_rapid.is_rapid)
-            cached_rapid.save() 
+            cached_rapid.save()
         return cached_rapid.is_rapid
 
     def analyze_move(self, msg, last_local):
@@ -1114,12 +1386,13 @@ class eptWorker(object):
             "vnid": msg.vnid,
             "addr": msg.addr,
         }
+        msg.wf.flush_writes()
         db_move = self.db[eptMove._classname].find_one(flt, projection)
         if db_move is None:
             logger.debug("new move detected")
             endpoint_type = get_addr_type(msg.addr, msg.type)
-            eptMove(fabric=msg.fabric, vnid=msg.vnid, addr=msg.addr, type=endpoint_type,
-                    count=1, events=[move_event]).save(refresh=False)
+            msg.wf.save(eptMove(fabric=msg.fabric, vnid=msg.vnid, addr=msg.addr, 
+                    type=endpoint_type, count=1, events=[move_event]))
         else:
             db_src = eptMoveEvent.from_dict(db_move["events"][0]["src"])
             db_dst = eptMoveEvent.from_dict(db_move["events"][0]["dst"])
@@ -1187,7 +1460,7 @@ class eptWorker(object):
             "vnid": msg.vnid,
             "addr": msg.addr,
         }
-        self.db[eptHistory._classname].update_many(flt, {"$set":{"is_offsubnet":False}})
+        msg.wf.update_many(eptHistory._classname, flt, {"$set":{"is_offsubnet":False}})
         if len(offsubnet_nodes)>0:
             nlist = []
             for node in offsubnet_nodes:
@@ -1197,11 +1470,17 @@ class eptWorker(object):
                 # recent event.
                 offsubnet_nodes[node].ts = msg.ts
             flt["$or"] = nlist
-            self.db[eptHistory._classname].update_many(flt, {"$set":{"is_offsubnet":True}})
+            msg.wf.update_many(eptHistory._classname, flt, {"$set":{"is_offsubnet":True}})
+            # watcher may set eptEndpoint is_offsubnet while any node is_offsubnet, assume it is
+            # set so next clear is not skipped by cached endpoint state
+            if update_local_result.endpoint is not None:
+                update_local_result.endpoint["is_offsubnet"] = True
         # clear eptEndpoint is_offsubnet flag if not currently offsubnet on any node
         elif update_local_result.is_offsubnet:
             logger.debug("clearing eptEndpoint is_offsubnet flag")
-            self.db[eptEndpoint._classname].update_one(flt, {"$set":{"is_offsubnet":False}})
+            msg.wf.update_one(eptEndpoint._classname, flt, {"$set":{"is_offsubnet":False}})
+            if update_local_result.endpoint is not None:
+                update_local_result.endpoint["is_offsubnet"] = False
 
         # suppress the event to watcher if within suppress interval
         if len(offsubnet_nodes)>0:
@@ -1235,9 +1514,10 @@ class eptWorker(object):
                     msgs.append(wmsg)
                     # mark watch ts for suppression of future events
                     flt["node"] = node
-                    self.db[eptHistory._classname].update_one(flt, {"$set":{
+                    msg.wf.update_one(eptHistory._classname, flt, {"$set":{
                         "watch_offsubnet_ts":msg.ts
                     }})
+                    per_node_history_events[node][0].watch_offsubnet_ts = msg.ts
                 logger.debug("sending %s offsubnet events to watcher", len(msgs))
                 self.send_msg(msgs)
 
@@ -1378,7 +1658,7 @@ class eptWorker(object):
             "vnid": msg.vnid,
             "addr": msg.addr,
         }
-        self.db[eptHistory._classname].update_many(flt, {"$set":{"is_stale":False}})
+        msg.wf.update_many(eptHistory._classname, flt, {"$set":{"is_stale":False}})
         if len(stale_nodes)>0:
             nlist = []
             for node in stale_nodes:
@@ -1388,12 +1668,18 @@ class eptWorker(object):
                 stale_nodes[node].ts = msg.ts
                 nlist.append({"node":node})
             flt["$or"] = nlist
-            self.db[eptHistory._classname].update_many(flt, {"$set":{"is_stale":True}})
+            msg.wf.update_many(eptHistory._classname, flt, {"$set":{"is_stale":True}})
+            # watcher may set eptEndpoint is_stale while any node is_stale, assume it is set so 
+            # next clear is not skipped by cached endpoint state
+            if update_local_result.endpoint is not None:
+                update_local_result.endpoint["is_stale"] = True
         # clear eptEndpoint is_stale flag if not currently stale on any node
         elif update_local_result.is_stale:
             logger.debug("clearing eptEndpoint is_stale flag")
             flt.pop("node",None)
-            self.db[eptEndpoint._classname].update_one(flt, {"$set":{"is_stale":False}})
+            msg.wf.update_one(eptEndpoint._classname, flt, {"$set":{"is_stale":False}})
+            if update_local_result.endpoint is not None:
+                update_local_result.endpoint["is_stale"] = False
 
         # suppress the event to watcher if within suppress interval
         if len(stale_nodes)>0:
@@ -1434,10 +1720,12 @@ class eptWorker(object):
                     msgs.append(wmsg)
                     # mark watch ts for suppression of future events
                     flt["node"] = node
-                    self.db[eptHistory._classname].update_one(flt, {"$set":{
+                    msg.wf.update_one(eptHistory._classname, flt, {"$set":{
                         "watch_stale_ts": msg.ts,
                         "watch_stale_event": stale_nodes[node].to_dict()
                     }})
+                    per_node_history_events[node][0].watch_stale_ts = msg.ts
+                    per_node_history_events[node][0].watch_stale_event = stale_nodes[node]
                 logger.debug("sending %s stale events to watcher", len(msgs))
                 self.send_msg(msgs)
 
@@ -1497,7 +1785,7 @@ class eptWorker(object):
 
     def handle_watch_rapid(self, msg):
         """ receive an eptMsgWorkRapid message and immediately performs notification action. If
-            refresh_rapid is enabled, then adds the object to watch_rapid dict with execute
+            refresh_rapid is enabled, then adds the object to watch_rapid queue with execute
             timestamp (xts) of msg.ts + eptSettings.rapid_holdtime + TRANSITORY_RAPID timer. If 
             object already exists it is overwritten with new watch event. This allows suppression
             of refresh events for endpoints that are continuously 'rapid' and waits until they 
@@ -1515,23 +1803,21 @@ class eptWorker(object):
         if msg.wf.settings.refresh_rapid:
             key = "%s,%s,%s" % (msg.fabric, msg.vnid, msg.addr)
             msg.xts = msg.now + msg.wf.settings.rapid_holdtime + TRANSITORY_RAPID
-            with self.watch_rapid_lock:
-                self.watch_rapid[key] = msg
+            self.watch_rapid.push(key, msg)
             logger.debug("watch rapid added with xts: %.03f, delta: %.03f", msg.xts, msg.xts-msg.now)
 
     def handle_watch_offsubnet(self, msg):
-        """ recieves an eptMsgWorkWatchOffSubnet message and adds object to watch_offsubnet dict with 
+        """ recieves an eptMsgWorkWatchOffSubnet message and adds object to watch_offsubnet queue with
             execute timestamp (xts) of msg.ts + TRANSITORY_OFFSUBNET timer. If object already
             exists it is overwritten with the new watch event.
         """
         key = "%s,%s,%s,%s" % (msg.fabric, msg.vnid, msg.addr, msg.node)
         msg.xts = msg.now + TRANSITORY_OFFSUBNET
-        with self.watch_offsubnet_lock:
-            self.watch_offsubnet[key] = msg
+        self.watch_offsubnet.push(key, msg)
         logger.debug("watch offsubnet added with xts: %.03f, delta: %.03f", msg.xts, msg.xts-msg.now)
 
     def handle_watch_stale(self, msg):
-        """ recevie an eptMsgWorkWatchStale message and adds object to watch_stale dict with execute
+        """ recevie an eptMsgWorkWatchStale message and adds object to watch_stale queue with execute
             timestamp (xts) of msg.ts + TRANSITORY_STALE or TRANSITORY_STALE_NO_LOCAL timer.
             If object already exists it is overwritten with the new watch event.
         """
@@ -1540,8 +1826,7 @@ class eptWorker(object):
             msg.xts = msg.now + TRANSITORY_STALE_NO_LOCAL
         else:
             msg.xts = msg.now + TRANSITORY_STALE
-        with self.watch_stale_lock:
-            self.watch_stale[key] = msg
+        self.watch_stale.push(key, msg)
         logger.debug("watch stale added with xts: %.03f, delta: %.03f", msg.xts, msg.xts-msg.now)
 
     def execute_watch(self):
@@ -1551,217 +1836,363 @@ class eptWorker(object):
         self.execute_generic_watch("offsubnet")
         self.execute_generic_watch("stale")
         self.execute_watch_rapid()
+        for wf in self.fabrics.values():
+            if wf.clear_service is not None:
+                wf.clear_service.close_idle()
 
-    def watcher_get_xts_ready(self, lock, msgs):
-        """ receive a lock and dict 'msgs' and pop off msgs that are ready to execute.
+    def watcher_get_xts_ready(self, watch_queue):
+        """ receive an eptWatchQueue and pop off msgs that are ready to execute.
             return tuple (key, msg) of ready msgs
         """
-        ts = time.time()
-        work = []               # tuple of (key, msg) of watch event that is ready
-        paused = {}             # count of work per fabric for accounting only
-        with lock:
-            # get msg events that are ready, remove key from corresponding dict
-            for k, msg in msgs.items():
-                if msg.wf.watcher_paused:
-                    if msg.fabric not in paused:
-                        paused[msg.fabric] = 0
-                    paused[msg.fabric]+=1
-                else:
-                    if msg.xts <= ts: 
-                        work.append((k, msg))
-            for (k, msg) in work: msgs.pop(k, None)
-        if len(paused) > 0:
-            for fab in paused:
-                logger.debug("paused %s watch events for fabric %s", paused[fab], fab)
-        return work
+        return watch_queue.pop_ready(time.time())
 
     def execute_watch_rapid(self):
         """ get list of rapid msgs that are ready to execute and if is_rapid has cleared OR endpoint
             has is_rapid still set but current rapid calculation implies endpoint is no longer rapid,
-            then perform refresh
+            then perform refresh. eptEndpoint objects are read with a single query per fabric batch
         """
-        work = self.watcher_get_xts_ready(self.watch_rapid_lock, self.watch_rapid)
+        work = self.watcher_get_xts_ready(self.watch_rapid)
         if len(work) > 0:
             logger.debug("execute %s ready watch rapid events", len(work))
+            fabric_work = {}
             for (k, msg) in work:
-                logger.debug("checking: %s", msg)
-                flt = {
+                if msg.fabric not in fabric_work:
+                    fabric_work[msg.fabric] = []
+                fabric_work[msg.fabric].append(msg)
+            projection = {
+                "is_rapid": 1,
+                "rapid_lts": 1,
+                "rapid_count": 1,
+                "rapid_lcount": 1,
+            }
+            for fabric in fabric_work:
+                for i in xrange(0, len(fabric_work[fabric]), WATCH_BATCH_SIZE):
+                    batch = fabric_work[fabric][i:i+WATCH_BATCH_SIZE]
+                    endpoints = self.watcher_find_batch(eptEndpoint, fabric, batch, projection,
+                                                            per_node=False)
+                    for msg in batch:
+                        logger.debug("checking: %s", msg)
+                        self.execute_watch_rapid_endpoint(msg, 
+                                endpoints.get((msg.vnid, msg.addr), None))
+
+    def execute_watch_rapid_endpoint(self, msg, endpoint):
+        """ perform rapid watch check for single msg against eptEndpoint db document """
+        if endpoint is not None:
+            is_rapid = endpoint["is_rapid"]
+            if is_rapid:
+                ts_delta = time.time() - endpoint["rapid_lts"]
+                rate = 0
+                if ts_delta > 0:
+                    rate = 60.0*(endpoint["rapid_count"]-endpoint["rapid_lcount"])/ts_delta
+                    is_rapid = rate > msg.wf.settings.rapid_threshold
+                logger.debug("updating is_rapid to %r from current rate %.3f",is_rapid,rate)
+            if not is_rapid: 
+                logger.debug("is_rapid is False, requesting refresh")
+                msg = eptMsgSubOp(MSG_TYPE.REFRESH_EPT, data ={
                     "fabric": msg.fabric,
                     "addr": msg.addr,
                     "vnid": msg.vnid,
-                }
-                projection = {"events":{"$slice":1}}
-                endpoint = self.db[eptEndpoint._classname].find_one(flt, projection)
-                if endpoint is not None:
-                    is_rapid = endpoint["is_rapid"]
-                    if is_rapid:
-                        ts_delta = time.time() - endpoint["rapid_lts"]
-                        rate = 0
-                        if ts_delta > 0:
-                            rate = 60.0*(endpoint["rapid_count"]-endpoint["rapid_lcount"])/ts_delta
-                            is_rapid = rate > msg.wf.settings.rapid_threshold
-                        logger.debug("updating is_rapid to %r from current rate %.3f",is_rapid,rate)
-                    if not is_rapid: 
-                        logger.debug("is_rapid is False, requesting refresh")
-                        msg = eptMsgSubOp(MSG_TYPE.REFRESH_EPT, data ={
-                            "fabric": msg.fabric,
-                            "addr": msg.addr,
-                            "vnid": msg.vnid,
-                            "type": msg.type,
-                        })
-                        self.redis.publish(SUBSCRIBER_CTRL_CHANNEL, msg.jsonify())
-                        self.increment_stats(SUBSCRIBER_CTRL_CHANNEL, tx=True)
-                    else:
-                        logger.debug("is_rapid is True, skipping refresh")
-                else:
-                    logger.debug("endpoint not found in db")
+                    "type": msg.type,
+                })
+                self.redis.publish(SUBSCRIBER_CTRL_CHANNEL, msg.jsonify())
+                self.increment_stats(SUBSCRIBER_CTRL_CHANNEL, tx=True)
+            else:
+                logger.debug("is_rapid is True, skipping refresh")
+        else:
+            logger.debug("endpoint not found in db")
 
     def execute_generic_watch(self, watch_type):
-        """ loop through all events in watch_type dict. for each event with xts ready check if 
+        """ pop all events in watch_type queue with xts ready. for each event check if
             watch_type (is_offsubnet/is_stale) value within corresponding eptHistory object is set.
             If true, update eptEndpoint (is_offsubnet/is_stale) attribute and then perform 
             configured notify and remediate actions.  Add object ept collection with dup check, 
             but perform remediation action unconditionally.
+
+            Ready events are grouped per fabric and checked in batches of WATCH_BATCH_SIZE with a
+            single eptHistory and ept collection read per batch. All clear commands are queued
+            after the batches complete and executed in the background by the clear threads.
         """
         if watch_type == "offsubnet":
-            lock = self.watch_offsubnet_lock
             msgs = self.watch_offsubnet
-            ept_db = eptOffSubnet
-            ept_db_attr = "is_offsubnet"
-            event_class = eptOffSubnetEvent
-            remediate_attr = "auto_clear_offsubnet"
-            work = self.watcher_get_xts_ready(lock, msgs)
+            work = self.watcher_get_xts_ready(msgs)
         elif watch_type == "stale":
-            lock = self.watch_stale_lock
             msgs = self.watch_stale
-            ept_db = eptStale
-            ept_db_attr = "is_stale"
-            event_class = eptStaleEvent
-            remediate_attr = "auto_clear_stale"
-            work = self.watcher_get_xts_ready(lock, msgs)
+            work = self.watcher_get_xts_ready(msgs)
         else:
             logger.error("unsupported watch type '%s'", watch_type)
             return
 
         if len(work) > 0:
-            clear_events = []   # list of clear tuples (cmd, key, reason, event)
             logger.debug("execute %s ready watch %s events", len(work), watch_type)
+            fabric_work = {}
             for (key, msg) in work:
-                logger.debug("checking: %s", msg)
                 # check if key is in watch_rapid, if so ignore this event
                 rapid_key = "%s,%s,%s" % (msg.fabric, msg.vnid, msg.addr)
                 if rapid_key in self.watch_rapid:
-                    logger.debug("skipping execute event as endpoint is flagged as rapid")
+                    logger.debug("skipping execute event as endpoint is flagged as rapid: %s", msg)
                     continue
-                flt = {
-                    "fabric": msg.fabric,
-                    "vnid": msg.vnid,
-                    "addr": msg.addr,
-                    "node": msg.node,
-                }
-                projection = {
-                    ept_db_attr: 1,
-                    "events": {"$slice": 4},
-                }
-                h = self.db[eptHistory._classname].find_one(flt, projection)
-                if h is None or not h[ept_db_attr]:
-                    logger.debug("%s is false", ept_db_attr)
-                else:
-                    logger.debug("%s is true, updating eptEndpoint", ept_db_attr)
-                    # update eptEndpoint object 
-                    flt2 = copy.copy(flt)
-                    flt2.pop("node",None)
-                    self.db[eptEndpoint._classname].update_one(flt2, {"$set":{ept_db_attr:True}})
-                    
-                    # for db push, the only non-key value not present is 'type' which we will set as
-                    # a key to allow proper upsert functionality if object does not exists (upsert)
-                    key = copy.copy(flt)
-                    key["type"] = msg.type
-                    event = event_class.from_dict(msg.event)
-
-                    # dup check is two parts. dup flag is initialized to false and set to true if
-                    # last event is_duplicate of current event. dup flag can then be cleared if 
-                    # a delete has occurred in eptHistory since the last event_class event. either 
-                    # ways we need to do a read of event_class.  this is useful because watch events
-                    # that are still offsubnet/stale are less frequently than analyze_stale or 
-                    # anaylze_offsubnet events. The hope is reads in the watch reduce reads in the 
-                    # worker nodes
-                    is_duplicate = False
-                    db_obj = self.db[ept_db._classname].find_one(flt,{"events":{"$slice":1}})
-                    if db_obj is not None and "events" in db_obj and len(db_obj["events"])>0:
-                        db_event = event_class.from_dict(db_obj["events"][0])
-                        if event.is_duplicate(db_event):
-                            is_duplicate = True
-                            # check if there was a delete since db_event
-                            for h_event in h["events"]:
-                                if h_event["ts"] > db_event.ts and h_event["status"] == "deleted":
-                                    is_duplicate = False
-                                    break
-                    if is_duplicate:
-                        logger.debug("suppressing notification and db update for duplicate event")
-                    else:
-                        msg.wf.push_event(ept_db._classname, key, event.to_dict())
-                        # send notification if enabled
-                        subject = "%s event for %s" % (watch_type, msg.addr)
-                        txt = "%s event [fabric: %s, %s, addr: %s] %s" % (
-                            watch_type,
-                            msg.fabric,
-                            event.vnid_name if len(event.vnid_name)>0 else "vnid:%d" % msg.vnid,
-                            msg.addr,
-                            event.notify_string()
-                        )
-                        msg.wf.queue_notification(watch_type, subject, txt)
-
-                    # even if duplicate, add to clear list if remediation is enabled
-                    if getattr(msg.wf.settings, remediate_attr):
-                        logger.debug("%s enabled, adding endpoint to clear list", remediate_attr)
-                        cmd = "clear --fabric %s --pod %s --node %s --addr %s --vnid %s " % (
-                                msg.fabric,
-                                msg.wf.cache.get_pod_id(msg.node),
-                                msg.node,
-                                msg.addr,
-                                msg.vnid)
-                        if msg.type == "mac":
-                            cmd+= "--addr_type mac"
-                        else:
-                            cmd+= "--addr_type ip --vrf_name \"%s\""%parse_vrf_name(event.vnid_name)
-                        clear_events.append((cmd,key,ept_db_attr,event)) 
-            # perform clear action for all clear cmds
+                if msg.fabric not in fabric_work:
+                    fabric_work[msg.fabric] = []
+                fabric_work[msg.fabric].append(msg)
+            clear_events = []   # list of clear tuples (eptClearEndpoint, key, reason, event, wf)
+            for fabric in fabric_work:
+                batch = fabric_work[fabric]
+                for i in xrange(0, len(batch), WATCH_BATCH_SIZE):
+                    clear_events.extend(self.execute_generic_watch_batch(watch_type, fabric,
+                                            batch[i:i+WATCH_BATCH_SIZE]))
+            # perform clear action for all clear endpoints
             if len(clear_events) > 0:
-                logger.debug("executing %s clear endpoint commands", len(clear_events))
-                ts = time.time()
-                for (cmd, key, ept_db_attr, event) in clear_events:
-                    if execute_worker(cmd):
-                        # add event to eptRemediate and send notification if enabled
-                        reason = "stale" if ept_db_attr == "is_stale" else "offsubnet"
-                        msg.wf.push_event(eptRemediate._classname, key, {
-                            "ts": ts,
-                            "vnid_name": event.vnid_name,
-                            "action": "clear",
-                            "reason": reason,
-                        })
-                        # send notification if enabled
-                        subject = "auto-clear %s endpoint" % reason
-                        txt = "auto-clear %s endpoint [fabric: %s, %s, addr: %s]" % (
-                            reason,
-                            key["fabric"],
-                            event.vnid_name if len(event.vnid_name)>0 else "vnid:%d" % key["vnid"],
-                            key["addr"],
-                        )
-                        msg.wf.queue_notification("clear", subject, txt)
+                self.execute_clear_events(clear_events)
+
+    def execute_generic_watch_batch(self, watch_type, fabric, batch):
+        """ perform generic watch checks for a list of msgs within a single fabric. Return list of
+            clear tuples (eptClearEndpoint, key, reason, event, wf) for endpoints requiring 
+            remediation
+        """
+        if watch_type == "offsubnet":
+            ept_db = eptOffSubnet
+            ept_db_attr = "is_offsubnet"
+            event_class = eptOffSubnetEvent
+            remediate_attr = "auto_clear_offsubnet"
+        else:
+            ept_db = eptStale
+            ept_db_attr = "is_stale"
+            event_class = eptStaleEvent
+            remediate_attr = "auto_clear_stale"
+
+        clear_events = []
+        endpoint_updates = []   # list of UpdateOne for eptEndpoint
+        ept_db_updates = []     # list of UpdateOne for ept_db push events
+        projection = {
+            ept_db_attr: 1,
+            "events": {"$slice": 4},
+        }
+        history = self.watcher_find_batch(eptHistory, fabric, batch, projection)
+        active = []
+        for msg in batch:
+            h = history.get((msg.vnid, msg.addr, msg.node), None)
+            if h is None or not h.get(ept_db_attr, False):
+                logger.debug("%s is false for %s", ept_db_attr, msg)
+            else:
+                active.append((msg, h))
+        if len(active) == 0:
+            return clear_events
+
+        logger.debug("%s is true for %s endpoints, updating eptEndpoint", ept_db_attr, len(active))
+        # dup check is two parts. dup flag is initialized to false and set to true if last event
+        # is_duplicate of current event. dup flag can then be cleared if a delete has occurred in
+        # eptHistory since the last event_class event. either ways we need to do a read of 
+        # event_class.  this is useful because watch events that are still offsubnet/stale are less
+        # frequently than analyze_stale or anaylze_offsubnet events. The hope is reads in the watch
+        # reduce reads in the worker nodes
+        db_objs = self.watcher_find_batch(ept_db, fabric, [a[0] for a in active],
+                                            {"events":{"$slice":1}})
+        for (msg, h) in active:
+            flt = {
+                "fabric": msg.fabric,
+                "vnid": msg.vnid,
+                "addr": msg.addr,
+            }
+            endpoint_updates.append(UpdateOne(flt, {"$set":{ept_db_attr:True}}))
+
+            # for db push, the only non-key value not present is 'type' which we will set as a key
+            # to allow proper upsert functionality if object does not exists (upsert)
+            key = copy.copy(flt)
+            key["node"] = msg.node
+            key["type"] = msg.type
+            event = event_class.from_dict(msg.event)
+
+            is_duplicate = False
+            db_obj = db_objs.get((msg.vnid, msg.addr, msg.node), None)
+            if db_obj is not None and "events" in db_obj and len(db_obj["events"])>0:
+                db_event = event_class.from_dict(db_obj["events"][0])
+                if event.is_duplicate(db_event):
+                    is_duplicate = True
+                    # check if there was a delete since db_event
+                    for h_event in h.get("events", []):
+                        if h_event["ts"] > db_event.ts and h_event["status"] == "deleted":
+                            is_duplicate = False
+                            break
+            if is_duplicate:
+                logger.debug("suppressing notification and db update for duplicate event")
+            else:
+                update = get_push_event_update(event.to_dict(), 
+                                rotate=msg.wf.settings.max_per_node_endpoint_events)
+                ept_db_updates.append(UpdateOne(key, update, upsert=True))
+                # send notification if enabled
+                subject = "%s event for %s" % (watch_type, msg.addr)
+                txt = "%s event [fabric: %s, %s, addr: %s] %s" % (
+                    watch_type,
+                    msg.fabric,
+                    event.vnid_name if len(event.vnid_name)>0 else "vnid:%d" % msg.vnid,
+                    msg.addr,
+                    event.notify_string()
+                )
+                msg.wf.queue_notification(watch_type, subject, txt)
+
+            # even if duplicate, add to clear list if remediation is enabled
+            if getattr(msg.wf.settings, remediate_attr):
+                logger.debug("%s enabled, adding endpoint to clear list", remediate_attr)
+                vrf_name = ""
+                if msg.type != "mac" and len(event.vnid_name) > 0:
+                    vrf_name = parse_vrf_name(event.vnid_name)
+                ep = eptClearEndpoint(msg.wf.cache.get_pod_id(msg.node), msg.node, msg.vnid,
+                        msg.addr, addr_type="mac" if msg.type == "mac" else "ip", 
+                        vrf_name=vrf_name)
+                clear_events.append((ep, key, watch_type, event, msg.wf))
+
+        self.watcher_bulk_write(eptEndpoint, endpoint_updates)
+        self.watcher_bulk_write(ept_db, ept_db_updates)
+        return clear_events
+
+    def watcher_find_batch(self, eptObject, fabric, batch, projection, per_node=True):
+        """ read eptObject documents for list of msgs within a single fabric with one query.
+            return dict of documents indexed by tuple (vnid, addr, node) or (vnid, addr) if 
+            per_node is false
+        """
+        flt = {
+            "fabric": fabric,
+            "addr": {"$in": list(set([msg.addr for msg in batch]))},
+            "vnid": {"$in": list(set([msg.vnid for msg in batch]))},
+        }
+        projection = copy.copy(projection)
+        projection.update({"vnid": 1, "addr": 1})
+        if per_node:
+            flt["node"] = {"$in": list(set([msg.node for msg in batch]))}
+            projection["node"] = 1
+        ret = {}
+        for doc in self.db[eptObject._classname].find(flt, projection):
+            if per_node:
+                ret[(doc["vnid"], doc["addr"], doc["node"])] = doc
+            else:
+                ret[(doc["vnid"], doc["addr"])] = doc
+        return ret
+
+    def watcher_bulk_write(self, eptObject, ops):
+        """ execute list of write operations against eptObject collection as an unordered bulk
+            write. return bool success
+        """
+        if len(ops) == 0:
+            return True
+        try:
+            self.db[eptObject._classname].bulk_write(ops, ordered=False)
+            return True
+        except BulkWriteError as be:
+            logger.warn("%s bulkwrite error: %s", eptObject._classname, be.details)
+        except Exception as e:
+            logger.error("Traceback:\n%s", traceback.format_exc())
+        return False
+
+    def start_clear_threads(self):
+        """ start watch_clear_concurrency clear threads if not already running """
+        with self.clear_lock:
+            if len(self.clear_threads) > 0:
+                return
+            for i in xrange(0, max(1, self.watch_clear_concurrency)):
+                t = threading.Thread(target=self.execute_clear_thread)
+                t.name = "wrk-clear-%s" % i
+                t.daemon = True
+                t.start()
+                self.clear_threads.append(t)
+
+    def stop_clear_threads(self):
+        """ signal each clear thread to exit once the clear in progress has completed """
+        with self.clear_lock:
+            for t in self.clear_threads:
+                self.clear_queue.put(None)
+            self.clear_threads = []
+
+    def execute_clear_events(self, clear_events):
+        """ queue clear of endpoints for list of clear tuples (eptClearEndpoint, key, reason, 
+            event, wf) to the clear threads and return without waiting for the clear to complete.
+            Endpoints are grouped per fabric and node and up to watch_clear_concurrency nodes
+            across all fabrics are cleared in parallel using the clear service of each fabric.
+            Endpoints with a clear already pending are skipped.
+        """
+        self.start_clear_threads()
+        groups = {}
+        skipped = 0
+        with self.clear_lock:
+            for (ep, key, reason, event, wf) in clear_events:
+                pending_key = (wf.fabric, ep.node, ep.vnid, ep.addr)
+                if pending_key in self.clear_pending:
+                    skipped+= 1
+                    continue
+                self.clear_pending.add(pending_key)
+                gkey = (wf.fabric, ep.node)
+                if gkey not in groups:
+                    # clear service is created here as it is shared by all threads for the fabric
+                    groups[gkey] = (wf, wf.get_clear_service(), [])
+                groups[gkey][2].append((ep, key, reason, event))
+        logger.debug("queueing %s clear endpoint requests on %s nodes (%s already pending)",
+                len(clear_events)-skipped, len(groups), skipped)
+        for gkey in sorted(groups):
+            self.clear_queue.put(groups[gkey])
+
+    def execute_clear_thread(self):
+        """ long-lived thread that clears each (wf, clear service, clear tuples) group of a single
+            node from clear_queue until None is received. For each successful clear, add event to
+            eptRemediate and send notification if enabled
+        """
+        while True:
+            group = self.clear_queue.get()
+            if group is None:
+                self.clear_queue.task_done()
+                return
+            (wf, clear_service, clears) = group
+            try:
+                results = clear_service.clear([c[0] for c in clears])
+                for node in sorted(results):
+                    logger.debug("clear %s node-%s: %s", clear_service.get_fabric_name(), node,
+                            results[node])
+                self.execute_clear_complete(wf, clears)
+            except Exception as e:
+                logger.error("Traceback:\n%s", traceback.format_exc())
+            finally:
+                with self.clear_lock:
+                    for (ep, key, reason, event) in clears:
+                        self.clear_pending.discard((wf.fabric, ep.node, ep.vnid, ep.addr))
+                self.clear_queue.task_done()
+
+    def execute_clear_complete(self, wf, clears):
+        """ add event to eptRemediate and send notification for each successful clear tuple
+            (eptClearEndpoint, key, reason, event)
+        """
+        ts = time.time()
+        for (ep, key, reason, event) in clears:
+            if not ep.success:
+                logger.debug("failed to clear endpoint %s", ep)
+                continue
+            wf.push_event(eptRemediate._classname, key, {
+                "ts": ts,
+                "vnid_name": event.vnid_name,
+                "action": "clear",
+                "reason": reason,
+            })
+            # send notification if enabled
+            subject = "auto-clear %s endpoint" % reason
+            txt = "auto-clear %s endpoint [fabric: %s, %s, addr: %s]" % (
+                reason,
+                key["fabric"],
+                event.vnid_name if len(event.vnid_name)>0 else "vnid:%d" % key["vnid"],
+                key["addr"],
+            )
+            wf.queue_notification("clear", subject, txt)
 
     def handle_endpoint_delete(self, msg):
         """ handle endpoint delete requests.  This needs to flush the local cache and delete all
             eptEndpoint object using rest object (which will trigger delete of all appropriate 
             dependencies)
             caches:
-                rapid_cache
+                rapid_table
+                endpoint_cache
         """
         logger.debug("deleting %s [0x%06x %s]", msg.fabric, msg.vnid, msg.addr)
         # remove from local caches
         cache = msg.wf.cache
         key = cache.get_key_str(addr=msg.addr, vnid=msg.vnid)
-        cache.rapid_cache.remove(key)
+        cache.rapid_table.remove(key)
+        cache.remove_endpoint_state(msg.vnid, msg.addr)
         # delete from db
         endpoint = eptEndpoint.load(fabric=msg.fabric, vnid=msg.vnid, addr=msg.addr)
         if endpoint.exists():
@@ -1774,6 +2205,20 @@ class eptWorker(object):
         logger.debug("reloading settings for fabric %s", msg.fabric)
         msg.wf.settings_reload()
 
+    def handle_cache_warmup(self, msg):
+        """ receive eptMsgWork with WORK_TYPE.CACHE_WARMUP broadcast by subscriber after the
+            initial build of the fabric and bulk load the fabric caches
+        """
+        if not self.cache_warmup:
+            return
+        logger.debug("cache warm up for fabric %s", msg.fabric)
+        try:
+            msg.wf.cache.warm_up()
+        except Exception as e:
+            # caches are still populated on demand if warm up fails
+            logger.debug("Traceback:\n%s", traceback.format_exc())
+            logger.warn("[%s] failed to warm up cache for fabric %s: %s", self, msg.fabric, e)
+
     def handle_epm_eof(self, msg):
         """ receive eptMsgWork with WORK_TYPE.FABRIC_EPM_EOF and send ack back to subscriber """
         logger.debug("received epm eof for fabric %s", msg.fabric)
@@ -1818,4 +2263,5 @@ class eptWorkerUpdateLocalResult(object):
         self.is_offsubnet = False       # eptEndpoint object is currently offsubnet
         self.is_stale = False           # eptEndpoint object is currently stale
         self.exists = False             # eptEndpoint entry exists
+        self.endpoint = None            # eptEndpoint projection (shared with endpoint state)
 
@@ -1,21 +1,34 @@
 
 from ... utils import get_app_config
 from ... utils import get_db
+from .. utils import SmtpConnection
 from .. utils import get_apic_session
+from .. utils import get_syslog_handler
 from .. utils import send_emails
 from .. utils import syslog
+from . common import NOTIFY_EMAIL_MAX_BULK
 from . common import NOTIFY_INTERVAL
+from . common import NOTIFY_OVERFLOW_MAX_SIZE
 from . common import NOTIFY_QUEUE_MAX_SIZE
+from . common import NOTIFY_SMTP_IDLE_TIMEOUT
+from . common import WRITE_BUFFER_MAX_DELAY
+from . common import WRITE_BUFFER_MAX_OPS
+from . common import WRITE_BUFFER_MAX_RETRIES
 from . common import BackgroundThread
+from . common import get_push_event_update
 from . common import push_event
 from . ept_cache import eptCache
+from . ept_clear import eptClearService
 from . dns_cache import DNSCache
 from . ept_msg import eptEpmEventParser
 from . ept_settings import eptSettings
+from . ept_write_buffer import eptWriteBuffer
 from six.moves.queue import Queue
 from six.moves.queue import Full
 
+import collections
 import logging
+import re
 import time
 import traceback
 
@@ -24,19 +37,43 @@ logger = logging.getLogger(__name__)
 
 class eptWorkerFabric(object):
     """ tracks cache and settings for each fabric actively being monitored, also provides useful
-        notification and push_event functions
+        notification and push_event functions. If write_buffer is enabled, then push_event, save,
+        update_one, and update_many are buffered and written to the db in bulk. The caller must
+        call flush_writes before reading any object that may have a pending write.
     """
-    def __init__(self, fabric):
+    def __init__(self, fabric, write_buffer=False, shared_cache=False):
         self.fabric = fabric
         self.start_ts = time.time()
         self.settings = eptSettings.load(fabric=fabric, settings="default")
-        self.cache = eptCache(fabric)
+        # workers on the same host can share a read-mostly cache segment for common lookups
+        shared_cache_dir = None
+        if shared_cache:
+            shared_cache_dir = get_app_config().get("WORKER_SHARED_CACHE_DIR", "")
+            if len(shared_cache_dir) == 0:
+                shared_cache_dir = None
+        self.cache = eptCache(fabric, shared_cache_dir=shared_cache_dir)
         self.dns_cache = DNSCache()
         self.db = get_db()
         self.watcher_paused = False
         self.session = None
+        self.clear_service = None
         self.notify_queue = None
         self.notify_thread = None
+        # notifications received while notify queue is full, sent on next notify interval. If the
+        # overflow is also full then the oldest notification is dropped
+        self.notify_overflow = collections.deque(maxlen=NOTIFY_OVERFLOW_MAX_SIZE)
+        self.notify_drop_count = 0
+        self.notify_drop_reported = 0
+        # persistent notification transports used by watcher notify thread
+        self.smtp_connection = None
+        self.syslog_handler = None
+        self.syslog_address = None
+        self.write_buffer = None
+        if write_buffer:
+            self.write_buffer = eptWriteBuffer(self.db, max_ops=WRITE_BUFFER_MAX_OPS,
+                                                max_delay=WRITE_BUFFER_MAX_DELAY,
+                                                max_retries=WRITE_BUFFER_MAX_RETRIES)
+            self.cache.write_buffer = self.write_buffer
         self.init() 
 
     def init(self):
@@ -55,12 +92,20 @@ class eptWorkerFabric(object):
 
     def close(self):
         """ stateful close when worker receives FABRIC_STOP for this fabric """
+        self.cache.flush_rapid()
+        self.flush_writes()
         if self.db is not None:
             self.db.client.close()
+        if self.clear_service is not None:
+            self.clear_service.close()
         if self.session is not None:
             self.session.close()
         if self.notify_thread is not None:
             self.notify_thread.exit()
+        if self.smtp_connection is not None:
+            self.smtp_connection.close()
+        if self.syslog_handler is not None:
+            self.syslog_handler.close()
         # remove all objects from notify queue
         if self.notify_queue is not None:
             try:
@@ -80,6 +125,11 @@ class eptWorkerFabric(object):
         if self.session is None:
             logger.error("failed to get session object within worker fabric")
 
+        # watcher keeps smtp session and syslog socket open between notifications and resolves
+        # notification servers before the first notification is sent
+        self.smtp_connection = SmtpConnection(idle_timeout=NOTIFY_SMTP_IDLE_TIMEOUT)
+        self.resolve_notify_servers()
+
         # watcher will also send notifications within a background thread to ensure that 
         # any delay in syslog or email does not backup other service events
         self.notify_thread = BackgroundThread(func=self.execute_notify, name="notify", count=0, 
@@ -87,11 +137,22 @@ class eptWorkerFabric(object):
         self.notify_thread.daemon = True
         self.notify_thread.start()
 
+    def get_clear_service(self, concurrency=1):
+        """ return eptClearService for this fabric, created on first use. The clear service keeps
+            ssh connections to each node open between clears and uses the watcher apic session
+        """
+        if self.clear_service is None:
+            self.clear_service = eptClearService(self.fabric, session=self.session,
+                                                    concurrency=concurrency)
+        return self.clear_service
+
     def settings_reload(self):
         """ reload settings from db """
         logger.debug("reloading settings for %s", self.fabric)
         self.settings.reload()
         self.init()
+        if self.smtp_connection is not None:
+            self.resolve_notify_servers()
 
     def get_uptime_delta_offset(self, delta=None):
         """ return difference between provided delta and current uptime. If the uptime_delta is 
@@ -107,10 +168,50 @@ class eptWorkerFabric(object):
         # wrapper to push an event to eptHistory events list.  set per_node to false to use 
         # max_endpoint_event rotate length, else max_per_node_endpoint_events value is used
         if per_node:
-            return push_event(self.db[table], key, event, 
-                    rotate=self.settings.max_per_node_endpoint_events)
+            rotate = self.settings.max_per_node_endpoint_events
+        else:
+            rotate = self.settings.max_endpoint_events
+        if self.write_buffer is not None:
+            update = get_push_event_update(event, rotate=rotate)
+            return self.write_buffer.update_one(table, get_write_key(key), key, update,
+                                                upsert=True)
+        return push_event(self.db[table], key, event, rotate=rotate)
+
+    def save(self, obj):
+        # wrapper to save a new Rest object (eptHistory, eptEndpoint, eptMove...) without refresh
+        if self.write_buffer is not None:
+            op = obj._save(bulk_prep=True)
+            if op is not None:
+                self.write_buffer.add(obj._classname, get_write_key(obj.get_keys()), op)
+            return
+        obj.save(refresh=False)
+
+    def update_one(self, table, flt, update):
+        # wrapper for db update_one
+        if self.write_buffer is not None:
+            self.write_buffer.update_one(table, get_write_key(flt), flt, update)
         else:
-            return push_event(self.db[table], key, event, rotate=self.settings.max_endpoint_events)
+            self.db[table].update_one(flt, update)
+
+    def update_many(self, table, flt, update):
+        # wrapper for db update_many
+        if self.write_buffer is not None:
+            self.write_buffer.update_many(table, get_write_key(flt), flt, update)
+        else:
+            self.db[table].update_many(flt, update)
+
+    def flush_writes(self):
+        # write any buffered updates to the db, return False if any write failed and was requeued
+        # or dropped
+        if self.write_buffer is not None:
+            return self.write_buffer.flush()
+        return True
+
+    def flush_expired_writes(self):
+        # write buffered updates to the db if max delay has been exceeded
+        if self.write_buffer is not None:
+            return self.write_buffer.flush_expired()
+        return True
 
     def get_learn_type(self, vnid, flags=[]):
         # based on provide vnid and flags return learn type for endpoint:
@@ -171,18 +272,60 @@ class eptWorkerFabric(object):
             ret["syslog_port"] = self.syslog_port
         return ret
 
-    def send_notification(self, notify_type, subject=None, txt=None, bulk=None):
+    def resolve_notify_servers(self):
+        # best effort dns lookup of syslog and smtp servers so results are cached before the first
+        # notification is sent
+        try:
+            if self.syslog_server is not None:
+                self.dns_cache.dns_lookup(self.syslog_server, query_type="A")
+            if self.email_address is not None:
+                smtp_server = None
+                if self.settings.smtp_type == "relay":
+                    smtp_server = self.settings.smtp_relay_server
+                elif self.settings.smtp_type == "direct":
+                    r1 = re.search("^[^@]+@(?P<domain>.{3,})$", self.email_address)
+                    if r1 is not None:
+                        smtp_server = self.dns_cache.dns_lookup(r1.group("domain"),query_type="MX")
+                if smtp_server is not None and len(smtp_server) > 0:
+                    self.dns_cache.dns_lookup(smtp_server, query_type="A")
+        except Exception as e:
+            logger.debug("Traceback:\n%s", traceback.format_exc())
+            logger.warn("failed to resolve notification servers: %s", e)
+
+    def get_syslog_handler(self, server, port):
+        # return persistent syslog handler for server and port, handler is recreated if the resolved
+        # server address changes
+        if not isinstance(port, int):
+            port = 514
+        address = (self.dns_cache.dns_lookup(server, query_type="A") or server, port)
+        if self.syslog_handler is not None and self.syslog_address != address:
+            self.syslog_handler.close()
+            self.syslog_handler = None
+        if self.syslog_handler is None:
+            logger.debug("creating syslog handler for %s", address)
+            self.syslog_handler = get_syslog_handler(address[0], address[1])
+            self.syslog_address = address
+        return self.syslog_handler
+
+    def send_notification(self, notify_type, subject=None, txt=None, bulk=None, email_bulk=None):
         # send proper notifications for this fabric.  set notify_type to none to skip enable check
         # and force notification. user can set bulk to list of (subject/txt) tuples to send a list
         # of notifications at the same time.  All notifications must be of the same notify_type.
+        # email_bulk can be set to send a different list of (subject/txt) tuples as emails than the
+        # list sent as syslogs. Persistent smtp and syslog transports are used when the watcher
+        # notify thread has been initialized.
         success = True
         errmsg = ""
         notify = self.notification_enabled(notify_type)
         if notify["enabled"]:
             if notify["email_address"] is not None:
                 emails = []
-                if bulk is not None:
-                    for (bulk_subject, bulk_txt) in bulk:
+                if email_bulk is not None:
+                    bulk_emails = email_bulk
+                else:
+                    bulk_emails = bulk
+                if bulk_emails is not None:
+                    for (bulk_subject, bulk_txt) in bulk_emails:
                         emails.append({
                             "sender": get_app_config().get("EMAIL_SENDER", None),
                             "receiver": notify["email_address"],
@@ -200,23 +343,29 @@ class eptWorkerFabric(object):
                 (success, errmsg) = send_emails(
                     settings = self.settings,
                     dns_cache = self.dns_cache,
-                    emails=emails
+                    emails=emails,
+                    connection=self.smtp_connection,
                 )
                 if not success:
                     logger.warn("failed to send email: %s", errmsg)
             if notify["syslog_server"] is not None:
+                handler = None
+                if self.smtp_connection is not None:
+                    handler = self.get_syslog_handler(notify["syslog_server"],notify["syslog_port"])
                 if bulk is not None:
                     for (bulk_subject, bulk_txt) in bulk:
                         syslog(bulk_txt, 
                             dns_cache=self.dns_cache,
                             server=notify["syslog_server"], 
                             server_port=notify["syslog_port"],
+                            handler=handler,
                         )
                 else:
                     syslog(txt, 
                         dns_cache=self.dns_cache,
                         server=notify["syslog_server"],
                         server_port=notify["syslog_port"],
+                        handler=handler,
                     )
             return (success, errmsg)
         else:
@@ -224,7 +373,9 @@ class eptWorkerFabric(object):
             return (False, "notification not enabled")
 
     def queue_notification(self, notify_type, subject, txt):
-        # queue notification that will be sent at next iteration of NOTIFY_INTERVAL
+        # queue notification that will be sent at next iteration of NOTIFY_INTERVAL. If the queue
+        # is full, the notification is held in the overflow list and sent at the next interval.
+        # If the overflow list is also full, the oldest overflow notification is dropped
         if self.notify_queue is None:
             logger.error("notify queue not initialized for worker fabric")
             return
@@ -233,19 +384,49 @@ class eptWorkerFabric(object):
                 self.notify_queue.qsize())
             self.notify_queue.put_nowait((notify_type, subject, txt, time.time()))
         except Full as e:
-            logger.error("failed to enqueue notification, queue is full (size: %s)", 
-                self.notify_queue.qsize())
+            if len(self.notify_overflow) >= self.notify_overflow.maxlen:
+                self.notify_drop_count+= 1
+            self.notify_overflow.append((notify_type, subject, txt, time.time()))
+
+    def coalesce_notifications(self, notify_type, bulk):
+        # receive list of (subject, txt) tuples and return tuple (bulk, email_bulk). Identical
+        # notifications are merged into a single notification with a repeat count. If more than
+        # NOTIFY_EMAIL_MAX_BULK notifications remain, then email_bulk is a single digest email
+        # containing all notifications, else email_bulk is the same as bulk
+        counts = {}
+        merged = []
+        for n in bulk:
+            if n not in counts:
+                counts[n] = 0
+                merged.append(n)
+            counts[n]+= 1
+        ret = []
+        for (subject, txt) in merged:
+            if counts[(subject, txt)] > 1:
+                txt = "%s (repeated %s times)" % (txt, counts[(subject, txt)])
+            ret.append((subject, txt))
+        if len(ret) <= NOTIFY_EMAIL_MAX_BULK:
+            return (ret, ret)
+        subject = "%s %s notifications for fabric %s" % (len(bulk), notify_type, self.fabric)
+        return (ret, [(subject, "\n".join([n[1] for n in ret]))])
 
     def execute_notify(self):
         # send any notifications sitting in queue, log number of notifications sent and max queue
         # time. We want to support bulk notifications (mainly for email to prevent multiple login
         # on smpt_relay_auth setups) so this function will sort based on notify type and execute
-        # send notification with bulk flag.
+        # send notification with bulk flag. Similar notifications are coalesced and a burst of
+        # notifications is sent as a single digest email.
         msgs = {}  # indexed by notify type and contains tuple (subject,txt)
         count = 0
+        overflow = 0
         max_queue_time = 0
+        pending = []
         while not self.notify_queue.empty():
-            (notify_type, subject, txt, q_ts) = self.notify_queue.get()
+            pending.append(self.notify_queue.get())
+        while len(self.notify_overflow) > 0:
+            pending.append(self.notify_overflow.popleft())
+            overflow+= 1
+        for (notify_type, subject, txt, q_ts) in pending:
             count+= 1
             q_time = time.time() - q_ts
             if q_time > max_queue_time:
@@ -254,8 +435,18 @@ class eptWorkerFabric(object):
                 msgs[notify_type] = []
             msgs[notify_type].append((subject, txt))
         for notify_type in msgs:
-            self.send_notification(notify_type, bulk=msgs[notify_type])
+            (bulk, email_bulk) = self.coalesce_notifications(notify_type, msgs[notify_type])
+            self.send_notification(notify_type, bulk=bulk, email_bulk=email_bulk)
+        if overflow > 0:
+            logger.warn("notify queue full, %s notifications held until next interval", overflow)
+        dropped = self.notify_drop_count - self.notify_drop_reported
+        if dropped > 0:
+            self.notify_drop_reported+= dropped
+            logger.warn("notify overflow full, %s notifications dropped (total %s)", dropped,
+                        self.notify_drop_count)
         if count > 0:
             logger.debug("sent %s notifications, max queue time %0.3f sec", count, max_queue_time)
 
-
+def get_write_key(flt):
+    """ return write buffer ordering key for an endpoint object filter """
+    return (flt.get("vnid", None), flt.get("addr", None))
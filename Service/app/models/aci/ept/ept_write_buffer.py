@@ -0,0 +1,170 @@
+
+from pymongo import InsertOne
+from pymongo import UpdateMany
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import logging
+import threading
+import time
+import traceback
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+# bulk write error codes for a write that conflicts with an existing document, never retried
+DUPLICATE_KEY_ERRORS = [11000, 11001]
+
+class eptWriteBuffer(object):
+    """ write-behind buffer for db updates from the worker hot path. Write operations are grouped
+        into unordered bulk_write batches per collection and flushed when max_ops is reached or the
+        oldest buffered write is older than max_delay seconds.
+
+        Each write has an ordering key (collection, vnid, addr) and writes for the same key must be
+        applied in the order they were added. Writes are placed into rounds where a key appears at
+        most once per round.  Each round is flushed before the next so per-key order is preserved
+        while all writes within a round are free to execute unordered.
+
+        A write that is known to have failed (per-index writeErrors of the bulk write) is requeued 
+        along with all later writes for the same key and retried on the next flush. Writes that
+        fail more than max_retries times are dropped. Most writes are not idempotent ($push, $inc,
+        and inserts) so writes with a duplicate key error or an unknown outcome (any exception
+        other than BulkWriteError) are logged and dropped instead of being applied twice.
+    """
+    def __init__(self, db, max_ops=1024, max_delay=0.1, max_retries=3):
+        self.db = db
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        # list of rounds, each round is a dict indexed by collection with list of pending writes
+        # where each pending write is a tuple (key, op, retry count)
+        self.rounds = []
+        # last round index for each ordering key
+        self.keys = {}
+        self.count = 0
+        self.first_ts = 0
+        # stats
+        self.total_ops = 0
+        self.total_flushes = 0
+        self.total_retries = 0
+        self.total_dropped = 0
+
+    def __repr__(self):
+        return "pending:%s, rounds:%s, total_ops:%s, total_flushes:%s, retries:%s, dropped:%s" % (
+            self.count, len(self.rounds), self.total_ops, self.total_flushes, self.total_retries,
+            self.total_dropped
+        )
+
+    def add(self, collection, key, op):
+        """ add a write operation (InsertOne, UpdateOne, UpdateMany) for collection with ordering key
+            tuple. The buffer is flushed if max_ops is reached.  Return False if the flush
+            triggered by this write failed, else return True.
+        """
+        with self.lock:
+            self._add(collection, key, op, 0)
+            if self.count >= self.max_ops:
+                return self._flush()
+        return True
+
+    def _add(self, collection, key, op, retries):
+        # must be called with lock held
+        okey = (collection, key)
+        index = self.keys.get(okey, -1) + 1
+        if index >= len(self.rounds):
+            self.rounds.append({})
+        if collection not in self.rounds[index]:
+            self.rounds[index][collection] = []
+        self.rounds[index][collection].append((key, op, retries))
+        self.keys[okey] = index
+        if self.count == 0:
+            self.first_ts = time.time()
+        self.count+= 1
+
+    def insert_one(self, collection, key, doc):
+        """ buffer insert of doc into collection """
+        return self.add(collection, key, InsertOne(doc))
+
+    def update_one(self, collection, key, flt, update, upsert=False):
+        """ buffer update_one. The filter is copied as callers often reuse and modify it """
+        return self.add(collection, key, UpdateOne(dict(flt), update, upsert=upsert))
+
+    def update_many(self, collection, key, flt, update):
+        """ buffer update_many. The filter is copied as callers often reuse and modify it """
+        return self.add(collection, key, UpdateMany(dict(flt), update))
+
+    def flush(self):
+        """ write all buffered operations to the db. Return False if any write failed """
+        with self.lock:
+            return self._flush()
+
+    def flush_expired(self):
+        """ flush buffered operations if oldest write has exceeded max delay. Return False if any
+            write failed
+        """
+        with self.lock:
+            if self.count > 0 and time.time() - self.first_ts >= self.max_delay:
+                return self._flush()
+        return True
+
+    def _flush(self):
+        # must be called with lock held so the next flush cannot start before this one completes.
+        # Return True if all writes were successfully applied.
+        if self.count == 0:
+            return True
+        rounds = self.rounds
+        count = self.count
+        self.rounds = []
+        self.keys = {}
+        self.count = 0
+        self.total_flushes+= 1
+        ts = time.time()
+        # ordering keys with a failed write, all later writes for the key are requeued
+        failed_keys = set()
+        requeue = []
+        dropped = 0
+        for r in rounds:
+            for collection in r:
+                writes = []
+                for w in r[collection]:
+                    if (collection, w[0]) in failed_keys:
+                        requeue.append((collection, w))
+                    else:
+                        writes.append(w)
+                if len(writes) == 0:
+                    continue
+                failed = set()
+                try:
+                    self.db[collection].bulk_write([w[1] for w in writes], ordered=False)
+                except BulkWriteError as be:
+                    logger.warn("%s bulkwrite error: %s", collection, be.details)
+                    for e in be.details.get("writeErrors", []):
+                        if e.get("code", 0) in DUPLICATE_KEY_ERRORS:
+                            logger.error("dropping %s write with duplicate key: %s", collection,
+                                            writes[e["index"]][1])
+                            dropped+= 1
+                        else:
+                            failed.add(e["index"])
+                except Exception as e:
+                    logger.error("Traceback:\n%s", traceback.format_exc())
+                    logger.error("dropping %s %s writes with unknown outcome", len(writes), 
+                                    collection)
+                    dropped+= len(writes)
+                for i in sorted(failed):
+                    (key, op, retries) = writes[i]
+                    if retries >= self.max_retries:
+                        logger.error("dropping %s write after %s retries: %s", collection,
+                                        retries, op)
+                        dropped+= 1
+                    else:
+                        failed_keys.add((collection, key))
+                        requeue.append((collection, (key, op, retries+1)))
+        # requeued writes are added before any new write in the original order
+        for (collection, (key, op, retries)) in requeue:
+            self._add(collection, key, op, retries)
+        self.total_ops+= count - len(requeue)
+        self.total_retries+= len(requeue)
+        self.total_dropped+= dropped
+        logger.debug("flushed %s writes in %s rounds in %0.3f sec (requeued: %s, dropped: %s)",
+                        count, len(rounds), time.time() - ts, len(requeue), dropped)
+        return len(requeue) == 0 and dropped == 0
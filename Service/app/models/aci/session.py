@@ -16,6 +16,7 @@ from OpenSSL.crypto import load_privatekey
 from OpenSSL.crypto import sign
 
 import base64
+import collections
 import copy
 import json
 import logging
@@ -262,16 +263,18 @@ class Session(object):
         """
         return self._send(method, url, data=data, timeout=timeout, retry=retry)
 
-    def get(self, url, timeout=None, retry=True):
+    def get(self, url, timeout=None, retry=True, stream=False):
         """ perform REST GET request to apic
 
             url (str)       relative url to get
             timeout (int)   timeout in seconds to complete the request
             retry (bool)    retry get on failure
+            stream (bool)   do not read response body until accessed. The caller must close the
+                            response once the body has been consumed
 
             returns requests response object
         """
-        return self._send("GET", url, timeout=timeout, retry=retry)
+        return self._send("GET", url, timeout=timeout, retry=retry, stream=stream)
 
     def init_subscription_thread(self):
         """ start subscription thread """
@@ -333,7 +336,7 @@ class Session(object):
         if self.session is not None:
             self.session.close()
 
-    def _send(self, method, url, data=None, timeout=None, retry=True):
+    def _send(self, method, url, data=None, timeout=None, retry=True, stream=False):
         """ perform GET/POST/DELETE request to apic
             returns requests response object
         """
@@ -358,7 +361,7 @@ class Session(object):
         #logger.debug("%s %s", method, url)
         # perform request method with optional retry
         resp = session_method(url, data=data, verify=self.verify_ssl, timeout=timeout, 
-                    proxies=self._proxies, cookies=cookies)
+                    proxies=self._proxies, cookies=cookies, stream=stream)
         if resp.status_code == 403 and retry:
             logger.warn('%s, refreshing login and will try again', resp.text)
             resp = self._send_login()
@@ -372,7 +375,7 @@ class Session(object):
                 elif method == "DELETE":
                     session_method = self.session.delete
                 resp = session_method(url, data=data, verify=self.verify_ssl, timeout=timeout, 
-                        proxies=self._proxies, cookies=cookies)
+                        proxies=self._proxies, cookies=cookies, stream=stream)
                 logger.debug('returning resp: %s', resp)
             else:
                 logger.warn('retry login failed')
@@ -482,8 +485,72 @@ class Login(threading.Thread):
 
         return self.exit()
 
+class EventBuffer(object):
+    """ bounded buffer of raw websocket frames between the websocket reader and event dispatcher.
+        The reader blocks when the buffer is full so events are never dropped. The high water mark
+        (reset each time stats are logged) and full count indicate that the dispatcher callbacks
+        are not keeping up with the websocket.
+    """
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.frames = collections.deque()
+        self.cond = threading.Condition()
+        # stats
+        self.high_water = 0
+        self.max_high_water = 0
+        self.total = 0
+        self.full_count = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __repr__(self):
+        return "size:%s, max_size:%s, high_water:%s, max_high_water:%s, total:%s, full:%s" % (
+            len(self.frames), self.max_size, self.high_water, self.max_high_water, self.total,
+            self.full_count)
+
+    def put(self, frame, timeout=1.0):
+        """ add frame to buffer, blocking up to timeout seconds if buffer is full.
+            return bool success
+        """
+        with self.cond:
+            if len(self.frames) >= self.max_size:
+                self.full_count+= 1
+                self.cond.wait(timeout)
+                if len(self.frames) >= self.max_size:
+                    return False
+            self.frames.append(frame)
+            self.total+= 1
+            if len(self.frames) > self.high_water:
+                self.high_water = len(self.frames)
+                if self.high_water > self.max_high_water:
+                    self.max_high_water = self.high_water
+            self.cond.notify_all()
+            return True
+
+    def get(self, timeout=1.0):
+        """ remove and return oldest frame, blocking up to timeout seconds if buffer is empty.
+            return None if no frame is available
+        """
+        with self.cond:
+            if len(self.frames) == 0:
+                self.cond.wait(timeout)
+                if len(self.frames) == 0:
+                    return None
+            frame = self.frames.popleft()
+            self.cond.notify_all()
+            return frame
+
+    def reset_high_water(self):
+        """ reset high water mark to current size """
+        with self.cond:
+            self.high_water = len(self.frames)
+
 class EventHandler(threading.Thread):
-    """ thread responsible for websocket event callbacks """
+    """ thread responsible for websocket reads. Each raw frame is added to the subscriber event
+        buffer with its receive timestamp and parsed by the event dispatcher thread so that slow 
+        callbacks never block reads from the websocket
+    """
     def __init__(self, subscriber):
         threading.Thread.__init__(self)
         self.subscriber = subscriber
@@ -506,22 +573,38 @@ class EventHandler(threading.Thread):
                 self.failure_reason = "websocket unexpectedly closed"
                 return
             if len(event) > 0:
-                # parse event, determine subscription_ids and callback
-                # note subsciption_ids is list of subscriptions... 
+                frame = (event, time.time())
+                if not self.subscriber.event_buffer.put(frame):
+                    logger.warn("event buffer full, websocket reads blocked: %s", 
+                            self.subscriber.event_buffer)
+                    while not self._exit and not self.subscriber.event_buffer.put(frame):
+                        pass
+
+class EventDispatcher(threading.Thread):
+    """ thread responsible for parsing raw websocket frames from subscriber event buffer and 
+        executing callbacks. A single dispatcher is used so callbacks receive events in the order
+        they were received on the websocket.
+    """
+    def __init__(self, subscriber):
+        threading.Thread.__init__(self)
+        self.subscriber = subscriber
+        self._exit = False
+
+    def exit(self):
+        """ exit thread """
+        logger.debug("exiting subscription event dispatcher thread")
+        self._exit = True
+
+    def run(self):
+        threading.currentThread().name = "session-dispatch"
+        while not self._exit:
+            frame = self.subscriber.event_buffer.get()
+            if frame is not None:
                 try:
-                    js = json.loads(event)
-                    js["_ts"] = time.time()
-                    if "subscriptionId" in js:
-                        for s_id in js["subscriptionId"]:
-                            cb = self.subscriber._subscription_ids.get(s_id, None)
-                            if cb is not None:
-                                cb.execute_callback(js)
-                            else:
-                                logger.debug("ignorning event, no callback for %s", s_id)
-                    else:
-                        logger.debug("invalid ws event, no subscription_id: %s", js)
-                except ValueError as e:
-                    logger.debug("failed to parse ws event: %s", event)
+                    self.subscriber.dispatch_event(frame[0], frame[1])
+                except Exception as e:
+                    logger.debug("Traceback:\n%s", traceback.format_exc())
+                    logger.warn("failed to dispatch event: %s", e)
 
 class CallbackHandler(object):
     """ handles callback for event for single url with pause support """
@@ -567,6 +650,10 @@ class CallbackHandler(object):
 
 class Subscriber(threading.Thread):
     """ thread responsible for event subscriptions """
+
+    EVENT_BUFFER_SIZE = 65536       # max number of raw websocket frames pending dispatch
+    EVENT_BUFFER_WARN = 0.75        # percentage of buffer size high water mark warning
+
     def __init__(self, session, resubscribe=True):
         threading.Thread.__init__(self)
         self.failure_reason = None
@@ -583,6 +670,8 @@ class Subscriber(threading.Thread):
         self._event_q = Queue()
         self.resubscribe = resubscribe
         self.event_handler_thread = None
+        self.event_dispatcher_thread = None
+        self.event_buffer = EventBuffer(max_size=Subscriber.EVENT_BUFFER_SIZE)
         self._lock = threading.Lock()
         self.restarting = False
 
@@ -608,6 +697,8 @@ class Subscriber(threading.Thread):
         self._exit = True
         # close any open websockets
         self._close_web_socket()
+        if self.event_dispatcher_thread is not None:
+            self.event_dispatcher_thread.exit()
         # cleanup pointers (should be empty as subscriptions are removed during socket close)
         for (_id, cb) in self._subscription_ids.items():
             cb.flush()
@@ -622,6 +713,7 @@ class Subscriber(threading.Thread):
         while not self._exit:
             # sleep for configured subscription refresh time
             time.sleep(self._session.subscription_refresh_time)
+            self.log_event_buffer_stats()
             try:
                 if not self.refresh_subscriptions():
                     logger.warn("failed to refresh one or more subscription")
@@ -632,6 +724,42 @@ class Subscriber(threading.Thread):
                 logger.warn("failed to refresh subscriptions, exiting thread")
                 return self.exit()
 
+    def log_event_buffer_stats(self):
+        """ log event buffer stats and reset high water mark """
+        if self.event_buffer.high_water >= Subscriber.EVENT_BUFFER_WARN*self.event_buffer.max_size:
+            logger.warn("event buffer high water mark exceeded: %s", self.event_buffer)
+        else:
+            logger.debug("event buffer %s", self.event_buffer)
+        self.event_buffer.reset_high_water()
+
+    def dispatch_event(self, event, ts):
+        """ parse raw websocket event received at ts and execute callback for each subscription """
+        # parse event, determine subscription_ids and callback
+        # note subsciption_ids is list of subscriptions... 
+        try:
+            js = json.loads(event)
+        except ValueError as e:
+            logger.debug("failed to parse ws event: %s", event)
+            return
+        js["_ts"] = ts
+        if "subscriptionId" in js:
+            for s_id in js["subscriptionId"]:
+                cb = self._subscription_ids.get(s_id, None)
+                if cb is not None:
+                    cb.execute_callback(js)
+                else:
+                    logger.debug("ignorning event, no callback for %s", s_id)
+        else:
+            logger.debug("invalid ws event, no subscription_id: %s", js)
+
+    def _start_event_dispatcher(self):
+        """ start event dispatcher thread if not currently running """
+        if self.event_dispatcher_thread is None or not self.event_dispatcher_thread.is_alive():
+            logger.debug("starting event dispatcher")
+            self.event_dispatcher_thread = EventDispatcher(self)
+            self.event_dispatcher_thread.daemon = True
+            self.event_dispatcher_thread.start()
+
     def pause(self, url):
         """ pause and buffer callbacks for events for single url"""
         logger.debug("pausing url %s", url)
@@ -865,6 +993,7 @@ class Subscriber(threading.Thread):
         self._close_web_socket()
         self._ws = self._get_web_socket()
         if self._ws is not None:
+            self._start_event_dispatcher()
             self.event_handler_thread = EventHandler(self)
             self.event_handler_thread.daemon = True
             self.event_handler_thread.start()
@@ -959,6 +1088,7 @@ class Subscriber(threading.Thread):
                 self._subscription_ids = subscription_ids
                 self._ws = ws
                 logger.debug("starting new event handler")
+                self._start_event_dispatcher()
                 self.event_handler_thread = EventHandler(self)
                 self.event_handler_thread.daemon = True
                 self.event_handler_thread.start()
@@ -434,6 +434,9 @@ class SubscriptionCtrl(object):
                     hasattr(self.session.subscription_thread.event_handler_thread, "is_alive") and \
                     self.session.subscription_thread.event_handler_thread.is_alive()
                 )
+                sub_thread = self.session.subscription_thread
+                dispatcher = getattr(sub_thread, "event_dispatcher_thread", None)
+                alive = alive and dispatcher is not None and dispatcher.is_alive()
                 if not alive:
                     self.set_failure("websocket is not connected or event handler thread has died")
 
@@ -7,12 +7,15 @@ from ..utils import get_app
 from ..utils import get_app_config
 from ..utils import pretty_print
 
+import collections
+import json
 import logging
 import logging.handlers
 import os
 import re
 import signal
 import subprocess
+import threading
 import time
 import traceback
 
@@ -22,6 +25,12 @@ logger = logging.getLogger(__name__)
 # static queue thresholds and timeouts
 SESSION_MAX_TIMEOUT = 120   # apic timeout hardcoded to 90...
 SESSION_LOGIN_TIMEOUT = 10  # login should be fast
+STREAM_CHUNK_SIZE = 1048576 # size of each read from response body when stream decoding
+
+# streaming decoder
+json_decoder = json.JSONDecoder()
+imdata_reg = re.compile("\"imdata\"\s*:\s*\[")
+total_count_reg = re.compile("\"totalCount\"\s*:\s*\"(?P<count>[0-9]+)\"")
 
 ###############################################################################
 #
@@ -82,45 +91,217 @@ def build_query_filters(**kwargs):
     if len(opts)>0: opts = "?%s" % opts.strip("&")
     return opts
                 
-def _get(session, url, timeout=None, limit=None, page_size=75000):
+def _get_page(session, url, timeout):
+    # get and decode a single page, return json dict with imdata and totalCount or None on error
+    tstart = time.time()
+    try:
+        resp = session.get(url, timeout=timeout)
+    except Exception as e:
+        logger.warn("exception occurred in get request: %s", e)
+        return None
+    if resp is None or not resp.ok:
+        logger.warn("failed to get data: %s", url)
+        return None
+    try:
+        js = resp.json()
+    except ValueError as e:
+        logger.warn("failed to decode resp: %s", resp.text)
+        return None
+    if "imdata" not in js or "totalCount" not in js:
+        logger.warn("failed to parse js reply: %s", pretty_print(js))
+        return None
+    logger.debug("time: %0.3f, results count: %s/%s", time.time() - tstart, len(js["imdata"]),
+            js["totalCount"])
+    return js
+
+def _iter_page(session, url, timeout, page_info):
+    # get a single page and incrementally decode the response body, yielding each imdata object as
+    # soon as it is received. On error None is yielded. On success page_info is updated with the 
+    # totalCount and count of objects on the page. Peak memory is bounded by a single chunk and 
+    # object instead of the entire page.
+    tstart = time.time()
+    try:
+        resp = session.get(url, timeout=timeout, stream=True)
+    except Exception as e:
+        logger.warn("exception occurred in get request: %s", e)
+        yield None
+        return
+    if resp is None or not resp.ok:
+        logger.warn("failed to get data: %s", url)
+        yield None
+        return
+    try:
+        chunks = resp.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+        buf = ""
+        count = 0
+        total_count = None
+        # read until start of imdata list, totalCount is expected before imdata
+        while True:
+            r1 = imdata_reg.search(buf)
+            if r1 is not None:
+                r2 = total_count_reg.search(buf, 0, r1.start())
+                if r2 is not None:
+                    total_count = r2.group("count")
+                i = r1.end()
+                break
+            chunk = next(chunks, None)
+            if chunk is None:
+                logger.warn("failed to parse js reply: %s", buf[0:1024])
+                yield None
+                return
+            buf+= chunk
+        # decode one object at a time from buffer, reading another chunk if object is incomplete
+        while True:
+            while i < len(buf) and buf[i] in " \t\r\n,":
+                i+= 1
+            if i < len(buf) and buf[i] == "]":
+                break
+            obj = None
+            if i < len(buf):
+                try:
+                    (obj, i) = json_decoder.raw_decode(buf, i)
+                except ValueError as e:
+                    pass
+            if obj is not None:
+                count+= 1
+                yield obj
+                continue
+            chunk = next(chunks, None)
+            if chunk is None:
+                logger.warn("failed to decode resp, incomplete object at: %s", buf[i:i+1024])
+                yield None
+                return
+            buf = buf[i:] + chunk
+            i = 0
+        # totalCount may also follow imdata
+        if total_count is None:
+            buf = buf[i:] + "".join(chunks)
+            r2 = total_count_reg.search(buf)
+            if r2 is None:
+                logger.warn("failed to parse js reply, no totalCount: %s", buf[0:1024])
+                yield None
+                return
+            total_count = r2.group("count")
+        page_info["count"] = count
+        page_info["totalCount"] = total_count
+        logger.debug("time: %0.3f, results count: %s/%s", time.time() - tstart, count, total_count)
+    finally:
+        resp.close()
+
+class PageFetch(threading.Thread):
+    """ fetch a single page in the background, result is available in js after join. If the fetch
+        is cancelled then the request is skipped if not yet started, else the page is discarded as
+        soon as it is received.
+    """
+    def __init__(self, session, url, timeout):
+        threading.Thread.__init__(self)
+        self.session = session
+        self.url = url
+        self.timeout = timeout
+        self.js = None
+        self.cancelled = False
+        self.daemon = True
+
+    def cancel(self):
+        """ cancel fetch and release the page if already received """
+        self.cancelled = True
+        self.js = None
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            js = _get_page(self.session, self.url, self.timeout)
+            if not self.cancelled:
+                self.js = js
+        except Exception as e:
+            logger.error("Traceback:\n%s", traceback.format_exc())
+
+def _get(session, url, timeout=None, limit=None, page_size=None, concurrency=None, 
+        stream_decode=False):
     # handle session request and perform basic data validation.  
     # this module always returns a generator of the results. If there is an error the first item
     # in the iterator (or on the received page) will be None.
+    # When concurrency is greater than 1, the totalCount from the first page is used to determine
+    # the remaining pages and up to concurrency pages are prefetched in parallel. Objects are 
+    # always yielded in page order.
+    # When stream_decode is set, each page is decoded incrementally as it is received. Prefetched
+    # pages are fully decoded so stream_decode only applies when concurrency is 1.
 
     page = 0
     if timeout is None:
         timeout = SESSION_MAX_TIMEOUT
+    if page_size is None:
+        page_size = int(get_app_config().get("APIC_PAGE_SIZE", 75000))
+    if concurrency is None:
+        concurrency = int(get_app_config().get("APIC_PAGE_CONCURRENCY", 1))
+    if stream_decode and concurrency > 1:
+        stream_decode = False
 
     url_delim = "?"
     if "?" in url: url_delim="&"
     
     count_received = 0
     count_yield = 0
-    # walk through pages until return count is less than page_size 
-    while True:
-        turl = "%s%spage-size=%s&page=%s" % (url, url_delim, page_size, page)
-        logger.debug("host:%s, timeout:%s, get:%s", session.hostname, timeout, turl)
-        tstart = time.time()
-        try:
-            resp = session.get(turl, timeout=timeout)
-        except Exception as e:
-            logger.warn("exception occurred in get request: %s", e)
-            yield None
-            return
-        if resp is None or not resp.ok:
-            logger.warn("failed to get data: %s", url)
-            yield None
-            return
-        try:
-            js = resp.json()
-            if "imdata" not in js or "totalCount" not in js:
-                logger.warn("failed to parse js reply: %s", pretty_print(js))
+    total_pages = None
+    pending = collections.deque()
+    try:
+        # walk through pages until return count is less than page_size 
+        while True:
+            if len(pending) > 0:
+                fetch = pending.popleft()
+                fetch.join()
+                js = fetch.js
+            elif stream_decode:
+                turl = "%s%spage-size=%s&page=%s" % (url, url_delim, page_size, page)
+                logger.debug("host:%s, timeout:%s, get:%s", session.hostname, timeout, turl)
+                page_info = {}
+                for obj in _iter_page(session, turl, timeout, page_info):
+                    if obj is None:
+                        yield None
+                        return
+                    count_yield+=1
+                    if (limit is not None and count_yield >= limit):
+                        logger.debug("limit(%s) hit or exceeded", limit)
+                        return
+                    yield obj
+                count_received+= page_info["count"]
+                if page_info["count"]<page_size or count_received>=int(page_info["totalCount"]):
+                    return
+                page+= 1
+                continue
+            else:
+                turl = "%s%spage-size=%s&page=%s" % (url, url_delim, page_size, page)
+                logger.debug("host:%s, timeout:%s, get:%s", session.hostname, timeout, turl)
+                js = _get_page(session, turl, timeout)
+            if js is None:
                 yield None
                 return
             count_received+= len(js["imdata"])
-            logger.debug("time: %0.3f, results count: %s/%s", time.time() - tstart, count_received,
-                    js["totalCount"])
-                
+            if len(js["imdata"])<page_size or count_received >= int(js["totalCount"]):
+                last_page = True
+            else:
+                last_page = False
+                page+= 1
+
+            # plan remaining pages from total count of first page and keep prefetch window full.
+            # pages beyond the limit are never fetched
+            if concurrency > 1 and not last_page:
+                if total_pages is None:
+                    total_pages = (int(js["totalCount"]) + page_size - 1) / page_size
+                    if limit is not None:
+                        total_pages = min(total_pages, (limit + page_size - 1) / page_size)
+                    logger.debug("prefetching %s pages with concurrency %s", total_pages, 
+                            concurrency)
+                next_page = page + len(pending)
+                while len(pending) < concurrency and next_page < total_pages:
+                    turl = "%s%spage-size=%s&page=%s" % (url, url_delim, page_size, next_page)
+                    logger.debug("host:%s, timeout:%s, get:%s", session.hostname, timeout, turl)
+                    fetch = PageFetch(session, turl, timeout)
+                    fetch.start()
+                    pending.append(fetch)
+                    next_page+= 1
+
             for obj in js["imdata"]:
                 count_yield+=1
                 if (limit is not None and count_yield >= limit):
@@ -128,16 +309,18 @@ def _get(session, url, timeout=None, limit=None, page_size=75000):
                     return
                 yield obj
 
-            if len(js["imdata"])<page_size or count_received >= int(js["totalCount"]):
+            if last_page:
                 #logger.debug("all pages received")
                 return
-            page+= 1
-        except ValueError as e:
-            logger.warn("failed to decode resp: %s", resp.text)
-            yield None
-            return
-    yield None
-    return
+            # release reference to page before waiting on the next one
+            js = None
+    finally:
+        # on limit, error, or consumer closing the generator early, cancel pending prefetches so
+        # their pages are released as soon as they are received
+        if len(pending) > 0:
+            logger.debug("cancelling %s pending page fetches", len(pending))
+            for fetch in pending:
+                fetch.cancel()
 
 def get_dn(session, dn, timeout=None, **kwargs):
     # get a single dn.  Note, with advanced queries this may be list as well
@@ -155,15 +338,25 @@ def get_dn(session, dn, timeout=None, **kwargs):
         # empty non-None object implies valid empty response
         return {} 
     
-def get_class(session, classname, timeout=None, limit=None, stream=False, **kwargs):
+def get_class(session, classname, timeout=None, limit=None, stream=False, page_size=None,
+        concurrency=None, node_dn=None, **kwargs):
     # perform class query.  If stream is set to true then this will act as an iterator yielding the
     # next result. If the query failed then the first (and only) result of the iterator will be None
+    # page_size and concurrency default to APIC_PAGE_SIZE and APIC_PAGE_CONCURRENCY from config
+    # streamed results are decoded incrementally unless APIC_STREAM_DECODE is disabled
+    # set node_dn (topology/pod-X/node-Y) to limit the class query to a single node
     opts = build_query_filters(**kwargs)
-    url = "/api/class/%s.json%s" % (classname, opts)
+    if node_dn is not None:
+        url = "/api/node/class/%s/%s.json%s" % (node_dn, classname, opts)
+    else:
+        url = "/api/class/%s.json%s" % (classname, opts)
     if stream:
-        return _get(session, url, timeout=timeout, limit=limit) 
+        return _get(session, url, timeout=timeout, limit=limit, page_size=page_size,
+                concurrency=concurrency,
+                stream_decode=bool(get_app_config().get("APIC_STREAM_DECODE", True)))
     ret = []
-    for obj in _get(session, url, timeout=timeout, limit=limit):
+    for obj in _get(session, url, timeout=timeout, limit=limit, page_size=page_size,
+            concurrency=concurrency):
         if obj is None:
             return None
         ret.append(obj)
@@ -595,29 +788,34 @@ def get_file_md5(path):
 ###############################################################################
 
 def syslog(msg, server="localhost", server_port=514, severity="info", process="EPT", 
-        facility=logging.handlers.SysLogHandler.LOG_LOCAL7, dns_cache=None):
+        facility=logging.handlers.SysLogHandler.LOG_LOCAL7, dns_cache=None, handler=None):
     """ send a syslog message to remote server.  return boolean success
         for acceptible facilities see:
             https://docs.python.org/2/library/logging.handlers.html
             15.9.9. SysLogHandler
+        If a SysLogHandler is provided then it is used to send the message and left open for the
+        next message, else a handler is created for server and server_port and closed after send.
     """
     from . ept.dns_cache import DNSCache
 
     if msg is None:
         logger.error("unable to send syslog: no message provided")
         return False
-    if server is None:
+    if server is None and handler is None:
         logger.error("unable to send syslog: no server provided")
         return False
-    if dns_cache is None:
+    if dns_cache is None and handler is None:
         dns_cache = DNSCache()
 
     # best effort, try to do preliminary DNS lookup on server so we can cache this info between
     # syslog messages. If dns lookup fails here then let syslog library tries its own DNS lookup
-    cached_server = dns_cache.dns_lookup(server, query_type="A")
-    if cached_server is not None:
-        logger.debug("using dns ip for server: %s", cached_server)
-        server = cached_server
+    if handler is None:
+        cached_server = dns_cache.dns_lookup(server, query_type="A")
+        if cached_server is not None:
+            logger.debug("using dns ip for server: %s", cached_server)
+            server = cached_server
+    else:
+        facility = handler.facility
 
     try:
         if(isinstance(server_port, int)):
@@ -680,9 +878,10 @@ def syslog(msg, server="localhost", server_port=514, severity="info", process="E
     # setup logger for syslog
     syslogger = logging.getLogger("syslog")
     syslogger.setLevel(logging.DEBUG)
-    fmt = "%(asctime)s %(message)s"
-    remote_syslog = logging.handlers.SysLogHandler(address=(server,port),facility=facility)
-    remote_syslog.setFormatter(logging.Formatter(fmt=fmt,datefmt=": %Y %b %d %H:%M:%S %Z:"))
+    if handler is None:
+        remote_syslog = get_syslog_handler(server, port, facility=facility)
+    else:
+        remote_syslog = handler
     syslogger.addHandler(remote_syslog)
 
     # send syslog (only supporting native python priorities for now)
@@ -701,11 +900,70 @@ def syslog(msg, server="localhost", server_port=514, severity="info", process="E
     method(s)
     # remove syslogger from handler and restore old loggers
     syslogger.removeHandler(remote_syslog)
+    if handler is None:
+        remote_syslog.close()
     for h in old_handlers: logger.addHandler(h)
     # return success
     return True
 
-def send_emails(settings=None, dns_cache=None, emails=None):
+def get_syslog_handler(server, server_port=514, facility=logging.handlers.SysLogHandler.LOG_LOCAL7):
+    """ return SysLogHandler for remote server that can be provided to syslog function. The caller
+        is responsible for closing the handler
+    """
+    fmt = "%(asctime)s %(message)s"
+    handler = logging.handlers.SysLogHandler(address=(server,server_port),facility=facility)
+    handler.setFormatter(logging.Formatter(fmt=fmt,datefmt=": %Y %b %d %H:%M:%S %Z:"))
+    return handler
+
+class SmtpConnection(object):
+    """ persistent smtp session that can be provided to send_emails. The session is kept open after
+        the emails are sent and reused by the next send to the same smtp server. A session idle for
+        more than idle_timeout seconds is closed before reuse as most smtp servers drop idle clients
+    """
+    def __init__(self, idle_timeout=60.0):
+        self.idle_timeout = idle_timeout
+        self.smtp = None
+        self.key = None
+        self.override_sender = None
+        self.last_ts = 0
+
+    def get(self, key):
+        """ return tuple (smtp, override_sender) for open session matching key. The session is
+            removed from the connection until returned with set. (None, None) is returned if there
+            is no valid session
+        """
+        smtp = self.smtp
+        override_sender = self.override_sender
+        valid = self.key == key and time.time() - self.last_ts <= self.idle_timeout
+        self.smtp = None
+        self.key = None
+        self.override_sender = None
+        if smtp is not None and not valid:
+            logger.debug("closing idle or stale smtp session")
+            try: smtp.quit()
+            except Exception as e: pass
+            smtp = None
+        if smtp is None:
+            return (None, None)
+        return (smtp, override_sender)
+
+    def set(self, key, smtp, override_sender=None):
+        """ save open smtp session for key """
+        self.close()
+        self.smtp = smtp
+        self.key = key
+        self.override_sender = override_sender
+        self.last_ts = time.time()
+
+    def close(self):
+        """ close current smtp session """
+        if self.smtp is not None:
+            try: self.smtp.quit()
+            except Exception as e: pass
+        self.smtp = None
+        self.key = None
+
+def send_emails(settings=None, dns_cache=None, emails=None, connection=None):
     """ using Rest.Settings object with configured SMTP settings, send an email using the native
         python smtplib. 
 
@@ -718,6 +976,10 @@ def send_emails(settings=None, dns_cache=None, emails=None):
                                 sender(str)   email sender address. Note smtp_relay_username in 
                                               settings object will override provided sender address 
                                               if smtp_relay_authentication is enabled.
+        connection(SmtpConnection) optional persistent smtp session. If provided, the session is
+                                reused when the smtp server is unchanged and kept open on success.
+                                If the server has closed the reused session then a new session is
+                                created and the email is sent again.
 
         If there is more than one email provided then function will return on first failure or after
         all emails have successfully been sent
@@ -787,32 +1049,65 @@ def send_emails(settings=None, dns_cache=None, emails=None):
         smtp_server = cached_server
 
     # send email with TLS and optional login if this is an SMTP relay and auth enabled
-    s = None
-    try:
+    def connect():
+        # return tuple (smtp, override_sender, error) for new smtp session
         override_sender = None
         logger.debug("sending email (%s,%s) auth:%r", smtp_server, smtp_port, smtp_auth)
-        s = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
+        smtp = smtplib.SMTP(smtp_server, smtp_port, timeout=10)
         try:
-            s.starttls()
-            s.ehlo()
+            smtp.starttls()
+            smtp.ehlo()
         except (smtplib.SMTPHeloError, smtplib.SMTPException) as tls_error:
             logger.warn("start tls failed, trying to proceed anyways: %s", tls_error)
         if smtp_auth:
             # override sender with smtp_relay_username
             override_sender = settings.smtp_relay_username
             try:
-                s.login(settings.smtp_relay_username, settings.smtp_relay_password)
+                smtp.login(settings.smtp_relay_username, settings.smtp_relay_password)
             except Exception as e:
-                return err("login error %s" % e)
+                try: smtp.quit()
+                except Exception as e2: pass
+                return (None, None, "login error %s" % e)
+        return (smtp, override_sender, None)
+
+    s = None
+    key = (smtp_server, smtp_port, smtp_auth, settings.smtp_relay_username if smtp_auth else None)
+    try:
+        reused = False
+        if connection is not None:
+            (s, override_sender) = connection.get(key)
+            reused = s is not None
+        if s is None:
+            (s, override_sender, error) = connect()
+            if error is not None:
+                return err(error)
         # try to send each email in valid_emails list
         for (sender, receiver, text) in valid_emails:
             if override_sender is not None:
                 sender = override_sender
             logger.debug("from %s to %s: %s", sender, receiver, text.get_payload())
-            ret = s.sendmail(sender, [receiver], text.as_string())
+            try:
+                ret = s.sendmail(sender, [receiver], text.as_string())
+            except (smtplib.SMTPServerDisconnected, socket.error) as e:
+                if not reused:
+                    raise
+                # persistent session closed by the server, reconnect once and resend
+                logger.debug("smtp session closed (%s), reconnecting", e)
+                reused = False
+                try: s.close()
+                except Exception as e2: pass
+                (s, override_sender, error) = connect()
+                if error is not None:
+                    return err(error)
+                if override_sender is not None:
+                    sender = override_sender
+                ret = s.sendmail(sender, [receiver], text.as_string())
             # we only support one receiver, therefore if there was no exception raised then the 
             # email should have successfully been delivered to the receiver
             logger.debug("email successfully sent")
+        if connection is not None:
+            connection.set(key, s, override_sender)
+            s = None
         return (True, "")
     except socket.error as serr:
         logger.debug("socket error: %s", serr)
@@ -839,95 +1134,24 @@ def clear_endpoint(fabric, pod, node, vnid, addr, addr_type="ip", vrf_name=""):
         return bool success
     """
     from . fabric import Fabric
-    from . ept.common import parse_vrf_name
-    from . ept.common import get_mac_string
-    from . ept.common import get_mac_value
-    from . ept.ept_vnid import eptVnid
+    from . ept.ept_clear import eptClearEndpoint
+    from . ept.ept_clear import eptClearService
     if isinstance(fabric, Fabric):
         f = fabric
     else:
         f = Fabric.load(fabric=fabric)
 
     logger.debug("clear endpoint [%s, node:%s, vnid:%s, addr:%s]", f.fabric, node, vnid, addr)
-    session = None
+    if not f.exists():
+        logger.warn("unknown fabric: %s", f.fabric)
+        return False
+    ep = eptClearEndpoint(pod, node, vnid, addr, addr_type="ip" if addr_type == "ip" else "mac",
+                            vrf_name=vrf_name)
+    service = eptClearService(f)
     try:
-        if not f.exists():
-            logger.warn("unknown fabric: %s", f.fabric)
-            return False
-        session = get_apic_session(f)
-        if session is None:
-            logger.warn("failed to get apic session for fabric: %s", f.fabric)
-            return False
-        ssh = get_ssh_connection(f, pod, node, session=session)
-        if ssh is None:
-            logger.warn("failed to ssh to pod:%s node:%s", pod, node)
-            return False
-
-        if addr_type == "ip":
-            ctype = "ipv6" if ":" in addr else "ip"
-            if len(vrf_name) == 0:
-                # try to determine vrf name from eptVnid table
-                v = eptVnid.find(fabric=f.fabric, vnid=vnid)
-                if len(v) > 0:
-                    vrf_name = parse_vrf_name(v[0].name)
-                    if vrf_name is None:
-                        logger.warn("failed to parse vrf name from ept vnid_name: %s", v.name)
-                        return False
-                else:
-                    logger.warn("failed to determine vnid_name for fabric:%s,vnid:%s",f.fabric,vnid)
-                    return False
-            cmd="vsh -c 'clear system internal epm endpoint key vrf %s %s %s'"%(vrf_name,ctype,addr)
-            if ssh.cmd(cmd) == "prompt":
-                logger.debug("successfully cleared endpoint: %s", cmd)
-                return True
-            else:
-                logger.warn("failed to execute clear cmd: %s", cmd)
-                return False
-        else:
-            # first cast mac into correct format
-            addr = get_mac_string(get_mac_value(addr),fmt="std")
-        
-            # to determine mac FD need to first verify mac exists and then use parent dn to query
-            # l2BD, vlanCktEp, vxlanCktEp object (good thing here is that we don't care which object 
-            # type, each will have id attribute that is the PI vlan)
-            # here we have two choices, first is APIC epmMacEp query which hits all nodes or, since
-            # ssh session is already up, we can execute directly on the leaf. For that latter case,
-            # it will be easier to use moquery with grep then parsing json with extra terminal
-            # characters...
-            cmd="moquery -c epmMacEp -f 'epm.MacEp.addr==\"%s\"' | egrep '^dn' | egrep 'vxlan-%s'"%(
-                    addr, vnid)
-            if ssh.cmd(cmd) == "prompt":
-                r1 = re.search("dn[ ]*:[ ]*(?P<dn>sys/.+)/db-ep", ssh.output)
-                if r1 is not None:
-                    cmd = "moquery -d '%s' | egrep '^id'" % r1.group("dn")
-                    if ssh.cmd(cmd) == "prompt":
-                        r2 = re.search("id[ ]*:[ ]*(?P<pi>[0-9]+)", ssh.output)
-                        if r2 is not None:
-                            cmd = "vsh -c 'clear system internal epm endpoint key vlan %s mac %s'"%(
-                                r2.group("pi"), addr)
-                            if ssh.cmd(cmd) == "prompt":
-                                logger.debug("successfully cleared endpoint: %s", cmd)
-                                return True
-                            else:
-                                logger.warn("failed to execute clear cmd: %s", cmd)
-                                return False
-                        else:
-                            logger.warn("failed to extract pi-vlan id from %s: %s", r1.group("dn"), 
-                                ssh.output)
-                            return False
-                    else:
-                        logger.warn("failed to execute command: %s", cmd)
-                else:
-                    logger.debug("failed to parse bd/cktEp from dn or endpoint not found: %s",
-                        ssh.output)
-                    # assume parsing was fine and that endpoint is no longer present (so cleared!)
-                    return True
-            else:
-                logger.warn("failed to execute moquery command to determine mac fd on leaf")
-                return False
+        service.clear([ep])
     finally:
-        if session is not None:
-            logger.debug("clossing session")
-            session.close()
+        service.close()
+    return ep.success
 
         
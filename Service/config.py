@@ -149,6 +149,46 @@ REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
 REDIS_DB = int(os.environ.get("REDIS_DB", 0))
 
+# number of dispatcher processes forked by the manager to dispatch work to workers. Work is 
+# partitioned by fabric across dispatchers. Set to 0 for the manager to dispatch all work.
+MANAGER_DISPATCHER_COUNT = int(os.environ.get("MANAGER_DISPATCHER_COUNT", 0))
+
+# workers buffer endpoint history/state db writes and flush them in bulk by size or short deadline.
+# Set to 0 to write each update directly to the db.
+WORKER_WRITE_BUFFER = bool(int(os.environ.get("WORKER_WRITE_BUFFER", 1)))
+
+# max number of messages a worker pulls from its queues per redis round trip. Broadcast channel
+# messages are handled between each batch.
+WORKER_QUEUE_BATCH_SIZE = int(os.environ.get("WORKER_QUEUE_BATCH_SIZE", 64))
+
+# directory on a host-local filesystem (i.e., /dev/shm/ept) where workers on the same host share
+# a snapshot of common fabric lookups (node, tunnel, vpc, pc, vnid, epg, and subnet). Each snapshot
+# is versioned by cache flush generation. Leave empty to disable.
+WORKER_SHARED_CACHE_DIR = os.environ.get("WORKER_SHARED_CACHE_DIR", "")
+
+# workers bulk load node, tunnel, vpc, pc, vnid, epg, and subnet caches once the subscriber
+# completes the initial build of the fabric and size each cache from the number of objects in the
+# fabric. Set to 0 to populate caches on first lookup only.
+WORKER_CACHE_WARMUP = bool(int(os.environ.get("WORKER_CACHE_WARMUP", 1)))
+
+# memory budget in MB for all caches within each worker process. Caches are periodically resized
+# to fit the budget, favoring caches with the highest miss cost. Defaults to 0 for fixed cache
+# sizes.
+WORKER_CACHE_MEMORY_MB = int(os.environ.get("WORKER_CACHE_MEMORY_MB", 0))
+
+# watcher auto-clears stale and offsubnet endpoints over pooled ssh connections on up to this many
+# nodes across all fabrics in parallel.
+WATCHER_CLEAR_CONCURRENCY = int(os.environ.get("WATCHER_CLEAR_CONCURRENCY", 4))
+# max number of nodes the endpoint clear api clears in parallel for a single request.
+API_CLEAR_CONCURRENCY = int(os.environ.get("API_CLEAR_CONCURRENCY", 16))
+
+# apic class queries are paged with APIC_PAGE_SIZE objects per page. Set APIC_PAGE_CONCURRENCY
+# greater than 1 to prefetch up to that many pages in parallel on large queries.
+APIC_PAGE_SIZE = int(os.environ.get("APIC_PAGE_SIZE", 75000))
+APIC_PAGE_CONCURRENCY = int(os.environ.get("APIC_PAGE_CONCURRENCY", 1))
+# streamed class queries decode each object as it is received instead of the full page at once
+APIC_STREAM_DECODE = bool(int(os.environ.get("APIC_STREAM_DECODE", 1)))
+
 # email options
 EMAIL_SENDER = os.environ.get("EMAIL_SENDER", "noreply@aci.app")
 
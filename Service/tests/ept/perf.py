@@ -27,14 +27,25 @@ from app.models.aci.ept.common import get_ipv6_string
 from app.models.aci.ept.common import get_mac_string
 from app.models.aci.fabric import Fabric
 from app.models.aci.ept.common import get_ipv4_string, get_ipv6_string
-from app.models.aci.ept.epg import eptEpg
-from app.models.aci.ept.history import eptHistory
-from app.models.aci.ept.node import eptNode
-from app.models.aci.ept.subnet import eptSubnet
-from app.models.aci.ept.tunnel import eptTunnel
-from app.models.aci.ept.vnid import eptVnid
-from app.models.aci.ept.vpc import eptVpc
+from app.models.aci.ept.ept_epg import eptEpg
+from app.models.aci.ept.ept_history import eptHistory
+from app.models.aci.ept.ept_node import eptNode
+from app.models.aci.ept.ept_subnet import eptSubnet
+from app.models.aci.ept.ept_tunnel import eptTunnel
+from app.models.aci.ept.ept_vnid import eptVnid
+from app.models.aci.ept.ept_vpc import eptVpc
+from app.models.aci.ept.ept_msg import eptEpmEventParser
+from app.models.aci.ept.ept_msg import parse_epm_dn_fast
+from app.models.aci.ept.ept_msg import parse_epm_dn_regex
+from scale import scale
+from scale import node_base_id
+from scale import vrf_base_vnid
+from scale import bd_base_vnid
+from scale import v4_subnet_base
+from scale import v6_subnet_base
+from scale import mac_base
 db = None
+overlay_vnid = 0xffffef
 
 class Subnet(object):
     def __init__(self, addr, mask, subnet_type, vrf, bd, prefix):
@@ -97,10 +108,97 @@ def dummy_work(subnets, count):
     logger.debug("completed %s lookups, time: %0.3f, avg: %0.6f, jobs/sec: %0.6f", count, total_time,
         total_time/count, count/total_time)
 
+def get_epm_node_records(node_index):
+    # return list of (classname, dn) for all epm records on a single node generated from the
+    # endpoint scale in scale.py. Each local ip also has an epmRsMacEpToIpEpAtt record
+    node = node_base_id + node_index
+    vrf = vrf_base_vnid + node_index % scale["vrfs"]
+    bd = bd_base_vnid + node_index % (scale["vrfs"] * scale["bds_per_vrf"])
+    base = "topology/pod-1/node-%s/sys/ctx-[vxlan-%s]" % (node, vrf)
+    local = "%s/bd-[vxlan-%s]/vlan-[vlan-%s]" % (base, bd, 100 + node_index % 3000)
+    rs = "rsmacEpToIpEpAtt-[sys/ctx-[vxlan-%s]/bd-[vxlan-%s]/vlan-[vlan-%s]/db-ep/ip-[%s]]"
+    offset = node_index * 0x10000
+    records = []
+    def add_mac(count, dn_prefix):
+        for i in xrange(0, count):
+            mac = get_mac_string(mac_base + offset + len(records))
+            records.append(("epmMacEp", "%s/db-ep/mac-%s" % (dn_prefix, mac)))
+    def add_ip(count, ipv6, is_local):
+        for i in xrange(0, count):
+            if ipv6:
+                ip = get_ipv6_string(v6_subnet_base + offset + len(records))
+            else:
+                ip = get_ipv4_string(v4_subnet_base + offset + len(records))
+            if is_local:
+                records.append(("epmIpEp", "%s/db-ep/ip-[%s]" % (local, ip)))
+                mac = get_mac_string(mac_base + offset + i)
+                records.append(("epmRsMacEpToIpEpAtt", "%s/db-ep/mac-%s/%s" % (local, mac,
+                    rs % (vrf, bd, 100 + node_index % 3000, ip))))
+            else:
+                records.append(("epmIpEp", "%s/db-ep/ip-[%s]" % (base, ip)))
+
+    add_mac(scale["per_node_local_vpc_mac"] + scale["per_node_local_orphan_mac"], local)
+    add_ip(scale["per_node_local_vpc_ipv4"] + scale["per_node_local_orphan_ipv4"], False, True)
+    add_ip(scale["per_node_local_vpc_ipv6"] + scale["per_node_local_orphan_ipv6"], True, True)
+    add_mac(scale["per_node_xr_vpc_mac"] + scale["per_node_xr_ptep_mac"], local)
+    add_ip(scale["per_node_xr_vpc_ipv4"] + scale["per_node_xr_ptep_ipv4"], False, False)
+    add_ip(scale["per_node_xr_vpc_ipv6"] + scale["per_node_xr_ptep_ipv6"], True, False)
+    return records
+
+def epm_parser_perf(node_count):
+    # parse epm records of each node with parse_epm_dn_regex, parse_epm_dn_fast, and the full
+    # eptEpmEventParser parse used by the subscriber and return dict of total time per parser.
+    # Nothing is written to the db
+    parser = eptEpmEventParser("esc-aci-fab4", overlay_vnid)
+    totals = {"regex": 0.0, "fast": 0.0, "parse": 0.0, "count": 0, "fallback": 0}
+    for n in xrange(0, node_count):
+        records = get_epm_node_records(n)
+        totals["count"]+= len(records)
+
+        ts = time.time()
+        for (classname, dn) in records:
+            parse_epm_dn_regex(dn, rs=(classname == "epmRsMacEpToIpEpAtt"))
+        totals["regex"]+= time.time() - ts
+
+        ts = time.time()
+        for (classname, dn) in records:
+            if parse_epm_dn_fast(dn, rs=(classname == "epmRsMacEpToIpEpAtt")) is None:
+                totals["fallback"]+= 1
+        totals["fast"]+= time.time() - ts
+
+        ts = time.time()
+        for (classname, dn) in records:
+            parser.parse(classname, {"dn": dn, "status": "", "flags": "local", "pcTag": "32771"},
+                1.0)
+        totals["parse"]+= time.time() - ts
+
+        if (n+1) % 50 == 0:
+            logger.debug("nodes: %s, records: %s", n+1, totals["count"])
+    return totals
+
 
 
 if __name__ == "__main__":
 
+    import argparse
+    parser = argparse.ArgumentParser(description="endpoint tracker perf tests")
+    parser.add_argument("--epm-parser", action="store_true", dest="epm_parser",
+        help="benchmark epm dn parsing with the endpoint scale in scale.py (no db required)")
+    parser.add_argument("--nodes", action="store", dest="nodes", type=int,
+        default=scale["nodes"], help="number of nodes to generate epm records for")
+    args = parser.parse_args()
+
+    if args.epm_parser:
+        setup_logger(logger, stdout=True)
+        totals = epm_parser_perf(args.nodes)
+        count = totals["count"]
+        for p in ["regex", "fast", "parse"]:
+            logger.debug("%-6s count: %s, time: %0.3f, avg: %0.9f, per/sec: %0.3f", p, count,
+                totals[p], totals[p]/count, count/totals[p])
+        logger.debug("fast path fallback count: %s, speedup: %0.2fx", totals["fallback"],
+            totals["regex"]/totals["fast"])
+        sys.exit(0)
+
     # db updates through environment settings - required before initializing db
     os.environ["MONGO_DBNAME"] = "scaledb1"
 
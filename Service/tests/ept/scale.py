@@ -391,13 +391,13 @@ from app.models.aci.ept.common import get_ipv6_string
 from app.models.aci.ept.common import get_mac_string
 from app.models.aci.fabric import Fabric
 from app.models.aci.ept.common import get_ipv4_string, get_ipv6_string
-from app.models.aci.ept.epg import eptEpg
-from app.models.aci.ept.history import eptHistory
-from app.models.aci.ept.node import eptNode
-from app.models.aci.ept.subnet import eptSubnet
-from app.models.aci.ept.tunnel import eptTunnel
-from app.models.aci.ept.vnid import eptVnid
-from app.models.aci.ept.vpc import eptVpc
+from app.models.aci.ept.ept_epg import eptEpg
+from app.models.aci.ept.ept_history import eptHistory
+from app.models.aci.ept.ept_node import eptNode
+from app.models.aci.ept.ept_subnet import eptSubnet
+from app.models.aci.ept.ept_tunnel import eptTunnel
+from app.models.aci.ept.ept_vnid import eptVnid
+from app.models.aci.ept.ept_vpc import eptVpc
 db = None
 
 def allocate_new_value(atype):
@@ -0,0 +1,211 @@
+
+import json
+import logging
+import pytest
+import re
+import threading
+import time
+
+from app.models.aci.utils import PageFetch
+from app.models.aci.utils import _get
+from app.models.aci.utils import get_class
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+@pytest.fixture(scope="module")
+def app(request, app):
+    # module level setup
+    app.config["LOGIN_ENABLED"] = False
+
+    # teardown called after all tests in session have completed
+    def teardown(): pass
+    request.addfinalizer(teardown)
+
+    logger.debug("(%s) module level app setup completed", __name__)
+    return app
+
+class dummyResponse(object):
+    # response with body returned in chunks of chunk_size bytes when streamed
+    def __init__(self, text, ok=True, chunk_size=None):
+        self.text = text
+        self.ok = ok
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        if self.chunk_size is not None:
+            chunk_size = self.chunk_size
+        for i in xrange(0, len(self.text), chunk_size):
+            yield self.text[i:i+chunk_size]
+
+    def close(self):
+        self.closed = True
+
+class dummySession(object):
+    # session returning a page of objects for each paged class query
+    def __init__(self, objects, delay=0, fail_page=None, chunk_size=None):
+        self.hostname = "apic1"
+        self.objects = objects
+        self.delay = delay
+        self.fail_page = fail_page
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.pages = []
+        self.responses = []
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def get(self, url, timeout=None, stream=False):
+        r1 = re.search("page-size=(?P<size>[0-9]+)&page=(?P<page>[0-9]+)", url)
+        size = int(r1.group("size"))
+        page = int(r1.group("page"))
+        with self.lock:
+            self.pages.append(page)
+            self.inflight+= 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.inflight-= 1
+        if page == self.fail_page:
+            return dummyResponse("", ok=False)
+        resp = dummyResponse(self.get_body(self.objects[page*size:(page+1)*size]),
+                chunk_size=self.chunk_size)
+        self.responses.append(resp)
+        return resp
+
+    def get_body(self, imdata):
+        return json.dumps({"totalCount": "%s" % len(self.objects), "imdata": imdata})
+
+def get_objects(count):
+    return [{"fvCEp": {"attributes": {"dn": "uni/tn-ag/ep-%s" % i, "ip": "10.1.1.%s" % i}}}
+            for i in xrange(0, count)]
+
+def test_get_class_sequential_pages(app):
+    # ensure all pages are read in order with default concurrency of 1
+    objects = get_objects(10)
+    session = dummySession(objects)
+    ret = get_class(session, "fvCEp", page_size=3, concurrency=1)
+    assert ret == objects
+    assert session.pages == [0, 1, 2, 3]
+    assert session.max_inflight == 1
+
+def test_get_class_prefetch_pages_in_order(app):
+    # ensure prefetched pages are requested once, in parallel, and objects yielded in page order
+    objects = get_objects(50)
+    session = dummySession(objects, delay=0.05)
+    ret = get_class(session, "fvCEp", page_size=5, concurrency=4)
+    assert ret == objects
+    assert sorted(session.pages) == range(0, 10)
+    assert 1 < session.max_inflight <= 4
+
+def test_get_class_prefetch_exact_page_multiple(app):
+    # ensure no extra page is requested when total count is a multiple of page size
+    objects = get_objects(20)
+    session = dummySession(objects)
+    ret = get_class(session, "fvCEp", page_size=5, concurrency=3)
+    assert ret == objects
+    assert sorted(session.pages) == range(0, 4)
+
+def test_get_class_prefetch_page_error(app):
+    # ensure failed prefetch page yields None after all objects of the previous pages
+    objects = get_objects(50)
+    session = dummySession(objects, fail_page=3)
+    assert get_class(session, "fvCEp", page_size=5, concurrency=4) is None
+    ret = [obj for obj in _get(session, "/api/class/fvCEp.json", page_size=5, concurrency=4)]
+    assert ret == objects[0:15] + [None]
+
+def test_get_class_prefetch_limit(app):
+    # ensure limit is applied across prefetched pages and no page beyond the limit is requested
+    objects = get_objects(50)
+    session = dummySession(objects)
+    ret = get_class(session, "fvCEp", page_size=5, concurrency=4, limit=13)
+    assert ret == objects[0:12]
+    assert sorted(session.pages) == range(0, 3)
+
+def test_get_class_prefetch_cancel_on_close(app, monkeypatch):
+    # ensure pending prefetches are cancelled and their pages released when the consumer closes
+    # the generator early
+    fetches = []
+    class trackedPageFetch(PageFetch):
+        def __init__(self, *args):
+            PageFetch.__init__(self, *args)
+            fetches.append(self)
+    monkeypatch.setattr("app.models.aci.utils.PageFetch", trackedPageFetch)
+    objects = get_objects(50)
+    session = dummySession(objects, delay=0.1)
+    gen = _get(session, "/api/class/fvCEp.json", page_size=5, concurrency=4)
+    assert next(gen) == objects[0]
+    gen.close()
+    assert len(fetches) == 4
+    assert all([f.cancelled for f in fetches])
+    for f in fetches:
+        f.join(5.0)
+    assert all([f.js is None for f in fetches])
+
+def get_stream_objects(count):
+    # objects with strings that contain json delimiters, escapes, and nested objects
+    ret = []
+    for i in xrange(0, count):
+        ret.append({"fvCEp": {
+            "attributes": {
+                "dn": "uni/tn-ag/ap-a1/epg-e1/cep-[00:00:00:00:00:%02x]" % i,
+                "descr": "quote \" brace { } bracket [ ] comma , colon : %s" % i,
+                "path": "c:\\temp\\%s\\" % i,
+                "name": u"caf\u00e9-%s" % i,
+            },
+            "children": [{"fvIp": {"attributes": {"addr": "10.1.1.%s" % i, "rn": "ip-[]"}}}],
+        }})
+    return ret
+
+def get_stream(session, page_size=100):
+    return [o for o in _get(session, "/api/class/fvCEp.json", page_size=page_size, concurrency=1,
+            stream_decode=True)]
+
+def test_stream_decode_chunk_boundaries(app):
+    # ensure objects are decoded when chunks split strings, escapes, and nested objects
+    objects = get_stream_objects(5)
+    for chunk_size in [1, 2, 3, 5, 7, 13, 64, 1048576]:
+        session = dummySession(objects, chunk_size=chunk_size)
+        assert get_stream(session) == objects
+        assert session.pages == [0]
+        assert all([r.closed for r in session.responses])
+
+def test_stream_decode_multiple_pages(app):
+    # ensure stream decode walks all pages using the count of objects decoded per page
+    objects = get_stream_objects(10)
+    session = dummySession(objects, chunk_size=7)
+    assert get_stream(session, page_size=4) == objects
+    assert session.pages == [0, 1, 2]
+
+def test_stream_decode_empty_and_total_count_after_imdata(app):
+    # ensure totalCount is read when it follows imdata along with an empty imdata list
+    class totalCountLast(dummySession):
+        def get_body(self, imdata):
+            return "{\"imdata\": %s, \"totalCount\": \"%s\"}" % (json.dumps(imdata), 
+                    len(self.objects))
+    objects = get_stream_objects(3)
+    session = totalCountLast(objects, chunk_size=4)
+    assert get_stream(session) == objects
+    session = totalCountLast([], chunk_size=4)
+    assert get_stream(session) == []
+
+def test_stream_decode_truncated_input(app):
+    # ensure truncated or invalid body yields None after the objects that were fully received
+    class truncated(dummySession):
+        def get_body(self, imdata):
+            body = dummySession.get_body(self, imdata)
+            return body[0:body.index("quote", len(json.dumps(imdata[0])))]
+    objects = get_stream_objects(3)
+    for chunk_size in [1, 5, 1048576]:
+        session = truncated(objects, chunk_size=chunk_size)
+        assert get_stream(session) == objects[0:1] + [None]
+        assert all([r.closed for r in session.responses])
+
+    class invalid(dummySession):
+        def get_body(self, imdata):
+            return "{\"totalCount\": \"1\", \"error\": {}}"
+    assert get_stream(invalid(objects, chunk_size=3)) == [None]
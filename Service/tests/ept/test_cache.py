@@ -3,18 +3,23 @@ import logging
 import pytest
 import time
 
+from app.models.utils import get_redis
 from app.models.aci.fabric import Fabric
 
 from app.models.aci.ept.ept_cache import eptCache
 from app.models.aci.ept.ept_cache import hitCache
 from app.models.aci.ept.ept_cache import hitCacheNotFound
-from app.models.aci.ept.ept_cache import offsubnetCachedObject
+from app.models.aci.ept.ept_cache import subnetPrefixCachedObject
+from app.models.aci.ept.ept_endpoint import eptEndpoint
 from app.models.aci.ept.ept_epg import eptEpg
 from app.models.aci.ept.ept_node import eptNode
 from app.models.aci.ept.ept_subnet import eptSubnet
 from app.models.aci.ept.ept_tunnel import eptTunnel
 from app.models.aci.ept.ept_vnid import eptVnid
 from app.models.aci.ept.ept_vpc import eptVpc
+from app.models.aci.ept.common import get_cache_generation_key
+from app.models.aci.ept.common import get_cache_invalid_key
+from app.models.aci.ept.common import update_cache_generation
 from app.models.aci.ept.common import get_ip_prefix
 
 # module level logging
@@ -50,6 +55,7 @@ def func_prep(request, app):
         eptNode.delete(_filters={})
         eptVpc.delete(_filters={})
         eptTunnel.delete(_filters={})
+        eptEndpoint.delete(_filters={})
         
     request.addfinalizer(teardown)
     return
@@ -178,6 +184,36 @@ def test_hit_cache_general_name_and_none_lookup(app, func_prep):
     assert h_cache.get_size() == 1
 
 
+def test_hit_cache_preload_and_hit_order(app, func_prep):
+    # preload adds items in order without updating hit/miss counters and stops once cache is full.
+    # A push for an existing key updates the value along with name references
+    h_cache = hitCache(3)
+    count = h_cache.preload([
+        ("key1", dummyHitObject("name1", "val1")),
+        ("key2", None),
+        ("key3", "val3"),
+        ("key4", "val4"),
+    ])
+    assert count == 3
+    assert h_cache.get_size() == 3
+    assert h_cache.head.key == "key3" and h_cache.tail.key == "key1"
+    assert h_cache.hit_count == 0 and h_cache.miss_count == 0 and h_cache.evict_count == 0
+    assert "name1" in h_cache.name_hash and "key2" in h_cache.none_hash
+
+    # hit on tail moves it to head, second hit on head does not change order
+    assert h_cache.search("key1").val == "val1"
+    assert h_cache.search("key1").val == "val1"
+    assert h_cache.head.key == "key1" and h_cache.tail.key == "key2"
+    assert h_cache.hit_count == 2
+
+    h_cache.push("key1", dummyHitObject("name1b", "val1b"))
+    assert h_cache.get_size() == 3
+    assert "name1" not in h_cache.name_hash
+    assert h_cache.search("name1b", name=True).val == "val1b"
+    h_cache.push("key2", "val2")
+    assert "key2" not in h_cache.none_hash
+    assert h_cache.head.key == "key2"
+
 def test_get_peer_node_lookup(app, func_prep):
     # add eptNode object and ensure cache returns peer value if found, and 0 if not present
     # trigger flush and ensure value is no longer found within cache
@@ -212,6 +248,192 @@ def test_get_tunnel_remote_lookup(app, func_prep):
     assert cache.get_tunnel_remote(node, intf) == remote
     assert isinstance(cache.tunnel_cache.search(keystr), eptTunnel)
 
+def test_cache_warm_up(app, func_prep):
+    # ensure warm up loads all objects for the fabric, grows caches from collection size, and that
+    # subsequent lookups are served from cache
+    for i in xrange(600):
+        assert eptTunnel(fabric=tfabric, node=101, intf="tunnel%s" % i, remote=102).save()
+    assert eptTunnel(fabric="other-fabric", node=101, intf="tunnel1", remote=103).save()
+    assert eptSubnet.load(fabric=tfabric, name="subnet1", bd=1, ip="10.1.1.1/24").save()
+    assert eptSubnet.load(fabric=tfabric, name="subnet2", bd=1, ip="10.1.2.1/24").save()
+    cache = get_test_cache()
+    assert cache.warm_up() == 601
+    assert cache.tunnel_cache.max_size == int(600 * eptCache.WARM_CACHE_HEADROOM)
+    assert cache.tunnel_cache.get_size() == 600
+    assert cache.node_cache.max_size == eptCache.MAX_CACHE_SIZE
+    assert cache.get_tunnel_remote(101, "tunnel1") == 102
+    assert cache.get_tunnel_remote(101, "tunnel599") == 102
+    assert len(cache.get_subnets(1)) == 2
+    assert cache.tunnel_cache.miss_count == 0 and cache.subnet_cache.miss_count == 0
+
+def test_cache_memory_budget(app, func_prep):
+    # ensure budget is given to caches under pressure, caches that are not full keep their working
+    # set, and all caches keep their minimum size when budget is exceeded
+    cache = get_test_cache()
+    for i in xrange(eptCache.MAX_CACHE_SIZE):
+        cache.tunnel_cache.push("tunnel%s" % i, "val%s" % i)
+    for i in xrange(100):
+        assert isinstance(cache.tunnel_cache.search("missing%s" % i), hitCacheNotFound)
+    budget = 64*1024*1024
+    assert cache.apply_memory_budget(budget) == eptCache.MAX_CACHE_SIZE * 1024
+    assert cache.tunnel_cache.max_size > eptCache.MAX_CACHE_SIZE
+    assert cache.node_cache.max_size == eptCache.MAX_CACHE_SIZE
+    assert cache.endpoint_cache.max_size == eptCache.MAX_ENDPOINT_STATE_CACHE_SIZE
+    total = 0
+    for (cache_name, min_size, entry_bytes) in eptCache.BUDGET_CACHES:
+        total+= getattr(cache, cache_name).max_size * entry_bytes
+    assert total <= budget
+
+    # no misses since last budget so tunnel cache is reduced to working set plus headroom
+    cache.apply_memory_budget(budget)
+    assert cache.tunnel_cache.max_size == int(eptCache.MAX_CACHE_SIZE*eptCache.WARM_CACHE_HEADROOM)
+
+    # budget too small for working sets reduces each cache to minimum size
+    cache.apply_memory_budget(1)
+    assert cache.tunnel_cache.max_size == eptCache.MAX_CACHE_SIZE
+
+def test_rapid_table_flush_and_compact(app, func_prep):
+    # ensure rapid counters are only written to the db on flush and that compaction removes the
+    # oldest entries that are not rapid
+    cache = get_test_cache()
+    table = cache.rapid_table
+    table.max_size = table.compact_size = 4
+    for i in xrange(4):
+        addr = "10.1.1.%s" % i
+        assert eptEndpoint.load(fabric=tfabric, vnid=1, addr=addr, type="ipv4").save()
+        r = cache.get_rapid_endpoint(1, addr, "ipv4")
+        r.rapid_count = 10 + i
+        r.rapid_lts = 100.0 + i
+        r.is_rapid = (i == 0)
+        r.save()
+    assert table.get_size() == 4
+    assert eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.1").rapid_count == 0
+    assert table.flush() == 4
+    assert table.flush() == 0
+    assert eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.1").rapid_count == 11
+    assert eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.0").is_rapid
+
+    # new entry triggers compaction, 10.1.1.0 is rapid so 10.1.1.1 is oldest removed entry
+    r = cache.get_rapid_endpoint(1, "10.1.1.1", "ipv4")
+    assert r.rapid_count == 11 and table.hit_count == 1
+    cache.get_rapid_endpoint(1, "10.1.1.9", "ipv4")
+    assert table.get_size() == 4
+    assert table.evict_count == 1
+    assert cache.get_rapid_endpoint(1, "10.1.1.0", "ipv4").rapid_count == 10
+    assert cache.get_rapid_endpoint(1, "10.1.1.2", "ipv4").rapid_count == 12
+    assert cache.get_rapid_endpoint(1, "10.1.1.1", "ipv4").rapid_count == 0
+
+def test_rapid_table_increment_marks_dirty(app, func_prep):
+    # ensure counter increments without explicit save are written on flush, compaction, and when
+    # endpoint state is released
+    cache = get_test_cache()
+    table = cache.rapid_table
+    for i in xrange(2):
+        assert eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.%s" % i, type="ipv4").save()
+    r = cache.get_rapid_endpoint(1, "10.1.1.0", "ipv4")
+    assert len(table.dirty) == 0
+    r.rapid_count+= 1
+    r.rapid_icount+= 1
+    assert table.flush() == 1
+    e = eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.0")
+    assert e.rapid_count == 1 and e.rapid_icount == 1
+
+    # compaction flushes increments before removing entries
+    table.max_size = table.compact_size = 1
+    cache.get_rapid_endpoint(1, "10.1.1.0", "ipv4").rapid_count+= 1
+    cache.get_rapid_endpoint(1, "10.1.1.1", "ipv4")
+    assert table.evict_count == 1
+    assert eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.0").rapid_count == 2
+
+    # release flushes increments before clearing the table
+    cache.get_rapid_endpoint(1, "10.1.1.1", "ipv4").rapid_count+= 5
+    cache.release_endpoint_state()
+    assert table.get_size() == 0
+    assert eptEndpoint.load(fabric=tfabric, vnid=1, addr="10.1.1.1").rapid_count == 5
+
+def test_shared_cache_lookup_and_generation(app, func_prep, tmpdir):
+    # ensure a shared cache segment is built once and used by other caches on the host and that
+    # a flush only reloads the segment after the flush generation is incremented
+    redis = get_redis()
+    gen_key = get_cache_generation_key(tfabric, eptTunnel._classname)
+    redis.delete(gen_key)
+    node = 101
+    intf = "tunnel17"
+    assert eptTunnel(fabric=tfabric, node=node, intf=intf, remote=102).save()
+    c1 = eptCache(fabric=tfabric, shared_cache_dir=str(tmpdir))
+    c2 = eptCache(fabric=tfabric, shared_cache_dir=str(tmpdir))
+    assert c1.get_tunnel_remote(node, intf) == 102
+    assert c1.shared_cache[eptTunnel._classname].build_count == 1
+    assert c2.get_tunnel_remote(node, intf) == 102
+    assert c2.get_tunnel_remote(node, "tunnel891") == 0
+    shared = c2.shared_cache[eptTunnel._classname]
+    assert shared.build_count == 0 and shared.hit_count == 1 and shared.miss_count == 1
+
+    # update without generation change continues to use the current segment
+    t = eptTunnel.load(fabric=tfabric, node=node, intf=intf)
+    t.remote = 103
+    assert t.save()
+    c2.handle_flush(eptTunnel._classname)
+    assert c2.get_tunnel_remote(node, intf) == 102
+    # sender of flush increments the generation and a new segment is built on next lookup
+    redis.incr(gen_key)
+    c1.handle_flush(eptTunnel._classname)
+    c2.handle_flush(eptTunnel._classname)
+    assert c2.get_tunnel_remote(node, intf) == 103
+    assert c1.get_tunnel_remote(node, intf) == 103
+    assert len(tmpdir.listdir(fil=lambda p: p.ext == ".seg")) == 1
+    redis.delete(gen_key)
+
+def test_shared_cache_named_flush(app, func_prep, tmpdir):
+    # ensure a named flush invalidates only the named object without a new generation, the
+    # invalidation applies to caches mapping the segment later, and a full flush clears it
+    redis = get_redis()
+    gen_key = get_cache_generation_key(tfabric, eptTunnel._classname)
+    inv_key = get_cache_invalid_key(tfabric, eptTunnel._classname)
+    redis.delete(gen_key, inv_key)
+    node = 101
+    names = dict([(intf, "topology/pod-1/node-%s/sys/tunnel-[%s]" % (node, intf)) 
+                    for intf in ["tunnel17", "tunnel18", "tunnel19"]])
+    for intf in ["tunnel17", "tunnel18"]:
+        assert eptTunnel(fabric=tfabric, name=names[intf], node=node, intf=intf, remote=102).save()
+    c1 = eptCache(fabric=tfabric, shared_cache_dir=str(tmpdir))
+    assert c1.get_tunnel_remote(node, "tunnel17") == 102
+    assert c1.get_tunnel_remote(node, "tunnel18") == 102
+    shared = c1.shared_cache[eptTunnel._classname]
+
+    # update one tunnel and create a new one, each with a named flush
+    t = eptTunnel.load(fabric=tfabric, name=names["tunnel17"])
+    t.remote = 103
+    assert t.save()
+    assert eptTunnel(fabric=tfabric, name=names["tunnel19"], node=node, intf="tunnel19", 
+                        remote=104).save()
+    for intf in ["tunnel17", "tunnel19"]:
+        update_cache_generation(redis, tfabric, eptTunnel._classname, names[intf])
+        c1.handle_flush(eptTunnel._classname, name=names[intf])
+    assert redis.get(gen_key) is None
+    assert c1.get_tunnel_remote(node, "tunnel17") == 103
+    assert c1.get_tunnel_remote(node, "tunnel19") == 104
+    assert shared.build_count == 1 and shared.invalid_count == 2
+    # unchanged tunnel is still served from the segment
+    c1.handle_flush(eptTunnel._classname)
+    hit_count = shared.hit_count
+    assert c1.get_tunnel_remote(node, "tunnel18") == 102
+    assert shared.hit_count == hit_count + 1
+
+    # cache mapping the segment after the named flush loads invalidated names from redis
+    c2 = eptCache(fabric=tfabric, shared_cache_dir=str(tmpdir))
+    assert c2.get_tunnel_remote(node, "tunnel17") == 103
+    assert c2.get_tunnel_remote(node, "tunnel19") == 104
+    assert c2.shared_cache[eptTunnel._classname].build_count == 0
+
+    # full flush starts a new generation and clears invalidated names
+    update_cache_generation(redis, tfabric, eptTunnel._classname)
+    assert int(redis.get(gen_key)) == 1 and redis.scard(inv_key) == 0
+    c1.handle_flush(eptTunnel._classname)
+    assert c1.get_tunnel_remote(node, "tunnel19") == 104
+    assert shared.build_count == 2 and len(shared.invalid_names) == 0
+    redis.delete(gen_key, inv_key)
+
 def test_get_pc_vpc_id_lookup(app, func_prep):
     # add eptVpc object and ensure cache returns vpc id if found, else 0
     # trigger flush for single name and ensure only that name is removed
@@ -311,9 +533,9 @@ def test_ip_is_offsubnet_full(app, func_prep):
     # ip_is_offsubnet relies on three different caches:
     #   subnet_cache
     #   epg_cache
-    #   offsubnet_cache
-    # A flush for a bd in epg_cache or subnet_cache should delete all cached objects within 
-    # offsubhet_cache.  Ensure that is happening correctly.
+    #   prefix_cache
+    # A flush for a bd in subnet_cache should delete the precompiled prefixes for the bd within
+    # prefix_cache while an epg flush leaves prefix_cache intact. Ensure that is happening correctly.
     # Most importantly, ensure that offsubnet check is executing correctly.  I.e., an IP learned on
     # subnet should return False (not offsubnet) and an IP learned off subnet should return true
 
@@ -363,60 +585,30 @@ def test_ip_is_offsubnet_full(app, func_prep):
     subnet2 = cache.subnet_cache.search(cache.get_key_str(bd=2))
     assert type(subnet2) is list and len(subnet2) == 1 and subnet2[0].ip == "30.1.1.1/16"
 
-    # ensure ip's are present within cache
-    assert not cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="10.1.1.5")).offsubnet
-    assert not cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="20.1.1.5")).offsubnet
-    assert not cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="2001:1:2:3:4:5:6:abcd")).offsubnet
-    assert cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="2001:1:2:3:4:5:5:abcd")).offsubnet
-    assert cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="2001::abcd")).offsubnet
-    assert cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="30.1.2.5")).offsubnet
-    assert not cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1004,ip="30.1.2.5")).offsubnet
-    assert not cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="40.2.1.5")).offsubnet
-    assert not cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1005,ip="40.3.1.5")).offsubnet
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0xffff,ip="1.1.1.1")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=1,ip="30.1.2.5")),
-            hitCacheNotFound)
-
-    logger.debug("offsubnet keys: %s" % cache.offsubnet_cache.key_hash.keys())
-    logger.debug("offsubnet names: %s" % cache.offsubnet_cache.name_hash.keys())
+    # ensure precompiled prefixes are present for each bd
+    prefixes = cache.prefix_cache.search(cache.get_key_str(bd=1))
+    assert isinstance(prefixes, subnetPrefixCachedObject) and prefixes.count == 4
+    prefixes = cache.prefix_cache.search(cache.get_key_str(bd=2))
+    assert isinstance(prefixes, subnetPrefixCachedObject) and prefixes.count == 1
+    assert prefixes.match(get_ip_prefix("30.1.2.5")[0]) == "subnet4"
+    assert prefixes.match(get_ip_prefix("30.2.2.5")[0]) is None
 
-    # flush of single epg name should flush all offsubnet_cache for corresponding bd (which is name)
+    # flush of single epg name should not flush prefixes for the bd
     cache.handle_flush(eptEpg._classname, name="epg1")
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="10.1.1.5")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1002,ip="10.1.1.6")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1003,ip="10.1.1.7")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1005,ip="10.1.1.9")),
+    assert isinstance(cache.epg_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001)),
             hitCacheNotFound)
-    # entry for bd 2 still present
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1004,ip="30.1.2.5")),
-            offsubnetCachedObject)
+    assert isinstance(cache.prefix_cache.search(cache.get_key_str(bd=1)),subnetPrefixCachedObject)
 
-    # repeat for subnet flush by first adding values back into cache...
+    # flush of single subnet should flush prefixes only for corresponding bd
     add_hits_to_cache()
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="10.1.1.5")),
-            offsubnetCachedObject)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1002,ip="10.1.1.6")),
-            offsubnetCachedObject)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1003,ip="10.1.1.7")),
-            offsubnetCachedObject)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1005,ip="10.1.1.9")),
-            offsubnetCachedObject)
-
     cache.handle_flush(eptSubnet._classname, name="subnet3")
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1001,ip="10.1.1.5")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1002,ip="10.1.1.6")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1003,ip="10.1.1.7")),
-            hitCacheNotFound)
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1005,ip="10.1.1.9")),
-            hitCacheNotFound)
-    # entry for bd 2 still present
-    assert isinstance(cache.offsubnet_cache.search(cache.get_key_str(vrf=vrf,pctag=0x1004,ip="30.1.2.5")),
-            offsubnetCachedObject)
-
+    assert isinstance(cache.prefix_cache.search(cache.get_key_str(bd=1)), hitCacheNotFound)
+    assert isinstance(cache.prefix_cache.search(cache.get_key_str(bd=2)),subnetPrefixCachedObject)
+
+    # removed subnet is no longer matched after flush
+    eptSubnet.load(fabric=tfabric,name="subnet2").remove()
+    cache.handle_flush(eptSubnet._classname, name="subnet2")
+    assert cache.ip_is_offsubnet(vrf, 0x1001, "20.1.1.5")
+    assert not cache.ip_is_offsubnet(vrf, 0x1001, "10.1.1.5")
+    assert cache.prefix_cache.search(cache.get_key_str(bd=1)).count == 3
 
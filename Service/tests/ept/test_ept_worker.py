@@ -69,16 +69,35 @@ tenant ag, vrf v1, bd bd1/bd2/bd3, app a1, epg e1/e2/e3
 
 
 """
+import collections
+import json
 import logging
 import pytest
+import threading
 import time
 
 from app.models.aci.fabric import Fabric
+from app.models.aci.ept.common import MANAGER_CTRL_CHANNEL
 from app.models.aci.ept.common import MANAGER_WORK_QUEUE
+from app.models.aci.ept.common import NOTIFY_EMAIL_MAX_BULK
+from app.models.aci.ept.common import get_cache_generation_key
+from app.models.aci.ept.common import get_cache_invalid_key
+from app.models.aci.ept.common import EndpointPresence
+from app.models.aci.ept.common import HashRing
+from app.models.aci.ept.common import get_msg_hash
 from app.models.aci.ept.ept_msg import *
+from app.models.aci.ept.ept_cache import eptCache
+from app.models.aci.ept.ept_clear import eptClearEndpoint
+from app.models.aci.ept.ept_clear import eptClearService
+from app.models.aci.ept.ept_dispatcher import DispatchFence
+from app.models.aci.ept.ept_dispatcher import TrackedWorker
+from app.models.aci.ept.ept_dispatcher import WorkerDispatch
+from app.models.aci.ept.ept_manager import migrate_queue
+from app.models.aci.ept.ept_manager import split_rebalance_frames
 from app.models.aci.ept.ept_worker import eptWorker
 from app.models.aci.ept.ept_queue_stats import eptQueueStats
 from app.models.aci.ept.ept_epg import eptEpg
+from app.models.aci.ept.ept_epm_digest import eptEpmDigest
 from app.models.aci.ept.ept_subnet import eptSubnet
 from app.models.aci.ept.ept_vnid import eptVnid
 from app.models.aci.ept.ept_node import eptNode
@@ -96,11 +115,17 @@ from app.models.aci.ept.ept_endpoint import eptEndpointEvent
 from app.models.aci.ept.ept_rapid import eptRapid
 from app.models.aci.ept.ept_remediate import eptRemediate
 from app.models.aci.ept.ept_settings import eptSettings
+from app.models.aci.ept.ept_subscriber import eptSubscriber
+from app.models.aci.ept.ept_watch_queue import eptWatchQueue
+from app.models.aci.ept.ept_worker_fabric import eptWorkerFabric
+from app.models.aci.ept.ept_write_buffer import eptWriteBuffer
 
 from app.models.rest.db import db_setup
 from app.models.utils import get_db
 from app.models.utils import get_redis
 from app.models.utils import pretty_print
+from pymongo.errors import BulkWriteError
+from six.moves.queue import Queue
 
 # module level logging
 logger = logging.getLogger(__name__)
@@ -352,6 +377,42 @@ def test_epm_parser_parse_basic(app, func_prep):
     assert msg.bd == 15007704
     assert msg.wt == WORK_TYPE.EPM_RS_IP_EVENT
 
+def test_epm_parser_parse_dn_fast_path(app, func_prep):
+    # fast path dn parser must match regex parser and fall back to regex for unusual dns
+    base = "topology/pod-1/node-101/sys/ctx-[vxlan-2916352]"
+    bd = "%s/bd-[vxlan-15007704]/vlan-[vlan-101]" % base
+    rs = "rsmacEpToIpEpAtt-[sys/ctx-[vxlan-2916352]/bd-[vxlan-15007704]/vlan-[vlan-101]/"
+    rs+= "db-ep/ip-[10.1.1.101]]"
+    fast = [
+        ("%s/db-ep/mac-00:00:40:01:01:01" % bd, False),
+        ("%s/db-ep/mac-[00:00:40:01:01:01]" % bd, False),
+        ("%s/db-ep/ip-[10.1.1.101]" % bd, False),
+        ("%s/db-ep/ip-[2001:10:1:1::101]" % base, False),
+        ("topology/pod-1/node-101/sys/inst-overlay-1/db-ep/ip-[10.0.0.32]", False),
+        ("%s/db-ep/mac-00:00:40:01:01:01/%s" % (bd, rs), True),
+    ]
+    for (dn, rs_dn) in fast:
+        ret = parse_epm_dn_fast(dn, rs=rs_dn)
+        assert ret is not None
+        assert ret == parse_epm_dn_regex(dn, rs=rs_dn)
+    assert parse_epm_dn("%s/db-ep/mac-00:00:40:01:01:01/%s" % (bd, rs), rs=True) == \
+            (101, 2916352, 15007704, "vlan-101", "00:00:40:01:01:01", "10.1.1.101")
+    assert parse_epm_dn(fast[4][0]) == (101, None, 0, "", "10.0.0.32", "")
+
+    # unusual dns are not handled by fast path but still parsed via regex
+    dn = "%s/db-ep/ip-[10.1.1.101]/extra" % bd
+    assert parse_epm_dn_fast(dn) is None
+    assert parse_epm_dn(dn) == (101, 2916352, 15007704, "vlan-101", "10.1.1.101", "")
+    dn = "node-101/sys/ctx-[vxlan-2916352]/db-ep/ip-[10.1.1.101]"
+    assert parse_epm_dn_fast(dn) is None
+    assert parse_epm_dn(dn) == (101, 2916352, 0, "", "10.1.1.101", "")
+
+    # invalid dns are rejected by both
+    assert parse_epm_dn("topology/pod-1/node-101/sys/db-ep/ip-[10.1.1.101]") is None
+    assert parse_epm_dn("%s/db-ep/mac-00:00:40:01:01:01" % bd, rs=True) is None
+    assert parser.parse("epmRsMacEpToIpEpAtt", {"dn": "%s/db-ep/mac-00:00:40:01:01:01"%bd}, 1.0) \
+            is None
+
 def get_epg_encap_pctag_vnid(val):
     # return tuple (encap, pctag, bd_vnid) for this bd or epg (assume epg if epg=True)
     if val is None or val == 1 or val == 4:
@@ -466,9 +527,11 @@ def get_epm_event(node, addr, ip=None, wt=WORK_TYPE.EPM_IP_EVENT, remote_node=No
     logger.debug("[w1] %s" % msg)
     return msg
 
-def get_worker(role="worker"):
-    # get a worker to handle event 
+def get_worker(role="worker", write_buffer=False):
+    # get a worker to handle event. Most tests read the db directly after handling an event so
+    # the write buffer is disabled unless explicitly requested
     dut = eptWorker("w1", role)
+    dut.write_buffer = write_buffer
     # need to setup db and redis
     dut.db = get_db()
     dut.redis = get_redis()
@@ -2082,6 +2145,53 @@ def test_handle_endpoint_update_learn_type(app, func_prep):
     assert len(e)==1
     assert e[0].learn_type == "psvi"
 
+def test_handle_endpoint_event_endpoint_state_cache(app, func_prep):
+    # endpoint state cache keeps the last per-node history event and last two local events for the
+    # endpoint so subsequent events are analyzed without a db read. Ensure cached state is in sync
+    # with the db and that an endpoint delete removes the cached state.
+    dut = get_worker()
+    mac = "00:00:01:02:03:04"
+    ip = "10.1.1.101"
+
+    # local learn on node-101 and then move to node-102
+    msg = get_epm_event(101, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=1.0)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    msg = get_epm_event(101, mac, ip=ip, wt=WORK_TYPE.EPM_RS_IP_EVENT, epg=1, ts=1.0)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    msg = get_epm_event(102, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=2.0)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    msg = get_epm_event(102, mac, ip=ip, wt=WORK_TYPE.EPM_RS_IP_EVENT, epg=1, ts=2.0)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+
+    cache = msg.wf.cache
+    # first event is a miss, all other events for the endpoint are served from cache
+    assert cache.endpoint_cache.miss_count == 1
+    assert cache.endpoint_cache.hit_count == 3
+    state = cache.endpoint_cache.peek(cache.get_key_str(vnid=vrf_vnid, addr=ip))
+    assert state is not None
+    assert sorted(state.history.keys()) == [101, 102]
+    for node in state.history:
+        assert len(state.history[node]) == 1
+        h = eptHistory.find(fabric=tfabric, addr=ip, node=node)
+        assert len(h) == 1
+        assert state.history[node][0].to_dict() == eptHistoryEvent.from_dict(h[0].events[0]).to_dict()
+
+    e = eptEndpoint.find(fabric=tfabric, addr=ip)
+    assert len(e) == 1
+    assert len(state.endpoint["events"]) == 2
+    assert [x["node"] for x in state.endpoint["events"]] == [x["node"] for x in e[0].events[0:2]]
+    assert state.endpoint["events"][0]["node"] == 102
+
+    # endpoint delete must remove cached state
+    msg = eptMsgWorkDeleteEpt(ip, "worker", {"vnid": vrf_vnid}, WORK_TYPE.DELETE_EPT, fabric=tfabric)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_delete(msg)
+    assert cache.endpoint_cache.peek(cache.get_key_str(vnid=vrf_vnid, addr=ip)) is None
+
 def test_create_ept_msg_bulk(app, func_prep):
     # create, parse, and jsonify an eptMsgBulk object
 
@@ -2103,6 +2213,936 @@ def test_create_ept_msg_bulk(app, func_prep):
         assert m.wt == WORK_TYPE.EPM_IP_EVENT
         assert m.addr == ip
 
+def test_create_ept_msg_bulk_binary(app, func_prep):
+    # pack eptMsgBulk with binary wire version and ensure parse returns identical epm events
+
+    mac = "00:00:01:02:03:04"
+    ip = "10.1.1.101"
+    msg1 = get_epm_event(101, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=1.5)
+    msg2 = get_epm_event(102, mac, ip=ip, wt=WORK_TYPE.EPM_RS_IP_EVENT, epg=1, ts=2.0)
+    msg3 = get_epm_event(103, mac, wt=WORK_TYPE.EPM_MAC_EVENT, epg=1, intf="eth1/1", ts=3.0)
+    msg1.flags = ["local", "vpc-attached"]
+    msg3.force = True
+    for i, m in enumerate([msg1, msg2, msg3]):
+        m.seq = i+1
+    bulk = eptMsgBulk()
+    bulk.msgs = [msg1, msg2, msg3]
+
+    data = bulk.pack(WIRE_VERSION_BINARY)
+    assert data[:1] == WIRE_MAGIC
+    assert len(data) < len(bulk.jsonify())
+
+    p = eptMsg.parse(data, brief=True)
+    assert p.msg_type == MSG_TYPE.BULK
+    assert p.msg_count == 3
+    assert p.seq == 3
+
+    p = eptMsg.parse(data)
+    assert len(p.msgs) == 3
+    for i, m in enumerate(p.msgs):
+        assert json.loads(m.jsonify()) == json.loads(bulk.msgs[i].jsonify())
+
+    # json is used for receivers without binary support and for non-epm events
+    assert bulk.pack(WIRE_VERSION_JSON)[:1] == "{"
+    bulk.msgs.append(eptMsgWorkDeleteEpt(mac, "worker", {"vnid":1}, WORK_TYPE.DELETE_EPT, seq=4))
+    data = bulk.pack(WIRE_VERSION_BINARY)
+    assert data[:1] == "{"
+    assert len(eptMsg.parse(data).msgs) == 4
+
+def test_send_msg_route(app, func_prep):
+    # ensure msgs sent to manager include route info that matches worker hash without parsing
+    dut = get_worker()
+    mac = "00:00:01:02:03:04"
+    ip = "10.1.1.101"
+    msg1 = get_epm_event(101, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=1.0)
+    msg2 = eptMsgWork(0, "watcher", {}, WORK_TYPE.FABRIC_WATCH_PAUSE, fabric=tfabric)
+    dut.send_msg([msg1, msg2])
+
+    data = redis.lrange(MANAGER_WORK_QUEUE, 0, -1)
+    assert len(data) == 1
+    p = eptMsg.parse(data[0], raw=True)
+    assert len(p.msgs) == 0
+    assert len(p.raw_msgs) == 2
+    assert p.route[0] == [get_msg_hash(msg1), "worker", msg1.qnum]
+    assert p.route[1] == [None, "watcher", msg2.qnum]
+    assert eptMsg.parse(p.raw_msgs[0]).addr == ip
+
+    # without raw, route is ignored and msgs are parsed
+    msgs = get_queue_msgs()
+    assert len(msgs) == 2
+    assert msgs[0].addr == ip
+
+def test_worker_dispatch_routed_bulk(app, func_prep):
+    # ensure WorkerDispatch forwards serialized msgs to worker queue based on worker table
+    dut = get_worker()
+    ip = "10.1.1.101"
+    msg1 = get_epm_event(101, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=1.0)
+    msg2 = get_epm_event(102, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=2.0)
+    dut.send_msg([msg1, msg2])
+    data = redis.lpop(MANAGER_WORK_QUEUE)
+
+    stats = []
+    dispatch = WorkerDispatch(redis, lambda q, tx=False, count=1: stats.append((q, tx, count)))
+    tw = TrackedWorker.from_json({"worker_id": "w9", "role": "worker", "queues": ["q0_w9"]})
+    assert TrackedWorker.from_json(tw.to_json()).to_json() == tw.to_json()
+    dispatch.active_workers = {"worker": [tw]}
+    dispatch.rebuild_rings()
+    dispatch.dispatch(MANAGER_WORK_QUEUE, data)
+
+    assert (MANAGER_WORK_QUEUE, False, 2) in stats
+    assert tw.last_seq == [2]
+    msgs = get_queue_msgs(queue="q0_w9", pop=True)
+    assert len(msgs) == 2
+    assert msgs[0].ts == 1.0 and msgs[1].ts == 2.0
+
+def test_worker_dispatch_seq_shared_across_dispatchers(app, func_prep):
+    # ensure multiple dispatchers sending to the same worker queue never reuse a seq
+    js = {"worker_id": "w9", "role": "worker", "queues": ["q0_w9"]}
+    dispatchers = []
+    for i in xrange(0, 2):
+        dispatch = WorkerDispatch(redis, lambda q, tx=False, count=1: None)
+        dispatch.active_workers = {"worker": [TrackedWorker.from_json(js)]}
+        dispatch.rebuild_rings()
+        dispatchers.append(dispatch)
+    ip = "10.1.1.101"
+    for i in xrange(0, 3):
+        msg1 = get_epm_event(101, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=1.0)
+        msg2 = get_epm_event(102, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1", ts=2.0)
+        assert dispatchers[i%2].send_bulk([(get_msg_hash(msg1), msg1), (get_msg_hash(msg2), msg2)])
+
+    msgs = get_queue_msgs(queue="q0_w9", pop=True)
+    assert [m.seq for m in msgs] == range(1, 7)
+    assert dispatchers[0].active_workers["worker"][0].last_seq == [6]
+    assert dispatchers[1].active_workers["worker"][0].last_seq == [4]
+
+def test_rebalance_split_frames(app, func_prep):
+    # ensure only msgs for moved keys leave the queue, in order, and eof is kept on active worker
+    w1 = TrackedWorker.from_json({"worker_id": "w1", "role": "worker", "queues": ["q0_w1"]})
+    w2 = TrackedWorker.from_json({"worker_id": "w2", "role": "worker", "queues": ["q0_w2"]})
+    ring = HashRing([w1, w2], key=lambda w: w.worker_id)
+    get_owner = lambda m: ring.get(get_msg_hash(m))
+    bulk = eptMsgBulk()
+    for i in xrange(0, 32):
+        bulk.msgs.append(get_epm_event(101, "10.1.1.%s" % i, wt=WORK_TYPE.EPM_IP_EVENT))
+        bulk.msgs[-1].seq = i + 1
+    eof = eptMsgWork("", "worker", {}, WORK_TYPE.FABRIC_EPM_EOF, qnum=0, fabric=tfabric)
+    frames = [bulk.jsonify(), eof.jsonify()]
+    owners = [get_owner(m) for m in bulk.msgs]
+    assert w1 in owners and w2 in owners
+
+    (keep, moved) = split_rebalance_frames(frames, w1, False, get_owner)
+    kept = eptMsg.parse(keep[0])
+    kept = kept.msgs if kept.msg_type == MSG_TYPE.BULK else [kept]
+    assert [m.seq for m in kept] == [m.seq for i, m in enumerate(bulk.msgs) if owners[i] is w1]
+    assert keep[1] == frames[1]
+    assert [o for (o, m) in moved] == [w2] * owners.count(w2)
+    assert [m.seq for (o, m) in moved] == \
+        [m.seq for i, m in enumerate(bulk.msgs) if owners[i] is w2]
+
+    # all msgs leave a retired queue and eof is forwarded to all workers
+    (keep, moved) = split_rebalance_frames(frames, w1, True, lambda m: w2)
+    assert len(keep) == 0
+    assert [o for (o, m) in moved] == [w2] * 32 + [None]
+    assert moved[-1][1].wt == WORK_TYPE.FABRIC_EPM_EOF
+
+def test_rebalance_migrate_queue_atomic(app, func_prep):
+    # ensure a frame popped by the worker while the manager reads its queue is neither lost nor
+    # pushed back onto the queue, the migrate is retried against the updated queue
+    w1 = TrackedWorker.from_json({"worker_id": "w1", "role": "worker", "queues": ["q0_w1"]})
+    w2 = TrackedWorker.from_json({"worker_id": "w2", "role": "worker", "queues": ["q0_w2"]})
+    frames = []
+    for i in xrange(0, 4):
+        msg = get_epm_event(101, "10.1.1.%s" % i, wt=WORK_TYPE.EPM_IP_EVENT)
+        msg.seq = i + 1
+        frames.append(msg.jsonify())
+    redis.rpush("q0_w1", *frames)
+    popped = []
+    def get_owner(m):
+        # worker pops the head of its queue during the first read, odd seq moves to w2
+        if len(popped) == 0:
+            popped.append(redis.lpop("q0_w1"))
+        return w2 if m.seq % 2 == 1 else w1
+    moved = migrate_queue(redis, w1, 0, False, get_owner)
+    assert popped == [frames[0]]
+    assert [m.seq for (o, m) in moved] == [3]
+    assert redis.lrange("q0_w1", 0, -1) == [frames[1], frames[3]]
+
+    # all msgs are removed from retired queue
+    moved = migrate_queue(redis, w1, 0, True, lambda m: w2)
+    assert [m.seq for (o, m) in moved] == [2, 4]
+    assert redis.llen("q0_w1") == 0
+
+def test_dispatch_fence_hold_and_release(app, func_prep):
+    # ensure hold waits for sends in progress and blocks new sends until release
+    fence = DispatchFence()
+    fence.enter()
+    assert not fence.hold(timeout=0.1)
+    fence.exit()
+    assert fence.hold(timeout=0.1)
+    sent = []
+    def send():
+        fence.enter()
+        sent.append(time.time())
+        fence.exit()
+    t = threading.Thread(target=send)
+    t.start()
+    time.sleep(0.2)
+    assert len(sent) == 0
+    release_ts = time.time()
+    fence.release()
+    t.join(1.0)
+    assert len(sent) == 1 and sent[0] >= release_ts
+
+def test_worker_rebalance_pause_ack_and_resume(app, func_prep):
+    # ensure worker acks pause to manager and blocks until resume is received
+    dut = get_worker()
+    p = redis.pubsub(ignore_subscribe_messages=True)
+    p.subscribe(MANAGER_CTRL_CHANNEL)
+    dut.check_rebalance()
+    pause = eptMsgWork(0, "worker", {"phase": "pause", "version": 3}, WORK_TYPE.WORKER_REBALANCE)
+    resume = eptMsgWork(0, "worker", {"phase": "resume", "version": 3}, WORK_TYPE.WORKER_REBALANCE)
+    dut.handle_redis_msgs("q0_w1", pause.jsonify())
+    assert dut.rebalance_pause == 3
+    t = threading.Timer(0.2, dut.handle_redis_msgs, args=("q0_w1", resume.jsonify()))
+    t.start()
+    ts = time.time()
+    dut.check_rebalance()
+    assert time.time() - ts >= 0.1
+    assert dut.rebalance_pause is None
+    ack = None
+    for i in xrange(0, 50):
+        ret = p.get_message(timeout=0.1)
+        if ret is not None and ret["type"] == "message":
+            ack = eptMsg.parse(ret["data"])
+            break
+    p.close()
+    assert ack is not None and ack.msg_type == MSG_TYPE.REBALANCE_ACK
+    assert ack.data == {"id": "w1", "version": 3, "phase": "pause"}
+
+def test_hash_ring_worker_join_leave(app, func_prep):
+    # ensure adding or removing a worker only moves the endpoints owned by that worker
+    ring1 = HashRing(["w0", "w1", "w2"])
+    ring2 = HashRing(["w0", "w1", "w2", "w3"])
+    ring3 = HashRing(["w0", "w2"])
+    moved = 0
+    for i in xrange(0, 1000):
+        msg = get_epm_event(101, "10.1.%s.%s" % (i/256, i%256), wt=WORK_TYPE.EPM_IP_EVENT)
+        _hash = get_msg_hash(msg)
+        owner = ring1.get(_hash)
+        if ring2.get(_hash) != owner:
+            assert ring2.get(_hash) == "w3"
+            moved+= 1
+        if owner != "w1":
+            assert ring3.get(_hash) == owner
+    # expect roughly 1/4 of the endpoints to move to the new worker
+    assert 100 < moved < 400
+    assert HashRing([]).get(1) is None
+
+def test_endpoint_presence_membership(app, func_prep):
+    # ensure endpoint presence set returns correct membership across multiple sorted runs
+    p = EndpointPresence()
+    p.RUN_SIZE = 64
+    for i in xrange(0, 1000):
+        p.add(101 + i%2, vrf_vnid, "10.1.%s.%s" % (i/256, i%256))
+    assert len(p) == 1000
+    assert len(p.runs) == 1000/64 and len(p.current) == 1000%64
+    assert p.contains(101, vrf_vnid, "10.1.0.0")
+    # runs are merged into a single sorted key array on first lookup
+    assert len(p.runs) == 0 and len(p.current) == 0
+    assert len(p.keys) == 1000 and list(p.keys) == sorted(p.keys)
+    assert (102, vrf_vnid, "10.1.0.1") in p
+    assert not p.contains(102, vrf_vnid, "10.1.0.0")
+    assert not p.contains(101, bd1_vnid, "10.1.0.0")
+    # additional adds after first lookup are merged on next lookup
+    p.add(103, vrf_vnid, "10.1.0.0")
+    assert p.contains(103, vrf_vnid, "10.1.0.0")
+    assert p.contains(101, vrf_vnid, "10.1.0.0")
+
+def test_epm_digest_commit_and_endpoint_delete(app, func_prep):
+    # ensure staged epm digests are only returned after commit, records not seen are deleted on
+    # commit, pending digests are discarded, and digests are removed with the endpoint
+    db = get_db()
+    ip = "10.1.1.101"
+    attr = {"modTs": "2019-01-01T00:00:00.000+00:00", "flags": "local", "ifId": "eth1/1"}
+    digest = eptEpmDigest.get_digest(attr)
+    attr["modTs"] = "2019-01-02T00:00:00.000+00:00"
+    assert eptEpmDigest.get_digest(attr) != digest
+    dn1 = "topology/pod-1/node-101/sys/ctx-[vxlan-%s]/db-ep/ip-[%s]" % (vrf_vnid, ip)
+    dn2 = "topology/pod-1/node-101/sys/ctx-[vxlan-%s]/db-ep/ip-[10.1.1.102]" % vrf_vnid
+    assert eptEpmDigest.stage(db, tfabric, {
+        dn1: ("epmIpEp", 101, vrf_vnid, ip, digest),
+        dn2: ("epmIpEp", 101, vrf_vnid, "10.1.1.102", digest),
+    })
+    assert len(eptEpmDigest.get_digests(db, tfabric, [dn1, dn2])) == 0
+    seen = EndpointPresence()
+    seen.add("epmIpEp", 0, dn1)
+    seen.add("epmIpEp", 0, dn2)
+    assert eptEpmDigest.commit(db, tfabric, seen)
+    assert eptEpmDigest.get_digests(db, tfabric, [dn1, dn2]) == {dn1: digest, dn2: digest}
+    seen = EndpointPresence()
+    seen.add("epmIpEp", 0, dn1)
+    assert eptEpmDigest.commit(db, tfabric, seen)
+    assert eptEpmDigest.get_digests(db, tfabric, [dn1, dn2]) == {dn1: digest}
+    # pending digest of an uncommitted build is discarded
+    assert eptEpmDigest.stage(db, tfabric, {
+        dn1: ("epmIpEp", 101, vrf_vnid, ip, "0"),
+        dn2: ("epmIpEp", 101, vrf_vnid, "10.1.1.102", "0"),
+    })
+    eptEpmDigest.clear_pending(db, tfabric)
+    seen.add("epmIpEp", 0, dn2)
+    assert eptEpmDigest.commit(db, tfabric, seen)
+    assert eptEpmDigest.get_digests(db, tfabric, [dn1, dn2]) == {dn1: digest}
+
+    assert eptEndpoint.load(fabric=tfabric, vnid=vrf_vnid, addr=ip, type="ipv4").save()
+    eptEndpoint.load(fabric=tfabric, vnid=vrf_vnid, addr=ip).remove()
+    assert len(eptEpmDigest.get_digests(db, tfabric, [dn1])) == 0
+
+def get_build_subscriber():
+    # get subscriber for endpoint db build tests, msgs sent to workers are kept in sub.sent_msgs
+    sub = eptSubscriber(Fabric.load(fabric=tfabric))
+    sub.db = get_db()
+    sub.redis = redis
+    sub.epm_parser = eptEpmEventParser(tfabric, overlay_vnid)
+    sub.sent_msgs = []
+    lock = threading.Lock()
+    def send_msg(msg, prepend=False):
+        with lock:
+            sub.sent_msgs.extend(msg if isinstance(msg, list) else [msg])
+    sub.send_msg = send_msg
+    return sub
+
+def get_epm_build_objects(node, classname, count):
+    # return list of epm objects for classname on a single node as returned by a class query
+    local = "topology/pod-1/node-%s/sys/ctx-[vxlan-%s]/bd-[vxlan-%s]/vlan-[vlan-101]" % (node,
+            vrf_vnid, bd1_vnid)
+    ret = []
+    for i in xrange(0, count):
+        mac = "00:00:00:00:%02X:%02X" % (node % 256, i)
+        ip = "10.%s.1.%s" % (node % 256, i)
+        if classname == "epmMacEp":
+            dn = "%s/db-ep/mac-%s" % (local, mac)
+        elif classname == "epmIpEp":
+            dn = "%s/db-ep/ip-[%s]" % (local, ip)
+        else:
+            dn = "%s/db-ep/mac-%s/rsmacEpToIpEpAtt-[sys/ctx-[vxlan-%s]/bd-[vxlan-%s]" % (local,
+                    mac, vrf_vnid, bd1_vnid)
+            dn+= "/vlan-[vlan-101]/db-ep/ip-[%s]]" % ip
+        ret.append({classname: {"attributes": {"dn": dn, "status": "", "flags": "local",
+                    "pcTag": "%s" % epg1_pctag}}})
+    return ret
+
+def test_build_endpoint_db_per_node(app, func_prep, monkeypatch):
+    # ensure each in-service leaf/spine is queried per epm class with bounded concurrency, all
+    # records are sent to workers, and epm class order is kept within each node
+    sub = get_build_subscriber()
+    calls = []
+    lock = threading.Lock()
+    state = {"inflight": 0, "max_inflight": 0}
+    def get_class(session, classname, stream=False, node_dn=None, **kwargs):
+        with lock:
+            calls.append((node_dn, classname))
+            state["inflight"]+= 1
+            state["max_inflight"] = max(state["max_inflight"], state["inflight"])
+        time.sleep(0.05)
+        with lock:
+            state["inflight"]-= 1
+        return iter(get_epm_build_objects(int(node_dn.split("node-")[1]), classname, 3))
+    monkeypatch.setattr("app.models.aci.ept.ept_subscriber.get_class", get_class)
+
+    endpoints = EndpointPresence()
+    counts = {"create": 0, "skip": 0}
+    assert sub.build_endpoint_db_per_node(endpoints, counts, 2)
+    nodes = [101, 102, 103, 104]
+    assert sorted(set([c[0] for c in calls])) == ["topology/pod-1/node-%s" % n for n in nodes]
+    assert len(calls) == len(nodes) * len(sub.epm_subscription_classes)
+    assert 1 < state["max_inflight"] <= 2
+    assert counts == {"create": 36, "skip": 0}
+    for n in nodes:
+        assert [m.classname for m in sub.sent_msgs if m.node == n] == \
+            ["epmRsMacEpToIpEpAtt"]*3 + ["epmIpEp"]*3 + ["epmMacEp"]*3
+        assert (n, vrf_vnid, "10.%s.1.0" % n) in endpoints
+        assert (n, bd1_vnid, "00:00:00:00:%02X:00" % n) in endpoints
+    assert "(4/4 nodes)" in Fabric.load(fabric=tfabric).events[0]["description"]
+
+def test_build_endpoint_db_per_node_failure(app, func_prep, monkeypatch):
+    # ensure build fails and remaining nodes are not queried when a node query fails
+    sub = get_build_subscriber()
+    calls = []
+    def get_class(session, classname, stream=False, node_dn=None, **kwargs):
+        calls.append(node_dn)
+        if node_dn == "topology/pod-1/node-102":
+            return iter([None])
+        return iter(get_epm_build_objects(int(node_dn.split("node-")[1]), classname, 3))
+    monkeypatch.setattr("app.models.aci.ept.ept_subscriber.get_class", get_class)
+
+    counts = {"create": 0, "skip": 0}
+    assert not sub.build_endpoint_db_per_node(EndpointPresence(), counts, 1)
+    assert calls == ["topology/pod-1/node-101"]*3 + ["topology/pod-1/node-102"]
+    assert len([m for m in sub.sent_msgs if m.node == 102]) == 0
+
+def test_build_epm_class_delta_sync(app, func_prep, monkeypatch):
+    # ensure records with an unchanged committed digest are skipped, changed records are sent to
+    # workers, and staged digests are committed and missing records removed on epm eof ack
+    monkeypatch.setattr(eptEpmDigest, "LOOKUP_BATCH_SIZE", 2)
+    db = get_db()
+    sub = get_build_subscriber()
+    sub.settings.epm_delta_sync = True
+    sub.broadcast = lambda msg: None
+    objs = get_epm_build_objects(101, "epmIpEp", 5)
+    dns = [o["epmIpEp"]["attributes"]["dn"] for o in objs]
+    def build(objs):
+        sub.sent_msgs = []
+        sub.epm_digest_seen = EndpointPresence()
+        sub.epm_eof_tracking = {"w1": False}
+        counts = {"create": 0, "skip": 0}
+        assert sub.build_epm_class("epmIpEp", iter(objs), EndpointPresence(), counts)
+        return counts
+
+    assert build(objs) == {"create": 5, "skip": 0}
+    assert len(sub.sent_msgs) == 5
+    # staged digests are not used until all workers ack epm eof
+    assert len(eptEpmDigest.get_digests(db, tfabric, dns)) == 0
+    ack = eptMsgSubOp(MSG_TYPE.FABRIC_EPM_EOF_ACK, {"fabric": tfabric, "addr": "w1"})
+    sub.handle_subscriber_ctrl(ack)
+    assert sub.epm_digest_seen is None and sub.epm_eof_tracking is None
+    assert sorted(eptEpmDigest.get_digests(db, tfabric, dns).keys()) == sorted(dns)
+
+    # one changed record and one record no longer present
+    objs[1]["epmIpEp"]["attributes"]["pcTag"] = "any"
+    assert build(objs[0:4]) == {"create": 1, "skip": 3}
+    assert [m.addr for m in sub.sent_msgs] == ["10.101.1.1"]
+    sub.handle_subscriber_ctrl(ack)
+    digests = eptEpmDigest.get_digests(db, tfabric, dns)
+    assert sorted(digests.keys()) == sorted(dns[0:4])
+    assert digests[dns[1]] == eptEpmDigest.get_digest(objs[1]["epmIpEp"]["attributes"])
+    assert build(objs[0:4]) == {"create": 0, "skip": 4}
+
+def test_subscriber_reset_cache_generations(app, func_prep):
+    # ensure each shared collection starts a generation newer than any previous run after the
+    # initial build and workers are flushed for each collection
+    sub = get_build_subscriber()
+    msgs = []
+    sub.broadcast = lambda msg: msgs.append(msg)
+    keys = [get_cache_generation_key(tfabric, c[1]._classname) for c in eptCache.COLLECTION_CACHES]
+    for k in keys:
+        redis.set(k, 5)
+    inv_key = get_cache_invalid_key(tfabric, eptTunnel._classname)
+    redis.sadd(inv_key, "topology/pod-1/node-101/sys/tunnel-[tunnel17]")
+    ts = int(time.time()*1000)
+    sub.reset_cache_generations()
+    generations = [int(redis.get(k)) for k in keys]
+    assert all([g >= ts for g in generations])
+    assert redis.scard(inv_key) == 0
+    assert sorted([m.data["cache"] for m in msgs]) == sorted([c[1]._classname
+                                                        for c in eptCache.COLLECTION_CACHES])
+    assert all([m.wt == WORK_TYPE.FLUSH_CACHE for m in msgs])
+    # a later rebuild continues from the current generation
+    sub.reset_cache_generations()
+    assert all([int(redis.get(k)) > g for (k, g) in zip(keys, generations)])
+    for k in keys:
+        redis.delete(k)
+
+def test_worker_cache_warmup_after_build(app, func_prep):
+    # ensure worker caches are not loaded on fabric start and are bulk loaded when the subscriber
+    # broadcasts cache warmup after the initial build
+    dut = get_worker()
+    dut.cache_warmup = True
+    dut.fabric_start(tfabric)
+    wf = dut.fabrics[tfabric]
+    assert wf.cache.tunnel_cache.get_size() == 0
+    msg = eptMsgWork(0, "worker", {}, WORK_TYPE.CACHE_WARMUP, fabric=tfabric)
+    msg = eptMsg.parse(msg.jsonify())
+    dut.set_msg_worker_fabric(msg)
+    dut.work_type_handlers[msg.wt](msg)
+    assert wf.cache.tunnel_cache.get_size() == len(eptTunnel.find(fabric=tfabric)) > 0
+
+def test_worker_get_queue_batch(app, func_prep):
+    # ensure worker drains pending messages from its queue in order up to the requested count
+    dut = get_worker()
+    q = dut.queues[0]
+    redis.delete(q)
+    for i in range(5):
+        redis.rpush(q, "msg%s" % i)
+    batch = dut.get_queue_batch(3)
+    assert [d for (bq, d) in batch] == ["msg0", "msg1", "msg2"]
+    assert all([bq == q for (bq, d) in batch])
+    assert redis.llen(q) == 2
+    batch = dut.get_queue_batch(3)
+    assert [d for (bq, d) in batch] == ["msg3", "msg4"]
+    assert redis.llen(q) == 0
+    assert len(dut.get_queue_batch(3)) == 0
+
+def test_watch_queue_ready_order_and_rearm(app, func_prep):
+    # ensure watch events are popped in xts order, a re-armed key only executes with latest xts,
+    # and paused fabrics are skipped
+    class dummyWatch(object):
+        def __init__(self, fabric, xts, paused=False):
+            self.fabric = fabric
+            self.xts = xts
+            self.wf = type("wf", (object,), {"watcher_paused": paused})()
+    wq = eptWatchQueue()
+    wq.push("k1", dummyWatch("f1", 3.0))
+    wq.push("k2", dummyWatch("f1", 1.0))
+    wq.push("k3", dummyWatch("f1", 2.0))
+    wq.push("k2", dummyWatch("f1", 5.0))
+    wq.push("k4", dummyWatch("f2", 1.0, paused=True))
+    assert len(wq) == 4 and "k2" in wq
+    assert [k for (k, m) in wq.pop_ready(4.0)] == ["k3", "k1"]
+    assert len(wq) == 2
+    assert [k for (k, m) in wq.pop_ready(6.0)] == ["k2"]
+    assert "k4" in wq
+    assert wq.remove_fabric("f2") == 1
+    assert len(wq) == 0 and wq.entries == 0
+
+def test_watcher_find_batch(app, func_prep):
+    # ensure watcher batch read returns only documents matching the exact (vnid, addr, node) of each
+    # msg even though the query is an $in across all msgs in the batch
+    class dummyWatch(object):
+        def __init__(self, vnid, addr, node):
+            self.vnid = vnid
+            self.addr = addr
+            self.node = node
+    dut = get_worker(role="watcher")
+    dut.db[eptHistory._classname].insert_many([
+        {"fabric": tfabric, "vnid": 1, "addr": "10.1.1.1", "node": 101, "is_stale": True},
+        {"fabric": tfabric, "vnid": 1, "addr": "10.1.1.2", "node": 102, "is_stale": False},
+        {"fabric": tfabric, "vnid": 2, "addr": "10.1.1.1", "node": 101, "is_stale": True},
+        {"fabric": "other", "vnid": 1, "addr": "10.1.1.2", "node": 101, "is_stale": True},
+    ])
+    batch = [dummyWatch(1, "10.1.1.1", 101), dummyWatch(1, "10.1.1.2", 101)]
+    docs = dut.watcher_find_batch(eptHistory, tfabric, batch, {"is_stale": 1})
+    assert docs[(1, "10.1.1.1", 101)]["is_stale"]
+    assert (1, "10.1.1.2", 101) not in docs
+    assert len(docs) == 1
+    docs = dut.watcher_find_batch(eptHistory, tfabric, batch, {"is_stale": 1}, per_node=False)
+    assert (1, "10.1.1.2") in docs and (1, "10.1.1.1") in docs
+
+class dummyClearConnection(object):
+    # ssh connection returning the next output from outputs list for each command
+    def __init__(self, outputs, result="prompt"):
+        self.cmds = []
+        self.outputs = outputs
+        self.output = ""
+        self.result = result
+        self.closed = False
+        self.child = type("child", (object,), {"isalive": lambda s: True})()
+    def cmd(self, command):
+        self.cmds.append(command)
+        self.output = self.outputs.pop(0) if len(self.outputs) > 0 else ""
+        return self.result
+    def close(self):
+        self.closed = True
+
+def test_clear_service_batch_and_reuse(app, func_prep):
+    # ensure clear service reuses pooled node connection, chains clear commands per node, and
+    # caches the mac FD pi-vlan so the next clear of the same mac skips the FD lookup
+    dummyConnection = dummyClearConnection
+    fd = "sys/ctx-[vxlan-1]/bd-[vxlan-100]/vlan-[vlan-12]"
+    c = dummyConnection([
+        "dn    : %s/db-ep/mac-00:00:00:00:00:01\n" % fd,
+        "dn    : %s\nid    : 12\n" % fd,
+    ])
+    svc = eptClearService(tfabric, session=object(), concurrency=2)
+    svc.pool[101] = [(c, time.time())]
+    eps = [
+        eptClearEndpoint(1, 101, 1, "10.1.1.1", vrf_name="tn:v1"),
+        eptClearEndpoint(1, 101, 100, "00:00:00:00:00:01", addr_type="mac"),
+        eptClearEndpoint(1, 101, 100, "00:00:00:00:00:02", addr_type="mac"),
+    ]
+    results = svc.clear(eps)
+    assert results[101]["total"] == 3 and results[101]["success"] == 3
+    assert len(c.cmds) == 3
+    assert "key vrf tn:v1 ip 10.1.1.1" in c.cmds[2]
+    assert "key vlan 12 mac 00:00:00:00:00:01" in c.cmds[2]
+    assert "00:00:00:00:00:02" not in c.cmds[2]
+    assert svc.pi_cache[(101, fd)] == "12"
+
+    c.cmds = []
+    c.outputs = ["dn    : %s/db-ep/mac-00:00:00:00:00:01\n" % fd]
+    ep = eptClearEndpoint(1, 101, 100, "00:00:00:00:00:01", addr_type="mac")
+    svc.clear([ep])
+    assert ep.success
+    assert len(c.cmds) == 2 and "key vlan 12 mac" in c.cmds[1]
+    assert svc.reuse_count == 2 and svc.connect_count == 0
+
+def test_clear_service_retry_stale_connection(app, func_prep, monkeypatch):
+    # ensure a clear that fails on a pooled connection closed by the node while idle is retried
+    # once on a new connection, the stale connection is closed, and a failure on a new
+    # connection is not retried
+    fd = "sys/ctx-[vxlan-1]/bd-[vxlan-100]/vlan-[vlan-12]"
+    stale = dummyClearConnection([], result="eof")
+    fresh = dummyClearConnection([
+        "dn    : %s/db-ep/mac-00:00:00:00:00:01\n" % fd,
+        "dn    : %s\nid    : 12\n" % fd,
+    ])
+    connections = [fresh]
+    def get_connection(*args, **kwargs):
+        return connections.pop(0) if len(connections) > 0 else None
+    monkeypatch.setattr("app.models.aci.ept.ept_clear.get_ssh_connection", get_connection)
+    svc = eptClearService(tfabric, session=object())
+    svc.pool[101] = [(stale, time.time())]
+    eps = [
+        eptClearEndpoint(1, 101, 1, "10.1.1.1", vrf_name="tn:v1"),
+        eptClearEndpoint(1, 101, 100, "00:00:00:00:00:01", addr_type="mac"),
+    ]
+    results = svc.clear(eps)
+    assert results[101]["total"] == 2 and results[101]["success"] == 2
+    assert len(stale.cmds) == 1 and stale.closed
+    assert len(fresh.cmds) == 3 and not fresh.closed
+    assert svc.pool[101][0][0] is fresh
+    assert svc.retry_count == 1 and svc.reuse_count == 1 and svc.connect_count == 1
+
+    failed = dummyClearConnection([], result="eof")
+    connections.append(failed)
+    ep = eptClearEndpoint(1, 102, 1, "10.1.1.1", vrf_name="tn:v1")
+    svc.clear([ep])
+    assert not ep.success
+    assert len(failed.cmds) == 1 and failed.closed
+    assert svc.retry_count == 1 and svc.connect_count == 2
+    assert 102 not in svc.pool
+
+def test_clear_service_pi_vlan_rounds(app, func_prep):
+    # ensure mac FD and pi-vlan lookups are chained in rounds of batch_size and pi-vlan is paired
+    # with the dn of the same object regardless of attribute order
+    fds = ["sys/ctx-[vxlan-1]/bd-[vxlan-100]/vlan-[vlan-%s]" % i for i in xrange(0, 3)]
+    macs = ["00:00:00:00:00:0%s" % i for i in xrange(0, 3)]
+    c = dummyClearConnection([
+        "dn    : %s/db-ep/mac-%s\ndn    : %s/db-ep/mac-%s\n" % (fds[0], macs[0], fds[1], macs[1]),
+        "dn    : %s/db-ep/mac-%s\n" % (fds[2], macs[2]),
+        "# vlan.CktEp\nid    : 20\ndn    : %s\n# vlan.CktEp\ndn    : %s\nid    : 21\n" % (
+            fds[0], fds[1]),
+        "# l2.BD\ndn    : %s\n" % fds[2],
+    ])
+    svc = eptClearService(tfabric, session=object(), batch_size=2)
+    eps = [eptClearEndpoint(1, 101, 100, m, addr_type="mac") for m in macs]
+    ret = svc.get_pi_vlans(c, 101, eps)
+    assert len(c.cmds) == 4
+    assert [cmd.count("moquery") for cmd in c.cmds] == [2, 1, 2, 1]
+    assert ret[eps[0]] == "20" and ret[eps[1]] == "21"
+    assert ret[eps[2]] is None
+    assert svc.pi_cache == {(101, fds[0]): "20", (101, fds[1]): "21"}
+
+def test_execute_clear_events_parallel_nodes(app, func_prep):
+    # ensure watcher clears run in the background on up to watch_clear_concurrency nodes in
+    # parallel using a single clear service per fabric, the watch thread does not wait for the
+    # clear, pending endpoints are not queued twice, and remediation is only recorded for
+    # successful clears
+    class dummyClearService(object):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.release = threading.Event()
+            self.nodes = []
+            self.inflight = 0
+            self.max_inflight = 0
+        def get_fabric_name(self):
+            return tfabric
+        def clear(self, endpoints):
+            self.release.wait(5.0)
+            with self.lock:
+                self.nodes.append(endpoints[0].node)
+                self.inflight+= 1
+                self.max_inflight = max(self.max_inflight, self.inflight)
+            time.sleep(0.05)
+            with self.lock:
+                self.inflight-= 1
+            for ep in endpoints:
+                ep.success = (ep.node != 104)
+            return {endpoints[0].node: {"total": len(endpoints)}}
+    dut = get_worker(role="watcher")
+    dut.watch_clear_concurrency = 2
+    wf = eptWorkerFabric(tfabric)
+    wf.clear_service = dummyClearService()
+    def get_events(nodes, host=1):
+        events = []
+        for node in nodes:
+            addr = "10.1.%s.%s" % (host, node)
+            ep = eptClearEndpoint(1, node, 1, addr, vrf_name="v1")
+            key = {"fabric": tfabric, "vnid": 1, "addr": addr, "node": node}
+            events.append((ep, key, "stale", eptHistoryEvent(vnid_name="uni/tn-ag/ctx-v1"), wf))
+        return events
+    try:
+        events = get_events([101, 102, 103, 104]) + get_events([101], host=2)
+        dut.execute_clear_events(events)
+        assert len(dut.clear_threads) == 2
+        assert len(dut.clear_pending) == 5
+        # endpoint already pending is skipped
+        dup = get_events([101])
+        dut.execute_clear_events(dup)
+        wf.clear_service.release.set()
+        dut.clear_queue.join()
+        assert sorted(wf.clear_service.nodes) == [101, 102, 103, 104]
+        assert wf.clear_service.max_inflight == 2
+        assert [e[0].success for e in events] == [True, True, True, False, True]
+        assert not dup[0][0].success
+        assert len(dut.clear_pending) == 0
+        assert len(eptRemediate.find(fabric=tfabric)) == 4
+    finally:
+        wf.clear_service.release.set()
+        threads = dut.clear_threads
+        dut.stop_clear_threads()
+        for t in threads:
+            t.join(5.0)
+    assert not any([t.is_alive() for t in threads])
+
+def test_api_clear_endpoint_single_login(app, func_prep, monkeypatch):
+    # ensure endpoint clear api clears all valid leaf nodes with a single clear service so the apic
+    # login is shared, closes the service, and returns the per-node result
+    class dummyClearService(object):
+        instances = []
+        def __init__(self, fabric, session=None, concurrency=1, pi_cache_ttl=None):
+            self.concurrency = concurrency
+            self.calls = []
+            self.closed = False
+            dummyClearService.instances.append(self)
+        def clear(self, endpoints):
+            self.calls.append(list(endpoints))
+            ret = {}
+            for ep in endpoints:
+                ep.success = (ep.node != 103)
+                ret[ep.node] = {"total": 1, "success": int(ep.success), "time": 0.1234}
+            return ret
+        def close(self, clear_cache=True):
+            self.closed = True
+    monkeypatch.setattr("app.models.aci.ept.ept_endpoint.eptClearService", dummyClearService)
+    monkeypatch.setattr("app.models.aci.ept.ept_endpoint.api_clear_services", {})
+    f = Fabric.load(fabric=tfabric)
+    f.ssh_username = "admin"
+    f.ssh_password = "password"
+    assert f.save()
+
+    dut = get_worker()
+    mac = "00:00:01:02:03:04"
+    ip = "10.1.1.101"
+    msg = get_epm_event(101, ip, wt=WORK_TYPE.EPM_IP_EVENT, epg=1, intf="eth1/1")
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    msg = get_epm_event(101, mac, ip=ip, wt=WORK_TYPE.EPM_RS_IP_EVENT)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+
+    url = "/api/uni/fb-%s/endpoint/vnid-%s/addr-%s/clear" % (tfabric, vrf_vnid, ip)
+    response = app.client.post(url, data=json.dumps({
+        "nodes": [101, 103, 201, vpc_node_id],
+    }), content_type="application/json")
+    assert response.status_code == 200
+    js = json.loads(response.data)
+    assert len(dummyClearService.instances) == 1
+    svc = dummyClearService.instances[0]
+    assert svc.closed
+    assert svc.concurrency == int(app.config.get("API_CLEAR_CONCURRENCY", 1))
+    assert len(svc.calls) == 1
+    assert sorted([ep.node for ep in svc.calls[0]]) == [101, 103]
+    assert all([ep.vrf_name == "ag:v1" and ep.addr_type == "ip" for ep in svc.calls[0]])
+    assert not js["success"]
+    assert "invalid/unknown node 201" in js["error"]
+    assert "failed to clear endpoint on node 103" in js["error"]
+    assert js["nodes"] == {
+        "101": {"success": True, "time": 0.123},
+        "103": {"success": False, "time": 0.123},
+    }
+    r = eptRemediate.find(fabric=tfabric, addr=ip)
+    assert len(r) == 1 and r[0].node == 101
+
+def test_api_clear_endpoint_mac_pi_cache(app, func_prep, monkeypatch):
+    # ensure the clear service is kept between endpoint clear api requests so a second clear of
+    # the same mac skips the PI vlan moquery, and ssh connections are closed after each request
+    class dummySession(object):
+        def close(self): pass
+    connections = []
+    def get_connection(*args, **kwargs):
+        c = dummyClearConnection(list(outputs))
+        connections.append(c)
+        return c
+    monkeypatch.setattr("app.models.aci.ept.ept_clear.get_apic_session", lambda f: dummySession())
+    monkeypatch.setattr("app.models.aci.ept.ept_clear.get_ssh_connection", get_connection)
+    monkeypatch.setattr("app.models.aci.ept.ept_endpoint.api_clear_services", {})
+    f = Fabric.load(fabric=tfabric)
+    f.ssh_username = "admin"
+    f.ssh_password = "password"
+    assert f.save()
+
+    dut = get_worker()
+    msg = get_epm_event(101, "00:00:01:02:03:04", wt=WORK_TYPE.EPM_MAC_EVENT, epg=1,
+                        intf="eth1/1")
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    endpoint = eptEndpoint.find(fabric=tfabric, type="mac")[0]
+    fd = "sys/ctx-[vxlan-%s]/bd-[vxlan-%s]/vlan-[vlan-12]" % (vrf_vnid, endpoint.vnid)
+    outputs = [
+        "dn    : %s/db-ep/mac-%s\n" % (fd, endpoint.addr),
+        "dn    : %s\nid    : 12\n" % fd,
+    ]
+    url = "/api/uni/fb-%s/endpoint/vnid-%s/addr-%s/clear" % (tfabric, endpoint.vnid, endpoint.addr)
+    for i in xrange(0, 2):
+        response = app.client.post(url, data=json.dumps({"nodes": [101]}),
+                                    content_type="application/json")
+        assert response.status_code == 200
+        assert json.loads(response.data)["success"]
+        assert connections[i].closed
+        assert "key vlan 12 mac" in connections[i].cmds[-1]
+    assert len(connections) == 2
+    assert len([c for c in connections[0].cmds if "moquery -d" in c]) == 1
+    assert len([c for c in connections[1].cmds if "moquery -d" in c]) == 0
+    assert len(connections[1].cmds) == 2
+
+def test_notify_coalesce_and_overflow(app, func_prep):
+    # ensure identical notifications are merged, a burst of notifications is sent as a single
+    # digest email, and notifications received while the notify queue is full are not dropped
+    wf = eptWorkerFabric(tfabric)
+    (bulk, email_bulk) = wf.coalesce_notifications("stale", [("s1","t1"), ("s1","t1"), ("s2","t2")])
+    assert bulk == [("s1", "t1 (repeated 2 times)"), ("s2", "t2")]
+    assert email_bulk == bulk
+    notifications = [("s%s" % i, "t%s" % i) for i in xrange(0, NOTIFY_EMAIL_MAX_BULK+1)]
+    (bulk, email_bulk) = wf.coalesce_notifications("stale", notifications)
+    assert len(bulk) == NOTIFY_EMAIL_MAX_BULK+1
+    assert len(email_bulk) == 1 and email_bulk[0][1].startswith("t0\nt1\n")
+
+    wf.notify_queue = Queue(maxsize=1)
+    wf.queue_notification("stale", "s1", "t1")
+    wf.queue_notification("stale", "s2", "t2")
+    assert wf.notify_queue.qsize() == 1
+    assert len(wf.notify_overflow) == 1
+    wf.execute_notify()
+    assert wf.notify_queue.qsize() == 0
+    assert len(wf.notify_overflow) == 0
+
+def test_notify_overflow_bounded(app, func_prep):
+    # ensure notify overflow is bounded, the oldest notifications are dropped when it is full and
+    # the drops are counted
+    wf = eptWorkerFabric(tfabric)
+    wf.notify_queue = Queue(maxsize=1)
+    wf.notify_overflow = collections.deque(maxlen=2)
+    for i in xrange(0, 5):
+        wf.queue_notification("stale", "s%s" % i, "t%s" % i)
+    assert wf.notify_queue.qsize() == 1
+    assert [n[1] for n in wf.notify_overflow] == ["s3", "s4"]
+    assert wf.notify_drop_count == 2
+    wf.execute_notify()
+    assert len(wf.notify_overflow) == 0
+    assert wf.notify_drop_reported == 2
+
+def test_write_buffer_flush_and_ordering(app, func_prep):
+    # ensure buffered endpoint writes are not visible until flushed and events pushed for the same
+    # endpoint are applied in the order they were received
+    dut = get_worker(write_buffer=True)
+    addr = "00:00:01:02:03:04"
+    msg = get_epm_event(101, addr, wt=WORK_TYPE.EPM_MAC_EVENT, epg=1, intf="eth1/1", ts=1.0)
+    dut.set_msg_worker_fabric(msg)
+    assert msg.wf.write_buffer is not None
+    dut.handle_endpoint_event(msg)
+    assert len(eptHistory.find(fabric=tfabric, addr=addr)) == 0
+    msg = get_epm_event(101, addr, wt=WORK_TYPE.EPM_MAC_EVENT, epg=1, intf="eth1/2", ts=2.0)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    msg = get_epm_event(101, addr, wt=WORK_TYPE.EPM_MAC_EVENT, epg=1, intf="eth1/3", ts=3.0)
+    dut.set_msg_worker_fabric(msg)
+    dut.handle_endpoint_event(msg)
+    dut.flush_writes()
+
+    h = eptHistory.find(fabric=tfabric, addr=addr)
+    assert len(h)==1
+    assert h[0].count == 3
+    assert [e["intf_id"] for e in h[0].events] == ["eth1/3", "eth1/2", "eth1/1"]
+    e = eptEndpoint.find(fabric=tfabric, addr=addr)
+    assert len(e)==1
+    assert [ev["intf_id"] for ev in e[0].events] == ["eth1/3", "eth1/2", "eth1/1"]
+    assert e[0].first_learn["intf_id"] == "eth1/1"
+
+class dummyBulkCollection(object):
+    # collection that fails bulk writes for filters in fail list with error code in codes (default
+    # of 112 write conflict) and records applied ops
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def bulk_write(self, ops, ordered=True):
+        errors = []
+        for i, op in enumerate(ops):
+            addr = op._filter["addr"]
+            if self.db.error is not None:
+                raise self.db.error
+            if self.db.fail.get(addr, 0) > 0:
+                self.db.fail[addr]-= 1
+                code = self.db.codes.get(addr, 112)
+                errors.append({"index": i, "code": code, "errmsg": "fail %s" % addr})
+            else:
+                self.db.applied.append((self.name, addr, op._doc))
+        if len(errors) > 0:
+            raise BulkWriteError({"writeErrors": errors, "writeConcernErrors": []})
+
+class dummyBulkDb(object):
+    def __init__(self):
+        self.fail = {}
+        self.codes = {}
+        self.error = None
+        self.applied = []
+
+    def __getitem__(self, name):
+        return dummyBulkCollection(self, name)
+
+def test_write_buffer_requeue_failed_writes(app, func_prep):
+    # ensure failed buffered writes are requeued ahead of later writes for the same key, other
+    # keys are still written, and flush reports the failure
+    db = dummyBulkDb()
+    wb = eptWriteBuffer(db, max_ops=100, max_delay=0, max_retries=2)
+    for i in xrange(0, 3):
+        for addr in ["a1", "a2"]:
+            assert wb.update_one("c1", (1, addr), {"addr": addr}, {"seq": i})
+    db.fail["a1"] = 1
+    assert not wb.flush()
+    assert db.applied == [("c1", "a2", {"seq": 0}), ("c1", "a2", {"seq": 1}),
+                            ("c1", "a2", {"seq": 2})]
+    assert wb.count == 3
+    assert wb.total_retries == 3
+    assert wb.update_one("c1", (1, "a1"), {"addr": "a1"}, {"seq": 3})
+    db.applied = []
+    assert wb.flush()
+    assert db.applied == [("c1", "a1", {"seq": i}) for i in xrange(0, 4)]
+    assert wb.count == 0
+    assert wb.total_ops == 7
+
+    # writes are dropped after max_retries
+    db.applied = []
+    db.fail["a1"] = 3
+    assert wb.update_one("c1", (1, "a1"), {"addr": "a1"}, {"seq": 4})
+    assert not wb.flush()
+    assert not wb.flush_expired()
+    assert wb.count == 1
+    assert not wb.flush()
+    assert wb.count == 0
+    assert wb.total_dropped == 1
+    assert wb.flush()
+    assert db.applied == []
+
+    # duplicate key error and generic exception (unknown outcome) are dropped, not retried
+    db.fail["a1"] = 1
+    db.codes["a1"] = 11000
+    assert wb.update_one("c1", (1, "a1"), {"addr": "a1"}, {"seq": 5})
+    assert wb.update_one("c1", (1, "a2"), {"addr": "a2"}, {"seq": 5})
+    assert not wb.flush()
+    assert wb.count == 0
+    assert wb.total_dropped == 2
+    assert db.applied == [("c1", "a2", {"seq": 5})]
+    db.applied = []
+    db.error = Exception("db down")
+    assert wb.update_one("c1", (1, "a1"), {"addr": "a1"}, {"seq": 6})
+    assert not wb.flush()
+    assert wb.count == 0
+    assert wb.total_dropped == 3
+    db.error = None
+    assert wb.flush()
+    assert db.applied == []
+
+def test_write_buffer_push_event_failure(app, func_prep):
+    # ensure buffered push_event returns the failure of the flush triggered by max_ops
+    wf = eptWorkerFabric(tfabric, write_buffer=True)
+    wf.write_buffer = eptWriteBuffer(dummyBulkDb(), max_ops=2, max_delay=0, max_retries=0)
+    wf.write_buffer.db.error = Exception("db down")
+    assert wf.push_event(eptHistory._classname, {"fabric":tfabric, "addr":"a1"}, {"ts": 1.0})
+    assert not wf.push_event(eptHistory._classname, {"fabric":tfabric, "addr":"a2"}, {"ts":1.0})
+    assert wf.write_buffer.total_dropped == 2
+    assert wf.flush_writes()
+
 def test_flush_offsubnet_cache(app, func_prep):
     # when adding a new subnet to a running client, ensure that the offsubnet_cache is properly 
     # flushed such that new learns are correctly detected as on subnet.  Similarly, if the subnet
@@ -0,0 +1,144 @@
+
+import json
+import logging
+import pytest
+import threading
+import time
+
+from app.models.aci.session import CallbackHandler
+from app.models.aci.session import EventBuffer
+from app.models.aci.session import EventHandler
+from app.models.aci.session import Subscriber
+
+# module level logging
+logger = logging.getLogger(__name__)
+
+@pytest.fixture(scope="module")
+def app(request, app):
+    # module level setup
+    app.config["LOGIN_ENABLED"] = False
+
+    # teardown called after all tests in session have completed
+    def teardown(): pass
+    request.addfinalizer(teardown)
+
+    logger.debug("(%s) module level app setup completed", __name__)
+    return app
+
+class dummyWebSocket(object):
+    # websocket returning each frame in order, recv raises once all frames are read and closed
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.closed = threading.Event()
+        self.recv_count = 0
+
+    def recv(self):
+        if len(self.frames) > 0:
+            self.recv_count+= 1
+            return self.frames.pop(0)
+        self.closed.wait(5.0)
+        raise Exception("websocket closed")
+
+def get_frame(s_id, i):
+    return json.dumps({"subscriptionId": [s_id], "imdata": [{"fvCEp": {"attributes": {
+        "dn": "uni/tn-ag/ap-a1/epg-e1/cep-00:00:00:00:00:%02x" % i}}}]})
+
+def get_subscriber(callbacks):
+    # subscriber with a callback handler for each (subscription id, callback)
+    sub = Subscriber(None)
+    for (s_id, callback) in callbacks:
+        sub._subscription_ids[s_id] = CallbackHandler("/api/class/fvCEp.json", s_id, callback,
+                                                        False)
+    return sub
+
+def test_event_buffer_order_and_bound(app):
+    # ensure frames are returned in order, put fails after timeout when full, and stats are kept
+    buf = EventBuffer(max_size=3)
+    for i in xrange(0, 3):
+        assert buf.put(i)
+    assert not buf.put(3, timeout=0.01)
+    assert len(buf) == 3
+    assert buf.full_count == 1 and buf.total == 3
+    assert buf.high_water == 3
+    assert [buf.get(), buf.get()] == [0, 1]
+    buf.reset_high_water()
+    assert buf.high_water == 1 and buf.max_high_water == 3
+    assert buf.get() == 2
+    assert buf.get(timeout=0.01) is None
+
+def test_event_buffer_blocked_put_resumes(app):
+    # ensure a reader blocked on a full buffer completes as soon as a frame is removed
+    buf = EventBuffer(max_size=1)
+    assert buf.put("f0")
+    ret = []
+    t = threading.Thread(target=lambda: ret.append(buf.put("f1", timeout=5.0)))
+    t.daemon = True
+    t.start()
+    time.sleep(0.05)
+    assert t.is_alive()
+    assert buf.get() == "f0"
+    t.join(5.0)
+    assert ret == [True]
+    assert buf.get() == "f1"
+
+def test_dispatch_event_parse_and_receive_ts(app):
+    # ensure dispatch uses the receive timestamp, executes the callback of each subscription id,
+    # queues events for paused callbacks, and ignores invalid events
+    events1 = []
+    events2 = []
+    sub = get_subscriber([("1", events1.append), ("2", events2.append)])
+    sub._subscription_ids["2"].pause()
+    sub.dispatch_event(get_frame("1", 1), 100.0)
+    js = json.loads(get_frame("1", 2))
+    js["subscriptionId"] = ["1", "2", "3"]
+    sub.dispatch_event(json.dumps(js), 101.0)
+    sub.dispatch_event("{invalid", 102.0)
+    sub.dispatch_event(json.dumps({"imdata": []}), 103.0)
+    assert [e["_ts"] for e in events1] == [100.0, 101.0]
+    assert len(events2) == 0
+    sub._subscription_ids["2"].resume()
+    assert [e["_ts"] for e in events2] == [101.0]
+
+def test_event_reads_not_blocked_by_callbacks(app):
+    # ensure the websocket reader keeps reading while a callback is blocked and the dispatcher
+    # executes callbacks in websocket order with the timestamp each frame was received
+    release = threading.Event()
+    events = []
+    def callback(event):
+        release.wait(5.0)
+        events.append(event)
+    sub = get_subscriber([("1", callback)])
+    count = 10
+    sub._ws = dummyWebSocket([get_frame("1", i) for i in xrange(0, count)])
+    ts = time.time()
+    sub._start_event_dispatcher()
+    handler = EventHandler(sub)
+    handler.daemon = True
+    handler.start()
+    try:
+        # all frames are read while the first callback is still blocked
+        for i in xrange(0, 100):
+            if sub.event_buffer.total == count:
+                break
+            time.sleep(0.01)
+        assert sub._ws.recv_count == count
+        assert sub.event_buffer.total == count
+        assert len(events) == 0
+        read_ts = time.time()
+        release.set()
+        for i in xrange(0, 100):
+            if len(events) == count:
+                break
+            time.sleep(0.01)
+        assert len(events) == count
+        dns = [e["imdata"][0]["fvCEp"]["attributes"]["dn"] for e in events]
+        assert dns == [json.loads(get_frame("1", i))["imdata"][0]["fvCEp"]["attributes"]["dn"]
+                        for i in xrange(0, count)]
+        assert all([ts <= e["_ts"] <= read_ts for e in events])
+        assert sub.event_dispatcher_thread.is_alive()
+    finally:
+        release.set()
+        sub._ws.closed.set()
+        sub.event_dispatcher_thread.exit()
+        handler.join(5.0)
+    assert handler.failure_reason == "websocket unexpectedly closed"